@@ -28,6 +28,7 @@ import errno
 import os
 import sys
 import tempfile
+import time
 import zipfile
 
 from flumotion.common import errors, dag, python
@@ -67,16 +68,28 @@ class BundledFile:
         self.destination = destination
         self._last_md5sum = None
         self._last_timestamp = None
+        self._md5sumStat = None
+        self._md5sum = None
         self.zipped = False
 
+    def _read(self):
+        # read the file, caching its md5sum until it is modified
+        st = os.stat(self.source)
+        data = open(self.source, "rb").read()
+        self._md5sumStat = (st.st_mtime, st.st_size, st.st_ino)
+        self._md5sum = python.md5(data).hexdigest()
+        return st, data
+
     def md5sum(self):
         """
         Calculate the md5sum of the given file.
 
         @returns: the md5 sum a 32 character string of hex characters.
         """
-        data = open(self.source, "r").read()
-        return python.md5(data).hexdigest()
+        st = os.stat(self.source)
+        if self._md5sumStat != (st.st_mtime, st.st_size, st.st_ino):
+            self._read()
+        return self._md5sum
 
     def timestamp(self):
         """
@@ -113,9 +126,15 @@ class BundledFile:
         return False
 
     def pack(self, zip):
-        self._last_timestamp = self.timestamp()
-        self._last_md5sum = self.md5sum()
-        zip.write(self.source, self.destination)
+        # read the file once, for both its md5sum and the zip
+        st, data = self._read()
+        self._last_timestamp = st.st_mtime
+        self._last_md5sum = self._md5sum
+        info = zipfile.ZipInfo(self.destination,
+                               time.localtime(st.st_mtime)[:6])
+        info.external_attr = (st.st_mode & 0xFFFF) << 16L
+        info.compress_type = zip.compression
+        zip.writestr(info, data)
         self.zipped = True
 
 
@@ -147,6 +166,10 @@ class Unbundler:
     """
     I unbundle bundles by unpacking them in the given directory
     under directories with the bundle's md5sum.
+
+    Next to each of these directories, I write a manifest with the md5sum
+    of each unpacked file once they are all in place, so that complete
+    and intact bundles can be told apart from missing or broken ones.
     """
 
     def __init__(self, directory):
@@ -165,6 +188,35 @@ class Unbundler:
         """
         return self.unbundlePathByInfo(bundle.name, bundle.md5sum)
 
+    def _manifestPath(self, directory):
+        return directory + '.manifest'
+
+    def isUnbundled(self, name, md5sum):
+        """
+        Check if the bundle with the given name and md5sum has been
+        completely unbundled, and the unpacked files still have the
+        content they were unbundled with.
+
+        @rtype: bool
+        """
+        directory = self.unbundlePathByInfo(name, md5sum)
+        try:
+            handle = open(self._manifestPath(directory), 'r')
+            lines = handle.readlines()
+            handle.close()
+        except IOError:
+            return False
+
+        for line in lines:
+            fileSum, filepath = line.rstrip('\n').split(' ', 1)
+            try:
+                data = open(os.path.join(directory, filepath), 'rb').read()
+            except IOError:
+                return False
+            if python.md5(data).hexdigest() != fileSum:
+                return False
+        return True
+
     def unbundle(self, bundle):
         """
         Unbundle the given bundle.
@@ -180,8 +232,10 @@ class Unbundler:
         zipFile = zipfile.ZipFile(filelike, "r")
         zipFile.testzip()
 
+        manifest = []
         filepaths = zipFile.namelist()
-        for filepath in filepaths:
+        # the directory itself, for bundles without files
+        for filepath in [''] + filepaths:
             path = os.path.join(directory, filepath)
             parent = os.path.split(path)[0]
             try:
@@ -190,16 +244,25 @@ class Unbundler:
                 # Reraise error unless if it's an already existing
                 if err.errno != errno.EEXIST or not os.path.isdir(parent):
                     raise
+            if not filepath:
+                continue
             data = zipFile.read(filepath)
+            manifest.append('%s %s\n' % (python.md5(data).hexdigest(),
+                                         filepath))
+            self._write(path, data)
 
-            # atomically write to path, see #373
-            fd, tempname = tempfile.mkstemp(dir=parent)
-            handle = os.fdopen(fd, 'wb')
-            handle.write(data)
-            handle.close()
-            rename(tempname, path)
+        # only written when all the files are, marking the bundle complete
+        self._write(self._manifestPath(directory), ''.join(manifest))
         return directory
 
+    def _write(self, path, data):
+        # atomically write to path, see #373
+        fd, tempname = tempfile.mkstemp(dir=os.path.dirname(path))
+        handle = os.fdopen(fd, 'wb')
+        handle.write(data)
+        handle.close()
+        rename(tempname, path)
+
 
 class Bundler:
     """
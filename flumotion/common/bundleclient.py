@@ -77,16 +77,14 @@ class BundleLoader(log.Loggable):
             # figure out which bundles we're missing
             toFetch = []
             for name, md5 in sums:
-                path = os.path.join(configure.cachedir, name, md5)
-                if os.path.exists(path):
+                # checks the unpacked files against the manifest written
+                # once they were all in place, so that bundles left
+                # incomplete or damaged get fetched again
+                if self._unbundler.isUnbundled(name, md5):
                     self.log('%s is up to date', name)
                 else:
                     self.log('%s needs fetching', name)
-                # FIXME: We cannot be completelly sure the bundle has the
-                # correct content only by checking that the directory exists.
-                # The worker/manager could have died during a download leaving
-                # the package incomplete.
-                toFetch.append(name)
+                    toFetch.append(name)
             if toFetch:
                 return annotated(self.callRemote('getBundleZips', toFetch),
                                  toFetch, sums)
@@ -94,6 +92,7 @@ class BundleLoader(log.Loggable):
                 return {}, [], sums
 
         def unpackAndRegister((zips, toFetch, sums)):
+            expected = dict(sums)
             for name in toFetch:
                 if name not in zips:
                     msg = "Missing bundle %s was not received"
@@ -102,6 +101,10 @@ class BundleLoader(log.Loggable):
 
                 b = bundle.Bundle(name)
                 b.setZip(zips[name])
+                if b.md5sum != expected[name]:
+                    self.warning("bundle %s changed on the manager while "
+                                 "fetching it, got md5sum %s instead of %s",
+                                 name, b.md5sum, expected[name])
                 path = self._unbundler.unbundle(b)
 
             # register all package paths; to do so we need to reverse sums
@@ -0,0 +1,208 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_expiry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+"""expiry of keys after a time to live.
+Keeps keys ordered by absolute expiry time in a heap, so that finding the
+expired keys does not need to look at the live ones, and indexes them by
+group, so that the time to live of a whole group can be reset at once.
+"""
+
+import heapq
+
+__version__ = "$Rev$"
+
+
+class _Entry(object):
+    __slots__ = ('deadline', 'group', 'epoch', 'seq')
+
+    def __init__(self, deadline, group, epoch, seq):
+        self.deadline = deadline
+        self.group = group
+        self.epoch = epoch
+        self.seq = seq
+
+
+class _Group(object):
+    __slots__ = ('deadline', 'epoch', 'seq', 'keys')
+
+    def __init__(self):
+        self.deadline = None
+        # incremented on every keepAlive; keys added before the last
+        # keepAlive expire with the group, the others on their own
+        self.epoch = 0
+        self.seq = None
+        self.keys = set()
+
+
+class ExpiryQueue(object):
+    """
+    I keep track of keys that expire after a time to live, measured on a
+    clock that only advances when told to.
+
+    Keys can belong to a group. Resetting the time to live of a group
+    with keepAlive takes constant time, whatever the number of keys in
+    it; all the keys of the group added before then expire together.
+
+    @ivar now: the current time of the clock
+    @type now: float
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self._heap = [] # (deadline, seq, key, group name)
+        self._entries = {} # key -> _Entry
+        self._groups = {} # group name -> _Group
+        self._seq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _push(self, deadline, key, group):
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, key, group))
+        # removed keys and superseded deadlines are left in the heap until
+        # they come up; do not let them pile up
+        if len(self._heap) > 2 * (len(self._entries) + len(self._groups)) + 64:
+            self._compact()
+        return self._seq
+
+    def _compact(self):
+        heap = []
+        for key, entry in self._entries.iteritems():
+            if entry.seq is not None:
+                heap.append((entry.deadline, entry.seq, key, entry.group))
+        for name, group in self._groups.iteritems():
+            if group.seq is not None:
+                heap.append((group.deadline, group.seq, None, name))
+        heapq.heapify(heap)
+        self._heap = heap
+
+    def add(self, key, ttl, group=None):
+        """
+        Add a key, or reset the time to live of an existing one.
+
+        @param key: the key to add
+        @param ttl: the time to live of the key, or None for a key that
+                    only expires with its group
+        @type  ttl: float or None
+        @param group: the name of the group of the key, or None
+        """
+        if key in self._entries:
+            self.discard(key)
+        epoch = 0
+        if group is not None:
+            g = self._groups.get(group)
+            if g is None:
+                g = self._groups[group] = _Group()
+            g.keys.add(key)
+            epoch = g.epoch
+        entry = _Entry(None, group, epoch, None)
+        self._entries[key] = entry
+        if ttl is not None:
+            entry.deadline = self.now + ttl
+            entry.seq = self._push(entry.deadline, key, group)
+
+    def discard(self, key):
+        """
+        Remove a key, if present.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None or entry.group is None:
+            return
+        g = self._groups[entry.group]
+        g.keys.discard(key)
+        if not g.keys:
+            del self._groups[entry.group]
+
+    def keepAlive(self, group, ttl):
+        """
+        Reset the time to live of all the keys in a group.
+
+        @param group: the name of the group
+        @param ttl: the new time to live
+        @type  ttl: float
+        """
+        g = self._groups.get(group)
+        if g is None:
+            return
+        g.epoch += 1
+        g.deadline = self.now + ttl
+        g.seq = self._push(g.deadline, None, group)
+
+    def getTTL(self, key):
+        """
+        @returns: the time to live left for a key, or None if the key is
+                  unknown or does not expire
+        @rtype:   float or None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        deadline = self._getDeadline(entry)
+        if deadline is None:
+            return None
+        return deadline - self.now
+
+    def _getDeadline(self, entry):
+        if entry.group is not None:
+            g = self._groups[entry.group]
+            if entry.epoch < g.epoch:
+                return g.deadline
+        return entry.deadline
+
+    def advance(self, elapsed):
+        """
+        Advance the clock, removing the keys whose time to live ran out.
+
+        @param elapsed: the time to advance the clock by
+        @type  elapsed: float
+
+        @returns: the expired keys, in order of expiry
+        @rtype:   list
+        """
+        self.now += elapsed
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= self.now:
+            deadline, seq, key, name = heapq.heappop(heap)
+            if key is None:
+                g = self._groups.get(name)
+                if g is None or g.seq != seq:
+                    continue
+                g.seq = None
+                keys = [k for k in g.keys
+                        if self._entries[k].epoch < g.epoch]
+            else:
+                entry = self._entries.get(key)
+                if entry is None or entry.seq != seq:
+                    continue
+                if (entry.group is not None and
+                    entry.epoch < self._groups[entry.group].epoch):
+                    # a keepAlive on the group took over
+                    continue
+                keys = [key]
+            for k in keys:
+                self.discard(k)
+            expired.extend(keys)
+        return expired
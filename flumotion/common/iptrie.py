@@ -0,0 +1,278 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_iptrie -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+"""binary prefix tree keyed on network addresses.
+A path-compressed binary (Patricia) trie mapping network prefixes, given as
+an integer address and a prefix length, to values. Finding the prefixes
+containing an address takes at most one step per address bit (32 for IPv4,
+128 for IPv6), independently of the number of prefixes.
+"""
+
+__version__ = "$Rev$"
+
+# The number of bits of each byte value, to get the number of bits of an
+# address without int.bit_length(), which needs python 2.7
+_BYTE_BITS = [0] * 256
+for _i in range(1, 256):
+    _BYTE_BITS[_i] = _BYTE_BITS[_i >> 1] + 1
+del _i
+
+
+def _bitLength(n):
+    bits = 0
+    while n >> 8:
+        n >>= 8
+        bits += 8
+    return bits + _BYTE_BITS[n]
+
+
+class _Node(object):
+    """A node of the trie, for the first bits of net. Children are indexed
+    on the bit following them."""
+
+    __slots__ = ('net', 'bits', 'children', 'value', 'occupied')
+
+    def __init__(self, net, bits):
+        self.net = net
+        self.bits = bits
+        self.children = [None, None]
+        self.value = None
+        self.occupied = False
+
+
+class IPTrie(object):
+    """
+    A dictionary-like mapping from network prefixes to values that can also
+    find the prefixes containing a given address.
+
+    Keys are (net, bits) tuples, where net is the network address as an
+    integer and bits the prefix length. The host bits of net must be zero.
+    """
+
+    def __init__(self, width=32, items=()):
+        """
+        @param width: the number of bits of the addresses: 32 for IPv4,
+                      128 for IPv6
+        @type  width: int
+        """
+        self.width = width
+        self._root = _Node(0, 0)
+        self._len = 0
+        for key, value in items:
+            self[key] = value
+
+    def _checkKey(self, key):
+        net, bits = key
+        if bits < 0 or bits > self.width:
+            raise ValueError('Invalid prefix length %d' % (bits, ))
+        if net < 0 or net >> self.width:
+            raise ValueError('Invalid address %x' % (net, ))
+        if net & ((1 << (self.width - bits)) - 1):
+            raise ValueError('Net %x too specific for mask with %d bits'
+                             % (net, bits))
+        return net, bits
+
+    def _bit(self, address, index):
+        # the bit at index, counting from the most significant one
+        return (address >> (self.width - 1 - index)) & 1
+
+    def _commonBits(self, a, b, limit):
+        diff = a ^ b
+        if not diff:
+            return limit
+        return min(self.width - _bitLength(diff), limit)
+
+    def _find(self, net, bits):
+        node = self._root
+        while node is not None and node.bits < bits:
+            node = node.children[self._bit(net, node.bits)]
+        if node is not None and node.bits == bits and node.net == net:
+            return node
+        return None
+
+    def __setitem__(self, key, value):
+        net, bits = self._checkKey(key)
+        node = self._root
+        while True:
+            if node.bits == bits:
+                # only the root can get here without net matching
+                break
+            i = self._bit(net, node.bits)
+            child = node.children[i]
+            if child is None:
+                child = _Node(net, bits)
+                node.children[i] = child
+                node = child
+                break
+            common = self._commonBits(net, child.net,
+                                      min(bits, child.bits))
+            if common == child.bits:
+                node = child
+                continue
+            # the key diverges from the child, or is a prefix of it: put a
+            # node for the common bits between them
+            if common == bits:
+                middle = _Node(net, bits)
+            else:
+                mask = ((1 << common) - 1) << (self.width - common)
+                middle = _Node(net & mask, common)
+            middle.children[self._bit(child.net, common)] = child
+            node.children[i] = middle
+            if common == bits:
+                node = middle
+            else:
+                node = _Node(net, bits)
+                middle.children[self._bit(net, common)] = node
+            break
+
+        if not node.occupied:
+            self._len += 1
+        node.value = value
+        node.occupied = True
+
+    def __getitem__(self, key):
+        node = self._find(*key)
+        if node is None or not node.occupied:
+            raise KeyError(key)
+        return node.value
+
+    def __delitem__(self, key):
+        net, bits = key
+        # keep track of the path so that we can prune and merge nodes
+        path = []
+        node = self._root
+        while node is not None and node.bits < bits:
+            i = self._bit(net, node.bits)
+            path.append((node, i))
+            node = node.children[i]
+        if (node is None or node.bits != bits or node.net != net
+            or not node.occupied):
+            raise KeyError(key)
+
+        node.value = None
+        node.occupied = False
+        self._len -= 1
+
+        if not path:
+            return
+        parent, i = path[-1]
+        children = [c for c in node.children if c is not None]
+        if len(children) == 1:
+            parent.children[i] = children[0]
+        elif not children:
+            parent.children[i] = None
+            # the parent may now be a useless node with one child
+            others = [c for c in parent.children if c is not None]
+            if (len(path) > 1 and not parent.occupied
+                and len(others) == 1):
+                grandparent, j = path[-2]
+                grandparent.children[j] = others[0]
+
+    def __contains__(self, key):
+        node = self._find(*key)
+        return node is not None and node.occupied
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        node = self._find(*key)
+        if node is None or not node.occupied:
+            return default
+        return node.value
+
+    def iteritems(self):
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.occupied:
+                yield (node.net, node.bits), node.value
+            stack.extend([c for c in node.children if c is not None])
+
+    def iterkeys(self):
+        for key, value in self.iteritems():
+            yield key
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def _matching(self, address):
+        # the occupied nodes containing address, least specific first
+        width = self.width
+        found = []
+        node = self._root
+        while node is not None:
+            bits = node.bits
+            if bits and (address ^ node.net) >> (width - bits):
+                break
+            if node.occupied:
+                found.append(node)
+            if bits == width:
+                break
+            node = node.children[(address >> (width - 1 - bits)) & 1]
+        return found
+
+    def iterMatches(self, address):
+        """
+        Iterate over the prefixes containing address, the longest first.
+
+        @param address: the address to look up
+        @type  address: int
+
+        @returns: an iterator over ((net, bits), value) tuples
+        """
+        found = self._matching(address)
+        found.reverse()
+        for node in found:
+            yield (node.net, node.bits), node.value
+
+    def longestPrefix(self, address, default=None):
+        """
+        Find the longest prefix containing address.
+
+        @param address: the address to look up
+        @type  address: int
+
+        @returns: a ((net, bits), value) tuple, or default if no prefix
+                  contains address
+        """
+        found = self._matching(address)
+        if not found:
+            return default
+        node = found[-1]
+        return (node.net, node.bits), node.value
+
+    def longestPrefixValue(self, address, default=None):
+        """
+        Find the value associated to the longest prefix containing address.
+
+        @param address: the address to look up
+        @type  address: int
+
+        @returns: the value, or default if no prefix contains address
+        """
+        found = self._matching(address)
+        if not found:
+            return default
+        return found[-1].value
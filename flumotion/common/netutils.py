@@ -31,7 +31,7 @@ import struct
 
 from twisted.internet import address
 
-from flumotion.common import avltree
+from flumotion.common import avltree, iptrie
 
 __version__ = "$Rev$"
 
@@ -177,6 +177,7 @@ class RoutingTable(object):
                            r'(\d{1,2})'
                            r'(\s+([^\s](.*[^\s])?))?\s*$')
         ret = klass()
+        routeNames = set()
         n = 0
         for line in f:
             n += 1
@@ -195,14 +196,18 @@ class RoutingTable(object):
                 else:
                     route = defaultRouteName
             ret.addSubnet(route, m.group(1), int(m.group(2)))
-            if route not in ret.routeNames:
+            if route not in routeNames:
+                routeNames.add(route)
                 ret.routeNames.append(route)
 
         return ret
     fromFile = classmethod(fromFile)
 
     def __init__(self):
+        # the AVL tree keeps the subnets in order of preference for
+        # iteration, the trie finds the ones containing an IP
         self.avltree = avltree.AVLTree()
+        self._trie = iptrie.IPTrie(32) # (net, bits) -> sorted routes
         self.routeNames = []
 
     def getRouteNames(self):
@@ -218,10 +223,20 @@ class RoutingTable(object):
             raise ValueError('Net %s too specific for mask with %d bits'
                              % (ipv4String, maskBits))
         self.avltree.insert((mask, ipv4Int, route))
+        routes = self._trie.get((ipv4Int, maskBits))
+        if routes is None:
+            routes = self._trie[ipv4Int, maskBits] = []
+        routes.append(route)
+        # same order as the AVL tree
+        routes.sort(reverse=True)
 
     def removeSubnet(self, route, ipv4String, maskBits=32):
         ipv4Int, mask = self._parseSubnet(ipv4String, maskBits)
         self.avltree.delete((mask, ipv4Int, route))
+        routes = self._trie[ipv4Int, maskBits]
+        routes.remove(route)
+        if not routes:
+            del self._trie[ipv4Int, maskBits]
 
     def __iter__(self):
         return self.avltree.iterreversed()
@@ -243,9 +258,9 @@ class RoutingTable(object):
         if isinstance(ip, str):
             ip = ipv4StringToInt(ip)
 
-        for netmask, net, route in self:
-            if ip & netmask == net:
-                return route
+        routes = self._trie.longestPrefixValue(ip)
+        if routes:
+            return routes[0]
 
         return None
 
@@ -258,8 +273,8 @@ class RoutingTable(object):
         """
         if isinstance(ip, str):
             ip = ipv4StringToInt(ip)
-        for mask, net, route in self:
-            if ip & mask == net:
+        for subnet, routes in self._trie.iterMatches(ip):
+            for route in routes:
                 yield route
         # Yield the default route
         yield None
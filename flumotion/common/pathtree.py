@@ -0,0 +1,224 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_pathtree -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+"""radix tree keyed on strings.
+A compressed prefix tree mapping string keys (typically URL paths) to
+values, supporting longest-prefix lookups in time proportional to the
+length of the looked up string, independently of the number of keys.
+"""
+
+__version__ = "$Rev$"
+
+
+class _Node(object):
+    """A node of the radix tree. Children are stored in a dict keyed on
+    the first character of the edge label, with values being
+    (label, node) tuples."""
+
+    __slots__ = ('children', 'value', 'occupied')
+
+    def __init__(self):
+        self.children = {}
+        self.value = None
+        self.occupied = False
+
+
+class PathTree(object):
+    """
+    A dictionary-like mapping from strings to values that can also find
+    the value associated with the longest key that is a prefix of a given
+    string.
+
+    Matching is done on plain string prefixes, the same way as
+    C{path.startswith(prefix)} would.
+    """
+
+    def __init__(self, items=()):
+        self._root = _Node()
+        self._len = 0
+        for key, value in items:
+            self[key] = value
+
+    def _find(self, key):
+        node = self._root
+        i, n = 0, len(key)
+        while i < n:
+            edge = node.children.get(key[i])
+            if edge is None:
+                return None
+            label, child = edge
+            if not key.startswith(label, i):
+                return None
+            i += len(label)
+            node = child
+        return node
+
+    def __setitem__(self, key, value):
+        node = self._root
+        i, n = 0, len(key)
+        while i < n:
+            c = key[i]
+            edge = node.children.get(c)
+            if edge is None:
+                child = _Node()
+                node.children[c] = (key[i:], child)
+                node = child
+                break
+            label, child = edge
+            if key.startswith(label, i):
+                i += len(label)
+                node = child
+                continue
+            # the edge label and the key diverge, split the edge
+            common, limit = 1, min(len(label), n - i)
+            while common < limit and key[i + common] == label[common]:
+                common += 1
+            middle = _Node()
+            middle.children[label[common]] = (label[common:], child)
+            node.children[c] = (label[:common], middle)
+            node = middle
+            i += common
+
+        if not node.occupied:
+            self._len += 1
+        node.value = value
+        node.occupied = True
+
+    def __getitem__(self, key):
+        node = self._find(key)
+        if node is None or not node.occupied:
+            raise KeyError(key)
+        return node.value
+
+    def __delitem__(self, key):
+        # keep track of the path so that we can prune and merge nodes
+        path = []
+        node = self._root
+        i, n = 0, len(key)
+        while i < n:
+            edge = node.children.get(key[i])
+            if edge is None:
+                raise KeyError(key)
+            label, child = edge
+            if not key.startswith(label, i):
+                raise KeyError(key)
+            path.append((node, key[i]))
+            i += len(label)
+            node = child
+        if not node.occupied:
+            raise KeyError(key)
+
+        node.value = None
+        node.occupied = False
+        self._len -= 1
+
+        if not path:
+            return
+        parent, c = path[-1]
+        if not node.children:
+            # leaf, remove it and maybe merge the parent with its only
+            # remaining child
+            del parent.children[c]
+            if (len(path) > 1 and not parent.occupied
+                and len(parent.children) == 1):
+                grandparent, pc = path[-2]
+                self._merge(grandparent, pc)
+        elif len(node.children) == 1:
+            self._merge(parent, c)
+
+    def _merge(self, parent, c):
+        # merge the child of parent at c with its only child
+        label, node = parent.children[c]
+        (sublabel, subnode), = node.children.values()
+        parent.children[c] = (label + sublabel, subnode)
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node is not None and node.occupied
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        node = self._find(key)
+        if node is None or not node.occupied:
+            return default
+        return node.value
+
+    def iteritems(self):
+        stack = [('', self._root)]
+        while stack:
+            prefix, node = stack.pop()
+            if node.occupied:
+                yield prefix, node.value
+            for label, child in node.children.itervalues():
+                stack.append((prefix + label, child))
+
+    def iterkeys(self):
+        for key, value in self.iteritems():
+            yield key
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def longestPrefix(self, path, default=None):
+        """
+        Find the longest key that is a prefix of path.
+
+        @param path: the string to look up
+        @type  path: str
+
+        @returns: a (key, value) tuple, or default if no key is a prefix
+                  of path
+        """
+        node = self._root
+        found = node.occupied and ('', node.value) or default
+        i, n = 0, len(path)
+        while i < n:
+            edge = node.children.get(path[i])
+            if edge is None:
+                break
+            label, child = edge
+            if not path.startswith(label, i):
+                break
+            i += len(label)
+            node = child
+            if node.occupied:
+                found = (path[:i], node.value)
+        return found
+
+    def longestPrefixValue(self, path, default=None):
+        """
+        Find the value associated to the longest key that is a prefix of
+        path.
+
+        @param path: the string to look up
+        @type  path: str
+
+        @returns: the value, or default if no key is a prefix of path
+        """
+        found = self.longestPrefix(path)
+        if found is None:
+            return default
+        return found[1]
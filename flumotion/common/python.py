@@ -104,3 +104,107 @@ try:
     set = set
 except NameError:
     from sets import Set as set
+
+
+class _OrderedDict(dict):
+    """
+    A dictionary that remembers the order its keys were added in,
+    with the methods of collections.OrderedDict used in flumotion.
+
+    The keys are kept in a doubly linked list of [prev, next, key]
+    links, so adding, removing and popping keys at either end are
+    constant time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._links = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._links[key] = [last, root, key]
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        prev, next, _ = self._links.pop(key)
+        prev[1] = next
+        next[0] = prev
+
+    def __iter__(self):
+        root = self._root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
+
+    def clear(self):
+        dict.clear(self)
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None]
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs, ):
+            if hasattr(other, 'keys'):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError('dictionary is empty')
+        if last:
+            key = self._root[0][2]
+        else:
+            key = self._root[1][2]
+        return key, self.pop(key)
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+# collections.OrderedDict was introduced in 2.7
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = _OrderedDict
@@ -19,8 +19,10 @@
 
 # Headers in this file shall remain intact.
 
+import copy
 import struct
 import socket
+import time
 
 from twisted.web import http, server
 from twisted.web import resource as web_resource
@@ -31,7 +33,8 @@ from flumotion.configure import configure
 from flumotion.common import errors
 from flumotion.twisted.credentials import cryptChallenge
 
-from flumotion.common import common, log, keycards
+from flumotion.common import common, log, keycards, iptrie, python
+from flumotion.component.base import timerwheel
 
 #__all__ = ['HTTPStreamingResource', 'MultifdSinkStreamer']
 __version__ = "$Rev$"
@@ -70,6 +73,14 @@ class Issuer(log.Loggable):
         """
         raise NotImplementedError
 
+    def getCacheKey(self, keycard):
+        """
+        Return a key identifying the data of a keycard I issued that a
+        bouncer bases its decision on, or None if decisions on such
+        keycards should not be cached.
+        """
+        return None
+
 
 class HTTPGenericIssuer(Issuer):
     """
@@ -101,6 +112,9 @@ class HTTPAuthIssuer(Issuer):
             keycard.username, keycard.password, keycard.address))
         return keycard
 
+    def getCacheKey(self, keycard):
+        return (keycard.username, keycard.password, keycard.address)
+
 
 class HTTPTokenIssuer(Issuer):
     """
@@ -122,6 +136,9 @@ class HTTPTokenIssuer(Issuer):
             request.getClientIP(), request.path)
         return keycard
 
+    def getCacheKey(self, keycard):
+        return (keycard.token, keycard.address, keycard.path)
+
 
 class HTTPGetArgumentsIssuer(Issuer):
     """
@@ -135,10 +152,179 @@ class HTTPGetArgumentsIssuer(Issuer):
         path = request.path
         return keycards.KeycardHTTPGetArguments(arguments, address, path)
 
+    def getCacheKey(self, keycard):
+        arguments = [(k, tuple(v)) for k, v in keycard.arguments.items()]
+        arguments.sort()
+        return (tuple(arguments), keycard.address, keycard.path)
+
 
 BOUNCER_SOCKET = 'flumotion.component.bouncers.plug.BouncerPlug'
 
 
+class KeycardCache(log.Loggable):
+    """
+    I remember the decisions of a remote bouncer on keycards, so that
+    requests carrying the same credentials can be answered without asking
+    the bouncer again.
+
+    Decisions are kept for a limited time, and the least recently used
+    ones are dropped when I am full. Positive decisions are forgotten as
+    soon as their keycard is expired or cleaned up, so that revoking a
+    keycard in the bouncer also revokes the cached decision.
+    """
+
+    logCategory = 'httpauth'
+
+    def __init__(self, size, ttl):
+        """
+        @param size: the maximum number of decisions to keep
+        @type  size: int
+        @param ttl:  the time in seconds to keep decisions for
+        @type  ttl:  float
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (expiration time, keycard or None, decision time),
+        # least recently used first
+        self._entries = python.OrderedDict()
+        self._idToKey = {}
+
+    def get(self, key):
+        """
+        Look up a decision.
+
+        @returns: None if no decision is known, or a (keycard, age) tuple,
+                  where keycard is the authenticated keycard or None if
+                  it was refused, and age the time since the decision.
+        """
+        entry = self._entries.pop(key, None)
+        now = time.time()
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                self._forget(entry)
+            self.misses += 1
+            return None
+        # move it to the most recently used end
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1], now - entry[2]
+
+    def put(self, key, keycard):
+        """
+        Remember the decision on a keycard.
+
+        @param keycard: the authenticated keycard, or None if it was refused
+        """
+        self.remove(key)
+        now = time.time()
+        if keycard is not None:
+            self.removeKeycardId(keycard.id)
+            self._idToKey[keycard.id] = key
+        self._entries[key] = (now + self.ttl, keycard, now)
+        while len(self._entries) > self.size:
+            _, entry = self._entries.popitem(last=False)
+            self._forget(entry)
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._forget(entry)
+
+    def removeKeycardId(self, keycardId):
+        """
+        Forget the decision that authenticated the given keycard.
+        """
+        key = self._idToKey.pop(keycardId, None)
+        if key is not None:
+            self.log('forgetting decision on keycard %r', keycardId)
+            self._entries.pop(key, None)
+
+    def _forget(self, entry):
+        keycard = entry[1]
+        if keycard is not None:
+            self._idToKey.pop(keycard.id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class KeycardBatcher(log.Loggable):
+    """
+    I collect keycards to authenticate against remote bouncers for a short
+    time, and send them to each bouncer in one call.
+    """
+
+    logCategory = 'httpauth'
+
+    def __init__(self, authenticateMany, window, size):
+        """
+        @param authenticateMany: called with a bouncer name and a list of
+                                 keycards, returning a deferred firing the
+                                 list of resulting keycards or None
+        @type  authenticateMany: callable
+        @param window:           the time in seconds to collect keycards for
+        @type  window:           float
+        @param size:             the maximum number of keycards to send in
+                                 one call
+        @type  size:             int
+        """
+        self._authenticateMany = authenticateMany
+        self.window = window
+        self.size = size
+        self._pending = {} # bouncer name -> list of (keycard, deferred)
+        self._flushDC = None
+
+    def authenticate(self, bouncerName, keycard):
+        """
+        @rtype: L{twisted.internet.defer.Deferred} firing a keycard or None.
+        """
+        d = defer.Deferred()
+        pending = self._pending.setdefault(bouncerName, [])
+        pending.append((keycard, d))
+        if len(pending) >= self.size:
+            self._flush(bouncerName)
+        elif self._flushDC is None:
+            self._flushDC = reactor.callLater(self.window, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Send all the keycards collected so far.
+        """
+        if self._flushDC is not None:
+            if self._flushDC.active():
+                self._flushDC.cancel()
+            self._flushDC = None
+        for bouncerName in self._pending.keys():
+            self._flush(bouncerName)
+
+    def _flush(self, bouncerName):
+        batch = self._pending.pop(bouncerName)
+        self.debug('sending %d keycards to bouncer %s', len(batch),
+                   bouncerName)
+
+        def authenticated(results):
+            if results is None or len(results) != len(batch):
+                raise errors.FlumotionError(
+                    "Bouncer %s answered %r for %d keycards"
+                    % (bouncerName, results, len(batch)))
+            for (keycard, d), result in zip(batch, results):
+                d.callback(result)
+
+        def failed(failure):
+            # Requests that got no answer would never be replied to
+            for keycard, d in batch:
+                if not d.called:
+                    d.errback(failure)
+
+        d = defer.maybeDeferred(self._authenticateMany, bouncerName,
+                                [keycard for keycard, _ in batch])
+        d.addCallback(authenticated)
+        d.addErrback(failed)
+
+
 class HTTPAuthentication(log.Loggable):
     """
     Helper object for handling HTTP authentication for twisted.web
@@ -150,13 +336,16 @@ class HTTPAuthentication(log.Loggable):
     KEYCARD_TTL = 60 * 60
     KEYCARD_KEEPALIVE_INTERVAL = 20 * 60
     KEYCARD_TRYAGAIN_INTERVAL = 1 * 60
+    KEYCARD_CACHE_TTL = 60
+    KEYCARD_BATCH_SIZE = 100
 
     def __init__(self, component):
         self.component = component
         self._fdToKeycard = {}         # request fd -> Keycard
         self._idToKeycard = {}         # keycard id -> Keycard
-        self._fdToDurationCall = {}    # request fd -> IDelayedCall
-                                       # for duration
+        self._idToFds = {}             # keycard id -> set of request fds
+        self._timeouts = timerwheel.getTimerWheel() # (self, fd) -> duration
+        self._expiring = set()         # request fds in _timeouts
         self._domain = None            # used for auth challenge and on keycard
         self._issuer = HTTPAuthIssuer() # issues keycards; default for compat
         self.bouncerName = None
@@ -165,6 +354,8 @@ class HTTPAuthentication(log.Loggable):
                                        # doesn't specify one.
         self._pendingCleanups = []
         self._keepAlive = None
+        self._cache = None             # KeycardCache, if enabled
+        self._batcher = None           # KeycardBatcher, if enabled
 
         if (BOUNCER_SOCKET in self.component.plugs
             and self.component.plugs[BOUNCER_SOCKET]):
@@ -229,6 +420,24 @@ class HTTPAuthentication(log.Loggable):
     def setDefaultDuration(self, defaultDuration):
         self._defaultDuration = defaultDuration
 
+    def setKeycardCache(self, size, ttl=None):
+        """
+        Cache the decisions of the remote bouncer, so that clients
+        presenting the same credentials get admitted or refused without
+        asking the bouncer again. Clients admitted from the cache share the
+        keycard of the first one.
+
+        @param size: the maximum number of decisions to cache, or 0 to
+                     disable the cache
+        @type  size: int
+        @param ttl:  the time in seconds to keep decisions for
+        @type  ttl:  float
+        """
+        if size > 0:
+            self._cache = KeycardCache(size, ttl or self.KEYCARD_CACHE_TTL)
+        else:
+            self._cache = None
+
     def setIssuerClass(self, issuerClass):
         # FIXME: in the future, we want to make this pluggable and have it
         # look up somewhere ?
@@ -265,13 +474,91 @@ class HTTPAuthentication(log.Loggable):
             return defer.succeed(keycard)
         else:
             keycard.ttl = self.KEYCARD_TTL
+            key = None
+            if self._cache is not None:
+                key = self._issuer.getCacheKey(keycard)
+            if key is not None:
+                cached = self._getCachedDecision(key, keycard._fd)
+                if cached is not None:
+                    return defer.succeed(cached[0])
             self.debug('sending keycard to remote bouncer %r',
                        self.bouncerName)
-            return self.authenticateKeycard(self.bouncerName, keycard)
+            d = self.authenticateKeycard(self.bouncerName, keycard)
+            if key is not None:
+                d.addCallback(self._cacheDecision, key)
+            return d
+
+    def _getCachedDecision(self, key, fd):
+        # returns None if there is no usable decision, or a 1-tuple with
+        # the keycard to admit the client with, or None to refuse it
+        found = self._cache.get(key)
+        if found is None:
+            return None
+        cached, age = found
+        if cached is None:
+            self.debug('[fd %5d] refused from the cache', fd)
+            return (None, )
+
+        keycard = copy.copy(cached)
+        keycard._fd = fd
+        keycard._cached = True
+        if keycard.duration:
+            # the bouncer gave the first client this much time
+            keycard.duration -= age
+            if keycard.duration <= 0:
+                self._cache.remove(key)
+                return None
+        self.debug('[fd %5d] admitted from the cache with keycard id %s',
+                   fd, keycard.id)
+        return (keycard, )
+
+    def _cacheDecision(self, keycard, key):
+        if self._cache is not None:
+            self._cache.put(key, keycard)
+        return keycard
+
+    def setKeycardBatching(self, window, size=None):
+        """
+        Collect the keycards to authenticate against the remote bouncer
+        during the given time, and send them in a single call.
+
+        @param window: the time in seconds to collect keycards for, or 0 to
+                       send every keycard on its own
+        @type  window: float
+        @param size:   the maximum number of keycards to send in one call
+        @type  size:   int
+        """
+        self.stopKeycardBatching()
+        if window > 0:
+            self._batcher = KeycardBatcher(self.authenticateKeycards, window,
+                                           size or self.KEYCARD_BATCH_SIZE)
+
+    def stopExpirations(self):
+        """
+        Cancel the pending expirations of the clients' durations, since
+        the timer wheel is shared with the rest of the process.
+        """
+        for fd in self._expiring:
+            self._timeouts.remove((self, fd))
+        self._expiring.clear()
+
+    def stopKeycardBatching(self):
+        """
+        Stop collecting keycards, sending the ones collected so far.
+        """
+        if self._batcher is not None:
+            # also cancels the pending flush
+            self._batcher.flush()
+            self._batcher = None
 
     def authenticateKeycard(self, bouncerName, keycard):
+        if self._batcher is not None:
+            return self._batcher.authenticate(bouncerName, keycard)
         return self.component.medium.authenticate(bouncerName, keycard)
 
+    def authenticateKeycards(self, bouncerName, keycards):
+        return self.component.medium.authenticateMany(bouncerName, keycards)
+
     def keepAlive(self, bouncerName, issuerName, ttl):
         return self.component.medium.keepAlive(bouncerName, issuerName, ttl)
 
@@ -295,6 +582,8 @@ class HTTPAuthentication(log.Loggable):
                 self._pendingCleanups.append(pair)
             d = self.cleanupKeycard(bouncerName, keycard)
             d.addErrback(cleanupLater, (bouncerName, keycard))
+        if self._cache is not None:
+            self._cache.removeKeycardId(keycard.id)
         pending = self._pendingCleanups
         self._pendingCleanups = []
         cleanup(bouncerName, keycard)
@@ -306,47 +595,53 @@ class HTTPAuthentication(log.Loggable):
     def cleanupAuth(self, fd):
         if self.bouncerName and fd in self._fdToKeycard:
             keycard = self._fdToKeycard[fd]
-            self.debug('[fd %5d] asking bouncer %s to remove keycard id %s',
-                       fd, self.bouncerName, keycard.id)
-            self.doCleanupKeycard(self.bouncerName, keycard)
+            # clients admitted from the cache share the keycard, only
+            # remove it when the last one goes away
+            if len(self._idToFds[keycard.id]) == 1:
+                self.debug('[fd %5d] asking bouncer %s to remove keycard '
+                           'id %s', fd, self.bouncerName, keycard.id)
+                self.doCleanupKeycard(self.bouncerName, keycard)
         self._removeKeycard(fd)
 
     def _removeKeycard(self, fd):
         if self.bouncerName and fd in self._fdToKeycard:
             keycard = self._fdToKeycard[fd]
             del self._fdToKeycard[fd]
-            del self._idToKeycard[keycard.id]
-        if fd in self._fdToDurationCall:
-            self.debug('[fd %5d] canceling later expiration call' % fd)
-            self._fdToDurationCall[fd].cancel()
-            del self._fdToDurationCall[fd]
-
-    def _durationCallLater(self, fd):
+            fds = self._idToFds[keycard.id]
+            fds.discard(fd)
+            if not fds:
+                del self._idToFds[keycard.id]
+                del self._idToKeycard[keycard.id]
+        self._expiring.discard(fd)
+        if self._timeouts.remove((self, fd)):
+            self.debug('[fd %5d] canceling later expiration' % fd)
+
+    def _durationExpired(self, fd):
         """
         Expire a client due to a duration expiration.
         """
+        self._expiring.discard(fd)
         self.debug('[fd %5d] duration exceeded, expiring client' % fd)
 
-        # we're called from a callLater, so we've already run; just delete
-        if fd in self._fdToDurationCall:
-            del self._fdToDurationCall[fd]
-
         self.debug('[fd %5d] asking streamer to remove client' % fd)
         self.clientDone(fd)
 
     def expireKeycard(self, keycardId):
         """
-        Expire a client's connection associated with the keycard Id.
+        Expire the clients' connections associated with the keycard Id.
         """
-        keycard = self._idToKeycard[keycardId]
-        fd = keycard._fd
+        fds = list(self._idToFds[keycardId])
 
-        self.debug('[fd %5d] expiring client' % fd)
+        if self._cache is not None:
+            self._cache.removeKeycardId(keycardId)
 
-        self._removeKeycard(fd)
+        for fd in fds:
+            self.debug('[fd %5d] expiring client' % fd)
 
-        self.debug('[fd %5d] asking streamer to remove client' % fd)
-        self.clientDone(fd)
+            self._removeKeycard(fd)
+
+            self.debug('[fd %5d] asking streamer to remove client' % fd)
+            self.clientDone(fd)
 
     def expireKeycards(self, keycardIds):
         """
@@ -383,27 +678,33 @@ class HTTPAuthentication(log.Loggable):
             fd = request.transport.fileno()
 
             if self.bouncerName:
+                cached = getattr(keycard, '_cached', False)
                 # the request was finished before the callback was executed
                 if fd == -1:
+                    if cached:
+                        # other clients are using the keycard
+                        return None
                     self.debug('Request interrupted before authentification '
                                'was finished: asking bouncer %s to remove '
                                'keycard id %s', self.bouncerName, keycard.id)
                     self.doCleanupKeycard(self.bouncerName, keycard)
                     return None
-                if keycard.id in self._idToKeycard:
+                if keycard.id in self._idToKeycard and not cached:
                     self.warning("Duplicate keycard id: refusing")
                     raise errors.NotAuthenticatedError()
 
                 self._fdToKeycard[fd] = keycard
-                self._idToKeycard[keycard.id] = keycard
+                self._idToKeycard.setdefault(keycard.id, keycard)
+                self._idToFds.setdefault(keycard.id, set()).add(fd)
 
             duration = keycard.duration or self._defaultDuration
 
             if duration:
                 self.debug('new connection on %d will expire in %f seconds' % (
                     fd, duration))
-                self._fdToDurationCall[fd] = reactor.callLater(
-                    duration, self._durationCallLater, fd)
+                self._timeouts.add((self, fd), duration,
+                                   self._durationExpired, fd)
+                self._expiring.add(fd)
 
         return None
 
@@ -441,15 +742,27 @@ class HTTPAuthentication(log.Loggable):
         request.finish()
 
 
+def _parseAddress(ip):
+    # returns the address family and the address as an integer
+    if ':' in ip:
+        high, low = struct.unpack(">QQ", socket.inet_pton(socket.AF_INET6,
+                                                         ip))
+        return socket.AF_INET6, (high << 64) | low
+    return (socket.AF_INET,
+            struct.unpack(">I", socket.inet_pton(socket.AF_INET, ip))[0])
+
+
 class LogFilter:
 
     def __init__(self):
-        self.filters = [] # list of (network, mask)
+        # one trie of networks per address family
+        self.filters = {socket.AF_INET: iptrie.IPTrie(32),
+                        socket.AF_INET6: iptrie.IPTrie(128)}
 
     def addIPFilter(self, filter):
         """
         Add an IP filter of the form IP/prefix-length (CIDR syntax), or just
-        a single IP address
+        a single IP address. Both IPv4 and IPv6 addresses are supported.
         """
         definition = filter.split('/')
         if len(definition) == 2:
@@ -457,31 +770,34 @@ class LogFilter:
             prefixlen = int(prefixlen)
         elif len(definition) == 1:
             net = definition[0]
-            prefixlen = 32
+            prefixlen = None
         else:
             raise errors.ConfigError(
                 "Cannot parse filter definition %s" % filter)
 
-        if prefixlen < 0 or prefixlen > 32:
-            raise errors.ConfigError("Invalid prefix length")
-
-        mask = ~((1 << (32 - prefixlen)) - 1)
         try:
-            net = struct.unpack(">I", socket.inet_pton(socket.AF_INET, net))[0]
+            family, net = _parseAddress(net)
         except socket.error:
             raise errors.ConfigError(
                 "Failed to parse network address %s" % net)
+        trie = self.filters[family]
+        if prefixlen is None:
+            prefixlen = trie.width
+
+        if prefixlen < 0 or prefixlen > trie.width:
+            raise errors.ConfigError("Invalid prefix length")
+
+        mask = ((1 << prefixlen) - 1) << (trie.width - prefixlen)
         net = net & mask # just in case
 
-        self.filters.append((net, mask))
+        trie[net, prefixlen] = True
 
     def isInRange(self, ip):
         """
         Return true if ip is in any of the defined network(s) for this filter
         """
-        # Handles IPv4 only.
-        realip = struct.unpack(">I", socket.inet_pton(socket.AF_INET, ip))[0]
-        for f in self.filters:
-            if (realip & f[1]) == f[0]:
-                return True
-        return False
+        family, realip = _parseAddress(ip)
+        if family == socket.AF_INET6 and realip >> 32 == 0xffff:
+            # an IPv4-mapped IPv6 address
+            family, realip = socket.AF_INET, realip & 0xffffffff
+        return self.filters[family].longestPrefix(realip) is not None
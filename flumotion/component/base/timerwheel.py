@@ -0,0 +1,221 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_timerwheel -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+"""
+coarse-grained timeouts for large numbers of connections
+"""
+
+import math
+import time
+
+from twisted.internet import reactor
+
+from flumotion.common import log
+
+__version__ = "$Rev$"
+
+DEFAULT_RESOLUTION = 1.0
+DEFAULT_SLOTS = 512
+
+_wheel = None
+
+
+def getTimerWheel():
+    """
+    Returns the timer wheel shared by everything in the process.
+
+    @rtype: L{TimerWheel}
+    """
+    global _wheel
+    if _wheel is None:
+        _wheel = TimerWheel()
+    return _wheel
+
+
+class _Timer(object):
+    __slots__ = ('deadline', 'slot', 'callback', 'args')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.slot = None
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel(log.Loggable):
+    """
+    I call functions when deadlines pass, for large numbers of deadlines
+    that are often refreshed and rarely reached, like connection timeouts.
+
+    Deadlines are kept in a ring of slots, each covering resolution
+    seconds, so adding, refreshing and removing a deadline takes
+    constant time. A single delayed call advances the ring while
+    there are deadlines, and all the deadlines of a slot expire at once,
+    up to resolution seconds late.
+
+    Refreshing a deadline to a later time doesn't move it; it is moved
+    when its old slot is reached.
+
+    Each deadline is identified by a key, which can be any hashable
+    object.
+    """
+
+    logCategory = 'timerwheel'
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, slots=DEFAULT_SLOTS,
+                 clock=None):
+        """
+        @param resolution: the duration of a slot, in seconds
+        @type  resolution: float
+        @param slots:      the number of slots in the ring
+        @type  slots:      int
+        @param clock:      the clock to use instead of the reactor,
+                           for testing
+        @type  clock:      L{twisted.internet.task.Clock}
+        """
+        self.resolution = resolution
+        self._clock = clock or reactor
+        self._seconds = (clock and clock.seconds) or time.time
+        self._slots = [{} for i in range(slots)]
+        self._timers = {} # {key: _Timer}
+        self._tick = self._getTick(self._seconds())
+        self._call = None
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def add(self, key, timeout, callback, *args):
+        """
+        Calls a function with the given arguments when the timeout
+        expires, replacing any deadline with the same key.
+
+        @param timeout: the time from now in seconds
+        @type  timeout: float
+        """
+        self.remove(key)
+        timer = _Timer(self._seconds() + timeout, callback, args)
+        self._timers[key] = timer
+        self._place(key, timer)
+        self._schedule()
+
+    def touch(self, key, timeout):
+        """
+        Moves a deadline to the given time from now.
+
+        @param timeout: the time from now in seconds
+        @type  timeout: float
+        @return: whether there was a deadline for the key
+        @rtype:  bool
+        """
+        timer = self._timers.get(key, None)
+        if timer is None:
+            return False
+        deadline = self._seconds() + timeout
+        if deadline < timer.deadline:
+            # An earlier deadline may be in an earlier slot
+            del self._slots[timer.slot][key]
+            timer.deadline = deadline
+            self._place(key, timer)
+        else:
+            timer.deadline = deadline
+        return True
+
+    def remove(self, key):
+        """
+        Removes a deadline.
+
+        @return: whether there was a deadline for the key
+        @rtype:  bool
+        """
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        del self._slots[timer.slot][key]
+        if not self._timers:
+            self._cancel()
+        return True
+
+    def clear(self):
+        """
+        Removes all the deadlines.
+        """
+        for slot in self._slots:
+            slot.clear()
+        self._timers.clear()
+        self._cancel()
+
+    ### Private Methods ###
+
+    def _getTick(self, seconds):
+        return int(math.floor(seconds / self.resolution))
+
+    def _place(self, key, timer):
+        # The slot of a deadline is reached at or after the deadline
+        tick = int(math.ceil(timer.deadline / self.resolution))
+        tick = max(tick, self._tick + 1)
+        timer.slot = tick % len(self._slots)
+        self._slots[timer.slot][key] = timer
+
+    def _schedule(self):
+        if self._call is None and self._timers:
+            self._call = self._clock.callLater(self.resolution,
+                                               self._advance)
+
+    def _cancel(self):
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def _advance(self):
+        self._call = None
+        now = self._seconds()
+        current = self._getTick(now)
+        # Visiting each slot once is enough to catch up
+        first = max(self._tick + 1, current - len(self._slots) + 1)
+        expired = []
+        for tick in range(first, current + 1):
+            slot = self._slots[tick % len(self._slots)]
+            for key, timer in slot.items():
+                if timer.deadline <= now:
+                    del slot[key]
+                    del self._timers[key]
+                    expired.append(timer)
+                else:
+                    # Refreshed, or more than a ring away
+                    del slot[key]
+                    self._tick = tick
+                    self._place(key, timer)
+        self._tick = current
+
+        if expired:
+            self.log("%d deadlines expired", len(expired))
+        # Callbacks can add or remove deadlines
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception, e:
+                self.warning("Error calling expired timer: %s",
+                             log.getExceptionMessage(e))
+
+        self._schedule()
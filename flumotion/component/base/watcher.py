@@ -24,18 +24,37 @@ import time
 
 from twisted.internet import reactor
 
-from flumotion.common import log
+from flumotion.common import log, python
+from flumotion.twisted import inotify
 
 __version__ = "$Rev$"
 
+# the events that can change the watched files in a directory
+WATCH_MASK = (inotify.IN_MODIFY | inotify.IN_ATTRIB | inotify.IN_CLOSE_WRITE |
+              inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+              inotify.IN_CREATE | inotify.IN_DELETE |
+              inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+              inotify.IN_ONLYDIR)
+# the events telling a file was completely written
+WRITTEN_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+# the events telling a file is gone
+GONE_MASK = inotify.IN_DELETE | inotify.IN_MOVED_FROM
+# the events telling a watched directory is gone
+DIRECTORY_GONE_MASK = (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+                       inotify.IN_IGNORED | inotify.IN_UNMOUNT)
+
 
 class BaseWatcher(log.Loggable):
     """I watch for file changes.
 
     I am a base class for a file watcher. I can be specialized to watch
     any set of files.
+
+    @cvar useInotify: whether to use inotify when it is available
     """
 
+    useInotify = True
+
     def __init__(self, timeout):
         """Make a file watcher object.
 
@@ -43,6 +62,7 @@ class BaseWatcher(log.Loggable):
         @type timeout: int
         """
         self.timeout = timeout
+        self._inotify = None
         self._reset()
         self._subscribeId = 0
         self.subscribers = {}
@@ -72,7 +92,8 @@ class BaseWatcher(log.Loggable):
 
         @param fileChanged: A function to call when a file changes. This
         function will only be called if the file's details (size, mtime)
-        do not change during the timeout period.
+        do not change during the timeout period, or, with inotify, when
+        the file was closed after writing or moved in place.
         @type fileChanged: filename -> None
         @param fileDeleted: A function to call when a file is deleted.
         @type fileDeleted: filename -> None
@@ -113,54 +134,30 @@ class BaseWatcher(log.Loggable):
 
         Subscribers will be notified asynchronously of changes to the
         watched files.
-        """
 
-        def checkFiles():
-            self.log("checking for file changes")
-            new = self.getFileData()
-            changing = self._changingData
-            stable = self._stableData
-            for f in new:
-                if f not in changing:
-                    if not f in stable and self.isNewFileStable(f, new[f]):
-                        self.debug('file %s stable when noted', f)
-                        stable[f] = new[f]
-                        self.event('fileChanged', f)
-                    elif f in stable and new[f] == stable[f]:
-                        # no change
-                        pass
-                    else:
-                        self.debug('change start noted for %s', f)
-                        changing[f] = new[f]
-                else:
-                    if new[f] == changing[f]:
-                        self.debug('change finished for %s', f)
-                        del changing[f]
-                        stable[f] = new[f]
-                        self.event('fileChanged', f)
-                    else:
-                        self.log('change continues for %s', f)
-                        changing[f] = new[f]
-            for f in stable.keys():
-                if f not in new:
-                    # deletion
-                    del stable[f]
-                    self.debug('file %s has been deleted', f)
-                    self.event('fileDeleted', f)
-            for f in changing.keys():
-                if f not in new:
-                    self.debug('file %s has been deleted', f)
-                    del changing[f]
-            self._delayedCall = reactor.callLater(self.timeout,
-                                                  checkFiles)
-
-        assert self._delayedCall is None
-        checkFiles()
+        On Linux, when the watcher knows which directories to watch,
+        changes are notified by inotify, and only the changed files are
+        checked. Otherwise, all the files are checked every timeout.
+        """
+        assert self._delayedCall is None and self._inotify is None
+        if self.useInotify and inotify.HAS_INOTIFY:
+            directories = self.getDirectoriesToWatch()
+            if directories is not None:
+                try:
+                    self._startNotifying(directories)
+                    return
+                except inotify.INotifyError, e:
+                    self.info("not using inotify, polling for file "
+                              "changes: %s", log.getExceptionMessage(e))
+                    self._stopNotifying()
+        self._poll()
 
     def stop(self):
         """Stop checking for file changes.
         """
-        self._delayedCall.cancel()
+        if self._delayedCall is not None:
+            self._delayedCall.cancel()
+        self._stopNotifying()
         self._reset()
 
     def getFileData(self):
@@ -171,14 +168,24 @@ class BaseWatcher(log.Loggable):
         """
         ret = {}
         for f in self.getFilesToStat():
-            try:
-                stat = os.stat(f)
-                ret[f] = (stat.st_mtime, stat.st_size)
-            except OSError, e:
-                self.debug('could not read file %s: %s', f,
-                           log.getExceptionMessage(e))
+            data = self.getFileDataFor(f)
+            if data is not None:
+                ret[f] = data
         return ret
 
+    def getFileDataFor(self, fName):
+        """
+        @returns: DATA for a single file, as in L{getFileData}, or None
+                  if the file cannot be read
+        """
+        try:
+            stat = os.stat(fName)
+            return (stat.st_mtime, stat.st_size)
+        except OSError, e:
+            self.debug('could not read file %s: %s', fName,
+                       log.getExceptionMessage(e))
+            return None
+
     def isNewFileStable(self, fName, fData):
         """
         Check if the file is already stable when being added to the
@@ -203,6 +210,164 @@ class BaseWatcher(log.Loggable):
         """
         raise NotImplementedError
 
+    def getDirectoriesToWatch(self):
+        """
+        Override me to have changes notified by inotify.
+
+        @returns: the directories containing the watched files, or None
+                  to poll for changes
+        @rtype:   sequence of str
+        """
+        return None
+
+    def getWatchedFile(self, directory, name):
+        """
+        @param directory: a directory returned by L{getDirectoriesToWatch}
+        @param name:      the name of a file in the directory
+
+        @returns: the filename of the file, as in L{getFilesToStat}, or
+                  None if it is not watched
+        @rtype:   str
+        """
+        raise NotImplementedError
+
+    ### Private Methods ###
+
+    def _poll(self):
+        self.log("checking for file changes")
+        self._update(self.getFileData())
+        self._delayedCall = reactor.callLater(self.timeout, self._poll)
+
+    def _update(self, new):
+        # Compare the data of all the files with the known data
+        changing = self._changingData
+        stable = self._stableData
+        for f in new:
+            if f not in changing:
+                if not f in stable and self.isNewFileStable(f, new[f]):
+                    self.debug('file %s stable when noted', f)
+                    stable[f] = new[f]
+                    self.event('fileChanged', f)
+                elif f in stable and new[f] == stable[f]:
+                    # no change
+                    pass
+                else:
+                    self.debug('change start noted for %s', f)
+                    changing[f] = new[f]
+            else:
+                if new[f] == changing[f]:
+                    self.debug('change finished for %s', f)
+                    del changing[f]
+                    stable[f] = new[f]
+                    self.event('fileChanged', f)
+                else:
+                    self.log('change continues for %s', f)
+                    changing[f] = new[f]
+        for f in stable.keys():
+            if f not in new:
+                # deletion
+                del stable[f]
+                self.debug('file %s has been deleted', f)
+                self.event('fileDeleted', f)
+        for f in changing.keys():
+            if f not in new:
+                self.debug('file %s has been deleted', f)
+                del changing[f]
+
+    def _startNotifying(self, directories):
+        self._inotify = inotify.INotify(self._notified)
+        for directory in directories:
+            self._inotify.watch(directory, WATCH_MASK)
+        self._inotify.startReading()
+        # Changes happening from now on are notified
+        self._update(self.getFileData())
+        self._scheduleSettle()
+
+    def _stopNotifying(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _notified(self, directory, name, mask, cookie):
+        if mask & inotify.IN_Q_OVERFLOW:
+            self.info("too many file changes at once, checking all files")
+            self._update(self.getFileData())
+            self._scheduleSettle()
+            return
+        if name is None:
+            if mask & DIRECTORY_GONE_MASK:
+                self.warning("watched directory %s is gone, polling for "
+                             "file changes", directory)
+                self._stopNotifying()
+                if self._delayedCall is not None:
+                    self._delayedCall.cancel()
+                self._poll()
+            return
+        if mask & inotify.IN_ISDIR:
+            return
+        f = self.getWatchedFile(directory, name)
+        if f is None:
+            return
+        if mask & GONE_MASK:
+            self._fileGone(f)
+        elif mask & WRITTEN_MASK:
+            self._fileWritten(f)
+        else:
+            self._fileChanging(f)
+
+    def _fileGone(self, f):
+        self._changingData.pop(f, None)
+        if f in self._stableData:
+            del self._stableData[f]
+            self.debug('file %s has been deleted', f)
+            self.event('fileDeleted', f)
+
+    def _fileWritten(self, f):
+        # The writer is done with the file, no need to wait for it
+        data = self.getFileDataFor(f)
+        if data is None:
+            self._fileGone(f)
+            return
+        self._changingData.pop(f, None)
+        if self._stableData.get(f, None) != data:
+            self.debug('file %s has been written', f)
+            self._stableData[f] = data
+            self.event('fileChanged', f)
+
+    def _fileChanging(self, f):
+        data = self.getFileDataFor(f)
+        if data is None:
+            # The deletion will be notified
+            return
+        if f not in self._changingData and \
+                self._stableData.get(f, None) == data:
+            return
+        self.log('change noted for %s', f)
+        self._changingData[f] = data
+        self._scheduleSettle()
+
+    def _scheduleSettle(self):
+        if self._changingData and self._delayedCall is None:
+            self._delayedCall = reactor.callLater(self.timeout, self._settle)
+
+    def _settle(self):
+        # Only the changing files are checked
+        self._delayedCall = None
+        changing = self._changingData
+        for f, old in changing.items():
+            data = self.getFileDataFor(f)
+            if data is None:
+                del changing[f]
+            elif data == old:
+                self.debug('change finished for %s', f)
+                del changing[f]
+                self._stableData[f] = data
+                self.event('fileChanged', f)
+            else:
+                self.log('change continues for %s', f)
+                changing[f] = data
+        self._scheduleSettle()
+
 
 class DirectoryWatcher(BaseWatcher):
     """
@@ -220,6 +385,14 @@ class DirectoryWatcher(BaseWatcher):
                 for f in os.listdir(self.path)
                 if f not in self._ignorefiles]
 
+    def getDirectoriesToWatch(self):
+        return [self.path]
+
+    def getWatchedFile(self, directory, name):
+        if name in self._ignorefiles:
+            return None
+        return os.path.join(self.path, name)
+
 
 class FilesWatcher(BaseWatcher):
     """
@@ -229,6 +402,19 @@ class FilesWatcher(BaseWatcher):
     def __init__(self, files, timeout=30):
         BaseWatcher.__init__(self, timeout)
         self._files = files
+        self._names = {} # (directory, name) -> filename
 
     def getFilesToStat(self):
         return self._files
+
+    def getDirectoriesToWatch(self):
+        # The directories are watched rather than the files, to notice
+        # files being replaced
+        self._names = {}
+        for f in self._files:
+            directory, name = os.path.split(os.path.abspath(f))
+            self._names[(directory, name)] = f
+        return python.set([directory for directory, _ in self._names])
+
+    def getWatchedFile(self, directory, name):
+        return self._names.get((directory, name), None)
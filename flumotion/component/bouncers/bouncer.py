@@ -89,6 +89,7 @@ import time
 from twisted.internet import defer, reactor
 
 from flumotion.common import interfaces, keycards, errors, python
+from flumotion.common.expiry import ExpiryQueue
 from flumotion.common.poller import Poller
 from flumotion.common.componentui import WorkerComponentUIState
 
@@ -98,6 +99,33 @@ from flumotion.twisted import flavors, credentials
 __all__ = ['Bouncer']
 __version__ = "$Rev$"
 
+
+def authenticateKeycards(bouncer, keycards):
+    """
+    Authenticate several keycards with the authenticate method of a bouncer
+    component or plug, logging the failures through it.
+
+    @type  keycards: list of L{flumotion.common.keycards.Keycard}
+
+    @returns: a deferred firing the list of the authenticated keycards,
+              or None for the refused ones, in the same order
+    """
+
+    def authenticated(results):
+        ret = []
+        for keycard, (success, result) in zip(keycards, results):
+            if not success:
+                bouncer.warning('failed to authenticate keycard %r: %s',
+                                keycard, result.getErrorMessage())
+                result = None
+            ret.append(result)
+        return ret
+
+    d = defer.DeferredList([defer.maybeDeferred(bouncer.authenticate, k)
+                            for k in keycards], consumeErrors=True)
+    d.addCallback(authenticated)
+    return d
+
 EXPIRE_BLOCK_SIZE = 100
 
 
@@ -113,6 +141,14 @@ class BouncerMedium(component.BaseComponentMedium):
         """
         return self.comp.authenticate(keycard)
 
+    def remote_authenticateMany(self, keycards):
+        """
+        Authenticates the given keycards.
+
+        @type  keycards: list of L{flumotion.common.keycards.Keycard}
+        """
+        return self.comp.authenticateMany(keycards)
+
     def remote_keepAlive(self, issuerName, ttl):
         """
         Resets the expiry timeout for keycards issued by issuerName.
@@ -172,6 +208,8 @@ class Bouncer(component.BaseComponent):
         self._idCounter = 0
         self._idFormat = time.strftime('%Y%m%d%H%M%S-%%d')
         self._keycards = {} # keycard id -> Keycard
+        # ids of the keycards with a ttl or an issuer, by expiry time
+        self._keycardExpiry = ExpiryQueue()
 
         self._expirer = Poller(self._expire,
                                self.KEYCARD_EXPIRE_INTERVAL,
@@ -234,6 +272,17 @@ class Bouncer(component.BaseComponent):
             self.debug("Bouncer disabled, refusing authentication")
             return None
 
+    def authenticateMany(self, keycards):
+        """
+        Authenticate several keycards in one call.
+
+        @type  keycards: list of L{flumotion.common.keycards.Keycard}
+
+        @returns: a deferred firing the list of the authenticated keycards,
+                  or None for the refused ones, in the same order
+        """
+        return authenticateKeycards(self, keycards)
+
     def do_expireKeycards(self, elapsed):
         """
         Override to expire keycards managed by sub-classes.
@@ -244,11 +293,8 @@ class Bouncer(component.BaseComponent):
                   the expirer poller MAY be stopped.
         @rtype: bool
         """
-        for k in self._keycards.values():
-            if hasattr(k, 'ttl'):
-                k.ttl -= elapsed
-                if k.ttl <= 0:
-                    self.expireKeycardId(k.id)
+        for keycardId in self._keycardExpiry.advance(elapsed):
+            self.expireKeycardId(keycardId)
         return len(self._keycards) > 0
 
     def do_validate(self, keycard):
@@ -348,6 +394,7 @@ class Bouncer(component.BaseComponent):
             raise KeyError
 
         del self._keycards[keycard.id]
+        self._keycardExpiry.discard(keycard.id)
         self.on_keycardRemoved(keycard)
 
         self.info("removed keycard with id %s" % keycard.id)
@@ -361,9 +408,15 @@ class Bouncer(component.BaseComponent):
         self.removeKeycard(keycard)
 
     def keepAlive(self, issuerName, ttl):
-        for k in self._keycards.itervalues():
-            if hasattr(k, 'issuerName') and k.issuerName == issuerName:
-                k.ttl = ttl
+        self._keycardExpiry.keepAlive(issuerName, ttl)
+
+    def getKeycardTTL(self, keycard):
+        """
+        @returns: the time left before the keycard expires, or None if
+                  it does not expire
+        @rtype:   float or None
+        """
+        return self._keycardExpiry.getTTL(keycard.id)
 
     def expireAllKeycards(self):
         return self.expireKeycardIds(self._keycards.keys())
@@ -420,6 +473,10 @@ class Bouncer(component.BaseComponent):
         Used by sub-class knowing what they do.
         """
         self._keycards[keycard.id] = keycard
+        ttl = getattr(keycard, 'ttl', None)
+        issuerName = getattr(keycard, 'issuerName', None)
+        if ttl is not None or issuerName is not None:
+            self._keycardExpiry.add(keycard.id, ttl, issuerName)
         self.on_keycardAdded(keycard)
 
         self.debug("added keycard with id %s, ttl %r", keycard.id,
@@ -440,11 +497,13 @@ class AuthSessionBouncer(Bouncer):
 
     def init(self):
         # Keycards pending to be authenticated
-        self._sessions = {} # keycard id -> (ttl, data)
+        self._sessions = {} # keycard id -> data
+        self._sessionExpiry = ExpiryQueue()
 
     def on_disabled(self):
         # Removing all pending authentication
         self._sessions.clear()
+        self._sessionExpiry = ExpiryQueue()
 
     def do_extractKeycardInfo(self, keycard, oldData):
         """
@@ -474,8 +533,7 @@ class AuthSessionBouncer(Bouncer):
                  associated with the specified keycard
         @rtype: flumotion.common.keycards.Keycard or None
         """
-        data = keycard.id and self._sessions.get(keycard.id, None)
-        return data and data[1]
+        return keycard.id and self._sessions.get(keycard.id, None)
 
     def startAuthSession(self, keycard):
         """
@@ -546,6 +604,7 @@ class AuthSessionBouncer(Bouncer):
         """
         keycard.state = keycards.REFUSED
         del self._sessions[keycard.id]
+        self._sessionExpiry.discard(keycard.id)
 
     def confirmAuthSession(self, keycard):
         """
@@ -573,6 +632,7 @@ class AuthSessionBouncer(Bouncer):
             return False
 
         del self._sessions[keycardId]
+        self._sessionExpiry.discard(keycardId)
 
         # Check if there already an authenticated keycard with the same id
         if keycardId in self._keycards:
@@ -596,19 +656,16 @@ class AuthSessionBouncer(Bouncer):
         Updates the authentication session data.
         Can be used bu subclasses to modify the data directly.
         """
-        ttl, _oldData = self._sessions.get(keycard.id, (None, None))
-        if ttl is None:
+        if keycard.id not in self._sessions:
             ttl = getattr(keycard, 'ttl', None)
-        self._sessions[keycard.id] = (ttl, data)
+            if ttl is not None:
+                self._sessionExpiry.add(keycard.id, ttl)
+        self._sessions[keycard.id] = data
 
     def do_expireKeycards(self, elapsed):
         cont = Bouncer.do_expireKeycards(self, elapsed)
-        for id, (ttl, data) in self._sessions.items():
-            if ttl is not None:
-                ttl -= elapsed
-                self._sessions[id] = (ttl, data)
-                if ttl <= 0:
-                    del self._sessions[id]
+        for keycardId in self._sessionExpiry.advance(elapsed):
+            del self._sessions[keycardId]
 
         return cont and len(self._sessions) > 0
 
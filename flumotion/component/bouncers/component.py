@@ -37,6 +37,14 @@ class BouncerMedium(component.BaseComponentMedium):
         """
         return self.comp.authenticate(keycard)
 
+    def remote_authenticateMany(self, keycards):
+        """
+        Authenticates the given keycards.
+
+        @type  keycards: list of L{flumotion.common.keycards.Keycard}
+        """
+        return self.comp.authenticateMany(keycards)
+
     def remote_keepAlive(self, issuerName, ttl):
         """
         Resets the expiry timeout for keycards issued by issuerName.
@@ -92,6 +100,9 @@ class Bouncer(component.BaseComponent):
     def authenticate(self, keycard):
         return self.plug.authenticate(keycard)
 
+    def authenticateMany(self, keycards):
+        return self.plug.authenticateMany(keycards)
+
     def setEnabled(self, enabled):
         self.plug.setEnabled(enabled)
 
@@ -106,3 +117,6 @@ class Bouncer(component.BaseComponent):
 
     def keepAlive(self, issuerName, ttl):
         self.plug.keepAlive(issuerName, ttl)
+
+    def getKeycardTTL(self, keycard):
+        return self.plug.getKeycardTTL(keycard)
@@ -89,7 +89,9 @@ import time
 from twisted.internet import defer, reactor
 
 from flumotion.common import keycards, common, errors, python
+from flumotion.common.expiry import ExpiryQueue
 from flumotion.common.poller import Poller
+from flumotion.component.bouncers import bouncer
 from flumotion.component.plugs import base as pbase
 from flumotion.twisted import credentials
 
@@ -126,6 +128,8 @@ class BouncerPlug(pbase.ComponentPlug, common.InitMixin):
         self._idCounter = 0
         self._idFormat = time.strftime('%Y%m%d%H%M%S-%%d')
         self._keycards = {} # keycard id -> Keycard
+        # ids of the keycards with a ttl or an issuer, by expiry time
+        self._keycardExpiry = ExpiryQueue()
 
         self._expirer = Poller(self._expire,
                                self.KEYCARD_EXPIRE_INTERVAL,
@@ -154,11 +158,8 @@ class BouncerPlug(pbase.ComponentPlug, common.InitMixin):
         self.setEnabled(False)
 
     def _expire(self):
-        for k in self._keycards.values():
-            if hasattr(k, 'ttl'):
-                k.ttl -= self._expirer.timeout
-                if k.ttl <= 0:
-                    self.expireKeycardId(k.id)
+        for keycardId in self._keycardExpiry.advance(self._expirer.timeout):
+            self.expireKeycardId(keycardId)
 
     def authenticate(self, keycard):
         if not self.typeAllowed(keycard):
@@ -174,6 +175,17 @@ class BouncerPlug(pbase.ComponentPlug, common.InitMixin):
             self.debug("Bouncer disabled, refusing authentication")
             return None
 
+    def authenticateMany(self, keycards):
+        """
+        Authenticate several keycards in one call.
+
+        @type  keycards: list of L{flumotion.common.keycards.Keycard}
+
+        @returns: a deferred firing the list of the authenticated keycards,
+                  or None for the refused ones, in the same order
+        """
+        return bouncer.authenticateKeycards(self, keycards)
+
     def do_authenticate(self, keycard):
         """
         Must be overridden by subclasses.
@@ -216,6 +228,10 @@ class BouncerPlug(pbase.ComponentPlug, common.InitMixin):
             return False
 
         self._keycards[keycard.id] = keycard
+        ttl = getattr(keycard, 'ttl', None)
+        issuerName = getattr(keycard, 'issuerName', None)
+        if ttl is not None or issuerName is not None:
+            self._keycardExpiry.add(keycard.id, ttl, issuerName)
 
         self.debug("added keycard with id %s" % keycard.id)
         return True
@@ -225,6 +241,7 @@ class BouncerPlug(pbase.ComponentPlug, common.InitMixin):
             raise KeyError
 
         del self._keycards[keycard.id]
+        self._keycardExpiry.discard(keycard.id)
 
         self.debug("removed keycard with id %s" % keycard.id)
 
@@ -237,9 +254,15 @@ class BouncerPlug(pbase.ComponentPlug, common.InitMixin):
         self.removeKeycard(keycard)
 
     def keepAlive(self, issuerName, ttl):
-        for k in self._keycards.itervalues():
-            if hasattr(k, 'issuerName') and k.issuerName == issuerName:
-                k.ttl = ttl
+        self._keycardExpiry.keepAlive(issuerName, ttl)
+
+    def getKeycardTTL(self, keycard):
+        """
+        @returns: the time left before the keycard expires, or None if
+                  it does not expire
+        @rtype:   float or None
+        """
+        return self._keycardExpiry.getTTL(keycard.id)
 
     def expireAllKeycards(self):
         return defer.DeferredList(
@@ -252,6 +275,7 @@ class BouncerPlug(pbase.ComponentPlug, common.InitMixin):
             raise KeyError
 
         keycard = self._keycards.pop(keycardId)
+        self._keycardExpiry.discard(keycardId)
 
         return self.medium.callRemote('expireKeycard',
                                       keycard.requesterId, keycard.id)
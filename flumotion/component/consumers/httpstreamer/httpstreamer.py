@@ -216,6 +216,13 @@ class HTTPMedium(feedcomponent.FeedComponentMedium):
         d = self.callRemote('authenticate', bouncerName, keycard)
         return d
 
+    def authenticateMany(self, bouncerName, keycards):
+        """
+        @rtype: L{twisted.internet.defer.Deferred} firing a list of keycards
+                or None.
+        """
+        return self.callRemote('authenticateMany', bouncerName, keycards)
+
     def keepAlive(self, bouncerName, issuerName, ttl):
         """
         @rtype: L{twisted.internet.defer.Deferred}
@@ -521,6 +528,16 @@ class MultifdSinkStreamer(feedcomponent.ParseLaunchComponent, Stats):
         if 'issuer-class' in properties:
             self.httpauth.setIssuerClass(properties['issuer-class'])
 
+        if 'keycard-cache-size' in properties:
+            self.httpauth.setKeycardCache(
+                properties['keycard-cache-size'],
+                properties.get('keycard-cache-ttl'))
+
+        if 'keycard-batch-window' in properties:
+            self.httpauth.setKeycardBatching(
+                properties['keycard-batch-window'],
+                properties.get('keycard-batch-size'))
+
         if 'duration' in properties:
             self.httpauth.setDefaultDuration(
                 float(properties['duration']))
@@ -708,6 +725,8 @@ class MultifdSinkStreamer(feedcomponent.ParseLaunchComponent, Stats):
 
         if self.httpauth:
             self.httpauth.stopKeepAlive()
+            self.httpauth.stopKeycardBatching()
+            self.httpauth.stopExpirations()
 
         if self._tport:
             self._tport.stopListening()
@@ -64,6 +64,113 @@ ERROR_TEMPLATE = """<!doctype html public "-//IETF//DTD HTML 2.0//EN">
 
 HTTP_SERVER = '%s/%s' % (HTTP_NAME, HTTP_VERSION)
 
+# headers in the cached template, in lower case
+TEMPLATE_HEADERS = ('server', 'date', 'connection', 'cache-control',
+                    'content-type')
+
+# seconds to wait for the headers to be written
+HEADER_WRITE_TIMEOUT = 10.0
+
+
+class _HeaderWriter(log.Loggable):
+    """
+    I write the HTTP headers of a request straight to its socket.
+
+    When the socket is full, I register as a pull producer on the
+    request's transport and have it wait for the socket to be writable;
+    the transport then resumes me to write the rest.
+    """
+
+    logCategory = 'httpstreamer'
+
+    def __init__(self, request, data):
+        self.request = request
+        self.data = data
+        self.deferred = defer.Deferred()
+        self._timeout = None
+        self._registered = False
+
+    def start(self):
+        """
+        @rtype:   L{twisted.internet.defer.Deferred} firing a boolean
+        @returns: whether the headers were completely written
+        """
+        if not self._write():
+            self._timeout = reactor.callLater(HEADER_WRITE_TIMEOUT,
+                                              self._timedOut)
+            self._registered = True
+            self.request.transport.registerProducer(self, False)
+        return self.deferred
+
+    ### IPullProducer methods
+
+    def resumeProducing(self):
+        # the client could have gone away, and the fd been reused
+        if self.request.transport.fileno() != self.request.fdIncoming:
+            self.info('[fd %5d] Client gone while writing header'
+                      % self.request.fdIncoming)
+            self._finish(False)
+        elif not self._write():
+            self.log('[fd %5d] socket full, %d bytes of header left',
+                     self.request.fdIncoming, len(self.data))
+            self.request.transport.startWriting()
+
+    def stopProducing(self):
+        self.info('[fd %5d] Client gone while writing header'
+                  % self.request.fdIncoming)
+        self._registered = False
+        self._finish(False)
+
+    ### private methods
+
+    def _write(self):
+        # returns False when the socket is full
+        fd = self.request.fdIncoming
+
+        ### FIXME: there's a window where Twisted could have removed the
+        # fd because the client disconnected.  Catch EBADF correctly here.
+        while self.data:
+            try:
+                written = os.write(fd, self.data)
+            except OSError, (no, s):
+                if no == errno.EINTR:
+                    continue
+                if no == errno.EAGAIN:
+                    return False
+                if no == errno.EBADF:
+                    self.info('[fd %5d] client gone before writing header'
+                              % fd)
+                elif no == errno.ECONNRESET:
+                    self.info('[fd %5d] client reset connection writing '
+                              'header' % fd)
+                else:
+                    self.info('[fd %5d] unhandled write error when writing '
+                              'header: %s' % (fd, s))
+                self._finish(False)
+                return True
+            self.data = self.data[written:]
+
+        # tell TwistedWeb we already wrote headers ourselves
+        self.request.startedWriting = True
+        self._finish(True)
+        return True
+
+    def _timedOut(self):
+        self._timeout = None
+        self.info('[fd %5d] timed out writing header'
+                  % self.request.fdIncoming)
+        self._finish(False)
+
+    def _finish(self, written):
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+        if self._registered:
+            self._registered = False
+            self.request.transport.stopWriting()
+            self.request.transport.unregisterProducer()
+        self.deferred.callback(written)
+
 ### the Twisted resource that handles the base URL
 
 
@@ -104,6 +211,9 @@ class HTTPStreamingResource(web_resource.Resource, log.Loggable):
 
         self.logfilter = None
 
+        self._template = None # (content type, (head, tail))
+        self._date = None # (seconds, date header)
+
         web_resource.Resource.__init__(self)
 
     def clientRemoved(self, sink, fd, reason, stats):
@@ -194,7 +304,11 @@ class HTTPStreamingResource(web_resource.Resource, log.Loggable):
         """
         Write out the HTTP headers for the incoming HTTP request.
 
-        @rtype:   boolean
+        Since the socket is non-blocking, the rest of the headers is
+        written when it becomes writable again, until they are completely
+        written, the client goes away or L{HEADER_WRITE_TIMEOUT} passes.
+
+        @rtype:   L{twisted.internet.defer.Deferred} firing a boolean
         @returns: whether or not the file descriptor can be used further.
         """
         fd = request.transport.fileno()
@@ -204,31 +318,40 @@ class HTTPStreamingResource(web_resource.Resource, log.Loggable):
         if fd == -1:
             self.info('[fd %5d] Client gone before writing header' % fdi)
             # FIXME: do this ? del request
-            return False
+            return defer.succeed(False)
         if fd != request.fdIncoming:
             self.warning('[fd %5d] does not match current fd %d' % (fdi, fd))
             # FIXME: do this ? del request
-            return False
-
-        content = self.streamer.get_content_type()
-        request.setHeader('Server', HTTP_SERVER)
-        request.setHeader('Date', http.datetimeToString())
-        request.setHeader('Connection', 'close')
-        request.setHeader('Cache-Control', 'no-cache')
-        request.setHeader('Cache-Control', 'private')
-        request.setHeader('Content-type', content)
+            return defer.succeed(False)
 
-        # Call request modifiers
-        for modifier in self.modifiers:
-            modifier.modify(request)
+        # Remember what Twisted already set, so we can tell which headers
+        # were set by the request modifiers
+        defaults = None
+        if self.modifiers:
+            defaults = dict(request.headers)
+            for modifier in self.modifiers:
+                modifier.modify(request)
 
         # Mimic Twisted as close as possible
-        headers = []
+        extra = []
+        overrides = {}
         for name, value in request.headers.items():
-            headers.append('%s: %s\r\n' % (name.capitalize(), value))
+            lname = name.lower()
+            if lname not in TEMPLATE_HEADERS:
+                extra.append('%s: %s\r\n' % (name.capitalize(), value))
+            elif defaults is not None and defaults.get(name) != value:
+                overrides[lname] = value
         for cookie in request.cookies:
-            headers.append('%s: %s\r\n' % ("Set-Cookie", cookie))
+            extra.append('%s: %s\r\n' % ("Set-Cookie", cookie))
 
+        content = self.streamer.get_content_type()
+        if overrides:
+            # A modifier changed one of our own headers, don't use the
+            # cached template
+            head, tail = self._buildTemplate(content, overrides)
+        else:
+            head, tail = self._getTemplate(content)
+        data = ''.join([head, self._getDate(), tail] + extra + ['\r\n'])
 
         # ASF needs a Pragma header for live broadcasts
         # Apparently ASF breaks on WMP port 80 if you use the pragma header
@@ -239,31 +362,40 @@ class HTTPStreamingResource(web_resource.Resource, log.Loggable):
         #]:
             #setHeader('Pragma', 'features=broadcast')
 
-        #self.debug('setting Content-type to %s' % mime)
-        ### FIXME: there's a window where Twisted could have removed the
-        # fd because the client disconnected.  Catch EBADF correctly here.
-        try:
-            # TODO: This is a non-blocking socket, we really should check
-            # return values here, or just let twisted handle all of this
-            # normally, and not hand off the fd until after twisted has
-            # finished writing the headers.
-            os.write(fd, 'HTTP/1.0 200 OK\r\n%s\r\n' % ''.join(headers))
-            # tell TwistedWeb we already wrote headers ourselves
-            request.startedWriting = True
-            return True
-        except OSError, (no, s):
-            if no == errno.EBADF:
-                self.info('[fd %5d] client gone before writing header' % fd)
-            elif no == errno.ECONNRESET:
-                self.info(
-                    '[fd %5d] client reset connection writing header' % fd)
+        return _HeaderWriter(request, data).start()
+
+    def _getTemplate(self, content):
+        # The headers only change when the caps, and so the content type,
+        # change; the request modifier plugs are fixed
+        if self._template is None or self._template[0] != content:
+            self.debug('building header template for %s', content)
+            self._template = (content, self._buildTemplate(content))
+        return self._template[1]
+
+    def _buildTemplate(self, content, overrides={}):
+        # Returns the response line and headers that come before and
+        # after the date
+        headers = [('Server', HTTP_SERVER),
+                   ('Date', None),
+                   ('Connection', 'close'),
+                   ('Cache-Control', 'private'),
+                   ('Content-type', content)]
+        lines = ['HTTP/1.0 200 OK\r\n']
+        for name, value in headers:
+            if value is None:
+                # the date is spliced in for every client
+                head = ''.join(lines) + 'Date: '
+                lines = ['\r\n']
             else:
-                self.info(
-                    '[fd %5d] unhandled write error when writing header: %s'
-                    % (fd, s))
-        # trigger cleanup of request
-        del request
-        return False
+                value = overrides.get(name.lower(), value)
+                lines.append('%s: %s\r\n' % (name.capitalize(), value))
+        return head, ''.join(lines)
+
+    def _getDate(self):
+        now = int(time.time())
+        if self._date is None or self._date[0] != now:
+            self._date = (now, http.datetimeToString(now))
+        return self._date[1]
 
     def isReady(self):
         if self.streamer.caps == None:
@@ -398,8 +530,8 @@ class HTTPStreamingResource(web_resource.Resource, log.Loggable):
             self._handleNewClient(request)
         elif request.method == 'HEAD':
             self.debug('handling HEAD request')
-            self._writeHeaders(request)
-            request.finish()
+            d = self._writeHeaders(request)
+            d.addCallback(lambda _: request.finish())
         else:
             raise AssertionError
 
@@ -464,8 +596,12 @@ class HTTPStreamingResource(web_resource.Resource, log.Loggable):
 
     def _handleNewClient(self, request):
         # everything fulfilled, serve to client
+        d = self._writeHeaders(request)
+        d.addCallback(self._headersWritten, request)
+
+    def _headersWritten(self, written, request):
         fdi = request.fdIncoming
-        if not self._writeHeaders(request):
+        if not written:
             self.debug("[fd %5d] not adding as a client" % fdi)
             return
         self._addClient(request)
@@ -476,7 +612,7 @@ class HTTPStreamingResource(web_resource.Resource, log.Loggable):
         # then we figured out that a new request is only a Reader, so we
         # remove the removedWriter - this is because we never write to the
         # socket through twisted, only with direct os.write() calls from
-        # _writeHeaders.
+        # _HeaderWriter.
 
         # see http://twistedmatrix.com/trac/ticket/1796 for a guarantee
         # that this is a supported way of stealing the socket
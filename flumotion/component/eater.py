@@ -49,6 +49,9 @@ class Eater:
         self.streamheaderBufferProbeHandler = None
         self.setPadMonitor(None)
         self.uiState = componentui.WorkerComponentUIState()
+        # connections and disconts change several keys at once, send
+        # them as one delta
+        self.uiState.setBatching()
         self.uiState.addKey('eater-alias')
         self.uiState.set('eater-alias', eaterAlias)
         self.uiState.addKey('eater-name')
@@ -116,6 +116,8 @@ class FeederClient:
 
     def __init__(self, clientId):
         self.uiState = componentui.WorkerComponentUIState()
+        # stats come in bursts of sets, send them as one delta
+        self.uiState.setBatching()
         self.uiState.addKey('client-id', clientId)
         self.fd = None
         self.uiState.addKey('fd', None)
@@ -20,11 +20,13 @@
 # Headers in this file shall remain intact.
 
 import errno
+import heapq
 import os
 import stat
 import tempfile
 import threading
 import time
+from collections import deque
 
 from twisted.internet import defer, reactor, abstract
 
@@ -41,6 +43,8 @@ from flumotion.component.misc.httpserver.fileprovider import NotFoundError
 SEEK_SET = 0 # os.SEEK_SET is not defined in python 2.4
 FILE_COPY_BUFFER_SIZE = abstract.FileDescriptor.bufferSize
 MAX_LOGNAME_SIZE = 30 # maximum number of characters to use for logging a path
+DEFAULT_COPY_THREADS = 2
+DEFAULT_COPY_BANDWIDTH = 0 # in KB/s, 0 means unlimited
 
 
 LOG_CATEGORY = "fileprovider-localcached"
@@ -85,9 +89,13 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
     the cache usage changed and keep an estimation
     of the cache usage for statistics.
 
-    I'm creating a unique thread to do the file copying block by block,
-    for all files to be copied to the cache.
-    Using a thread instead of a reactor.callLater 'loop' allow for
+    I'm using a small pool of threads to do the file copying block by
+    block, for all files to be copied to the cache. Only the sessions
+    with pending reads or copy work are given to the threads, and
+    the pending reads are served before the copies.
+    The copy bandwidth of each session can be limited so the copies
+    don't starve the reads serving the clients.
+    Using threads instead of a reactor.callLater 'loop' allow for
     higher copy throughput and do not slow down the mail loop when
     lots of files are copied at the same time.
     Simulations with real request logs show that using a thread
@@ -108,6 +116,9 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
         cleanupEnabled = props.get('cleanup-enabled')
         cleanupHighWatermark = props.get('cleanup-high-watermark')
         cleanupLowWatermark = props.get('cleanup-low-watermark')
+        copyThreads = props.get('copy-threads', DEFAULT_COPY_THREADS)
+        copyBandwidth = props.get('copy-bandwidth', DEFAULT_COPY_BANDWIDTH)
+        self.copyBandwidth = copyBandwidth * 1000 # in bytes per second
 
         self._sessions = {} # {CopySession: None}
         self._index = {} # {path: CopySession}
@@ -122,16 +133,15 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
 
         common.ensureDir(self._sourceDir, "source")
 
-        # Startup copy thread
-        self._thread = CopyThread(self)
+        self._scheduler = CopyScheduler(max(1, copyThreads))
 
     def start(self, component):
         d = self.cache.setUp()
-        d.addCallback(lambda x: self._thread.start())
+        d.addCallback(lambda x: self._scheduler.start())
         return d
 
     def stop(self, component):
-        self._thread.stop()
+        self._scheduler.stop()
         dl = []
         for s in self._index.values():
             d = s.close()
@@ -201,21 +211,20 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
         if session in self._sessions:
             return
         self._sessions[session] = None
-        self._activateCopyLoop()
+        self._scheduler.schedule(session)
 
     def disableSession(self, session):
         self.debug("Stopping Copy Session '%s' (%d)",
                    session.logName, len(self._sessions))
         if session in self._sessions:
             del self._sessions[session]
-        if not self._sessions:
-            self._disableCopyLoop()
 
-    def _activateCopyLoop(self):
-        self._thread.wakeup()
-
-    def _disableCopyLoop(self):
-        self._thread.sleep()
+    def scheduleSession(self, session, urgent=False):
+        """
+        Tells the copy threads a session has work to do.
+        Urgent work, like reads for clients, is done first.
+        """
+        self._scheduler.schedule(session, urgent)
 
 
 class LocalPath(localpath.LocalPath, log.Loggable):
@@ -250,44 +259,156 @@ class LocalPath(localpath.LocalPath, log.Loggable):
         except OSError, e:
             if e.errno != errno.ENOENT:
                 self.warning("Error deleting file: %s", str(e))
+        self.plug.cache.forgetCachedFile(cachePath)
+
+
+class CopyScheduler(log.Loggable):
+    """
+    I run the work of the copy sessions in a pool of threads.
 
+    Only the sessions scheduled because they have work to do are queued,
+    and a session is never run by more than one thread at a time because
+    file seeking/reading is not thread safe. Urgent sessions are queued
+    first. A session telling it has to wait before copying again is
+    kept aside until then without holding a thread.
 
-class CopyThread(threading.Thread, log.Loggable):
+    The sessions run their work with doWork(), which returns None when
+    they have nothing more to do, 0 to be queued again right away,
+    or the time in seconds to wait before being queued again.
+    """
 
     logCategory = LOG_CATEGORY
 
-    def __init__(self, plug):
-        threading.Thread.__init__(self)
-        self.plug = plug
-        self._running = True
-        self._event = threading.Event()
+    (IDLE,
+     QUEUED,
+     RUNNING,
+     DELAYED) = range(4)
 
-    def stop(self):
+    def __init__(self, threadCount=DEFAULT_COPY_THREADS):
+        self._threadCount = threadCount
+        self._threads = []
         self._running = False
-        self._event.set()
-        self.join()
+        self._cond = threading.Condition()
+        self._ready = deque() # (ticket, session) for the queued sessions
+        self._tickets = {} # {session: ticket} of the valid queue entries
+        self._lastTicket = 0
+        self._delayed = [] # Heap of (time, session) for delayed sessions
+        self._states = {} # {session: state} for the sessions not idle
+        self._delays = {} # {session: time} for the delayed sessions
+        self._again = {} # {session: urgent} scheduled while running
+
+    def start(self):
+        self._running = True
+        for i in range(self._threadCount):
+            thread = threading.Thread(target=self._run,
+                                      name="copy-thread-%d" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
 
-    def wakeup(self):
-        self._event.set()
+    def stop(self):
+        self._cond.acquire()
+        try:
+            self._running = False
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def schedule(self, session, urgent=False):
+        self._cond.acquire()
+        try:
+            state = self._states.get(session, self.IDLE)
+            if state == self.RUNNING:
+                # Queued again when the running thread is done with it
+                self._again[session] = (urgent or
+                                         self._again.get(session, False))
+                return
+            if state == self.QUEUED and not urgent:
+                return
+            # The previous queue entry of queued sessions and the heap
+            # entry of delayed sessions are ignored later
+            self._enqueue(session, urgent)
+        finally:
+            self._cond.release()
 
-    def sleep(self):
-        self._event.clear()
+    ## Private Methods ##
 
-    def run(self):
+    def _enqueue(self, session, urgent):
+        # Called with the lock held
+        self._delays.pop(session, None)
+        self._states[session] = self.QUEUED
+        self._lastTicket += 1
+        self._tickets[session] = self._lastTicket
+        if urgent:
+            self._ready.appendleft((self._lastTicket, session))
+        else:
+            self._ready.append((self._lastTicket, session))
+        self._cond.notify()
+
+    def _delay(self, session, delay):
+        # Called with the lock held
+        until = time.time() + delay
+        self._states[session] = self.DELAYED
+        self._delays[session] = until
+        heapq.heappush(self._delayed, (until, session))
+        # A waiting thread may have to wake up sooner
+        self._cond.notify()
+
+    def _next(self):
+        # Called with the lock held
         while self._running:
-            sessions = self.plug._sessions.keys()
-            for session in sessions:
-                try:
-                    session.doServe()
-                except Exception, e:
-                    log.warning("Error during async file serving: %s",
-                                log.getExceptionMessage(e))
-                try:
-                    session.doCopy()
-                except Exception, e:
-                    log.warning("Error during file copy: %s",
-                                log.getExceptionMessage(e))
-            self._event.wait()
+            now = time.time()
+            while self._delayed and self._delayed[0][0] <= now:
+                until, session = heapq.heappop(self._delayed)
+                if self._delays.get(session) == until:
+                    self._enqueue(session, False)
+            while self._ready:
+                ticket, session = self._ready.popleft()
+                if self._tickets.get(session) != ticket:
+                    # Queued again as urgent since then
+                    continue
+                del self._tickets[session]
+                self._states[session] = self.RUNNING
+                return session
+            timeout = None
+            if self._delayed:
+                timeout = self._delayed[0][0] - now
+            self._cond.wait(timeout)
+        return None
+
+    def _done(self, session, delay):
+        # Called with the lock held
+        urgent = self._again.pop(session, None)
+        if urgent is not None or delay == 0:
+            self._enqueue(session, bool(urgent))
+        elif delay:
+            self._delay(session, delay)
+        else:
+            del self._states[session]
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                session = self._next()
+            finally:
+                self._cond.release()
+            if session is None:
+                return
+            try:
+                delay = session.doWork()
+            except Exception, e:
+                self.warning("Error during copy session work: %s",
+                             log.getExceptionMessage(e))
+                delay = None
+            self._cond.acquire()
+            try:
+                self._done(session, delay)
+            finally:
+                self._cond.release()
 
 
 class CopySessionCancelled(Exception):
@@ -340,6 +461,8 @@ class CopySession(log.Loggable):
         self._refCount = 0
         self._copied = 0 # None when the file is fully copied
         self._correction = 0 # Used to take into account copies data for stats
+        self._bandwidth = plug.copyBandwidth # in bytes per second
+        self._copyStarted = None
         self._startCopyingDefer = self._startCopying()
 
     def outdate(self):
@@ -391,6 +514,7 @@ class CopySession(log.Loggable):
 
                 d.addCallback(updateStats)
                 self._pending.append((position, size, d))
+                self.plug.scheduleSession(self, urgent=True)
                 return d
             # Not copying, it's safe to read directly
             self._sourceFile.seek(position)
@@ -430,6 +554,29 @@ class CopySession(log.Loggable):
             d.addCallback(lambda _: self._close())
             return d
 
+    def doWork(self):
+        """
+        Serves the pending reads, then copies the next block if the
+        copy bandwidth allows it.
+        Called in a copy thread context.
+
+        @return: None if there is nothing more to do, 0 if there is more
+                 to copy, or the time in seconds to wait before copying
+        """
+        while self.doServe():
+            pass
+        if not self.copying:
+            return None
+        if self._bandwidth and not self._waitCancel:
+            # Copying more than allowed since the copy started
+            elapsed = time.time() - self._copyStarted
+            excess = self._copied - elapsed * self._bandwidth
+            if excess > 0:
+                return excess / self._bandwidth
+        if self.doCopy():
+            return 0
+        return None
+
     def doServe(self):
         if not (self.copying and self._pending):
             # Nothing to do anymore.
@@ -500,6 +647,8 @@ class CopySession(log.Loggable):
     def _cancelSession(self):#
         if not self._cancelled:
             self.log("Canceling copy session")
+            # The temporary file will not be cached anymore
+            self._releaseCacheSpace()
             # Not a valid copy session anymore
             self._cancelled = True
             # If there is no more than 1 client using the session,
@@ -551,6 +700,7 @@ class CopySession(log.Loggable):
         self.debug("Start caching '%s' [fd %d]",
                    self.sourcePath, self._sourceFile.fileno())
         # Activate the copy
+        self._copyStarted = time.time()
         self.copying = True
         self.plug.activateSession(self)
 
@@ -575,6 +725,8 @@ class CopySession(log.Loggable):
             # to let the copying thread terminate current operations.
             # The file close operation are deferred.
             self._waitCancel = (closeSource, closeTempWrite)
+            # The copy may be waiting for bandwidth
+            self.plug.scheduleSession(self, urgent=True)
             return
         # No pending copy, we can close the files
         if closeSource:
@@ -645,6 +797,12 @@ class CopySession(log.Loggable):
                 self.warning("Failed to rename temporary file: %s",
                              log.getExceptionMessage(e))
             self._cancelSession()
+        else:
+            if self._allocTag is not None:
+                # The allocated space now belongs to the cached file
+                self.plug.cache.registerCachedFile(self.cachePath,
+                                                   self._allocTag)
+                self._allocTag = None
         # Complete all pending source read operations with the temporary file.
         for position, size, d in self._pending:
             try:
@@ -745,6 +903,10 @@ class TempFileDelegate(log.Loggable):
         self._position += len(d)
         return d
 
+    def sendfile(self, fd, size, stats):
+        # the data is still being copied to the cache
+        return None
+
     def close(self):
         if self._session is not None:
             self._session.decRef()
@@ -794,6 +956,14 @@ class DirectFileDelegate(log.Loggable):
             cls = errnoLookup.get(e.errno, FileError)
             raise cls("Failed to read data from file: %s" % str(e))
 
+    def sendfile(self, fd, size, stats):
+        if fileprovider.sendfile is None:
+            return None
+        position = self.tell()
+        sent = fileprovider.sendfile(fd, self._file.fileno(), position, size)
+        self.seek(position + sent)
+        return sent
+
     def close(self):
         if self._file is not None:
             try:
@@ -813,6 +983,12 @@ class CachedFileDelegate(DirectFileDelegate):
         stats.onBytesRead(0, len(data), 0)
         return data
 
+    def sendfile(self, fd, size, stats):
+        sent = DirectFileDelegate.sendfile(self, fd, size, stats)
+        if sent:
+            stats.onBytesRead(0, sent, 0)
+        return sent
+
     def close(self):
         if self._file is not None:
             self.log("Closing cached file [fd %d]", self._file.fileno())
@@ -874,6 +1050,11 @@ class CachedFile(fileprovider.File, log.Loggable):
         except:
             return defer.fail()
 
+    def sendfile(self, fd, size):
+        if self._delegate is None:
+            raise FileClosedError("File closed")
+        return self._delegate.sendfile(fd, size, self.stats)
+
     def close(self):
         if self._delegate:
             self.stats.onClosed()
@@ -937,6 +1118,7 @@ class CachedFile(fileprovider.File, log.Loggable):
         self._closeSourceFile(sourceFile)
         # We have a valid cached file, just delegate to it.
         self.debug("Serving cached file '%s'", cachedPath)
+        self.plug.cache.touchCachedFile(cachedPath)
         delegate = CachedFileDelegate(self.plug, cachedPath,
                                       cachedFile, cachedInfo)
         self.stats.onStarted(delegate.size, cachestats.CACHE_HIT)
@@ -949,6 +1131,7 @@ class CachedFile(fileprovider.File, log.Loggable):
         except OSError, e:
             if e.errno != errno.ENOENT:
                 self.warning("Error deleting cached file: %s", str(e))
+        self.plug.cache.forgetCachedFile(cachePath)
 
     def _tryTempFile(self, sourcePath, sourceFile, sourceInfo):
         session = self.plug.getCopySession(sourcePath)
@@ -20,12 +20,13 @@
 # Headers in this file shall remain intact.
 
 import errno
+import heapq
 import os
 import tempfile
 import time
 import stat
 
-from twisted.internet import defer, threads, protocol, reactor, utils
+from twisted.internet import defer, threads, reactor
 
 from flumotion.common import log, common, python, format, errors
 
@@ -40,9 +41,115 @@ DEFAULT_CLEANUP_HIGH_WATERMARK = 1.0
 DEFAULT_CLEANUP_LOW_WATERMARK = 0.6
 ID_CACHE_MAX_SIZE = 1024
 TEMP_FILE_POSTFIX = ".tmp"
+INDEX_JOURNAL_POSTFIX = ".index"
+# Compact the journal when it holds that many times more records
+# than there are files in the cache
+INDEX_COMPACT_RATIO = 4
+INDEX_COMPACT_MIN_RECORDS = 4096
+# Do not record accesses to a file more often than that, in seconds
+INDEX_ACCESS_RESOLUTION = 60
+
+
+class CacheIndex(object):
+    """
+    I keep the size and the last access time of the files in the cache,
+    so the least recently accessed ones can be found without scanning
+    the cache directory.
+
+    The heap can hold outdated items, they are dropped when popped.
+
+    @ivar usage: the total size of the indexed files, in bytes
+    @type usage: int
+    """
+
+    def __init__(self):
+        self.usage = 0
+        self._entries = {} # {identifier: (size, atime)}
+        self._heap = [] # [(atime, identifier)]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, identifier):
+        return identifier in self._entries
+
+    def items(self):
+        """
+        @rtype: list of (str, (int, int))
+        """
+        return self._entries.items()
+
+    def add(self, identifier, size, atime):
+        self.remove(identifier)
+        self._entries[identifier] = (size, atime)
+        self.usage += size
+        self._push(identifier, atime)
+
+    def touch(self, identifier, atime, resolution=0):
+        """
+        Update the access time of a file.
+
+        @return: True if the access time changed, False if the file is
+                 not indexed or was accessed less than resolution
+                 seconds before
+        @rtype:  bool
+        """
+        entry = self._entries.get(identifier)
+        if entry is None:
+            return False
+        size, oldTime = entry
+        if atime - oldTime < resolution or atime <= oldTime:
+            return False
+        self._entries[identifier] = (size, atime)
+        self._push(identifier, atime)
+        return True
+
+    def remove(self, identifier):
+        """
+        @return: the size of the removed file or None if it wasn't indexed
+        @rtype:  int
+        """
+        entry = self._entries.pop(identifier, None)
+        if entry is None:
+            return None
+        self.usage -= entry[0]
+        return entry[0]
+
+    def popOldest(self):
+        """
+        Remove the least recently accessed file from the index.
+
+        @return: the identifier and the size of the file or None
+        @rtype:  (str, int)
+        """
+        while self._heap:
+            atime, identifier = heapq.heappop(self._heap)
+            entry = self._entries.get(identifier)
+            if entry is not None and entry[1] == atime:
+                del self._entries[identifier]
+                self.usage -= entry[0]
+                return identifier, entry[0]
+        return None
+
+    def _push(self, identifier, atime):
+        heapq.heappush(self._heap, (atime, identifier))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Too many outdated items, rebuild the heap from the entries
+            self._heap = [(a, i) for i, (s, a) in self._entries.iteritems()]
+            heapq.heapify(self._heap)
 
 
 class CacheManager(object, log.Loggable):
+    """
+    I manage the space used by the files of a cache directory.
+
+    The files are tracked in a L{CacheIndex} that is updated as files
+    are cached, accessed and removed, and written to a journal in the
+    cache directory so it can be rebuilt when starting up.
+    Only when there is no journal the cache directory is scanned.
+    Files added to or removed from the directory by other means
+    are not accounted for.
+    """
 
     logCategory = LOG_CATEGORY
 
@@ -85,11 +192,21 @@ class CacheManager(object, log.Loggable):
 
         self._cacheUsage = None
         self._cacheUsageLastUpdate = None
-        self._lastCacheTime = None
 
         self._cacheMaxUsage = self._cacheSize * highWatermark # in bytes
         self._cacheMinUsage = self._cacheSize * lowWatermark # in bytes
 
+        # Each cache realm has its own journal
+        journalName = "." + self.getIdentifier("") + INDEX_JOURNAL_POSTFIX
+        self._journalPath = os.path.join(self._cacheDir, journalName)
+        self._journal = None
+        self._journalRecords = 0
+        self._pendingRecords = None # Records written while compacting
+
+        self._index = None
+        self._indexWaiters = [] # Deferreds waiting for the index
+        self._reservedSize = 0 # Space allocated for files being cached
+
     def setUp(self):
         """
         Initialize the cache manager
@@ -140,87 +257,240 @@ class CacheManager(object, log.Loggable):
     def updateCacheUsageStatistics(self):
         self.stats.onEstimateCacheUsage(self._cacheUsage, self._cacheSize)
 
-    def _updateCacheUsage(self, usage):
-        self.log('Disk usage for path %r is %d bytes', self._cacheDir, usage)
-        self._cacheUsageLastUpdate = time.time()
-        self._cacheUsage = usage
+    def _updateCacheUsage(self):
+        self._cacheUsage = self._index.usage + self._reservedSize
         self.updateCacheUsageStatistics()
-        return usage
+        return self._cacheUsage
 
     def updateCacheUsage(self):
         """
         @return: a defered with the cache usage in bytes.
         @raise: OSError or FlumotionError
         """
+        if self._index is not None:
+            return defer.succeed(self._cacheUsage)
+
+        d = defer.Deferred()
+        self._indexWaiters.append(d)
+        if len(self._indexWaiters) == 1:
+            self.debug("Loading cache index for path %r", self._cacheDir)
+            dl = threads.deferToThread(self._readIndex)
+            dl.addCallbacks(self._gotIndex, self._readIndexFailed)
+        return d
 
-        # Only calculate cache usage if the cache directory
-        # modification time changed since the last time we looked at it.
+    def registerCachedFile(self, path, tag):
+        """
+        Add a file completed in the cache directory to the index,
+        the cache space allocated for it is released.
+
+        @param path: the path of the cached file
+        @type  path: str
+        @param tag:  the allocation tag of the file space
+        @type  tag:  tuple
+        """
+        self.releaseCacheSpace(tag)
+        if self._index is None:
+            return
+        ident = os.path.basename(path)
+        _, size = tag
+        atime = int(time.time())
+        self._index.add(ident, size, atime)
+        self._writeJournal("+ %s %d %d\n" % (ident, size, atime))
+        self._updateCacheUsage()
+
+    def touchCachedFile(self, path):
+        """
+        Update the access time of a cached file in the index.
+
+        @param path: the path of the cached file
+        @type  path: str
+        """
+        if self._index is None:
+            return
+        ident = os.path.basename(path)
+        atime = int(time.time())
+        if self._index.touch(ident, atime, INDEX_ACCESS_RESOLUTION):
+            self._writeJournal("* %s %d\n" % (ident, atime))
+
+    def forgetCachedFile(self, path):
+        """
+        Remove a file deleted from the cache directory from the index.
+
+        @param path: the path of the cached file
+        @type  path: str
+        """
+        if self._index is None:
+            return
+        ident = os.path.basename(path)
+        if self._index.remove(ident) is not None:
+            self._writeJournal("- %s\n" % (ident, ))
+            self._updateCacheUsage()
+
+    def _readIndex(self):
+        # Called in a thread
+        index = CacheIndex()
         try:
-            cacheTime = os.path.getmtime(self._cacheDir)
-        except OSError, e:
-            return defer.fail(e)
-
-        if ((self._cacheUsage is None) or (self._lastCacheTime < cacheTime)):
-            self._lastCacheTime = cacheTime
-            self.log('Getting disk usage for path %r', self._cacheDir)
-            d = utils.getProcessOutput('du', ['-bs', self._cacheDir])
-            d.addCallback(lambda o: int(o.split('\t', 1)[0]))
-            d.addCallback(self._updateCacheUsage)
-            return d
+            f = open(self._journalPath, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._scanCacheDir(index)
+            return index, None
+        try:
+            records = self._replayJournal(f, index)
+        finally:
+            f.close()
+        return index, records
+
+    def _replayJournal(self, f, index):
+        # Called in a thread
+        records = 0
+        for line in f:
+            records += 1
+            fields = line.split()
+            try:
+                if fields[0] == '+':
+                    index.add(fields[1], int(fields[2]), int(fields[3]))
+                elif fields[0] == '*':
+                    index.touch(fields[1], int(fields[2]))
+                elif fields[0] == '-':
+                    index.remove(fields[1])
+            except (IndexError, ValueError):
+                # The last record may have been truncated by a crash
+                continue
+        return records
+
+    def _scanCacheDir(self, index):
+        # Called in a thread
+        for name in os.listdir(self._cacheDir):
+            if name.startswith('.') or name.endswith(TEMP_FILE_POSTFIX):
+                continue
+            try:
+                info = os.stat(os.path.join(self._cacheDir, name))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            if stat.S_ISREG(info.st_mode):
+                index.add(name, info.st_size, int(info.st_atime))
+
+    def _gotIndex(self, result):
+        index, records = result
+        self.debug("Cache index for path %r holds %d files (%sbytes)",
+                   self._cacheDir, len(index),
+                   format.formatStorage(index.usage))
+        self._index = index
+        self._cacheUsageLastUpdate = time.time()
+        if records is None or self._shouldCompactJournal(records):
+            # Write a fresh journal with the current index
+            self._compactJournal()
         else:
-            return defer.succeed(self._cacheUsage)
+            self._journalRecords = records
+            self._openJournal()
+        usage = self._updateCacheUsage()
+        waiters, self._indexWaiters = self._indexWaiters, []
+        for d in waiters:
+            d.callback(usage)
+
+    def _readIndexFailed(self, failure):
+        self.warning("Failed to load cache index: %s",
+                     log.getFailureMessage(failure))
+        waiters, self._indexWaiters = self._indexWaiters, []
+        for d in waiters:
+            d.errback(failure)
+
+    def _shouldCompactJournal(self, records):
+        return records > max(INDEX_COMPACT_MIN_RECORDS,
+                             INDEX_COMPACT_RATIO * len(self._index))
+
+    def _openJournal(self):
+        try:
+            # Line buffered so records are not lost if we crash
+            self._journal = open(self._journalPath, 'ab', 1)
+        except IOError, e:
+            self.warning("Failed to open cache index journal: %s",
+                         log.getExceptionMessage(e))
+
+    def _writeJournal(self, record):
+        self._journalRecords += 1
+        if self._pendingRecords is not None:
+            self._pendingRecords.append(record)
+            return
+        if self._journal is None:
+            return
+        try:
+            self._journal.write(record)
+        except IOError, e:
+            self.warning("Failed to write cache index journal: %s",
+                         log.getExceptionMessage(e))
+        if self._shouldCompactJournal(self._journalRecords):
+            self._compactJournal()
+
+    def _compactJournal(self):
+        self.debug("Compacting cache index journal %r", self._journalPath)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self._pendingRecords = []
+        self._journalRecords = len(self._index)
+        d = threads.deferToThread(self._writeSnapshot, self._index.items())
+        d.addErrback(self._writeSnapshotFailed)
+        d.addCallback(self._snapshotWritten)
+
+    def _writeSnapshot(self, entries):
+        # Called in a thread
+        tempPath = self._journalPath + TEMP_FILE_POSTFIX
+        f = open(tempPath, 'wb')
+        try:
+            for ident, (size, atime) in entries:
+                f.write("+ %s %d %d\n" % (ident, size, atime))
+        finally:
+            f.close()
+        os.rename(tempPath, self._journalPath)
+
+    def _writeSnapshotFailed(self, failure):
+        self.warning("Failed to compact cache index journal: %s",
+                     log.getFailureMessage(failure))
+        # Keep using the old journal, and do not retry right away
+        self._journalRecords = 0
+
+    def _snapshotWritten(self, _):
+        records, self._pendingRecords = self._pendingRecords, None
+        self._openJournal()
+        if self._journal is None:
+            return
+        try:
+            self._journal.writelines(records)
+        except IOError, e:
+            self.warning("Failed to write cache index journal: %s",
+                         log.getExceptionMessage(e))
 
     def _rmfiles(self, files):
-        try:
-            for path in files:
+        for path in files:
+            try:
                 os.remove(path)
-        except OSError, e:
-            if e.errno != errno.ENOENT:
-                # TODO: is warning() thread safe?
-                self.warning("Error cleaning cached file: %s", str(e))
-
-    def _setCacheUsage(self, _, usage):
-        # Update the cache usage
-        self._cacheUsage = usage
-        self._cacheUsageLastUpdate = time.time()
-        return usage
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    # TODO: is warning() thread safe?
+                    self.warning("Error cleaning cached file: %s", str(e))
 
     def _cleanUp(self):
         # Update cleanup statistics
         self.stats.onCleanup()
-        # List the cached files with file state
-        try:
-            listdir = os.listdir(self._cacheDir)
-        except OSError, e:
-            return defer.fail(e)
-
-        files = []
-        for f in listdir:
-            f = os.path.join(self._cacheDir, f)
-            # There's a possibility of getting an error on os.stat here.
-            try:
-                files.append((f, os.stat(f)))
-            except OSError, e:
-                if e.errno == errno.ENOENT:
-                    pass
-                else:
-                    return defer.fail(e)
-
-        # Calculate the cached file total size
-        usage = sum([d[1].st_size for d in files])
-        # Delete the cached file starting by the oldest accessed ones
-        files.sort(key=lambda d: d[1].st_atime)
+        # Delete the cached files starting by the oldest accessed ones
         rmlist = []
-        for path, info in files:
-            usage -= info.st_size
-            rmlist.append(path)
-            if usage <= self._cacheMinUsage:
-                # We reach the cleanup limit
-                self.debug('cleaned up, cache use is now %sbytes',
-                    format.formatStorage(usage))
+        while self._index.usage > self._cacheMinUsage:
+            oldest = self._index.popOldest()
+            if oldest is None:
                 break
+            ident, _ = oldest
+            self._writeJournal("- %s\n" % (ident, ))
+            rmlist.append(os.path.join(self._cacheDir, ident))
+        usage = self._updateCacheUsage()
+        self.debug('cleaned up %d files, cache use is now %sbytes',
+                   len(rmlist), format.formatStorage(usage))
         d = threads.deferToThread(self._rmfiles, rmlist)
-        d.addBoth(self._setCacheUsage, usage)
+        d.addBoth(lambda _: self._cacheUsage)
         return d
 
     def _allocateCacheSpaceAfterCleanUp(self, usage, size):
@@ -233,14 +503,14 @@ class CacheManager(object, log.Loggable):
             return None
 
         # There is enough space to allocate, allocation succeed
-        self._cacheUsage += size
-        self.updateCacheUsageStatistics()
+        self._reservedSize += size
+        self._updateCacheUsage()
         return (self._cacheUsageLastUpdate, size)
 
     def _allocateCacheSpace(self, usage, size):
         if usage + size < self._cacheMaxUsage:
-            self._cacheUsage += size
-            self.updateCacheUsageStatistics()
+            self._reservedSize += size
+            self._updateCacheUsage()
             return defer.succeed((self._cacheUsageLastUpdate, size))
 
         self.debug('cache usage will be %sbytes, need more cache',
@@ -288,8 +558,8 @@ class CacheManager(object, log.Loggable):
         """
         lastUpdate, size = tag
         if lastUpdate == self._cacheUsageLastUpdate:
-            self._cacheUsage -= size
-            self.updateCacheUsageStatistics()
+            self._reservedSize -= size
+            self._updateCacheUsage()
 
     def openCacheFile(self, path):
         """
@@ -308,6 +578,7 @@ class CacheManager(object, log.Loggable):
         try:
             return TempFile(self, path, tag, size, mtime)
         except OSError, e:
+            self.releaseCacheSpace(tag)
             return None
 
     def newTempFile(self, path, size, mtime=None):
@@ -334,7 +605,9 @@ class CachedFile:
 
         cachemgr.log("Opened cached file %s [fd %d]",
                      cachedPath, file.fileno())
+        cachemgr.touchCachedFile(cachedPath)
 
+        self.cachemgr = cachemgr
         self.name = cachedPath
         self.file = file
         self.stat = stat
@@ -349,6 +622,7 @@ class CachedFile:
             if (s[stat.ST_MTIME] > self.stat[stat.ST_MTIME]):
                 return
             os.unlink(self.name)
+            self.cachemgr.forgetCachedFile(self.name)
         except OSError, e:
             pass
 
@@ -410,7 +684,7 @@ class TempFile:
                 os.utime(self.name, (atime, mtime))
         except OSError, e:
             if e.errno == errno.ENOENT:
-                self.cachemgr.releaseCacheSpace(self.tag)
+                self._releaseCacheSpace()
             else:
                 self.cachemgr.warning(
                     "Failed to update modification time of temporary "
@@ -427,7 +701,7 @@ class TempFile:
             if not self._completed:
                 self.cachemgr.log("Temporary file canceled '%s' [fd %d]",
                                   self.name, self.fileno())
-                self.cachemgr.releaseCacheSpace(self.tag)
+                self._releaseCacheSpace()
                 os.unlink(self.name)
         except OSError, e:
             pass
@@ -437,6 +711,13 @@ class TempFile:
         self.file = None
         self.cachemgr = None
 
+    def _releaseCacheSpace(self):
+        # The allocated space is released or handed over to the
+        # cached file only once
+        if self.tag is not None:
+            self.cachemgr.releaseCacheSpace(self.tag)
+            self.tag = None
+
     def write(self, str):
         """
         @raise: OSError
@@ -463,8 +744,7 @@ class TempFile:
             return
         self._completed = True
 
-        _, size = self.tag
-        if (self.tell() != size and checkSize):
+        if (self.tell() != self.size and checkSize):
             raise IOError("Did not reach end of file")
 
         self.cachemgr.log("Temporary file completed '%s' [fd %d]",
@@ -475,6 +755,7 @@ class TempFile:
                 if mtime > self.mtime:
                     self.cachemgr.log("Did not complete(), "
                                       "a more recent version exists already")
+                    self._releaseCacheSpace()
                     os.unlink(self.name)
                     self.name = self._finishPath
                     return
@@ -484,13 +765,14 @@ class TempFile:
         try:
             os.rename(self.name, self._finishPath)
         except OSError, e:
-            if e.errno == errno.ENOENT:
-                self.cachemgr.releaseCacheSpace(self.tag)
-                self.cachemgr.warning(
-                    "Failed to rename file '%s': %s" %
-                    (self.name, str(e)))
-                return
+            self._releaseCacheSpace()
+            self.cachemgr.warning(
+                "Failed to rename file '%s': %s" %
+                (self.name, str(e)))
+            return
 
+        self.cachemgr.registerCachedFile(self._finishPath, self.tag)
+        self.tag = None
         self.setModificationTime()
 
         self.name = self._finishPath
@@ -21,6 +21,15 @@
 
 from flumotion.component.plugs import base as plugbase
 
+# sendfile(2) is wrapped by python since 3.3, or by the pysendfile module
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
 
 class FileError(Exception):
     """
@@ -166,6 +175,24 @@ class File(object):
         @type:       L{defer.Deferred}
         """
 
+    def sendfile(self, fd, size):
+        """
+        Sends data from the current position straight to the given
+        file descriptor with sendfile(2), without copying it through
+        userspace, and moves the position past the sent data.
+
+        @param fd:   the file descriptor to send the data to
+        @type  fd:   int
+        @param size: the maximum amount of bytes to send
+        @type  size: int
+
+        @return:     the amount of bytes sent, or None if the file
+                     cannot be sent that way.
+        @rtype:      int
+        @raises OSError: if sendfile(2) failed, for example with EAGAIN
+                         if the descriptor is non-blocking and full
+        """
+
     def close(self):
         """
         Close and cleanup the file.
@@ -0,0 +1,51 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+
+class HitRatioMixin(object):
+    """
+    A mixin class counting how many lookups of a cache found what they
+    were looking for.
+
+    @ivar hits:     the number of lookups served from the cache
+    @type hits:     int
+    @ivar misses:   the number of lookups that were not
+    @type misses:   int
+    @ivar hitRatio: the share of the lookups served from the cache,
+                    between 0.0 and 1.0
+    @type hitRatio: float
+    """
+
+    hits = 0
+    misses = 0
+
+    def hit(self):
+        self.hits += 1
+
+    def miss(self):
+        self.misses += 1
+
+    def getHitRatio(self):
+        total = self.hits + self.misses
+        if total:
+            return float(self.hits) / total
+        return 0.0
+    hitRatio = property(getHitRatio)
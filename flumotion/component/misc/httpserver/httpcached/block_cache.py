@@ -0,0 +1,474 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import array
+import errno
+import os
+import threading
+
+from twisted.internet import defer, threads
+
+from flumotion.common import common, log, python
+
+from flumotion.component.misc.httpserver import fileprovider
+from flumotion.component.misc.httpserver.httpcached import strategy_base
+
+LOG_CATEGORY = "block-cache"
+
+BLOCK_SIZE = 64 * 1024
+BLOCKS_POSTFIX = ".blocks"
+BITMAP_POSTFIX = ".map"
+
+
+class BlockReadError(Exception):
+    """
+    Raised when cached blocks could not be read back.
+    """
+
+
+class SparseObject(log.Loggable):
+    """
+    I hold the blocks of a remote resource retrieved so far.
+
+    The blocks are written at their offset in a sparse file, and a bitmap
+    file tells which blocks are present. The bitmap file starts with
+    a header line with the resource size, modification time and block
+    size, so a partially retrieved resource can be used again after
+    a restart as long as it did not change.
+
+    The blocks are read and written in threads, several at a time.
+
+    @ivar fetching: the deferreds waiting for blocks being retrieved
+    @type fetching: dict of int -> list of L{defer.Deferred}
+    @ivar usage:    the amount of data present, in bytes
+    @type usage:    int
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, identifier, path, length, mtime, blockSize):
+        self.identifier = identifier
+        self.length = length
+        self.mtime = int(mtime)
+        self.blockSize = blockSize
+        self.blockCount = (length + blockSize - 1) // blockSize
+        self.usage = 0
+        self.fetching = {}
+
+        self._dataPath = path + BLOCKS_POSTFIX
+        self._mapPath = path + BITMAP_POSTFIX
+        self._header = "%d %d %d\n" % (length, self.mtime, blockSize)
+        self._bitmap = array.array('B', [0] * ((self.blockCount + 7) // 8))
+        self._lock = threading.Lock() # Protects the bitmap writes
+
+    def matches(self, length, mtime):
+        return self.length == length and self.mtime == int(mtime)
+
+    def create(self):
+        """
+        Creates empty data and bitmap files.
+        @raise: IOError or OSError
+        """
+        open(self._dataPath, "wb").close()
+        f = open(self._mapPath, "wb")
+        try:
+            f.write(self._header)
+            f.write(self._bitmap.tostring())
+        finally:
+            f.close()
+
+    def load(self):
+        """
+        Reads the bitmap file.
+        @return: True if the bitmap file was valid.
+        @raise: IOError
+        """
+        f = open(self._mapPath, "rb")
+        try:
+            header = f.readline()
+            bitmap = f.read()
+        finally:
+            f.close()
+        if header != self._header or len(bitmap) != len(self._bitmap):
+            return False
+        if not os.path.exists(self._dataPath):
+            return False
+        self._bitmap = array.array('B', bitmap)
+        self.usage = sum([self.getBlockLength(i)
+                          for i in xrange(self.blockCount)
+                          if self.hasBlock(i)])
+        return True
+
+    def remove(self):
+        for path in (self._mapPath, self._dataPath):
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    self.warning("Error removing %s: %s", path,
+                                 log.getExceptionMessage(e))
+
+    def getBlockLength(self, index):
+        return min(self.blockSize, self.length - index * self.blockSize)
+
+    def hasBlock(self, index):
+        return bool(self._bitmap[index >> 3] & (1 << (index & 7)))
+
+    def readBlock(self, index):
+        """
+        @raise: IOError
+        """
+        f = open(self._dataPath, "rb")
+        try:
+            f.seek(index * self.blockSize)
+            data = f.read(self.getBlockLength(index))
+        finally:
+            f.close()
+        if len(data) != self.getBlockLength(index):
+            raise IOError("Block %d of %s truncated"
+                          % (index, self._dataPath))
+        return data
+
+    def writeBlock(self, index, data):
+        """
+        Writes a block and marks it as present.
+        The data is written before the bitmap so a block is never
+        marked as present without its data.
+        The usage is not updated, see L{addUsage}.
+        @return: the amount of bytes added, 0 if the block was present
+        @raise: IOError
+        """
+        assert len(data) == self.getBlockLength(index), "Wrong block size"
+        if self.hasBlock(index):
+            return 0
+        f = open(self._dataPath, "r+b")
+        try:
+            f.seek(index * self.blockSize)
+            f.write(data)
+        finally:
+            f.close()
+        byte = index >> 3
+        self._lock.acquire()
+        try:
+            if self.hasBlock(index):
+                # Written by another thread in the mean time
+                return 0
+            self._bitmap[byte] |= 1 << (index & 7)
+            f = open(self._mapPath, "r+b")
+            try:
+                f.seek(len(self._header) + byte)
+                f.write(self._bitmap[byte:byte + 1].tostring())
+            finally:
+                f.close()
+        finally:
+            self._lock.release()
+        return len(data)
+
+    def addUsage(self, size):
+        """
+        Accounts for blocks written by L{writeBlock}.
+        Only called from the reactor thread, so the usage does not change
+        while the cache looks at it.
+        """
+        self.usage += size
+
+
+class BlockCache(log.Loggable):
+    """
+    Caches the parts of remote resources retrieved with range requests,
+    by blocks of fixed size.
+
+    Requested data is aligned on block boundaries. Present blocks
+    are read from disk, and missing blocks are retrieved by runs of
+    consecutive blocks. Blocks already being retrieved are not requested
+    again, so overlapping requests share the same upstream retrieval.
+
+    The objects not used for the longest time are removed when
+    the blocks use more than the maximum size.
+
+    @ivar usage: the amount of data cached, in bytes
+    @type usage: int
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, reqmgr, directory, maxSize, blockSize=BLOCK_SIZE):
+        """
+        @param reqmgr:    the request manager used to retrieve blocks
+        @type  reqmgr:    L{request_manager.RequestManager}
+        @param directory: the directory where the blocks are kept
+        @type  directory: str
+        @param maxSize:   the maximum amount of data cached, in bytes
+        @type  maxSize:   int
+        @param blockSize: the size of the blocks, in bytes
+        @type  blockSize: int
+        """
+        self.reqmgr = reqmgr
+        self.directory = directory
+        self.maxSize = maxSize
+        self.blockSize = blockSize
+        self.usage = 0
+
+        # {IDENTIFIER: SparseObject}, least recently used first
+        self._objects = python.OrderedDict()
+
+    def setup(self):
+        """
+        Loads the objects left in the directory.
+        @rtype: L{defer.Deferred}
+        """
+        common.ensureDir(self.directory, "block cache")
+        d = threads.deferToThread(self._loadObjects)
+        d.addCallbacks(self._gotObjects, self._loadObjectsFailed)
+        return d
+
+    def read(self, identifier, url, offset, size, length, mtime):
+        """
+        Reads data of a remote resource, retrieving the blocks
+        not yet cached.
+
+        @param identifier: the cache identifier of the resource
+        @type  identifier: str
+        @param length:     the size of the resource, in bytes
+        @type  length:     int
+        @param mtime:      the modification time of the resource
+        @type  mtime:      int
+        @rtype: L{defer.Deferred} firing the data
+        """
+        if offset >= length:
+            return defer.succeed("") # EOF
+
+        obj = self._getObject(identifier, length, mtime)
+        if obj is None:
+            requester = strategy_base.BlockRequester(self.reqmgr, url, mtime)
+            return requester.retrieve(offset, size)
+
+        end = min(offset + size, length)
+        first = offset // self.blockSize
+        last = (end - 1) // self.blockSize
+
+        defers = []
+        missing = []
+        for index in xrange(first, last + 1):
+            if obj.hasBlock(index):
+                d = threads.deferToThread(obj.readBlock, index)
+                d.addErrback(self._readFailed, obj, index, url)
+                defers.append(d)
+                continue
+            d = defer.Deferred()
+            if index not in obj.fetching:
+                obj.fetching[index] = []
+                missing.append(index)
+            obj.fetching[index].append(d)
+            defers.append(d)
+
+        for start, stop in self._getRuns(missing):
+            self._fetch(obj, url, start, stop)
+
+        d = defer.DeferredList(defers, fireOnOneErrback=True,
+                               consumeErrors=True)
+        d.addCallbacks(self._gotBlocks, self._blocksFailed,
+                       callbackArgs=(offset - first * self.blockSize,
+                                     end - offset),
+                       errbackArgs=(url, mtime, offset, size))
+        return d
+
+    def forget(self, identifier):
+        """
+        Removes the blocks of a resource, for example because it got
+        fully cached.
+        """
+        obj = self._objects.get(identifier, None)
+        if obj is not None:
+            self._forget(obj)
+
+    ### Private Methods ###
+
+    def _loadObjects(self):
+        # Called in a thread
+        objects = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(BITMAP_POSTFIX):
+                continue
+            identifier = name[:-len(BITMAP_POSTFIX)]
+            path = os.path.join(self.directory, identifier)
+            try:
+                f = open(path + BITMAP_POSTFIX, "rb")
+                try:
+                    length, mtime, blockSize = map(int, f.readline().split())
+                finally:
+                    f.close()
+                atime = os.stat(path + BITMAP_POSTFIX).st_mtime
+                obj = SparseObject(identifier, path, length, mtime,
+                                   self.blockSize)
+                valid = blockSize == self.blockSize and obj.load()
+            except (IOError, OSError, ValueError):
+                obj = SparseObject(identifier, path, 0, 0, self.blockSize)
+                valid = False
+            if not valid:
+                obj.remove()
+                continue
+            objects.append((atime, obj))
+        objects.sort()
+        return [obj for _atime, obj in objects]
+
+    def _gotObjects(self, objects):
+        for obj in objects:
+            self._objects[obj.identifier] = obj
+            self.usage += obj.usage
+        self.debug("Block cache %s holds %d objects (%d bytes)",
+                   self.directory, len(self._objects), self.usage)
+        self._enforceLimit()
+
+    def _loadObjectsFailed(self, failure):
+        self.warning("Error loading block cache %s: %s",
+                     self.directory, failure.getErrorMessage())
+
+    def _getObject(self, identifier, length, mtime):
+        obj = self._objects.get(identifier, None)
+        if obj is not None:
+            if obj.matches(length, mtime):
+                # move it to the most recently used end
+                del self._objects[identifier]
+                self._objects[identifier] = obj
+                return obj
+            self.debug("Resource %s changed, dropping its blocks",
+                       identifier)
+            self._forget(obj)
+
+        if mtime is None or length > self.maxSize:
+            return None
+
+        path = os.path.join(self.directory, identifier)
+        obj = SparseObject(identifier, path, length, mtime, self.blockSize)
+        try:
+            obj.create()
+        except (IOError, OSError), e:
+            self.warning("Error creating block cache files for %s: %s",
+                         identifier, log.getExceptionMessage(e))
+            obj.remove()
+            return None
+        self._objects[identifier] = obj
+        return obj
+
+    def _forget(self, obj):
+        if self._isCached(obj):
+            del self._objects[obj.identifier]
+            self.usage -= obj.usage
+            obj.remove()
+
+    def _getRuns(self, indexes):
+        runs = []
+        for index in indexes:
+            if runs and runs[-1][1] == index - 1:
+                runs[-1][1] = index
+            else:
+                runs.append([index, index])
+        return runs
+
+    def _fetch(self, obj, url, first, last):
+        offset = first * self.blockSize
+        size = min(obj.length, (last + 1) * self.blockSize) - offset
+        self.log("Retrieving blocks %d to %d of %s", first, last, url)
+        requester = strategy_base.BlockRequester(self.reqmgr, url, obj.mtime)
+        d = requester.retrieve(offset, size)
+        d.addCallbacks(self._fetchDone, self._fetchFailed,
+                       callbackArgs=(obj, first, last),
+                       errbackArgs=(obj, first, last))
+
+    def _fetchDone(self, data, obj, first, last):
+        blocks = []
+        for index in xrange(first, last + 1):
+            start = (index - first) * self.blockSize
+            blocks.append((index, data[start:start + self.blockSize]))
+        if not self._isCached(obj):
+            self._blocksFetched(0, obj, blocks)
+            return
+        d = threads.deferToThread(self._writeBlocks, obj, blocks)
+        d.addCallbacks(self._blocksFetched, self._writeFailed,
+                       callbackArgs=(obj, blocks),
+                       errbackArgs=(obj, blocks))
+
+    def _writeBlocks(self, obj, blocks):
+        # Called in a thread
+        written = 0
+        for index, block in blocks:
+            if len(block) == obj.getBlockLength(index):
+                written += obj.writeBlock(index, block)
+        return written
+
+    def _writeFailed(self, failure, obj, blocks):
+        failure.trap(IOError, OSError)
+        if self._isCached(obj):
+            self.warning("Error writing blocks of %s: %s",
+                         obj.identifier, failure.getErrorMessage())
+            self._forget(obj)
+        self._blocksFetched(0, obj, blocks)
+
+    def _blocksFetched(self, written, obj, blocks):
+        # The object may have been forgotten in the mean time
+        if self._isCached(obj):
+            obj.addUsage(written)
+            self.usage += written
+        # Readers may read again right away, so the limit is enforced
+        # before they get their blocks
+        self._enforceLimit()
+        for index, block in blocks:
+            for d in obj.fetching.pop(index, []):
+                d.callback(block)
+
+    def _fetchFailed(self, failure, obj, first, last):
+        if failure.check(fileprovider.FileOutOfDate):
+            self._forget(obj)
+        for index in xrange(first, last + 1):
+            for d in obj.fetching.pop(index, []):
+                d.errback(failure)
+
+    def _readFailed(self, failure, obj, index, url):
+        failure.trap(IOError)
+        self.warning("Error reading block %d of %s: %s",
+                     index, url, failure.getErrorMessage())
+        self._forget(obj)
+        raise BlockReadError(failure.getErrorMessage())
+
+    def _gotBlocks(self, results, start, size):
+        data = "".join([block for _success, block in results])
+        return data[start:start + size]
+
+    def _blocksFailed(self, failure, url, mtime, offset, size):
+        # Unwrap the first error of the DeferredList
+        failure = failure.value.subFailure
+        if not failure.check(BlockReadError):
+            return failure
+        # The cached blocks are not usable, retrieve the data instead
+        requester = strategy_base.BlockRequester(self.reqmgr, url, mtime)
+        return requester.retrieve(offset, size)
+
+    def _isCached(self, obj):
+        return self._objects.get(obj.identifier, None) is obj
+
+    def _enforceLimit(self):
+        # The most recently used object is never removed
+        while self.usage > self.maxSize and len(self._objects) > 1:
+            obj = self._objects.itervalues().next()
+            self.debug("Removing blocks of %s (%d bytes)",
+                       obj.identifier, obj.usage)
+            self._forget(obj)
@@ -63,9 +63,11 @@ class FileProviderHTTPCachedPlug(fileprovider.FileProviderPlug, log.Loggable):
         # Used for the UI to know which plug is used
         updater.update("provider-name", "fileprovider-httpcached")
         self._reader.stats.startUpdates(updater)
+        self._reader.selector.startUpdates(updater)
 
     def stopStatsUpdates(self):
         self._reader.stats.stopUpdates()
+        self._reader.selector.stopUpdates()
 
     def getRootPath(self):
         return VirtualPath(self, BASE_PATH)
@@ -19,12 +19,15 @@
 
 # Headers in this file shall remain intact.
 
+import os
+
 from twisted.internet import defer
 
 from flumotion.common import log
 from flumotion.component.misc.httpserver import cachemanager
 from flumotion.component.misc.httpserver import cachestats
 from flumotion.component.misc.httpserver import localpath
+from flumotion.component.misc.httpserver.httpcached import block_cache
 from flumotion.component.misc.httpserver.httpcached import http_client
 from flumotion.component.misc.httpserver.httpcached import http_utils
 from flumotion.component.misc.httpserver.httpcached import request_manager
@@ -43,6 +46,10 @@ DEFAULT_SERVER_PORT = 3128
 DEFAULT_PROXY_PRIORITY = 1
 DEFAULT_CONN_TIMEOUT = 2
 DEFAULT_IDLE_TIMEOUT = 5
+DEFAULT_KEEPALIVE_CONNECTIONS = http_client.DEFAULT_KEEPALIVE_CONNECTIONS
+DEFAULT_KEEPALIVE_TIMEOUT = http_client.DEFAULT_KEEPALIVE_TIMEOUT
+DEFAULT_MAX_CONNECTIONS = 0
+DEFAULT_BLOCK_CACHE_SIZE = 0 # in MB, disabled
 
 
 class FileReaderHTTPCachedPlug(log.Loggable):
@@ -53,6 +60,9 @@ class FileReaderHTTPCachedPlug(log.Loggable):
      - Load-balanced HTTP servers with priority level (fall-back).
      - More than one IP by server hostname with periodic DNS refresh.
      - Connection resuming if HTTP connection got disconnected.
+     - Persistent HTTP connections reused between requests.
+     - Block caching of partially retrieved streams, with overlapping
+       range requests sharing the same upstream retrieval.
     """
 
     logCategory = LOG_CATEGORY
@@ -119,14 +129,39 @@ class FileReaderHTTPCachedPlug(log.Loggable):
         connTimeout = props.get('connection-timeout', DEFAULT_CONN_TIMEOUT)
         idleTimeout = props.get('idle-timeout', DEFAULT_IDLE_TIMEOUT)
 
-        client = http_client.StreamRequester(connTimeout, idleTimeout)
+        keepAliveConnections = props.get('keep-alive-connections',
+                                         DEFAULT_KEEPALIVE_CONNECTIONS)
+        keepAliveTimeout = props.get('keep-alive-timeout',
+                                     DEFAULT_KEEPALIVE_TIMEOUT)
+        maxConnections = props.get('max-connections',
+                                   DEFAULT_MAX_CONNECTIONS)
+
+        client = http_client.StreamRequester(connTimeout, idleTimeout,
+                                             keepAliveConnections,
+                                             keepAliveTimeout,
+                                             maxConnections)
 
+        self._client = client
+        self.selector = selector
         reqmgr = request_manager.RequestManager(selector, client)
 
         cacheTTL = props.get('cache-ttl', DEFAULT_CACHE_TTL)
 
+        blockCacheSizeInMB = props.get('block-cache-size',
+                                       DEFAULT_BLOCK_CACHE_SIZE)
+        blockCache = None
+        if blockCacheSizeInMB > 0:
+            # Each cache realm has its own block directory
+            blockName = ("." + self.cachemgr.getIdentifier("")
+                         + block_cache.BLOCKS_POSTFIX)
+            blockDir = os.path.join(cacheDir or cachemanager.DEFAULT_CACHE_DIR,
+                                    blockName)
+            blockCache = block_cache.BlockCache(reqmgr, blockDir,
+                                                blockCacheSizeInMB * 10 ** 6)
+
         self.strategy = strategy_basic.CachingStrategy(self.cachemgr,
-                                                       reqmgr, cacheTTL)
+                                                       reqmgr, cacheTTL,
+                                                       blockCache)
 
         self.resmgr = resource_manager.ResourceManager(self.strategy,
                                                        self.stats)
@@ -142,6 +177,7 @@ class FileReaderHTTPCachedPlug(log.Loggable):
     def stop(self):
         d = defer.Deferred()
         d.addCallback(lambda _: self.strategy.cleanup())
+        d.addCallback(lambda _: self._client.cleanup())
         d.addCallback(lambda _: self) # Don't return internal references
         d.callback(None)
         return d
@@ -21,8 +21,9 @@
 
 import datetime
 import cgi
+import time
 
-from twisted.internet import defer, protocol, reactor
+from twisted.internet import defer, error, protocol, reactor
 from twisted.python.util import InsensitiveDict
 from twisted.web import http
 
@@ -36,6 +37,9 @@ LOG_CATEGORY = "stream-provider"
 
 USER_AGENT = "FlumotionClient/0.1"
 
+DEFAULT_KEEPALIVE_CONNECTIONS = 4
+DEFAULT_KEEPALIVE_TIMEOUT = 4
+
 
 def ts2str(ts):
     if ts:
@@ -98,14 +102,19 @@ class StreamInfo(object):
 
 class StreamRequester(log.Loggable):
     """
-    Allows retrieval of data streams using HTTP 1.0.
+    Allows retrieval of data streams using HTTP 1.1.
     """
 
     logCategory = LOG_CATEGORY
 
-    def __init__(self, connTimeout=0, idleTimeout=0):
+    def __init__(self, connTimeout=0, idleTimeout=0,
+                 keepAliveConnections=DEFAULT_KEEPALIVE_CONNECTIONS,
+                 keepAliveTimeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 maxConnections=0):
         self.connTimeout = connTimeout
         self.idleTimeout = idleTimeout
+        self.pool = ConnectionPool(keepAliveConnections, keepAliveTimeout,
+                                   maxConnections)
 
     def retrieve(self, consumer, url, proxyAddress=None, proxyPort=None,
                  ifModifiedSince=None, ifUnmodifiedSince=None,
@@ -122,18 +131,364 @@ class StreamRequester(log.Loggable):
 
         getter = StreamGetter(consumer, url,
                               ifModifiedSince, ifUnmodifiedSince,
-                              start, size, self.idleTimeout)
+                              start, size, self.idleTimeout, self.pool)
         getter.connect(proxyAddress, proxyPort, self.connTimeout)
         return getter
 
+    def cleanup(self):
+        """
+        Close all the connections, the requests still running fail.
+
+        @return: a deferred triggered when the connections are closed
+        """
+        return self.pool.shutdown()
+
+
+class ConnectionPool(log.Loggable):
+    """
+    Keeps the connections to the servers open after a response
+    has been fully received, so the following requests to the same
+    server do not have to wait for a new TCP connection.
+
+    It also limits the number of simultaneous connections to a server;
+    when the limit is reached, requests wait for a connection
+    to be released, for no longer than their connection timeout.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, maxIdle=DEFAULT_KEEPALIVE_CONNECTIONS,
+                 idleTimeout=DEFAULT_KEEPALIVE_TIMEOUT, maxConnections=0):
+        """
+        @param maxIdle:        the maximum number of idle connections
+                               to keep open by server, 0 disables
+                               keep-alive
+        @type  maxIdle:        int
+        @param idleTimeout:    the time in seconds after which an idle
+                               connection is closed
+        @type  idleTimeout:    int
+        @param maxConnections: the maximum number of connections by
+                               server, 0 for no limit
+        @type  maxConnections: int
+        """
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+        self.maxConnections = maxConnections
+        self._idle = {} # {(host, port): [HTTPConnection]}
+        self._counts = {} # {(host, port): open or opening connections}
+        # {(host, port): [(Deferred, timeout, DelayedCall or None)]}
+        self._waiting = {}
+        self._connections = set() # connected HTTPConnection instances
+        self._shutdown = False
+
+    def getConnection(self, host, port, timeout=0, reuse=True):
+        """
+        @param reuse: whether an idle connection can be used
+        @type  reuse: bool
+
+        @return: a deferred triggered with a connected L{HTTPConnection}
+        @rtype:  L{twisted.internet.defer.Deferred}
+        """
+        if self._shutdown:
+            return defer.fail(errors.FlumotionError(
+                "Connection pool shut down"))
+        key = (host, port)
+        idle = self._idle.get(key)
+        if reuse and idle:
+            # The most recently used connection is the least likely
+            # to have been closed by the server
+            connection = idle.pop()
+            if not idle:
+                del self._idle[key]
+            connection.cancelIdleTimeout()
+            connection.reused = True
+            self.log("Reusing connection %s to %s:%s",
+                     connection.logName, host, port)
+            return defer.succeed(connection)
+        count = self._counts.get(key, 0)
+        if self.maxConnections and count >= self.maxConnections:
+            self.log("Too many connections to %s:%s, waiting", host, port)
+            d = defer.Deferred()
+            call = None
+            if timeout:
+                call = reactor.callLater(timeout, self._waitTimedOut, key, d)
+            self._waiting.setdefault(key, []).append((d, timeout, call))
+            return d
+        return self._connect(key, timeout)
+
+    def releaseConnection(self, connection):
+        """
+        Give back a connection on which a response has been fully received.
+        """
+        if self._shutdown:
+            connection.transport.loseConnection()
+            return
+        key = connection.key
+        if key in self._waiting:
+            d, _ = self._popWaiting(key)
+            connection.reused = True
+            d.callback(connection)
+            return
+        idle = self._idle.setdefault(key, [])
+        if len(idle) >= self.maxIdle:
+            if not idle:
+                del self._idle[key]
+            connection.transport.loseConnection()
+            return
+        idle.append(connection)
+        connection.startIdleTimeout(self.idleTimeout)
+
+    def idleTimedOut(self, connection):
+        """
+        Called by an idle connection that is closing after its timeout,
+        so it is not given to a request in the meantime.
+        """
+        self._removeIdle(connection)
+
+    def connectionLost(self, connection):
+        self._connections.discard(connection)
+        self._removeIdle(connection)
+        self._connectionGone(connection.key)
+
+    def shutdown(self):
+        """
+        Close all the connections, idle or not, and fail the requests
+        waiting for one. The pool cannot be used anymore afterwards.
+
+        @return: a deferred triggered when the connections are closed
+        """
+        self._shutdown = True
+        waiting, self._waiting = self._waiting, {}
+        for requests in waiting.values():
+            for d, _, call in requests:
+                if call is not None:
+                    call.cancel()
+                d.errback(errors.FlumotionError("Connection pool shut down"))
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.cancelIdleTimeout()
+        return defer.DeferredList([c.close() for c in list(self._connections)])
+
+    ### Private Methods ###
+
+    def _removeIdle(self, connection):
+        key = connection.key
+        idle = self._idle.get(key)
+        if idle and connection in idle:
+            idle.remove(connection)
+            if not idle:
+                del self._idle[key]
+
+    def _connect(self, key, timeout):
+        host, port = key
+        self._counts[key] = self._counts.get(key, 0) + 1
+        creator = protocol.ClientCreator(reactor, HTTPConnection, self, key)
+        d = creator.connectTCP(host, port, timeout)
+        d.addCallbacks(self._connected, self._connectFailed,
+                       errbackArgs=(key, ))
+        return d
+
+    def _connected(self, connection):
+        if self._shutdown:
+            # Shut down while connecting
+            connection.transport.loseConnection()
+            raise errors.FlumotionError("Connection pool shut down")
+        self._connections.add(connection)
+        return connection
+
+    def _connectFailed(self, failure, key):
+        self._connectionGone(key)
+        return failure
+
+    def _connectionGone(self, key):
+        count = self._counts.get(key, 0) - 1
+        if count > 0:
+            self._counts[key] = count
+        else:
+            self._counts.pop(key, None)
+        if key in self._waiting:
+            d, timeout = self._popWaiting(key)
+            self._connect(key, timeout).chainDeferred(d)
+
+    def _popWaiting(self, key):
+        # returns the oldest waiting request and what is left
+        # of its timeout
+        waiting = self._waiting[key]
+        d, timeout, call = waiting.pop(0)
+        if not waiting:
+            del self._waiting[key]
+        if call is not None:
+            timeout = max(call.getTime() - time.time(), 0.001)
+            call.cancel()
+        return d, timeout
+
+    def _waitTimedOut(self, key, d):
+        waiting = self._waiting[key]
+        for entry in waiting:
+            if entry[0] is d:
+                waiting.remove(entry)
+                break
+        if not waiting:
+            del self._waiting[key]
+        host, port = key
+        self.debug("Timed out waiting for a connection to %s:%s",
+                   host, port)
+        d.errback(error.TimeoutError(
+            "waiting for a connection to %s:%s" % (host, port)))
+
+
+class HTTPConnection(http.HTTPClient, log.Loggable):
+    """
+    A connection to an HTTP server, used by one L{StreamGetter}
+    at a time to send a request and receive its response.
+
+    The connection is persistent unless the server said otherwise.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.getter = None
+        self.reused = False
+
+        self._persistent = True
+        self._inBody = False
+        self._idleTimeout = None
+        self._closed = None
+
+        self.logName = common.log_id(self) # To be able to track the instance
+
+    ### Public Methods ###
+
+    def startRequest(self, getter):
+        assert self.getter is None, "Connection already used"
+        self.getter = getter
+
+    def release(self):
+        """
+        Called by the getter when its response has been fully received.
+        """
+        self.getter = None
+        if self.paused:
+            self.resumeProducing()
+        if self._persistent and self.connected:
+            self.pool.releaseConnection(self)
+        else:
+            self.transport.loseConnection()
+
+    def abort(self):
+        """
+        Called by the getter to drop the connection.
+        """
+        self.getter = None
+        self._persistent = False
+        if self.connected:
+            self.transport.loseConnection()
+
+    def close(self):
+        """
+        @return: a deferred triggered when the connection is lost
+        """
+        if not self.connected:
+            return defer.succeed(None)
+        if self._closed is None:
+            self._closed = defer.Deferred()
+        self.transport.loseConnection()
+        return self._closed
+
+    def startIdleTimeout(self, timeout):
+        self.cancelIdleTimeout()
+        if timeout:
+            self._idleTimeout = reactor.callLater(timeout, self._onIdle)
+
+    def cancelIdleTimeout(self):
+        if self._idleTimeout is not None:
+            self._idleTimeout.cancel()
+            self._idleTimeout = None
+
+    ### Overridden Methods ###
+
+    def connectionLost(self, reason):
+        self.log("Connection to %s:%s lost", self.key[0], self.key[1])
+        self.connected = 0
+        self.cancelIdleTimeout()
+        self._persistent = False
+        getter, self.getter = self.getter, None
+        self.pool.connectionLost(self)
+        if getter is not None:
+            getter.connectionLost(reason)
+        if self._closed is not None:
+            d, self._closed = self._closed, None
+            d.callback(None)
+
+    def sendCommand(self, command, path):
+        # We want HTTP/1.1 for conditional GET and range requests
+        self.transport.write('%s %s HTTP/1.1\r\n' % (command, path))
+
+    def lineReceived(self, line):
+        http.HTTPClient.lineReceived(self, line)
+        if self._inBody and self.length == 0:
+            # There is no body, so no raw data will tell us it's the end
+            self.setLineMode()
+            self.handleResponseEnd()
+
+    def handleStatus(self, version, status, message):
+        if self.getter is None:
+            # Nobody asked for anything
+            self.abort()
+            return
+        self._persistent = (version == 'HTTP/1.1')
+        self.getter.handleStatus(version, status, message)
+
+    def handleHeader(self, key, val):
+        if key.lower() == 'connection':
+            tokens = [t.strip().lower() for t in val.split(',')]
+            if 'close' in tokens:
+                self._persistent = False
+            elif 'keep-alive' in tokens:
+                self._persistent = True
+        if self.getter is not None:
+            self.getter.handleHeader(key, val)
+
+    def handleEndHeaders(self):
+        self._inBody = True
+        if self.length is None:
+            # The end of the body is when the connection is closed
+            self._persistent = False
+        if self.getter is not None:
+            self.getter.handleEndHeaders()
+
+    def handleResponsePart(self, data):
+        if self.getter is not None:
+            self.getter.handleResponsePart(data)
+
+    def handleResponseEnd(self):
+        # Get ready for the next response
+        self._inBody = False
+        self.firstLine = True
+        self.length = None
+        if self.getter is not None:
+            self.getter.handleResponseEnd()
+
+    ### Private Methods ###
+
+    def _onIdle(self):
+        self._idleTimeout = None
+        self.log("Closing idle connection to %s:%s", self.key[0], self.key[1])
+        self.pool.idleTimedOut(self)
+        self.transport.loseConnection()
+
 
-class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
+class StreamGetter(log.Loggable):
     """
-    Retrieves a stream using HTTP 1.0.
+    Retrieves a stream using HTTP 1.1.
 
-    This class is at the same time a Factory and a Protocol,
-    this can be done because it's a client and in twisted
-    client factories only create on protocol.
+    The request is sent on a connection given by a L{ConnectionPool};
+    when the response has been fully received, the connection is
+    given back to the pool to be reused by another request.
 
     The outcome, the stream info and stream data is forwarded
     to a common.StreamConsumer instance given at creating time.
@@ -151,7 +506,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
 
     def __init__(self, consumer, url,
                  ifModifiedSince=None, ifUnmodifiedSince=None,
-                 start=None, size=None, timeout=0):
+                 start=None, size=None, timeout=0, pool=None):
         self.consumer = consumer
         self.url = url
 
@@ -161,14 +516,18 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         self.start = start
         self.size = size
         self.timeout = timeout
+        self.pool = pool or ConnectionPool(maxIdle=0)
 
         self.headers = {}
         self.peer = None
         self.status = None
         self.info = None
+        self.connection = None
 
         self._connected = False
         self._canceled = False
+        self._retried = False
+        self._connTimeout = 0
         self._remaining = None
         self._idlecheck = None
 
@@ -185,68 +544,51 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         url = self.url
         self.host = proxyAddress or url.hostname
         self.port = proxyPort or url.port
+        self._connTimeout = timeout
         if url.scheme != 'http':
             msg = "URL scheme %s not implemented" % url.scheme
             self._serverError(common.NOT_IMPLEMENTED, msg)
         else:
             self.log("Connecting to %s:%s for %s",
                      self.host, self.port, self.url)
-            reactor.connectTCP(self.host, self.port, self, timeout)
+            self._getConnection()
 
     def pause(self):
-        if not self.paused and self.transport is not None:
-            self.pauseProducing()
+        connection = self.connection
+        if connection is not None and not connection.paused:
+            connection.pauseProducing()
             self.log("Request paused for %s", self.url)
 
     def resume(self):
-        if self.paused and self.transport is not None:
-            self.resumeProducing()
+        connection = self.connection
+        if connection is not None and connection.paused:
+            connection.resumeProducing()
             self.log("Request resumed for %s", self.url)
 
     def cancel(self):
-        if self._connected and self.transport is not None:
-            self.transport.loseConnection()
+        if self.connection is not None:
+            self.connection.abort()
+            self.connection = None
         self._cancelIdleCheck()
         self.log("Request canceled for %s", self.url)
         self._canceled = True
 
-    ### Overridden Methods ###
-
-    def buildProtocol(self, addr):
-        assert self.peer is None, "Protocol already built"
-        self.peer = addr
-        return self
-
-    def clientConnectionFailed(self, connector, reason):
-        self._serverError(common.SERVER_UNAVAILABLE, reason.getErrorMessage())
-
-    def connectionMade(self):
-        self.log("Connection made for %s", self.url)
-        self.sendCommand(self.HTTP_METHOD, self.url.location)
-        self.sendHeader('Host', self.url.host)
-        self.sendHeader('User-Agent', USER_AGENT)
-        self.sendHeader('Connection', "close") # Pipeline not yet supported
-
-        if self.ifModifiedSince:
-            datestr = http.datetimeToString(self.ifModifiedSince)
-            self.sendHeader('If-Modified-Since', datestr)
-
-        if self.ifUnmodifiedSince:
-            datestr = http.datetimeToString(self.ifUnmodifiedSince)
-            self.sendHeader('If-Unmodified-Since', datestr)
-
-        if self.start or self.size:
-            start = self.start or 0
-            end = (self.size and (start + self.size - 1)) or None
-            rangeSpecs = "bytes=%s-%s" % (start, end or "")
-            self.sendHeader('Range', rangeSpecs)
-
-        self.endHeaders()
-
-        self._resetIdleCheck()
+    ### Connection Callbacks ###
 
     def connectionLost(self, reason):
         self.log("Connection lost for %s", self.url)
+        connection, self.connection = self.connection, None
+        if (connection is not None and connection.reused
+            and self.status is None and not self._retried
+            and not self._canceled and self.consumer):
+            # The server closed the kept-alive connection
+            # before receiving our request, try a new one
+            self.debug("Reused connection closed by the server, "
+                       "retrying with a new connection")
+            self._retried = True
+            self._cancelIdleCheck()
+            self._getConnection(reuse=False)
+            return
         self.handleResponseEnd()
         if not self._canceled:
             self._serverError(common.SERVER_DISCONNECTED,
@@ -321,12 +663,55 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         else:
             self.log("Incomplete request %s", self.url.toString())
 
-    def sendCommand(self, command, path):
-        # We want HTTP/1.1 for conditional GET and range requests
-        self.transport.write('%s %s HTTP/1.1\r\n' % (command, path))
-
     ### Private Methods ###
 
+    def _getConnection(self, reuse=True):
+        d = self.pool.getConnection(self.host, self.port,
+                                    self._connTimeout, reuse)
+        d.addCallbacks(self._gotConnection, self._connectionFailed)
+
+    def _gotConnection(self, connection):
+        if self._canceled or not self.consumer:
+            # Nobody wants it anymore, give it to someone else
+            connection.release()
+            return
+        self.log("Got connection %s for %s", connection.logName, self.url)
+        self.connection = connection
+        self.peer = connection.transport.getPeer()
+        connection.startRequest(self)
+        self._sendRequest(connection)
+
+    def _connectionFailed(self, failure):
+        self._serverError(common.SERVER_UNAVAILABLE,
+                          failure.getErrorMessage())
+
+    def _sendRequest(self, connection):
+        connection.sendCommand(self.HTTP_METHOD, self.url.location)
+        connection.sendHeader('Host', self.url.host)
+        connection.sendHeader('User-Agent', USER_AGENT)
+        if self.pool.maxIdle:
+            connection.sendHeader('Connection', "keep-alive")
+        else:
+            connection.sendHeader('Connection', "close")
+
+        if self.ifModifiedSince:
+            datestr = http.datetimeToString(self.ifModifiedSince)
+            connection.sendHeader('If-Modified-Since', datestr)
+
+        if self.ifUnmodifiedSince:
+            datestr = http.datetimeToString(self.ifUnmodifiedSince)
+            connection.sendHeader('If-Unmodified-Since', datestr)
+
+        if self.start or self.size:
+            start = self.start or 0
+            end = (self.size and (start + self.size - 1)) or None
+            rangeSpecs = "bytes=%s-%s" % (start, end or "")
+            connection.sendHeader('Range', rangeSpecs)
+
+        connection.endHeaders()
+
+        self._resetIdleCheck()
+
     def _keepActive(self):
         self._updateCount += 1
 
@@ -351,11 +736,16 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         self._idlecheck = None
         self._serverError(common.SERVER_TIMEOUT, "Server timeout")
 
-    def _cancel(self):
+    def _cancel(self, done=False):
         self._cancelIdleCheck()
         if self.consumer:
-            if self.transport:
-                self.transport.loseConnection()
+            connection, self.connection = self.connection, None
+            if connection is not None:
+                if done:
+                    # The response has been fully received
+                    connection.release()
+                else:
+                    connection.abort()
             self.consumer = None
 
     def _serverError(self, code, message):
@@ -382,9 +772,12 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
             self.consumer.onData(self, data)
 
     def _streamDone(self):
-        if self.consumer:
-            self.consumer.streamDone(self)
-            self._cancel()
+        consumer = self.consumer
+        if consumer:
+            # Give the connection back first, so that a request started
+            # by the consumer can reuse it
+            self._cancel(True)
+            consumer.streamDone(self)
 
 
 if __name__ == "__main__":
@@ -20,6 +20,8 @@
 # Headers in this file shall remain intact.
 
 
+import time
+
 from flumotion.common import log
 from flumotion.component.misc.httpserver.httpcached import common
 from flumotion.component.misc.httpserver.httpcached import http_utils
@@ -83,6 +85,7 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
         self.current_request = None
         self.last_error = None
         self.last_message = None
+        self._requestTime = None # None when the server has answered
 
         self.logName = common.log_id(self) # To be able to track the instance
 
@@ -112,6 +115,8 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
                            self.current_server.port)
             proxy_address = s.ip
             proxy_port = s.port
+            s.requestStarted()
+            self._requestTime = time.time()
             self.current_request =\
                 self.client.retrieve(self, self.url,
                                      proxyAddress=proxy_address,
@@ -139,24 +144,29 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
         self.debug("Canceling request %s", self.url)
         self.current_request.cancel()
         self.current_request = None
+        self._requestEnded()
 
     def serverError(self, getter, code, message):
         self.debug("Server Error %s (%s) for %s using %s:%s",
                    message, code, self.url, getter.host, getter.port)
         self.last_error = code
         self.last_message = message
+        if self.current_server is not None:
+            self.current_server.reportError(code)
+        self._requestEnded()
         if code in (common.SERVER_DISCONNECTED,
                     common.SERVER_TIMEOUT):
             # The connection was established
             # and data may have already been received.
             self.consumer.serverError(self, code, message)
             return
-        self.current_server.reportError(code)
         self.retrieve()
 
     def conditionFail(self, getter, code, message):
         if self.current_request is None:
             return
+        self._serverAnswered()
+        self._requestEnded()
         self.log("Condition Error %s (%s) for %s",
                  message, code, self.url)
         self.consumer.conditionFail(self, code, message)
@@ -164,12 +174,15 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
     def streamNotAvailable(self, getter, code, message):
         if self.current_request is None:
             return
+        self._serverAnswered()
+        self._requestEnded()
         self.log("Stream not available \"%s\" for %s", message, self.url)
         self.consumer.streamNotAvailable(self, code, message)
 
     def onInfo(self, getter, info):
         if self.current_request is None:
             return
+        self._serverAnswered()
         self.consumer.onInfo(self, info)
 
     def onData(self, getter, data):
@@ -180,4 +193,20 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
     def streamDone(self, getter):
         if self.current_request is None:
             return
+        self._requestEnded()
         self.consumer.streamDone(self)
+
+    ### Private Methods ###
+
+    def _serverAnswered(self):
+        # Give the selector feedback on how long the server took to answer
+        if self._requestTime is not None:
+            latency = time.time() - self._requestTime
+            self._requestTime = None
+            self.current_server.reportLatency(latency)
+
+    def _requestEnded(self):
+        if self.current_server is not None:
+            self.current_server.requestEnded()
+            self.current_server = None
+        self._requestTime = None
@@ -23,14 +23,30 @@
 import operator
 import random
 import socket
+import time
 
 from twisted.internet import base, defer, threads, reactor
 from twisted.python import threadpool
 from flumotion.common import log
+from flumotion.component.misc.httpserver.httpcached import common
 
 DEFAULT_PRIORITY = 1.0
 DEFAULT_REFRESH_TIMEOUT = 300
 
+# Weight of the last measure in the latency and error rate averages
+EWMA_WEIGHT = 0.2
+# A server is ejected after that many errors in a row
+EJECTION_ERRORS = 3
+# The time in seconds a server stays ejected the first time,
+# doubled each time the probe request fails
+EJECTION_TIME = 10
+MAX_EJECTION_TIME = 300
+# Errors telling about the health of a server
+HEALTH_ERRORS = (common.SERVER_UNAVAILABLE, common.SERVER_DISCONNECTED,
+                 common.SERVER_TIMEOUT, common.INTERNAL_ERROR)
+
+STATS_UPDATE_PERIOD = 10
+
 LOG_CATEGORY = "server-selector"
 
 
@@ -69,6 +85,8 @@ class ServerSelector(log.Loggable):
 
         self._resolver = ThreadedResolver(reactor, sk)
         self._refresh = None
+        self._updater = None
+        self._statsCall = None
 
     def _addCallback(self, h, hostname, port, priority):
         ip_list = h[2]
@@ -105,15 +123,66 @@ class ServerSelector(log.Loggable):
         """
         Order the looked up servers by priority, and return them.
 
+        Within a priority, an ejected server due for a probe comes
+        first, then the healthy servers are ordered by picking
+        the least loaded of two random ones.
+        The servers still ejected come last, as a last resort.
+
         @return a generator of Server
         """
+        now = time.time()
+        ejected = []
         priorities = self.servers.keys()
         priorities.sort()
         for p in priorities:
-            servers = self.servers[p]
-            random.shuffle(servers)
+            healthy = []
+            for s in self.servers[p]:
+                if not s.isEjected():
+                    healthy.append(s)
+                elif s.shouldProbe(now):
+                    self.debug("Probing ejected server %r", s)
+                    s.startProbe()
+                    yield s
+                else:
+                    ejected.append(s)
+            while healthy:
+                if len(healthy) == 1:
+                    yield healthy.pop()
+                    break
+                i, j = random.sample(xrange(len(healthy)), 2)
+                if healthy[j].getLoad() < healthy[i].getLoad():
+                    i = j
+                yield healthy.pop(i)
+        ejected.sort(key=lambda s: (s.priority, s.ejectedUntil))
+        for s in ejected:
+            yield s
+
+    def getStatistics(self):
+        """
+        @return: the statistics of each server
+        @rtype:  dict of str -> dict
+        """
+        stats = {}
+        for servers in self.servers.values():
             for s in servers:
-                yield s
+                stats["%s:%d" % (s.ip, s.port)] = s.getStatistics()
+        return stats
+
+    def startUpdates(self, updater):
+        self._updater = updater
+        if updater and (self._statsCall is None):
+            self._updateStatistics()
+
+    def stopUpdates(self):
+        self._updater = None
+        if self._statsCall is not None:
+            self._statsCall.cancel()
+            self._statsCall = None
+
+    def _updateStatistics(self):
+        self._updater.update("upstream-servers", self.getStatistics())
+        self._statsCall = reactor.callLater(STATS_UPDATE_PERIOD,
+                                            self._updateStatistics)
 
     def _refreshCallback(self, host, hostname):
         # FIXME: improve me, avoid data duplication, Server info loss..
@@ -161,17 +230,113 @@ class ServerSelector(log.Loggable):
 
 
 class Server(object):
+    """
+    An HTTP server, keeping track of how well it answers requests.
+
+    A server is ejected after EJECTION_ERRORS errors in a row;
+    once its ejection time is over, a single probe request is sent
+    to it and it is reinstated if that request succeeds.
+
+    @ivar outstanding: the number of requests being processed
+    @type outstanding: int
+    @ivar latency:     average time in seconds to get a response,
+                       None if unknown
+    @type latency:     float
+    @ivar errorRate:   average rate of requests failing, from 0.0 to 1.0
+    @type errorRate:   float
+    """
 
     def __init__(self, ip, port, priority):
         self.ip = ip
         self.port = port
         self.priority = priority
 
+        self.outstanding = 0
+        self.latency = None
+        self.errorRate = 0.0
+        self.requestCount = 0
+        self.errorCount = 0
+        self.ejectedUntil = None
+
+        self._errorsInRow = 0
+        self._ejectionTime = EJECTION_TIME
+        self._probing = False
+
+    def isEjected(self):
+        return self.ejectedUntil is not None
+
+    def shouldProbe(self, now=None):
+        if self.ejectedUntil is None or self._probing:
+            return False
+        return (now or time.time()) >= self.ejectedUntil
+
+    def startProbe(self):
+        self._probing = True
+
+    def getLoad(self):
+        """
+        @return: the expected time to get a response if a request
+                 was sent now; unknown latencies are zero so that
+                 new servers get requests
+        @rtype:  float
+        """
+        return (self.latency or 0.0) * (self.outstanding + 1)
+
+    def requestStarted(self):
+        self.outstanding += 1
+        self.requestCount += 1
+
+    def requestEnded(self):
+        self.outstanding -= 1
+        # A probe request canceled before any response can be retried
+        self._probing = False
+
+    def reportLatency(self, latency):
+        """
+        Report a response received after the given time in seconds.
+        """
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += EWMA_WEIGHT * (latency - self.latency)
+        self.errorRate -= EWMA_WEIGHT * self.errorRate
+        self._errorsInRow = 0
+        if self.ejectedUntil is not None:
+            self.ejectedUntil = None
+            self._ejectionTime = EJECTION_TIME
+        self._probing = False
+
     def reportError(self, code):
-        pass
+        if code not in HEALTH_ERRORS:
+            return
+        self.errorCount += 1
+        self.errorRate += EWMA_WEIGHT * (1.0 - self.errorRate)
+        self._errorsInRow += 1
+        if self._probing:
+            # Probe failed, stay away longer
+            self._probing = False
+            self._ejectionTime = min(self._ejectionTime * 2,
+                                     MAX_EJECTION_TIME)
+            self.ejectedUntil = time.time() + self._ejectionTime
+        elif (self.ejectedUntil is None
+              and self._errorsInRow >= EJECTION_ERRORS):
+            self.ejectedUntil = time.time() + self._ejectionTime
+
+    def getStatistics(self):
+        return {"priority": self.priority,
+                "outstanding": self.outstanding,
+                "latency": self.latency or 0.0,
+                "error-rate": self.errorRate,
+                "request-count": self.requestCount,
+                "error-count": self.errorCount,
+                "ejected": self.ejectedUntil is not None}
 
     def __repr__(self):
         return "<%s: %s:%d>" % (type(self).__name__, self.ip, self.port)
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return ((self.ip, self.port, self.priority)
+                == (other.ip, other.port, other.priority))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
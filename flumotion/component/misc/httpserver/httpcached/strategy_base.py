@@ -61,14 +61,18 @@ class CachingStrategy(log.Loggable):
 
     Handles the cache lookup, cache expiration checks,
     statistics gathering and caching sessions managment.
+
+    When a block cache is given, the data not yet cached
+    by the sessions is retrieved and kept by blocks.
     """
 
     logCategory = "base-caching"
 
-    def __init__(self, cachemgr, reqmgr, ttl):
+    def __init__(self, cachemgr, reqmgr, ttl, blockCache=None):
         self.cachemgr = cachemgr
         self.reqmgr = reqmgr
         self.ttl = ttl
+        self.blockCache = blockCache
 
         self._identifiers = {} # {IDENTIFIER: CachingSession}
         self._etimes = {} # {IDENTIFIER: EXPIRATION_TIME}
@@ -77,7 +81,10 @@ class CachingStrategy(log.Loggable):
 
     def setup(self):
         self._startCleanupLoop()
-        return self.reqmgr.setup()
+        d = defer.maybeDeferred(self.reqmgr.setup)
+        if self.blockCache is not None:
+            d.addCallback(lambda _: self.blockCache.setup())
+        return d
 
     def cleanup(self):
         self._stopCleanupLoop()
@@ -117,7 +124,12 @@ class CachingStrategy(log.Loggable):
 
         return d
 
-    def requestData(self, url, offset=None, size=None, mtime=None):
+    def requestData(self, url, offset=None, size=None, mtime=None,
+                    length=None):
+        if self.blockCache is not None and length is not None:
+            identifier = self.cachemgr.getIdentifier(url.path)
+            return self.blockCache.read(identifier, url, offset, size,
+                                        length, mtime)
         requester = BlockRequester(self.reqmgr, url, mtime)
         return requester.retrieve(offset, size)
 
@@ -171,6 +183,8 @@ class CachingStrategy(log.Loggable):
 
     def _onResourceCached(self, session):
         self.keepCacheAlive(session.identifier)
+        if self.blockCache is not None:
+            self.blockCache.forget(session.identifier)
         del self._identifiers[session.identifier]
 
     def _onResourceError(self, session, error):
@@ -263,7 +277,8 @@ class BaseRemoteSource(resource_manager.DataSource):
             self.session._correction -= diff
             self.stats.onBytesRead(0, size, diff) # from cache
             return data
-        d = self.strategy.requestData(self.url, offset, size, self.mtime)
+        d = self.strategy.requestData(self.url, offset, size, self.mtime,
+                                      self.size)
         d.addCallback(self._requestDataCb)
         d.addErrback(self._requestDataFailed)
         return d
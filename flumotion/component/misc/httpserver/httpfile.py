@@ -19,6 +19,7 @@
 
 # Headers in this file shall remain intact.
 
+import errno
 import string
 import time
 
@@ -49,6 +50,9 @@ __version__ = "$Rev$"
 
 LOG_CATEGORY = "httpserver"
 
+# maximum amount of bytes sent by each sendfile(2) call
+SENDFILE_SIZE = 1024 * 1024
+
 try:
     resource.ErrorPage
     errorpage = resource
@@ -107,7 +111,8 @@ class File(resource.Resource, log.Loggable):
                  mimeToResource=None,
                  rateController=None,
                  requestModifiers=None,
-                 metadataProvider=None):
+                 metadataProvider=None,
+                 seekIndexCache=None):
         resource.Resource.__init__(self)
 
         self._path = path
@@ -117,10 +122,12 @@ class File(resource.Resource, log.Loggable):
         self._rateController = rateController
         self._metadataProvider = metadataProvider
         self._requestModifiers = requestModifiers or []
+        self._seekIndexCache = seekIndexCache
         self._factory = MimedFileFactory(httpauth, self._mimeToResource,
                                          rateController=rateController,
                                          metadataProvider=metadataProvider,
-                                         requestModifiers=requestModifiers)
+                                         requestModifiers=requestModifiers,
+                                         seekIndexCache=seekIndexCache)
 
     def getChild(self, path, request):
         self.log('getChild: self %r, path %r', self, path)
@@ -392,10 +399,15 @@ class File(resource.Resource, log.Loggable):
             if header:
                 consumer.write(header)
 
+            # The file can be sent straight to the socket, unless the
+            # data is rate controlled or has a header
+            zeroCopy = (consumer is request and not header
+                        and getattr(request, 'zeroCopy', False))
+
             # Set the provider first, because for very small file
             # the transfer could terminate right away.
             request._provider = provider
-            transfer = FileTransfer(provider, last + 1, consumer)
+            transfer = FileTransfer(provider, last + 1, consumer, zeroCopy)
             request._transfer = transfer
 
             # The important NOT_DONE_YET was already returned by the render()
@@ -439,12 +451,14 @@ class MimedFileFactory(log.Loggable):
                  mimeToResource=None,
                  rateController=None,
                  requestModifiers=None,
-                 metadataProvider=None):
+                 metadataProvider=None,
+                 seekIndexCache=None):
         self._httpauth = httpauth
         self._mimeToResource = mimeToResource or {}
         self._rateController = rateController
         self._requestModifiers = requestModifiers
         self._metadataProvider = metadataProvider
+        self._seekIndexCache = seekIndexCache
 
     def create(self, path):
         """
@@ -458,7 +472,8 @@ class MimedFileFactory(log.Loggable):
                      mimeToResource=self._mimeToResource,
                      rateController=self._rateController,
                      requestModifiers=self._requestModifiers,
-                     metadataProvider=self._metadataProvider)
+                     metadataProvider=self._metadataProvider,
+                     seekIndexCache=self._seekIndexCache)
 
 
 class FLVFile(File):
@@ -505,6 +520,8 @@ class MP4File(File):
     seconds.  If it is non-zero, I will seek inside the file to the sample with
     that time, and prepend the content with rebuilt MP4 tables, to make the
     output playable.
+    If I have a seek index cache, the data read to find the MP4 tables
+    and the rebuilt tables for recent start times are kept in it.
     """
 
     def do_prepareBody(self, request, provider, first, last):
@@ -526,13 +543,11 @@ class MP4File(File):
 
             def seekAndSetContentLength(header_and_offset):
                 header, offset = header_and_offset
-                # the header is a file-like object with the file pointer at the
-                # end, the offset is a number
-                length = last - offset + 1 + header.tell()
+                # the header is a string, the offset is a number
+                length = last - offset + 1 + len(header)
                 provider.seek(offset)
                 request.setHeader("Content-Length", str(length))
-                header.seek(0)
-                return header.read()
+                return header
 
             def seekingFailed(failure):
                 # swallow the failure and serve the file from the beginning
@@ -550,16 +565,44 @@ class MP4File(File):
             return defer.succeed(ret)
 
     def _split_file(self, provider, start):
+        cache = self._seekIndexCache
+        key = None
+        if cache is not None:
+            key = (str(self._path), provider.getmtime(), provider.getsize())
+            result = cache.getSeekPoint(key, start)
+            if result is not None:
+                self.log('Using cached MP4 header for start %f', start)
+                return defer.succeed(result)
+
         d = defer.Deferred()
 
         def read_some_data(how_much, from_where):
             if how_much:
+                if key is not None:
+                    data = cache.getChunk(key, from_where, how_much)
+                    if data is not None:
+                        feed_d = defer.maybeDeferred(splitter.feed, data)
+                        feed_d.addErrback(d.errback)
+                        return
                 provider.seek(from_where)
                 read_d = provider.read(how_much)
+                if key is not None:
+                    read_d.addCallback(keep_data, from_where)
                 read_d.addCallback(splitter.feed)
                 read_d.addErrback(d.errback)
             else:
-                d.callback(splitter.result())
+                # the header is a file-like object with the file pointer
+                # at the end
+                header, offset = splitter.result()
+                header.seek(0)
+                header = header.read()
+                if key is not None:
+                    cache.addSeekPoint(key, start, header, offset)
+                d.callback((header, offset))
+
+        def keep_data(data, from_where):
+            cache.addChunk(key, from_where, data)
+            return data
 
         splitter = mp4seek.async.Splitter(start)
         splitter.start(read_some_data)
@@ -576,7 +619,7 @@ class FileTransfer(log.Loggable):
 
     consumer = None
 
-    def __init__(self, provider, size, consumer):
+    def __init__(self, provider, size, consumer, zeroCopy=False):
         """
         @param provider: an asynchronous file provider
         @type  provider: L{fileprovider.File}
@@ -584,6 +627,10 @@ class FileTransfer(log.Loggable):
         @type  size: int
         @param consumer: consumer to receive the data
         @type  consumer: L{twisted.internet.interfaces.IFinishableConsumer}
+        @param zeroCopy: whether to try to send the data with sendfile(2)
+                         straight to the consumer's transport; the consumer
+                         must then be a L{httpserver.CancellableRequest}
+        @type  zeroCopy: bool
         """
         self.provider = provider
         self.size = size
@@ -593,6 +640,8 @@ class FileTransfer(log.Loggable):
         self._pending = None
         self._again = False # True if resume was called while waiting for data
         self._finished = False # Set when we finish a transfer
+        self._zeroCopy = zeroCopy
+        self._flushed = False # Set when the response headers were written
         self.debug("Calling registerProducer on %r", consumer)
         consumer.registerProducer(self, 0)
 
@@ -613,6 +662,9 @@ class FileTransfer(log.Loggable):
         self._terminate()
 
     def _produce(self):
+        if self._zeroCopy:
+            self._sendfile()
+            return
         if self._pending:
             # We already are waiting for data, just remember more is needed
             self._again = True
@@ -671,6 +723,62 @@ class FileTransfer(log.Loggable):
                      self.provider, log.getFailureMessage(failure))
         self._terminate()
 
+    def _sendfile(self):
+        transport = self.consumer.transport
+        if not self._flushed:
+            # The headers have to go out through the transport first;
+            # writing nothing queues them, and we get resumed once the
+            # transport's buffer has been emptied.
+            self._flushed = True
+            self.consumer.write('')
+            transport.startWriting()
+            return
+
+        if self.provider.tell() == self.size:
+            self.debug('Sent entire file of %d bytes from %s',
+                       self.size, self.provider)
+            self._terminate()
+            return
+
+        try:
+            sent = self.provider.sendfile(transport.fileno(),
+                                          min(SENDFILE_SIZE,
+                                              self.size - self.written))
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                transport.startWriting()
+                return
+            self.warning('Failure during file %s sending: %s',
+                         self.provider, log.getExceptionMessage(e))
+            self._terminate()
+            return
+        except fileprovider.FileError, e:
+            self.warning('Failure during file %s sending: %s',
+                         self.provider, log.getExceptionMessage(e))
+            self._terminate()
+            return
+
+        if sent is None:
+            self.debug('Cannot send file %s with sendfile, copying it',
+                       self.provider)
+            self._zeroCopy = False
+            self._produce()
+            return
+
+        if not sent:
+            self.warning('File %s ended before sending the full %d bytes',
+                         self.provider, self.size)
+            self._terminate()
+            return
+
+        self.written += sent
+        self.bytesWritten += sent
+        self.consumer.wroteDirectly(sent)
+
+        # Nothing goes through the transport's buffer, so ask it to resume
+        # us when the socket can be written to again
+        transport.startWriting()
+
     def _writeToConsumer(self, data):
         self.written += len(data)
         self.bytesWritten += len(data)
@@ -33,8 +33,11 @@ from flumotion.common import log, messages, errors, netutils, interfaces
 from flumotion.common.i18n import N_, gettexter
 from flumotion.component import component
 from flumotion.component.base import http as httpbase
+from flumotion.component.base import timerwheel
 from flumotion.component.component import moods
 from flumotion.component.misc.httpserver import httpfile, localprovider
+from flumotion.component.misc.httpserver import fileprovider, memorycache
+from flumotion.component.misc.httpserver import mp4cache
 from flumotion.component.misc.httpserver import serverstats
 from flumotion.component.misc.porter import porterclient
 from flumotion.twisted import fdserver
@@ -44,6 +47,9 @@ T_ = gettexter()
 
 UPTIME_UPDATE_INTERVAL = 5
 
+# the memory in bytes used to keep the seek index of MP4 files
+DEFAULT_MP4_SEEK_CACHE_SIZE = 32 * 1024 * 1024
+
 FILEPROVIDER_SOCKET = 'flumotion.component.misc.httpserver' \
                       '.fileprovider.FileProviderPlug'
 
@@ -53,7 +59,6 @@ class CancellableRequest(server.Request):
     def __init__(self, channel, queued):
         server.Request.__init__(self, channel, queued)
         now = time.time()
-        self.lastTimeWritten = now # Used by HTTPFileStreamer for timeout
         # we index some things by the fd, so we need to store it so we
         # can still use it (in the connectionLost() handler and in
         # finish()) after transport's fd has been closed
@@ -69,6 +74,11 @@ class CancellableRequest(server.Request):
         self._resourceSize = None
         self._bytesWritten = 0L
 
+        # whether the file can be sent straight to the socket with
+        # sendfile(2), see httpfile.FileTransfer
+        self.zeroCopy = (fileprovider.sendfile is not None
+                         and not self.isSecure())
+
         # Create the request statistic handler
         self.stats = serverstats.RequestStatistics(self._component.stats)
 
@@ -83,10 +93,21 @@ class CancellableRequest(server.Request):
         server.Request.write(self, data)
         size = len(data)
         self._bytesWritten += size
-        self.lastTimeWritten = time.time()
+        self._component.requestActive(self)
         # Update statistics
         self.stats.onDataSent(size)
 
+    def wroteDirectly(self, size):
+        """
+        Account for data sent to the client straight from a file,
+        without going through write().
+        """
+        self.sentLength += size
+        self._bytesWritten += size
+        self._component.requestActive(self)
+        # Update statistics
+        self.stats.onDataSent(size, zeroCopy=True)
+
     def finish(self):
         # it can happen that this method will be called with the
         # transport's fd already closed (if the connection is lost
@@ -172,6 +193,13 @@ class HTTPFileMedium(component.BaseComponentMedium):
         """
         return self.callRemote('authenticate', bouncerName, keycard)
 
+    def authenticateMany(self, bouncerName, keycards):
+        """
+        @rtype: L{twisted.internet.defer.Deferred} firing a list of keycards
+                or None.
+        """
+        return self.callRemote('authenticateMany', bouncerName, keycards)
+
     def keepAlive(self, bouncerName, issuerName, ttl):
         """
         @rtype: L{twisted.internet.defer.Deferred}
@@ -219,6 +247,8 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.stats = None
         self._rateControlPlug = None
         self._fileProviderPlug = None
+        self._memoryCache = None
+        self._seekIndexCache = None
         self._metadataProviderPlug = None
         self._loggers = []
         self._requestModifiers = []
@@ -237,7 +267,7 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self._pbclient = None
 
         self._twistedPort = None
-        self._timeoutRequestsCallLater = None
+        self._timeouts = timerwheel.getTimerWheel()
 
         self._pendingDisconnects = {}
         self._rootResource = None
@@ -328,6 +358,12 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             self.httpauth.setBouncerName(props['bouncer'])
         if 'issuer-class' in props:
             self.httpauth.setIssuerClass(props['issuer-class'])
+        if 'keycard-cache-size' in props:
+            self.httpauth.setKeycardCache(props['keycard-cache-size'],
+                                          props.get('keycard-cache-ttl'))
+        if 'keycard-batch-window' in props:
+            self.httpauth.setKeycardBatching(props['keycard-batch-window'],
+                                             props.get('keycard-batch-size'))
         if 'ip-filter' in props:
             logFilter = http.LogFilter()
             for f in props['ip-filter']:
@@ -352,6 +388,20 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             self._fileProviderPlug = localprovider.FileProviderLocalPlug(
                 plugProps)
 
+        if props.get('memory-cache-size', 0) > 0:
+            self._memoryCache = memorycache.MemoryCache(
+                props['memory-cache-size'],
+                props.get('memory-cache-file-size', 64 * 1024),
+                props.get('memory-cache-revalidate', 10.0))
+
+        seekCacheSize = props.get('mp4-seek-cache-size',
+                                  DEFAULT_MP4_SEEK_CACHE_SIZE)
+        if seekCacheSize > 0:
+            self._seekIndexCache = mp4cache.SeekIndexCache(
+                seekCacheSize,
+                props.get('mp4-seek-cache-points',
+                          mp4cache.DEFAULT_SEEK_POINTS))
+
         socket = ('flumotion.component.misc.httpserver'
                  '.metadataprovider.MetadataProviderPlug')
         plugs = self.plugs.get(socket, [])
@@ -374,11 +424,10 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
                 "a resource or path property must be set")
 
         site = Site(root, self)
-        self._timeoutRequestsCallLater = reactor.callLater(
-            self.REQUEST_TIMEOUT, self._timeoutRequests)
 
         # Create statistics handler and start updating ui state
-        self.stats = serverstats.ServerStatistics()
+        self.stats = serverstats.ServerStatistics(self._memoryCache,
+                                                  self._seekIndexCache)
         updater = StatisticsUpdater(self.uiState, "request-statistics")
         self.stats.startUpdates(updater)
         updater = StatisticsUpdater(self.uiState, "provider-statistics")
@@ -441,12 +490,14 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             self._fileProviderPlug.stopStatsUpdates()
         if self.httpauth:
             self.httpauth.stopKeepAlive()
-        if self._timeoutRequestsCallLater:
-            self._timeoutRequestsCallLater.cancel()
-            self._timeoutRequestsCallLater = None
+            self.httpauth.stopKeycardBatching()
+            self.httpauth.stopExpirations()
         if self._uptimeCallId:
             self._uptimeCallId.cancel()
             self._uptimeCallId = None
+        # the timer wheel is shared by the whole process
+        for request in self._connected_clients.values():
+            self._timeouts.remove(request)
         if self._twistedPort:
             self._twistedPort.stopListening()
 
@@ -495,39 +546,30 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         reactor.connectWith(fdserver.FDConnector, self._porterPath,
                             self._pbclient, 10, checkPID=False)
 
-    def _timeoutRequests(self):
-        self._timeoutRequestsCallLater = None
-
-        now = time.time()
-        for request in self._connected_clients.values():
-            if now - request.lastTimeWritten > self.REQUEST_TIMEOUT:
-                self.debug("Timing out connection on request for [fd %5d]",
-                    request.fd)
-                # Apparently this is private API. However, calling
-                # loseConnection is not sufficient - it won't drop the
-                # connection until the send queue is empty, which might never
-                # happen for an uncooperative client
-                request.channel.transport.connectionLost(
-                    errors.TimeoutException())
-
-        # FIXME: ideally, we shouldn't create another callLater if the
-        # component is shutting down, to leave the environment clean
-        # and tidy (right now, let's hope the process will be stopped
-        # eventually anyway)
-        self._timeoutRequestsCallLater = reactor.callLater(
-            self.REQUEST_TIMEOUT, self._timeoutRequests)
+    def _timeoutRequest(self, request):
+        self.debug("Timing out connection on request for [fd %5d]",
+                   request.fd)
+        # Apparently this is private API. However, calling
+        # loseConnection is not sufficient - it won't drop the
+        # connection until the send queue is empty, which might never
+        # happen for an uncooperative client
+        request.channel.transport.connectionLost(
+            errors.TimeoutException())
 
     def _getDefaultRootResource(self):
         node = self._fileProviderPlug.getRootPath()
         if node is None:
             return None
+        if self._memoryCache:
+            node = memorycache.MemoryPath(self._memoryCache, node)
 
         self.debug('Starting with mount point "%s"' % self.mountPoint)
         factory = httpfile.MimedFileFactory(self.httpauth,
             mimeToResource=self._mimeToResource,
             rateController=self._rateControlPlug,
             requestModifiers=self._requestModifiers,
-            metadataProvider=self._metadataProviderPlug)
+            metadataProvider=self._metadataProviderPlug,
+            seekIndexCache=self._seekIndexCache)
 
         root = factory.create(node)
         if self.mountPoint != '/':
@@ -583,9 +625,18 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         # request does not yet have proto and uri
         fd = request.transport.fileno() # ugly!
         self._connected_clients[fd] = request
+        self._timeouts.add(request, self.REQUEST_TIMEOUT,
+                           self._timeoutRequest, request)
         self.debug("[fd %5d] (ts %f) request %r started",
                    fd, time.time(), request)
 
+    def requestActive(self, request):
+        """
+        Tells that data was sent to a client, so its request
+        doesn't time out for REQUEST_TIMEOUT seconds.
+        """
+        self._timeouts.touch(request, self.REQUEST_TIMEOUT)
+
     def requestFinished(self, request, bytesWritten, timeConnected, fd):
 
         # PROBE: finishing request; see httpstreamer.resources
@@ -607,6 +658,7 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             d = defer.succeed(None)
 
         del self._connected_clients[fd]
+        self._timeouts.remove(request)
 
         self._total_bytes_written += bytesWritten
 
@@ -151,6 +151,16 @@ class LocalFile(fileprovider.File, log.Loggable):
         except:
             return defer.fail()
 
+    def sendfile(self, fd, size):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        if fileprovider.sendfile is None:
+            return None
+        position = self.tell()
+        sent = fileprovider.sendfile(fd, self._file.fileno(), position, size)
+        self.seek(position + sent)
+        return sent
+
     def close(self):
         if self._file is not None:
             try:
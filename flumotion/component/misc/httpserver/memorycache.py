@@ -0,0 +1,269 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver_memorycache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import time
+
+from twisted.internet import defer
+
+from flumotion.common import log, python
+from flumotion.component.misc.httpserver import fileprovider
+from flumotion.component.misc.httpserver.fileprovider import FileClosedError
+from flumotion.component.misc.httpserver.hitratio import HitRatioMixin
+
+LOG_CATEGORY = "memory-cache"
+
+
+class MemoryCache(log.Loggable, HitRatioMixin):
+    """
+    I keep the content of small files in memory, so that popular files
+    can be served without opening them through the file provider.
+
+    I hold at most maxSize bytes of file data, dropping the least
+    recently used files first. A file is checked against the provider's
+    modification time when it was last checked more than revalidate
+    seconds ago. A file served from memory counts as a hit, one that has
+    to be read or checked as a miss.
+
+    @ivar usage:  the amount of file data in memory, in bytes
+    @type usage:  int
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, maxSize, maxFileSize, revalidate):
+        """
+        @param maxSize:     the maximum amount of file data to keep, in bytes
+        @type  maxSize:     int
+        @param maxFileSize: the size in bytes of the biggest file to keep
+        @type  maxFileSize: int
+        @param revalidate:  the time in seconds after which a file is
+                            checked for modifications again
+        @type  revalidate:  float
+        """
+        self.maxSize = maxSize
+        self.maxFileSize = min(maxFileSize, maxSize)
+        self.revalidate = revalidate
+        self.usage = 0
+        # key -> CacheEntry, least recently used first
+        self._entries = python.OrderedDict()
+
+    def get(self, key):
+        """
+        @returns: the entry cached with the given key, or None
+        @rtype:   L{CacheEntry}
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            # move it to the most recently used end
+            self._entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        """
+        Keep the given entry, dropping the least recently used ones if
+        needed to stay in the memory budget.
+
+        @type entry: L{CacheEntry}
+        """
+        self.remove(key)
+        if entry.size > self.maxFileSize:
+            return
+        self._entries[key] = entry
+        self.usage += entry.size
+        while self.usage > self.maxSize:
+            oldKey, oldEntry = self._entries.popitem(last=False)
+            self.log("Dropping %r from memory", oldKey)
+            self.usage -= oldEntry.size
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.usage -= entry.size
+
+    def isFresh(self, entry):
+        return time.time() - entry.checked < self.revalidate
+
+
+class CacheEntry(object):
+    """
+    I hold the content of a file kept in memory.
+    """
+
+    __slots__ = ('data', 'mtime', 'size', 'checked')
+
+    def __init__(self, data, mtime):
+        self.data = data
+        self.mtime = mtime
+        self.size = len(data)
+        self.checked = time.time()
+
+
+class MemoryPath(fileprovider.FilePath, log.Loggable):
+    """
+    I wrap a file provider's FilePath, opening the files that fit in the
+    memory cache from memory.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, cache, path, key=()):
+        """
+        @type cache: L{MemoryCache}
+        @type path:  L{fileprovider.FilePath}
+        @param key:  the names of the children leading from the root path
+        @type  key:  tuple of str
+        """
+        self._cache = cache
+        self._path = path
+        self._key = key
+
+    def __str__(self):
+        return str(self._path)
+
+    def getMimeType(self):
+        return self._path.mimeType
+    mimeType = property(getMimeType)
+
+    def child(self, name):
+        return MemoryPath(self._cache, self._path.child(name),
+                          self._key + (name, ))
+
+    def open(self):
+        entry = self._cache.get(self._key)
+        if entry is not None and self._cache.isFresh(entry):
+            self._cache.hit()
+            return MemoryFile(entry, self.mimeType)
+        self._cache.miss()
+
+        d = defer.maybeDeferred(self._path.open)
+        d.addCallbacks(self._gotFile, self._openFailed,
+                       callbackArgs=(entry, ))
+        return d
+
+    def _openFailed(self, failure):
+        self._cache.remove(self._key)
+        return failure
+
+    def _gotFile(self, f, entry):
+        mtime = f.getmtime()
+        if entry is not None and entry.mtime == mtime:
+            self.log("%s did not change", self)
+            entry.checked = time.time()
+            f.close()
+            return MemoryFile(entry, self.mimeType, f)
+
+        self._cache.remove(self._key)
+        size = f.getsize()
+        if size > self._cache.maxFileSize:
+            return f
+
+        d = self._readAll(f, size)
+
+        def gotData(data):
+            f.close()
+            entry = CacheEntry(data, mtime)
+            self.debug("Keeping %s in memory (%d bytes)", self, entry.size)
+            self._cache.put(self._key, entry)
+            return MemoryFile(entry, self.mimeType, f)
+
+        def readFailed(failure):
+            f.close()
+            return failure
+
+        d.addCallbacks(gotData, readFailed)
+        return d
+
+    def _readAll(self, f, size):
+        # providers can return less data than asked for
+        chunks = []
+
+        def gotData(data):
+            chunks.append(data)
+            remaining = size - f.tell()
+            if data and remaining > 0:
+                return f.read(remaining).addCallback(gotData)
+            return ''.join(chunks)
+
+        f.seek(0)
+        return f.read(size).addCallback(gotData)
+
+
+class MemoryFile(fileprovider.File):
+    """
+    I serve the content of a file kept in memory.
+    """
+
+    # Overriding parent class properties to become attribute
+    mimeType = None
+
+    def __init__(self, entry, mimeType, source=None):
+        """
+        @param source: the file the content was read or checked from,
+                       already closed, or None if it was served from
+                       memory without opening it
+        @type  source: L{fileprovider.File}
+        """
+        self._entry = entry
+        self._source = source
+        self._position = 0
+        self.mimeType = mimeType
+
+    def __str__(self):
+        return "<MemoryFile %d bytes>" % (self._entry.size, )
+
+    def getmtime(self):
+        if self._entry is None:
+            raise FileClosedError("File closed")
+        return self._entry.mtime
+
+    def getsize(self):
+        if self._entry is None:
+            raise FileClosedError("File closed")
+        return self._entry.size
+
+    def tell(self):
+        if self._entry is None:
+            raise FileClosedError("File closed")
+        return self._position
+
+    def seek(self, offset):
+        if self._entry is None:
+            raise FileClosedError("File closed")
+        self._position = offset
+
+    def read(self, size):
+        if self._entry is None:
+            raise FileClosedError("File closed")
+        data = self._entry.data[self._position:self._position + size]
+        self._position += len(data)
+        return defer.succeed(data)
+
+    def sendfile(self, fd, size):
+        # the data is not in a file anymore
+        return None
+
+    def close(self):
+        self._entry = None
+
+    def getLogFields(self):
+        if self._source is None:
+            return {}
+        return self._source.getLogFields()
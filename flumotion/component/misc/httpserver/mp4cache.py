@@ -0,0 +1,167 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+from flumotion.common import log, python
+from flumotion.component.misc.httpserver.hitratio import HitRatioMixin
+
+LOG_CATEGORY = "mp4-seek-cache"
+
+DEFAULT_SEEK_POINTS = 32
+
+
+class SeekIndexCache(log.Loggable, HitRatioMixin):
+    """
+    I keep what is needed to seek in recently requested MP4 files, so
+    that seeking again doesn't read and parse the whole index again.
+
+    For each file, identified by its path, modification time and size,
+    I keep the data read to find the index and the headers generated
+    for the most recent seek points. A seek to a known point is served
+    without parsing anything. Other seeks in the same file are parsed
+    from the index kept in memory.
+
+    I hold at most maxSize bytes, dropping the least recently used
+    files first. A seek served from a generated header counts as a hit,
+    one that has to be parsed as a miss.
+
+    @ivar usage:  the amount of data in memory, in bytes
+    @type usage:  int
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, maxSize, maxSeekPoints=DEFAULT_SEEK_POINTS):
+        """
+        @param maxSize:       the maximum amount of data to keep, in bytes
+        @type  maxSize:       int
+        @param maxSeekPoints: the number of generated headers to keep
+                              for each file
+        @type  maxSeekPoints: int
+        """
+        self.maxSize = maxSize
+        self.maxSeekPoints = maxSeekPoints
+        self.usage = 0
+        # path -> IndexEntry, least recently used first
+        self._entries = python.OrderedDict()
+
+    def getSeekPoint(self, key, start):
+        """
+        @param key:   the path, modification time and size of the file
+        @type  key:   tuple
+        @param start: the time to seek to, in seconds
+        @type  start: float
+
+        @returns: the generated header and the offset in the file where
+                  the data starts, or None if the seek point is unknown
+        @rtype:   tuple of (str, int)
+        """
+        entry = self._getEntry(key)
+        result = None
+        if entry is not None:
+            result = entry.seekPoints.pop(start, None)
+            if result is not None:
+                entry.seekPoints[start] = result
+        if result is None:
+            self.miss()
+        else:
+            self.hit()
+        return result
+
+    def addSeekPoint(self, key, start, header, offset):
+        entry = self._getEntry(key, True)
+        old = entry.seekPoints.pop(start, None)
+        if old is not None:
+            self._resize(entry, -len(old[0]))
+        entry.seekPoints[start] = (header, offset)
+        self._resize(entry, len(header))
+        while len(entry.seekPoints) > self.maxSeekPoints:
+            oldStart, (oldHeader, _) = entry.seekPoints.popitem(last=False)
+            self._resize(entry, -len(oldHeader))
+        self._enforceLimit()
+
+    def getChunk(self, key, offset, size):
+        """
+        @returns: the data of the file read before at the given offset,
+                  or None
+        @rtype:   str
+        """
+        entry = self._getEntry(key)
+        if entry is None:
+            return None
+        return entry.chunks.get((offset, size), None)
+
+    def addChunk(self, key, offset, data):
+        if len(data) > self.maxSize:
+            return
+        entry = self._getEntry(key, True)
+        chunkKey = (offset, len(data))
+        if chunkKey in entry.chunks:
+            return
+        entry.chunks[chunkKey] = data
+        self._resize(entry, len(data))
+        self._enforceLimit()
+
+    def remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self.usage -= entry.size
+
+    ### Private Methods ###
+
+    def _getEntry(self, key, create=False):
+        path, mtime, size = key
+        entry = self._entries.pop(path, None)
+        if entry is not None and (entry.mtime, entry.fileSize) != (mtime,
+                                                                   size):
+            self.debug("%s changed, dropping its seek index", path)
+            self.usage -= entry.size
+            entry = None
+        if entry is None and create:
+            entry = IndexEntry(mtime, size)
+        if entry is not None:
+            # move it to the most recently used end
+            self._entries[path] = entry
+        return entry
+
+    def _resize(self, entry, delta):
+        entry.size += delta
+        self.usage += delta
+
+    def _enforceLimit(self):
+        while self.usage > self.maxSize and self._entries:
+            path, entry = self._entries.popitem(last=False)
+            self.log("Dropping seek index of %s from memory", path)
+            self.usage -= entry.size
+
+
+class IndexEntry(object):
+    """
+    I hold the seek index of an MP4 file kept in memory.
+    """
+
+    __slots__ = ('mtime', 'fileSize', 'chunks', 'seekPoints', 'size')
+
+    def __init__(self, mtime, fileSize):
+        self.mtime = mtime
+        self.fileSize = fileSize
+        self.chunks = {} # (offset, size) -> data
+        self.seekPoints = python.OrderedDict() # start -> (header, offset)
+        self.size = 0
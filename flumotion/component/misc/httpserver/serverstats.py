@@ -39,9 +39,9 @@ class RequestStatistics(object):
         self.bytesSent = 0L
         self._stats._onRequestStart(self)
 
-    def onDataSent(self, size):
+    def onDataSent(self, size, zeroCopy=False):
         self.bytesSent += size
-        self._stats._onRequestDataSent(self, size)
+        self._stats._onRequestDataSent(self, size, zeroCopy)
 
     def onCompleted(self, size):
         self._stats._onRequestComplete(self, size)
@@ -52,7 +52,15 @@ class ServerStatistics(object):
     _updater = None
     _callId = None
 
-    def __init__(self):
+    def __init__(self, memoryCache=None, seekIndexCache=None):
+        """
+        @param memoryCache:    the cache keeping small files in memory,
+                               if any
+        @type  memoryCache:    L{memorycache.MemoryCache}
+        @param seekIndexCache: the cache keeping the seek index of MP4
+                               files, if any
+        @type  seekIndexCache: L{mp4cache.SeekIndexCache}
+        """
         now = time.time()
         self.startTime = now
         self.currentRequestCount = 0
@@ -61,6 +69,7 @@ class ServerStatistics(object):
         self.requestCountPeakTime = now
         self.finishedRequestCount = 0
         self.totalBytesSent = 0L
+        self.totalBytesSentZeroCopy = 0L
 
         # Updated by a call to the update method
         self.meanRequestCount = 0
@@ -77,6 +86,8 @@ class ServerStatistics(object):
         self._lastUpdateTime = now
         self._lastRequestCount = 0
         self._lastBytesSent = 0L
+        self._memoryCache = memoryCache
+        self._seekIndexCache = seekIndexCache
 
     def startUpdates(self, updater):
         self._updater = updater
@@ -98,6 +109,24 @@ class ServerStatistics(object):
         return 0.0
     meanFileReadRatio = property(getMeanFileReadRatio)
 
+    def getMemoryCacheHitRatio(self):
+        if self._memoryCache is not None:
+            return self._memoryCache.hitRatio
+        return 0.0
+    memoryCacheHitRatio = property(getMemoryCacheHitRatio)
+
+    def getMemoryCacheUsage(self):
+        if self._memoryCache is not None:
+            return self._memoryCache.usage
+        return 0
+    memoryCacheUsage = property(getMemoryCacheUsage)
+
+    def getSeekCacheHitRatio(self):
+        if self._seekIndexCache is not None:
+            return self._seekIndexCache.hitRatio
+        return 0.0
+    seekCacheHitRatio = property(getSeekCacheHitRatio)
+
     def _update(self):
         now = time.time()
         updateDelta = now - self._lastUpdateTime
@@ -149,6 +178,19 @@ class ServerStatistics(object):
 
         # Update bytes read statistic key too
         self._set("total-bytes-sent", self.totalBytesSent)
+        self._set("total-bytes-sent-zero-copy", self.totalBytesSentZeroCopy)
+
+        # Update memory cache statistic keys
+        if self._memoryCache is not None:
+            self._set("memory-cache-hit-ratio", self.memoryCacheHitRatio)
+            self._set("memory-cache-usage", self.memoryCacheUsage)
+
+        # Update MP4 seek index cache statistic keys
+        if self._seekIndexCache is not None:
+            self._set("mp4-seek-cache-hits", self._seekIndexCache.hits)
+            self._set("mp4-seek-cache-misses", self._seekIndexCache.misses)
+            self._set("mp4-seek-cache-hit-ratio", self.seekCacheHitRatio)
+            self._set("mp4-seek-cache-usage", self._seekIndexCache.usage)
 
         self._lastRequestCount = self.totalRequestCount
         self._lastBytesSent = self.totalBytesSent
@@ -175,8 +217,10 @@ class ServerStatistics(object):
             self._set("request-count-peak", self.currentRequestCount)
             self._set("request-count-peak-time", now)
 
-    def _onRequestDataSent(self, stats, size):
+    def _onRequestDataSent(self, stats, size, zeroCopy):
         self.totalBytesSent += size
+        if zeroCopy:
+            self.totalBytesSentZeroCopy += size
 
     def _onRequestComplete(self, stats, size):
         self.currentRequestCount -= 1
@@ -206,11 +250,14 @@ class ServerStatistics(object):
             FRR: File Read Ratio
             MBR: Mean Bitrate
             CBR: Current Bitrate
+            TBS: Total Bytes Sent
+            ZBS: Zero-copy Bytes Sent, with sendfile(2)
         """
         log.debug("stats-http-server",
                   "TRC: %s; CRC: %d; CRR: %.2f; MRR: %.2f; "
-                  "FRR: %.4f; MBR: %d; CBR: %d",
+                  "FRR: %.4f; MBR: %d; CBR: %d; TBS: %d; ZBS: %d",
                   self.totalRequestCount, self.currentRequestCount,
                   self.currentRequestRate, self.meanRequestRate,
                   self.meanFileReadRatio, self.meanBitrate,
-                  self.currentBitrate)
+                  self.currentBitrate, self.totalBytesSent,
+                  self.totalBytesSentZeroCopy)
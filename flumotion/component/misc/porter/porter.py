@@ -23,6 +23,7 @@ import os
 import random
 import socket
 import string
+import sys
 import time
 from urllib2 import urlparse
 
@@ -31,9 +32,11 @@ from twisted.internet import protocol, reactor, address, error, defer
 from twisted.spread import pb
 from zope.interface import implements
 
-from flumotion.common import medium, log, messages, errors
+from flumotion.common import common, medium, log, messages, errors
+from flumotion.common import pathtree
 from flumotion.common.i18n import N_, gettexter
 from flumotion.component import component
+from flumotion.component.base import timerwheel
 from flumotion.component.component import moods
 from flumotion.twisted import credentials, fdserver, checkers
 from flumotion.twisted import reflect
@@ -41,6 +44,9 @@ from flumotion.twisted import reflect
 __version__ = "$Rev$"
 T_ = gettexter()
 
+# How often to update the FD handoff statistics in the UI state, in seconds
+HANDOFF_STATS_INTERVAL = 5
+
 
 class PorterAvatar(pb.Avatar, log.Loggable):
     """
@@ -78,6 +84,13 @@ class PorterAvatar(pb.Avatar, log.Loggable):
         self.log("Perspective called: deregistering default")
         self.porter.deregisterPrefix(prefix, self)
 
+    def perspective_getWorkerSocketPaths(self):
+        """
+        Return the socket paths of the porter worker processes, which the
+        streamer should also log into and register its paths with.
+        """
+        return self.porter.getWorkerSocketPaths()
+
 
 class PorterRealm(log.Loggable):
     """
@@ -116,33 +129,53 @@ class PorterMedium(component.BaseComponentMedium):
                 self.comp._interface, self.comp._external_interface)
 
 
-class Porter(component.BaseComponent, log.Loggable):
-    """
-    The porter optionally sits in front of a set of streamer components.
-    The porter is what actually deals with incoming connections on a socket.
-    It decides which streamer to direct the connection to, then passes the FD
-    (along with some amount of already-read data) to the appropriate streamer.
+class PorterDispatcher(common.InitMixin, log.Loggable):
     """
+    I keep track of the streamers logged into a porter and of the paths and
+    prefixes they registered, and decide where incoming connections go.
 
-    componentMediumClass = PorterMedium
+    I am shared by the porter component and by its worker processes, which
+    all accept connections on the same port and all have every streamer
+    logged in.
+    """
 
     def init(self):
         # We maintain a map of path -> avatar (the underlying transport is
-        # accessible from the avatar, we need this for FD-passing)
+        # accessible from the avatar, we need this for FD-passing), and a
+        # radix tree of prefix -> avatar for longest-prefix lookups
         self._mappings = {}
-        self._prefixes = {}
+        self._prefixes = pathtree.PathTree()
 
-        self._socketlistener = None
+        # Bytes buffered by client connections that haven't been handed off
+        # yet, and the maximum allowed (None means unlimited)
+        self._pendingBytes = 0
+        self._maxPendingBytes = None
+        self.clientTimeout = PorterProtocol.PORTER_CLIENT_TIMEOUT
 
-        self._socketPath = None
-        self._username = None
-        self._password = None
-        self._port = None
-        self._iptablesPort = None
-        self._porterProtocol = None
+    def addPendingBytes(self, count):
+        """
+        Account for data buffered by a client connection while waiting for
+        its first line.
 
-        self._interface = ''
-        self._external_interface = ''
+        @param count: the number of bytes buffered
+        @type  count: int
+
+        @returns: False if the total amount of buffered data exceeds the
+                  configured maximum, True otherwise
+        @rtype:   bool
+        """
+        self._pendingBytes += count
+        return (self._maxPendingBytes is None or
+                self._pendingBytes <= self._maxPendingBytes)
+
+    def removePendingBytes(self, count):
+        """
+        Release data previously accounted for with L{addPendingBytes}.
+
+        @param count: the number of bytes released
+        @type  count: int
+        """
+        self._pendingBytes -= count
 
     def registerPath(self, path, avatar):
         """
@@ -218,17 +251,11 @@ class Porter(component.BaseComponent, log.Loggable):
                 "Not removing prefix destination: expected avatar not found")
 
     def findPrefixMatch(self, path):
-        found = None
-        # TODO: Horribly inefficient. Replace with pathtree code.
-        for prefix in self._prefixes.keys():
-            self.log("Checking: %r, %r" % (prefix, path))
-            if (path.startswith(prefix) and
-                (not found or len(found) < len(prefix))):
-                found = prefix
-        if found:
-            return self._prefixes[found]
-        else:
-            return None
+        """
+        Find the avatar registered for the longest prefix of this path.
+        @returns: The Avatar for this prefix, or None.
+        """
+        return self._prefixes.longestPrefixValue(path)
 
     def findDestination(self, path):
         """
@@ -241,6 +268,205 @@ class Porter(component.BaseComponent, log.Loggable):
         else:
             return self.findPrefixMatch(path)
 
+    def getAvatars(self):
+        """
+        @returns: the avatars that have at least one path or prefix
+                  registered
+        @rtype:   set of L{PorterAvatar}
+        """
+        avatars = set(self._mappings.values())
+        avatars.update([avatar for _, avatar in self._prefixes.iteritems()])
+        return avatars
+
+    def getWorkerSocketPaths(self):
+        """
+        @returns: the socket paths of the porter worker processes streamers
+                  should log into, in addition to the porter itself
+        @rtype:   list of str
+        """
+        return []
+
+    def listenForStreamers(self, socketPath, username, password):
+        """
+        Start listening for streamers logging into the porter, on a socket
+        over which we can pass them FDs.
+
+        @raises twisted.internet.error.CannotListenError: if we can't listen
+        @returns: the listening port
+        """
+        realm = PorterRealm(self)
+        checker = checkers.FlexibleCredentialsChecker()
+        checker.addUser(username, password)
+
+        p = portal.Portal(realm, [checker])
+        serverfactory = pb.PBServerFactory(p)
+
+        # Rather than a normal listenTCP() or listenUNIX(), we use
+        # listenWith so that we can specify our particular Port, which
+        # creates Transports that we know how to pass FDs over.
+        try:
+            os.unlink(socketPath)
+        except OSError:
+            pass
+
+        return reactor.listenWith(fdserver.FDPort, socketPath, serverfactory)
+
+    def listenForClients(self, port, interface, protocolName,
+                         reusePort=False):
+        """
+        Start listening for client connections using the given porter
+        protocol.
+
+        @param reusePort: whether other processes can listen on the same
+                          port, sharing incoming connections with us
+        @type  reusePort: bool
+
+        @raises twisted.internet.error.CannotListenError: if we can't listen
+        @returns: the listening port
+        """
+        # Create the class that deals with the specific protocol we're proxying
+        # in this porter.
+        try:
+            proto = reflect.namedAny(protocolName)
+            self.debug("Created proto %r" % proto)
+        except (ImportError, AttributeError):
+            self.warning("Failed to import protocol '%s', defaulting to HTTP" %
+                protocolName)
+            proto = HTTPPorterProtocol
+
+        # And of course we also want to listen for incoming requests in the
+        # appropriate protocol (HTTP, RTSP, etc.)
+        factory = PorterProtocolFactory(self, proto)
+        return reactor.listenWith(
+            fdserver.PassableServerPort, port, factory,
+            interface=interface, reusePort=reusePort)
+
+
+class PorterWorkerProcess(protocol.ProcessProtocol, log.Loggable):
+    """
+    A porter worker process, spawned by the porter component. The worker
+    reads the streamer login credentials from its standard input, and exits
+    when it gets closed.
+    """
+
+    logCategory = 'porter'
+
+    def __init__(self, porter, socketPath):
+        self._porter = porter
+        self.socketPath = socketPath
+        self.pid = None
+
+    def connectionMade(self):
+        self.pid = self.transport.pid
+        self.transport.write('%s\n%s\n' % (self._porter._username,
+                                           self._porter._password))
+
+    def stop(self):
+        self.transport.closeStdin()
+
+    def processEnded(self, reason):
+        self.debug("porter worker %r exited: %s", self.pid,
+                   log.getFailureMessage(reason))
+        self._porter.workerEnded(self)
+
+
+class Porter(component.BaseComponent, PorterDispatcher):
+    """
+    The porter optionally sits in front of a set of streamer components.
+    The porter is what actually deals with incoming connections on a socket.
+    It decides which streamer to direct the connection to, then passes the FD
+    (along with some amount of already-read data) to the appropriate streamer.
+
+    When configured with more than one worker, the porter spawns additional
+    processes that listen on the same port (using SO_REUSEPORT) to spread
+    the work of accepting and parsing connections over several CPUs.
+    Streamers then log into each of them, see L{getWorkerSocketPaths}.
+    """
+
+    componentMediumClass = PorterMedium
+
+    def init(self):
+        self._socketlistener = None
+        self._clientlistener = None
+
+        self._socketPath = None
+        self._username = None
+        self._password = None
+        self._port = None
+        self._iptablesPort = None
+        self._porterProtocol = None
+
+        self._interface = ''
+        self._external_interface = ''
+
+        self._workerCount = 1
+        self._workers = {} # socket path -> PorterWorkerProcess
+        self._stopping = False
+
+        self._handoffStatsDC = None
+
+        # FDs waiting to be passed to streamers, and the average and
+        # maximum time they waited during the last interval
+        self.uiState.addKey('handoff-queue-depth', 0)
+        self.uiState.addKey('handoff-latency', 0.0)
+        self.uiState.addKey('handoff-latency-max', 0.0)
+
+    def _updateHandoffStats(self):
+        depth, sent, waitTotal, waitMax = 0, 0, 0.0, 0.0
+        for avatar in self.getAvatars():
+            if not avatar.isAttached():
+                continue
+            transport = avatar.mind.broker.transport
+            depth += transport.getQueuedFileDescriptors()
+            count, total, maximum = transport.popHandoffStats()
+            sent += count
+            waitTotal += total
+            waitMax = max(waitMax, maximum)
+
+        self.uiState.set('handoff-queue-depth', depth)
+        self.uiState.set('handoff-latency', sent and waitTotal / sent or 0.0)
+        self.uiState.set('handoff-latency-max', waitMax)
+
+        self._handoffStatsDC = reactor.callLater(HANDOFF_STATS_INTERVAL,
+                                                 self._updateHandoffStats)
+
+    def getWorkerSocketPaths(self):
+        return self._workers.keys()
+
+    def spawnWorker(self, socketPath):
+        """
+        Spawn a worker process accepting connections on our port, and
+        streamer logins on the given socket path.
+        """
+        from flumotion.component.misc.porter import porterworker
+        # the directory our code was loaded from, which is not necessarily
+        # in the python path (e.g. a bundle)
+        packagePath = porterworker.__file__
+        for _ in porterworker.__name__.split('.'):
+            packagePath = os.path.dirname(packagePath)
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        args = [sys.executable, '-c', porterworker.BOOTSTRAP, packagePath,
+                socketPath, str(self._port), self._interface,
+                self._porterProtocol, str(self.clientTimeout),
+                str(self._maxPendingBytes or 0)]
+        process = PorterWorkerProcess(self, socketPath)
+        reactor.spawnProcess(process, sys.executable, args, env=env,
+                             childFDs={0: 'w', 1: 1, 2: 2})
+        self._workers[socketPath] = process
+        self.info("Spawned porter worker %d for socket path %s",
+                  process.pid, socketPath)
+
+    def workerEnded(self, process):
+        if self._workers.get(process.socketPath) is not process:
+            return
+        del self._workers[process.socketPath]
+        if not self._stopping:
+            self.warning("Porter worker %d exited, respawning it",
+                         process.pid)
+            reactor.callLater(1, self.spawnWorker, process.socketPath)
+
     def generateSocketPath(self):
         """
         Generate a socket pathname in an appropriate location
@@ -295,8 +521,28 @@ class Porter(component.BaseComponent, log.Loggable):
         # interface
         self._external_interface = props.get('external-interface',
             self._interface)
+        self.clientTimeout = props.get('client-timeout', self.clientTimeout)
+        # zero or negative means no limit
+        maxPending = props.get('max-pending-bytes', 0)
+        if maxPending > 0:
+            self._maxPendingBytes = maxPending
+        self._workerCount = max(1, props.get('workers', 1))
+        if self._workerCount > 1 and not fdserver.canReusePort():
+            self.warning("SO_REUSEPORT is not supported on this system, "
+                         "not spawning porter workers")
+            m = messages.Warning(T_(N_(
+                "This system does not support sharing a port between "
+                "processes, so the porter will run a single process.")))
+            self.addMessage(m)
+            self._workerCount = 1
 
     def do_stop(self):
+        self._stopping = True
+        for process in self._workers.values():
+            process.stop()
+        if self._handoffStatsDC:
+            self._handoffStatsDC.cancel()
+            self._handoffStatsDC = None
         d = None
         if self._socketlistener:
             # stopListening() calls (via a callLater) connectionLost(), which
@@ -308,24 +554,10 @@ class Porter(component.BaseComponent, log.Loggable):
     def do_setup(self):
         # Create our combined PB-server/fd-passing channel
         self.have_properties()
-        realm = PorterRealm(self)
-        checker = checkers.FlexibleCredentialsChecker()
-        checker.addUser(self._username, self._password)
-
-        p = portal.Portal(realm, [checker])
-        serverfactory = pb.PBServerFactory(p)
 
         try:
-            # Rather than a normal listenTCP() or listenUNIX(), we use
-            # listenWith so that we can specify our particular Port, which
-            # creates Transports that we know how to pass FDs over.
-            try:
-                os.unlink(self._socketPath)
-            except OSError:
-                pass
-
-            self._socketlistener = reactor.listenWith(
-                fdserver.FDPort, self._socketPath, serverfactory)
+            self._socketlistener = self.listenForStreamers(
+                self._socketPath, self._username, self._password)
             self.info("Now listening on socketPath %s", self._socketPath)
         except error.CannotListenError, e:
             self.warning("Failed to create socket %s" % self._socketPath)
@@ -336,23 +568,10 @@ class Porter(component.BaseComponent, log.Loggable):
             self.setMood(moods.sad)
             return defer.fail(errors.ComponentSetupHandledError())
 
-        # Create the class that deals with the specific protocol we're proxying
-        # in this porter.
-        try:
-            proto = reflect.namedAny(self._porterProtocol)
-            self.debug("Created proto %r" % proto)
-        except (ImportError, AttributeError):
-            self.warning("Failed to import protocol '%s', defaulting to HTTP" %
-                self._porterProtocol)
-            proto = HTTPPorterProtocol
-
-        # And of course we also want to listen for incoming requests in the
-        # appropriate protocol (HTTP, RTSP, etc.)
-        factory = PorterProtocolFactory(self, proto)
         try:
-            reactor.listenWith(
-                fdserver.PassableServerPort, self._port, factory,
-                    interface=self._interface)
+            self._clientlistener = self.listenForClients(
+                self._port, self._interface, self._porterProtocol,
+                reusePort=self._workerCount > 1)
             self.info("Now listening on interface %r on port %d",
                       self._interface, self._port)
         except error.CannotListenError, e:
@@ -364,6 +583,12 @@ class Porter(component.BaseComponent, log.Loggable):
             self.setMood(moods.sad)
             return defer.fail(errors.ComponentSetupHandledError())
 
+        # The workers accept streamer logins on sockets next to ours
+        for i in range(1, self._workerCount):
+            self.spawnWorker('%s.%d' % (self._socketPath, i))
+
+        self._updateHandoffStats()
+
 
 class PorterProtocolFactory(protocol.Factory):
 
@@ -386,6 +611,11 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
     We can't guarantee that we read precisely a line, so the buffer we
     accumulate will actually be larger than what we actually parse.
 
+    Received data is kept as a list of chunks and only newly received data
+    is scanned for a line end, so that clients sending their request a few
+    bytes at a time don't cause the whole buffer to be copied and rescanned
+    on each read.
+
     @cvar MAX_SIZE:   the maximum number of bytes allowed for the first line
     @cvar delimiters: a list of valid line delimiters I check for
     """
@@ -396,7 +626,8 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
     MAX_SIZE = 4096
 
     # Timeout any client connected to the porter for longer than this. A normal
-    # client should only ever be connected for a fraction of a second.
+    # client should only ever be connected for a fraction of a second. The
+    # porter's client-timeout property overrides this.
     PORTER_CLIENT_TIMEOUT = 30
 
     # In fact, because we check \r, we'll never need to check for \r\n - we
@@ -407,11 +638,15 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
 
     def __init__(self, porter):
         self._buffer = ''
+        self._chunks = []
+        self._received = 0
+        self._finished = False
         self._porter = porter
         self.requestId = None # a string that should identify the request
 
-        self._timeoutDC = reactor.callLater(self.PORTER_CLIENT_TIMEOUT,
-            self._timeout)
+        self._clientTimeout = porter.clientTimeout
+        self._timeouts = timerwheel.getTimerWheel()
+        self._timeouts.add(self, self._clientTimeout, self._timeout)
 
     def connectionMade(self):
 
@@ -423,32 +658,58 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
         protocol.Protocol.connectionMade(self)
 
     def _timeout(self):
-        self._timeoutDC = None
         self.debug("Timing out porter client after %d seconds",
-            self.PORTER_CLIENT_TIMEOUT)
+            self._clientTimeout)
+        self._drop()
+
+    def _drop(self):
+        # stop processing and release the buffered data
+        self._finished = True
+        self._chunks = []
+        self._porter.removePendingBytes(self._received)
+        self._received = 0
         self.transport.loseConnection()
 
     def connectionLost(self, reason):
-        if self._timeoutDC:
-            self._timeoutDC.cancel()
-            self._timeoutDC = None
+        self._timeouts.remove(self)
+        self._finished = True
+        if self._received:
+            self._porter.removePendingBytes(self._received)
+            self._received = 0
+
+    def _findLineEnd(self, data):
+        # return the position of the first line delimiter character in data,
+        # or -1 if there isn't any
+        lf = data.find('\n')
+        cr = data.find('\r')
+        if cr == -1 or (lf != -1 and lf < cr):
+            return lf
+        return cr
 
     def dataReceived(self, data):
-        self._buffer = self._buffer + data
-        self.log("Got data, buffer now \"%s\"" % self._buffer)
+        if self._finished:
+            return
+        offset = self._received
+        self._chunks.append(data)
+        self._received += len(data)
+        self.log("Got data, %d bytes buffered", self._received)
+
+        if not self._porter.addPendingBytes(len(data)):
+            # PROBE: dropping
+            self.debug("[fd %5d] (ts %f) (request-id %r) dropping, "
+                       "porter pending data limit exceeded",
+                       self.transport.fileno(), time.time(),
+                       self.requestId)
+            return self._drop()
+
         # We accept more than just '\r\n' (the true HTTP line end) in the
-        # interests of compatibility.
-        for delim in self.delimiters:
-            try:
-                line, remaining = self._buffer.split(delim, 1)
-                break
-            except ValueError:
-                # We didn't find this delimiter; continue with the others.
-                pass
-        else:
+        # interests of compatibility. Only the new data needs to be scanned,
+        # what we had before didn't contain any delimiter.
+        end = self._findLineEnd(data)
+        if end == -1:
             # Failed to find a valid delimiter.
             self.log("No valid delimiter found")
-            if len(self._buffer) > self.MAX_SIZE:
+            if self._received > self.MAX_SIZE:
 
                 # PROBE: dropping
                 self.debug("[fd %5d] (ts %f) (request-id %r) dropping, "
@@ -456,12 +717,22 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
                            self.transport.fileno(), time.time(),
                            self.requestId)
 
-                return self.transport.loseConnection()
+                return self._drop()
             else:
                 # No delimiter found; haven't reached the length limit yet.
                 # Wait for more data.
                 return
 
+        self._finished = True
+        self._buffer = ''.join(self._chunks)
+        self._chunks = []
+        end += offset
+        for delim in self.delimiters:
+            if self._buffer.startswith(delim, end):
+                break
+        line = self._buffer[:end]
+        remaining = self._buffer[end + len(delim):]
+
         # Got a line. self._buffer is still our entire buffer, should be
         # provided to the slaved process.
         parsed = self.parseLine(line)
@@ -515,21 +786,23 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
                    self.transport.fileno(), time.time(), self.requestId,
                    destinationAvatar.avatarId)
 
-        # TODO: Check out blocking characteristics of sendFileDescriptor, fix
-        # if it blocks.
-        try:
-            destinationAvatar.mind.broker.transport.sendFileDescriptor(
-                self.transport.fileno(), self._buffer)
-        except OSError, e:
-            self.warning("[fd %5d] failed to send FD: %s",
-                         self.transport.fileno(), log.getExceptionMessage(e))
-            self.writeServiceUnavailableResponse()
-            return self.transport.loseConnection()
-
+        # The FD is queued on the avatar's connection and sent as soon as
+        # it's writable, so that a slow streamer doesn't block the porter.
+        # Until then, we must neither read from the client (the streamer
+        # has to get all the data) nor close its FD, nor time it out.
+        self.transport.stopReading()
+        self._timeouts.remove(self)
+        d = destinationAvatar.mind.broker.transport.queueFileDescriptor(
+            self.transport.fileno(), self._buffer)
+        d.addCallbacks(self._fileDescriptorSent, self._fileDescriptorFailed,
+                       callbackArgs=(destinationAvatar.avatarId, ))
+
+    def _fileDescriptorSent(self, wait, avatarId):
         # PROBE: sent fd; see no destination and fdserver.py
-        self.debug("[fd %5d] (ts %f) (request-id %r) sent fd to avatarId %s",
+        self.debug("[fd %5d] (ts %f) (request-id %r) sent fd to avatarId %s "
+                   "after %f seconds",
                    self.transport.fileno(), time.time(), self.requestId,
-                   destinationAvatar.avatarId)
+                   avatarId, wait)
 
         # After this, we don't want to do anything with the FD, other than
         # close our reference to it - but not close the actual TCP connection.
@@ -538,6 +811,14 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
         self.transport.keepSocketAlive = True
         self.transport.loseConnection()
 
+    def _fileDescriptorFailed(self, failure):
+        failure.trap(OSError)
+        self.warning("[fd %5d] failed to send FD: %s",
+                     self.transport.fileno(),
+                     log.getFailureMessage(failure))
+        self.writeServiceUnavailableResponse()
+        self.transport.loseConnection()
+
     def parseLine(self, line):
         """
         Parse the initial line of the request. Return an object that can be
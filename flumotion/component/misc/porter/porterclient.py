@@ -90,6 +90,9 @@ class PorterMedium(medium.BaseMedium):
     def deregisterPrefix(self, prefix):
         return self.callRemote("deregisterPrefix", prefix)
 
+    def getWorkerSocketPaths(self):
+        return self.callRemote("getWorkerSocketPaths")
+
 
 class PorterClientFactory(fpb.ReconnectingPBClientFactory):
     """
@@ -110,28 +113,99 @@ class PorterClientFactory(fpb.ReconnectingPBClientFactory):
         self.protocol = fdserver.FDPassingBroker
         self._childFactory = childFactory
 
+        # client factories logged into the porter's worker processes,
+        # keyed on their socket paths
+        self._workers = {}
+        self.connector = None
+
     def buildProtocol(self, addr):
         p = self.protocol(self._childFactory, FDPorterServer)
         p.factory = self
         return p
 
+    def _forEachWorker(self, method, *args):
+        # forward the call to the porter workers we're logged into; the
+        # ones we aren't logged into yet will get our paths when we are
+        for worker in self._workers.values():
+            if worker.medium.hasRemoteReference():
+                getattr(worker, method)(*args).addErrback(
+                    lambda f: self.debug("Porter worker call %s failed: %s",
+                                         method, log.getFailureMessage(f)))
+
     def registerPath(self, path):
+        self._forEachWorker('registerPath', path)
         return self.medium.registerPath(path)
 
     def deregisterPath(self, path):
+        self._forEachWorker('deregisterPath', path)
         return self.medium.deregisterPath(path)
 
     def registerPrefix(self, prefix):
+        self._forEachWorker('registerPrefix', prefix)
         return self.medium.registerPrefix(prefix)
 
     def deregisterPrefix(self, prefix):
+        self._forEachWorker('deregisterPrefix', prefix)
         return self.medium.deregisterPrefix(prefix)
 
     def registerDefault(self):
-        return self.medium.registerPrefix("/")
+        return self.registerPrefix("/")
 
     def deregisterDefault(self):
-        return self.medium.deregisterPrefix("/")
+        return self.deregisterPrefix("/")
+
+    def createWorkerFactory(self):
+        """
+        Create a client factory to log into a porter worker process.
+        Subclasses should override this so that the factory registers the
+        same paths as we do when it logs in.
+
+        @rtype: L{PorterClientFactory}
+        """
+        return self.__class__(self._childFactory)
+
+    def connectWorkers(self, result=None):
+        """
+        Ask the porter for its worker processes and log into the ones we
+        are not connected to yet, so that all of them pass us the requests
+        for our paths. Meant to be used as a callback once logged in.
+        """
+
+        def gotWorkerSocketPaths(paths):
+            for path in self._workers.keys():
+                if path not in paths:
+                    self.debug("Porter worker %s went away", path)
+                    self._stopWorker(path)
+            for path in paths:
+                if path in self._workers:
+                    continue
+                self.debug("Logging into porter worker at %s", path)
+                worker = self.createWorkerFactory()
+                worker.startLogin(self._credentials, worker.medium)
+                worker.connector = reactor.connectWith(
+                    fdserver.FDConnector, path, worker, 10, checkPID=False)
+                self._workers[path] = worker
+
+        def getWorkerSocketPathsFailed(failure):
+            # the porter doesn't have workers, or is too old to know
+            # about them
+            self.debug("Could not get porter worker socket paths: %s",
+                       log.getFailureMessage(failure))
+
+        d = self.medium.getWorkerSocketPaths()
+        d.addCallbacks(gotWorkerSocketPaths, getWorkerSocketPathsFailed)
+        d.addCallback(lambda _: result)
+        return d
+
+    def _stopWorker(self, path):
+        worker = self._workers.pop(path)
+        worker.stopTrying()
+        worker.connector.disconnect()
+
+    def stopTrying(self):
+        for path in self._workers.keys():
+            self._stopWorker(path)
+        fpb.ReconnectingPBClientFactory.stopTrying(self)
 
 
 class HTTPPorterClientFactory(PorterClientFactory):
@@ -147,6 +221,10 @@ class HTTPPorterClientFactory(PorterClientFactory):
         self._prefixes = prefixes or []
         self._do_start_deferred = do_start_deferred
 
+    def createWorkerFactory(self):
+        return HTTPPorterClientFactory(self._childFactory, self._mountPoints,
+                                       None, self._prefixes)
+
     def _fireDeferred(self, r):
         # If we still have the deferred, fire it (this happens after we've
         # completed log in the _first_ time, not subsequent times)
@@ -171,4 +249,5 @@ class HTTPPorterClientFactory(PorterClientFactory):
             self.debug("Registering mount prefix %s with porter", mount)
             deferred.addCallback(lambda r, m: self.registerPrefix(m),
                 mount)
+        deferred.addCallback(self.connectWorkers)
         deferred.addCallback(self._fireDeferred)
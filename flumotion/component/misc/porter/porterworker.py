@@ -0,0 +1,107 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_porter -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+"""porter worker processes.
+A porter configured with several workers spawns this many processes, minus
+itself, each accepting and dispatching connections on the same port as the
+porter.
+"""
+
+import sys
+
+from twisted.internet import error, protocol, reactor, stdio
+
+from flumotion.common import log
+from flumotion.component.misc.porter import porter
+
+__version__ = "$Rev$"
+
+
+# Run with python -c by the porter, passing the path our code should be
+# imported from followed by the arguments to main()
+BOOTSTRAP = """
+import sys
+from flumotion.common import package, setup
+setup.setup()
+package.getPackager().registerPackagePath(sys.argv[1], 'porter-worker')
+from flumotion.component.misc.porter import porterworker
+sys.exit(porterworker.main(sys.argv[2:]))
+"""
+
+
+class PorterWorker(porter.PorterDispatcher):
+    """
+    A porter running in a worker process. Streamers log into it as they do
+    into the porter, and it passes them the connections it accepts.
+    """
+
+    logCategory = 'porter-worker'
+
+    def __init__(self, clientTimeout, maxPendingBytes):
+        porter.PorterDispatcher.__init__(self)
+        self.clientTimeout = clientTimeout
+        if maxPendingBytes > 0:
+            self._maxPendingBytes = maxPendingBytes
+
+
+class _ParentWatcher(protocol.Protocol):
+    # The porter closes our standard input when we should exit, or
+    # when it dies
+
+    def connectionLost(self, reason):
+        log.info('porter-worker', 'Porter went away, exiting')
+        if reactor.running:
+            reactor.stop()
+
+
+def main(args):
+    """
+    Run a porter worker.
+
+    @param args: the socket path to accept streamer logins on, the port and
+                 interface to listen on, the porter protocol class name, the
+                 client timeout and the maximum pending bytes
+    @type  args: list of str
+    """
+    (socketPath, port, interface, protocolName, clientTimeout,
+     maxPendingBytes) = args
+
+    # the porter writes the streamer credentials to our standard input
+    username = sys.stdin.readline().rstrip('\n')
+    password = sys.stdin.readline().rstrip('\n')
+
+    worker = PorterWorker(int(clientTimeout), int(maxPendingBytes))
+    try:
+        listener = worker.listenForStreamers(socketPath, username, password)
+        worker.listenForClients(int(port), interface, protocolName,
+                                reusePort=True)
+    except error.CannotListenError, e:
+        log.warning('porter-worker', 'Could not listen: %s',
+                    log.getExceptionMessage(e))
+        return 1
+
+    log.info('porter-worker', 'Porter worker listening on port %s, '
+             'streamers log in on %s', port, socketPath)
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  listener.stopListening)
+    stdio.StandardIO(_ParentWatcher())
+    reactor.run()
+    return 0
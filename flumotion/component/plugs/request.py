@@ -1,4 +1,4 @@
-# -*- Mode: Python -*-
+# -*- test-case-name: flumotion.test.test_component_plugs_request -*-
 # vi:si:et:sw=4:sts=4:ts=4
 #
 # Flumotion - a streaming media server
@@ -19,13 +19,22 @@
 
 # Headers in this file shall remain intact.
 
+import threading
 import time
+from collections import deque
 
-from flumotion.common import errors
+from flumotion.common import errors, log
 from flumotion.component.plugs import base
 
 __version__ = "$Rev$"
 
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_FLUSH_SIZE = 1000
+DEFAULT_QUEUE_SIZE = 100000
+
+# Queued instead of a line to reopen the file after the lines before it
+_REOPEN = None
+
 
 class RequestLoggerPlug(base.ComponentPlug):
     """
@@ -66,27 +75,180 @@ def _http_session_completed_to_apache_log(args):
 
 
 class RequestLoggerFilePlug(RequestLoggerPlug):
+    """
+    I log requests to a file in the Apache combined log format.
+
+    Lines are queued in memory and written by a thread, in batches,
+    so a lot of clients leaving at once doesn't block the reactor.
+    The queue is written when flush-size lines are queued or
+    flush-interval seconds after the first line was queued.
+    When queue-size lines are waiting, new lines are dropped and
+    counted in lost, or the caller is blocked until there is room
+    if block-when-full is set.
+    """
+
+    logCategory = 'requestlogger'
+
     filename = None
     file = None
 
+    def __init__(self, args):
+        RequestLoggerPlug.__init__(self, args)
+        self.lost = 0 # lines dropped or that could not be written
+        self._reported = 0
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._lines = 0 # lines in the queue
+        self._reopens = 0 # reopen markers in the queue
+        self._running = False
+        self._thread = None
+
     def start(self, component=None):
-        self.filename = self.args['properties']['logfile']
+        props = self.args['properties']
+        self.filename = props['logfile']
+        self._flushInterval = props.get('flush-interval',
+                                        DEFAULT_FLUSH_INTERVAL)
+        self._queueSize = max(1, props.get('queue-size',
+                                           DEFAULT_QUEUE_SIZE))
+        self._flushSize = min(self._queueSize,
+                              max(1, props.get('flush-size',
+                                               DEFAULT_FLUSH_SIZE)))
+        self._block = props.get('block-when-full', False)
         try:
             self.file = open(self.filename, 'a')
         except IOError, data:
             raise errors.PropertyError('could not open log file %s '
                                          'for writing (%s)'
                                          % (self.filename, data[1]))
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name="request-logger")
+        self._thread.setDaemon(True)
+        self._thread.start()
 
     def stop(self, component=None):
+        # The queued lines are written before the thread exits
+        if self._thread:
+            self._cond.acquire()
+            try:
+                self._running = False
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+            self._thread.join()
+            self._thread = None
         if self.file:
             self.file.close()
             self.file = None
 
     def event_http_session_completed(self, args):
-        self.file.write(_http_session_completed_to_apache_log(args))
-        self.file.flush()
+        line = _http_session_completed_to_apache_log(args)
+        self._cond.acquire()
+        try:
+            while (self._block and self._running
+                   and self._lines >= self._queueSize):
+                self._cond.wait()
+            if not self._running or self._lines >= self._queueSize:
+                self.lost += 1
+                return
+            self._queue.append(line)
+            self._lines += 1
+            if self._lines == 1 or self._lines == self._flushSize:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
 
     def rotate(self):
-        self.stop()
-        self.start()
+        # The lines logged before rotating go to the old file
+        self._cond.acquire()
+        try:
+            if not self._running:
+                return
+            self._queue.append(_REOPEN)
+            self._reopens += 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    ### Private Methods ###
+
+    def _run(self):
+        self._cond.acquire()
+        try:
+            while True:
+                deadline = None
+                while (self._running and not self._reopens
+                       and self._lines < self._flushSize):
+                    if not self._queue:
+                        self._cond.wait()
+                        deadline = None
+                        continue
+                    if deadline is None:
+                        deadline = time.time() + self._flushInterval
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                items = self._queue
+                running = self._running
+                self._queue = deque()
+                self._lines = 0
+                self._reopens = 0
+                # Let blocked callers queue lines again
+                self._cond.notifyAll()
+                self._cond.release()
+                try:
+                    self._write(items)
+                finally:
+                    self._cond.acquire()
+                if self.lost != self._reported:
+                    self.warning("%d request log lines lost so far",
+                                 self.lost)
+                    self._reported = self.lost
+                if not running:
+                    break
+        finally:
+            self._cond.release()
+
+    def _write(self, items):
+        # Called from the writer thread, without the lock
+        lines = []
+        for item in items:
+            if item is _REOPEN:
+                self._writeLines(lines)
+                lines = []
+                self._reopen()
+            else:
+                lines.append(item)
+        self._writeLines(lines)
+
+    def _writeLines(self, lines):
+        if not lines:
+            return
+        if self.file is None:
+            self._countLost(len(lines))
+            return
+        try:
+            self.file.write(''.join(lines))
+            self.file.flush()
+        except IOError, e:
+            self.warning("could not write to log file %s: %s",
+                         self.filename, log.getExceptionMessage(e))
+            self._countLost(len(lines))
+
+    def _reopen(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        try:
+            self.file = open(self.filename, 'a')
+        except IOError, e:
+            self.warning("could not reopen log file %s: %s",
+                         self.filename, log.getExceptionMessage(e))
+
+    def _countLost(self, count):
+        self._cond.acquire()
+        try:
+            self.lost += count
+        finally:
+            self._cond.release()
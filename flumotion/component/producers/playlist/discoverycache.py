@@ -0,0 +1,178 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_component_playlist -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import os
+
+from twisted.internet import reactor
+
+from flumotion.common import log
+from flumotion.component.misc.httpserver.hitratio import HitRatioMixin
+
+__version__ = "$Rev$"
+
+# seconds to wait after a change before saving, to save changes in batches
+SAVE_DELAY = 10
+
+
+class DiscoveredMedia(object):
+    """
+    I hold what was discovered about a media file, with the same
+    attributes as a discoverer.
+    """
+
+    __slots__ = ('is_media', 'is_audio', 'is_video',
+                 'audiolength', 'videolength')
+
+    def __init__(self, is_media, is_audio, is_video, audiolength,
+                 videolength):
+        self.is_media = is_media
+        self.is_audio = is_audio
+        self.is_video = is_video
+        self.audiolength = audiolength
+        self.videolength = videolength
+
+    def fromDiscoverer(cls, disc, is_media):
+        return cls(bool(is_media), bool(disc.is_audio), bool(disc.is_video),
+                   int(disc.audiolength or 0), int(disc.videolength or 0))
+    fromDiscoverer = classmethod(fromDiscoverer)
+
+
+class DiscoveryCache(log.Loggable, HitRatioMixin):
+    """
+    I keep discovery results in a file, so that playlist items for
+    files that didn't change are known right away after a restart.
+
+    Results are keyed by the path, size and modification time of
+    the files. A file found in the cache counts as a hit, one that has
+    to be discovered as a miss.
+    """
+
+    logCategory = 'playlist-cache'
+
+    def __init__(self, path):
+        """
+        @param path: the file to keep the results in, or None to keep
+                     them in memory only
+        @type  path: str
+        """
+        self.path = path
+        self._entries = {} # filename -> (size, mtime, DiscoveredMedia)
+        self._saveCall = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """
+        Reads the results saved before, if any.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            f = open(self.path, 'r')
+            try:
+                for line in f:
+                    self._parseLine(line)
+            finally:
+                f.close()
+        except IOError, e:
+            self.warning("Could not read discovery cache %s: %s",
+                         self.path, log.getExceptionMessage(e))
+        self.info("Loaded %d discovered files from %s",
+                  len(self._entries), self.path)
+
+    def save(self):
+        """
+        Writes the results to the file now.
+        """
+        if self._saveCall is not None:
+            self._saveCall.cancel()
+            self._saveCall = None
+        if not self.path:
+            return
+        tmpPath = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            f = open(tmpPath, 'w')
+            try:
+                for filename, (size, mtime, media) in self._entries.items():
+                    f.write("%d\t%d\t%d\t%d\t%d\t%d\t%d\t%s\n"
+                            % (size, mtime, media.is_media, media.is_audio,
+                               media.is_video, media.audiolength,
+                               media.videolength, filename))
+            finally:
+                f.close()
+            # Replace the old file at once, so a crash doesn't lose it
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            self.warning("Could not write discovery cache %s: %s",
+                         self.path, log.getExceptionMessage(e))
+
+    def lookup(self, filename):
+        """
+        @returns: the media discovered before for the file if it didn't
+                  change since, or None
+        @rtype:   L{DiscoveredMedia}
+        """
+        key = self._getKey(filename)
+        entry = self._entries.get(filename, None)
+        if key is not None and entry is not None and entry[:2] == key:
+            self.hit()
+            return entry[2]
+        self.miss()
+        return None
+
+    def store(self, filename, media):
+        """
+        Keeps the media discovered for the file.
+
+        @type media: L{DiscoveredMedia}
+        """
+        key = self._getKey(filename)
+        if key is None:
+            return
+        self._entries[filename] = key + (media, )
+        if self._saveCall is None and self.path:
+            self._saveCall = reactor.callLater(SAVE_DELAY, self.save)
+
+    ### Private Methods ###
+
+    def _getKey(self, filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return (st.st_size, int(st.st_mtime))
+
+    def _parseLine(self, line):
+        fields = line.rstrip('\n').split('\t', 7)
+        if len(fields) != 8:
+            return
+        try:
+            values = [int(v) for v in fields[:7]]
+        except ValueError:
+            return
+        size, mtime = values[:2]
+        media = DiscoveredMedia(*[bool(v) for v in values[2:5]] +
+                                values[5:7])
+        self._entries[fields[7]] = (size, mtime, media)
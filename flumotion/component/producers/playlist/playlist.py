@@ -19,6 +19,7 @@
 
 # Headers in this file shall remain intact.
 
+import os
 import time
 
 import gst
@@ -26,12 +27,14 @@ from twisted.internet import defer, reactor
 
 from flumotion.common import messages, fxml, gstreamer, documentation
 from flumotion.common.i18n import N_, gettexter
+from flumotion.configure import configure
 from flumotion.component import feedcomponent
 from flumotion.component.base import watcher
 
 import smartscale
 import singledecodebin
 import playlistparser
+import discoverycache
 
 __version__ = "$Rev$"
 T_ = gettexter()
@@ -124,6 +127,13 @@ class PlaylistProducer(feedcomponent.FeedComponent):
         self._asrcs = {} # { PlaylistItem -> gnlsource }
 
         self.uiState.addListKey("playlist")
+        self.uiState.addKey("discovery-rate", 0.0)
+        self.uiState.addKey("discovery-pending", 0)
+        self.uiState.addKey("discovery-cache-hit-ratio", 0.0)
+
+        self._discoveryCache = None
+        self._discoveredLast = 0
+        self._discoveryReportTime = None
 
     def _buildAudioPipeline(self, pipeline, src):
         audiorate = gst.element_factory_make("audiorate")
@@ -280,8 +290,25 @@ class PlaylistProducer(feedcomponent.FeedComponent):
     def timeReport(self):
         ts = self.pipeline.get_clock().get_time()
         self.debug("Pipeline clock is now at %d -> %s", ts, _tsToString(ts))
+        self._updateDiscoveryState()
         reactor.callLater(10, self.timeReport)
 
+    def _updateDiscoveryState(self):
+        now = time.time()
+        discovered = self.playlistparser.discovered
+        if self._discoveryReportTime is not None:
+            elapsed = now - self._discoveryReportTime
+            if elapsed > 0:
+                rate = (discovered - self._discoveredLast) / elapsed
+                self.uiState.set("discovery-rate", rate)
+        self._discoveredLast = discovered
+        self._discoveryReportTime = now
+        self.uiState.set("discovery-pending",
+                         self.playlistparser.getPendingCount())
+        if self._discoveryCache is not None:
+            self.uiState.set("discovery-cache-hit-ratio",
+                             self._discoveryCache.hitRatio)
+
     def getCurrentPosition(self):
         return self.pipeline.query_position(gst.FORMAT_TIME)[0]
 
@@ -391,6 +418,11 @@ class PlaylistProducer(feedcomponent.FeedComponent):
         self._hasAudio = props.get('audio', True)
         self._hasVideo = props.get('video', True)
 
+        self._discoveryCachePath = props.get('discovery-cache',
+            os.path.join(configure.cachedir, 'playlist-discovery',
+                         self.name + '.cache'))
+        self._discoverers = props.get('discoverers', 2)
+
         pipeline = self._buildPipeline()
         self._setupClock(pipeline)
 
@@ -468,8 +500,14 @@ class PlaylistProducer(feedcomponent.FeedComponent):
             check_gnl(el)
 
     def do_setup(self):
+        if self._discoveryCachePath:
+            self._discoveryCache = discoverycache.DiscoveryCache(
+                self._discoveryCachePath)
+            self._discoveryCache.load()
+
         playlist = playlistparser.Playlist(self)
-        self.playlistparser = playlistparser.PlaylistXMLParser(playlist)
+        self.playlistparser = playlistparser.PlaylistXMLParser(playlist,
+            self._discoveryCache, self._discoverers)
         if self._baseDirectory:
             self.playlistparser.setBaseDirectory(self._baseDirectory)
 
@@ -483,3 +521,7 @@ class PlaylistProducer(feedcomponent.FeedComponent):
             self._watchDirectory(self._playlistdirectory)
 
         reactor.callLater(10, self.timeReport)
+
+    def do_stop(self):
+        if self._discoveryCache is not None:
+            self._discoveryCache.save()
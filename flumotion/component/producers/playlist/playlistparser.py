@@ -22,6 +22,7 @@
 import gst
 from gst.extend import discoverer
 
+import bisect
 import time
 import calendar
 from StringIO import StringIO
@@ -31,9 +32,14 @@ from xml.dom import Node
 from twisted.internet import reactor
 
 from flumotion.common import log, fxml
+from flumotion.component.producers.playlist import discoverycache
 
 __version__ = "$Rev$"
 
+# The playlist index keeps its items in chunks of CHUNK_SIZE to twice
+# as many items
+CHUNK_SIZE = 512
+
 
 class PlaylistItem(object, log.Loggable):
 
@@ -51,29 +57,265 @@ class PlaylistItem(object, log.Loggable):
         self.prev = None
 
 
+class _SortedItems(object):
+    """
+    I keep playlist items sorted by timestamp.
+
+    The items are split in chunks of chunkSize to twice as many items.
+    Finding an item is a binary search over the chunks and then inside
+    one of them, and inserting or removing an item only moves the items
+    of its chunk.
+    """
+
+    def __init__(self, chunkSize=CHUNK_SIZE):
+        self.chunkSize = chunkSize
+        self._chunks = [] # lists of items
+        self._keys = [] # the timestamps of the items in each chunk
+        self._firsts = [] # the first timestamp of each chunk
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for item in chunk:
+                yield item
+
+    def before(self, timestamp):
+        """
+        Returns the last item starting before timestamp, or None.
+        """
+        c = bisect.bisect_left(self._firsts, timestamp) - 1
+        if c < 0:
+            return None
+        j = bisect.bisect_left(self._keys[c], timestamp) - 1
+        return self._chunks[c][j]
+
+    def between(self, start, end):
+        """
+        Returns the items starting at or after start and before end.
+
+        @rtype: list of L{PlaylistItem}
+        """
+        c, j = self._position(start)
+        d, k = self._position(end)
+        if c == len(self._chunks):
+            return []
+        if c == d:
+            return self._chunks[c][j:k]
+        items = self._chunks[c][j:]
+        for chunk in self._chunks[c + 1:d]:
+            items.extend(chunk)
+        if d < len(self._chunks):
+            items.extend(self._chunks[d][:k])
+        return items
+
+    def after(self, timestamp):
+        """
+        Iterates over the items starting at or after timestamp.
+        The items cannot be changed during the iteration.
+        """
+        c, j = self._position(timestamp)
+        while c < len(self._chunks):
+            chunk = self._chunks[c]
+            while j < len(chunk):
+                yield chunk[j]
+                j += 1
+            c += 1
+            j = 0
+
+    def insert(self, item):
+        ts = item.timestamp
+        self._len += 1
+        if not self._chunks:
+            self._chunks.append([item])
+            self._keys.append([ts])
+            self._firsts.append(ts)
+            return
+        c = max(bisect.bisect_right(self._firsts, ts) - 1, 0)
+        keys = self._keys[c]
+        j = bisect.bisect_left(keys, ts)
+        keys.insert(j, ts)
+        self._chunks[c].insert(j, item)
+        if j == 0:
+            self._firsts[c] = ts
+        if len(keys) > 2 * self.chunkSize:
+            self._split(c)
+
+    def remove(self, item):
+        """
+        Removes the item.
+
+        @returns: whether the item was there
+        @rtype:   bool
+        """
+        position = self._locate(item)
+        if position is None:
+            return False
+        c, j = position
+        del self._chunks[c][j]
+        del self._keys[c][j]
+        self._len -= 1
+        self._update(c)
+        self._mergeAt(min(c, len(self._chunks) - 2))
+        return True
+
+    def removeMany(self, items):
+        """
+        Removes the items, updating each chunk they are in only once.
+
+        @returns: the items that were there
+        @rtype:   list of L{PlaylistItem}
+        """
+        doomed = {} # chunk index -> positions in the chunk
+        removed = []
+        for item in items:
+            position = self._locate(item)
+            if position is not None:
+                doomed.setdefault(position[0], []).append(position[1])
+                removed.append(item)
+
+        # from the end, so the positions left to remove stay valid
+        for c in sorted(doomed.keys(), reverse=True):
+            chunk = self._chunks[c]
+            keys = self._keys[c]
+            for j in sorted(doomed[c], reverse=True):
+                del chunk[j]
+                del keys[j]
+            self._update(c)
+            self._mergeAt(c)
+        self._len -= len(removed)
+        return removed
+
+    def removeBefore(self, item):
+        """
+        Removes the items before the given one.
+
+        @returns: the removed items
+        @rtype:   list of L{PlaylistItem}
+        """
+        c, j = self._locate(item)
+        removed = []
+        for chunk in self._chunks[:c]:
+            removed.extend(chunk)
+        removed.extend(self._chunks[c][:j])
+        del self._chunks[:c]
+        del self._keys[:c]
+        del self._firsts[:c]
+        del self._chunks[0][:j]
+        del self._keys[0][:j]
+        self._firsts[0] = self._keys[0][0]
+        self._len -= len(removed)
+        return removed
+
+    def retime(self, item, timestamp):
+        """
+        Changes the timestamp of the item, which must still be between
+        the timestamps of the items around it.
+        """
+        c, j = self._locate(item)
+        self._keys[c][j] = timestamp
+        if j == 0:
+            self._firsts[c] = timestamp
+        item.timestamp = timestamp
+
+    def _position(self, timestamp):
+        # returns the chunk and position in it where the items starting
+        # at or after timestamp start
+        c = max(bisect.bisect_left(self._firsts, timestamp) - 1, 0)
+        if c == len(self._chunks):
+            return c, 0
+        j = bisect.bisect_left(self._keys[c], timestamp)
+        if j == len(self._keys[c]):
+            return c + 1, 0
+        return c, j
+
+    def _locate(self, item):
+        # returns the chunk and position in it of the item, or None
+        ts = item.timestamp
+        c = max(bisect.bisect_left(self._firsts, ts) - 1, 0)
+        while c < len(self._chunks):
+            keys = self._keys[c]
+            j = bisect.bisect_left(keys, ts)
+            while j < len(keys) and keys[j] == ts:
+                if self._chunks[c][j] is item:
+                    return c, j
+                j += 1
+            if j < len(keys):
+                return None
+            # items with the same timestamp can go on in the next chunk
+            c += 1
+        return None
+
+    def _update(self, c):
+        # drops chunk c if it is empty, or updates its first timestamp
+        if self._keys[c]:
+            self._firsts[c] = self._keys[c][0]
+        else:
+            del self._chunks[c]
+            del self._keys[c]
+            del self._firsts[c]
+
+    def _split(self, c):
+        half = self.chunkSize
+        self._chunks.insert(c + 1, self._chunks[c][half:])
+        self._keys.insert(c + 1, self._keys[c][half:])
+        self._firsts.insert(c + 1, self._keys[c][half])
+        del self._chunks[c][half:]
+        del self._keys[c][half:]
+
+    def _mergeAt(self, c):
+        # merges chunk c with the next one if either got too small,
+        # returns whether they were merged
+        if c < 0 or c + 1 >= len(self._chunks):
+            return False
+        small = self.chunkSize // 2
+        if len(self._keys[c]) >= small and len(self._keys[c + 1]) >= small:
+            return False
+        self._chunks[c].extend(self._chunks.pop(c + 1))
+        self._keys[c].extend(self._keys.pop(c + 1))
+        del self._firsts[c + 1]
+        if len(self._keys[c]) > 2 * self.chunkSize:
+            self._split(c)
+            return False
+        return True
+
+
 class Playlist(object, log.Loggable):
+    """
+    I keep the items of a playlist ordered by timestamp.
+
+    Items never overlap; adding an item shortens, moves or removes the
+    items it overlaps. Since items don't overlap, ordering them by start
+    also orders them by end, so the items are kept in a sorted index,
+    and finding the item playing at some time or the items in some time
+    range is a binary search.
+
+    The items are also linked to their neighbours through their next
+    and prev attributes, starting with the items attribute.
+    """
     logCategory = 'playlist-list'
 
     def __init__(self, producer):
         """
         Create an initially empty playlist
         """
-        self.items = None # PlaylistItem linked list
+        self.items = None # first PlaylistItem of the linked list
         self._itemsById = {}
+        self._index = _SortedItems()
 
         self.producer = producer
 
+    def __len__(self):
+        return len(self._index)
+
     def _findItem(self, timePosition):
         # timePosition is the position in terms of the clock time
         # Get the item that corresponds to timePosition, or None
-        cur = self.items
-        while cur:
-            if cur.timestamp < timePosition and \
-                    cur.timestamp + cur.duration > timePosition:
-                return cur
-            if cur.timestamp > timePosition:
-                return None # fail without having to iterate over everything
-            cur = cur.next
+        cur = self._index.before(timePosition)
+        if cur and cur.timestamp + cur.duration > timePosition:
+            return cur
         return None
 
     def _getCurrentItem(self):
@@ -83,6 +325,29 @@ class Playlist(object, log.Loggable):
             item, position)
         return item
 
+    def _forgetItem(self, item):
+        items = self._itemsById.get(item.id, None)
+        if items and item in items:
+            items.remove(item)
+            if not items:
+                del self._itemsById[item.id]
+
+    def getItemsInRange(self, start, end):
+        """
+        Returns the items playing at some time between start and end.
+
+        @param start: the start of the range, in clock time
+        @type  start: long
+        @param end:   the end of the range, in clock time
+        @type  end:   long
+        @rtype: list of L{PlaylistItem}
+        """
+        items = self._index.between(start, end)
+        prev = self._index.before(start)
+        if prev and prev.timestamp + prev.duration > start:
+            items.insert(0, prev)
+        return items
+
     def removeItems(self, piid):
         current = self._getCurrentItem()
 
@@ -90,6 +355,8 @@ class Playlist(object, log.Loggable):
             return
 
         items = self._itemsById[piid]
+        kept = []
+        removed = []
         for item in items:
             self.debug("removeItems: item %r ts: %d", item, item.timestamp)
             if current:
@@ -98,11 +365,19 @@ class Playlist(object, log.Loggable):
             if (current and item.timestamp < current.timestamp +
                     current.duration):
                 self.debug("Not removing current item!")
+                kept.append(item)
                 continue
-            self.unlinkItem(item)
+            removed.append(item)
+
+        for item in self._index.removeMany(removed):
+            self._unlink(item)
+        for item in removed:
             self.producer.unscheduleItem(item)
 
-        del self._itemsById[piid]
+        if kept:
+            self._itemsById[piid] = kept
+        else:
+            del self._itemsById[piid]
 
     def addItem(self, piid, timestamp, uri, offset, duration,
                 hasAudio, hasVideo):
@@ -118,7 +393,10 @@ class Playlist(object, log.Loggable):
                 "cannot add")
             return None
         # We don't care about anything older than now; drop references to them
-        if current:
+        if current and current is not self.items:
+            for item in self._index.removeBefore(current):
+                self._forgetItem(item)
+            current.prev = None
             self.items = current
 
         newitem = PlaylistItem(piid, timestamp, uri, offset, duration)
@@ -133,45 +411,34 @@ class Playlist(object, log.Loggable):
         # prev starts strictly before the new item
         # next starts after the new item, and ends after the
         # end of the new item
-        prev = next = None
-        item = self.items
-        while item:
-            if item.timestamp < newitem.timestamp:
-                prev = item
-            else:
-                break
-            item = item.next
-
-        if prev:
-            item = prev.next
-        while item:
+        prev = self._index.before(newitem.timestamp)
+        next = None
+        covered = []
+        for item in self._index.after(newitem.timestamp):
             if (item.timestamp > newitem.timestamp and
                     item.timestamp + item.duration >
                     newitem.timestamp + newitem.duration):
                 next = item
                 break
-            item = item.next
+            covered.append(item)
 
-        if prev:
-            # Then things between prev and next (next might be None) are to be
-            # deleted. Do so.
-            cur = prev.next
-            while cur != next:
-                self._itemsById[cur.id].remove(cur)
-                if not self._itemsById[cur.id]:
-                    del self._itemsById[cur.id]
-                self.producer.unscheduleItem(cur)
-                cur = cur.next
+        # Then things between prev and next (next might be None) are to be
+        # deleted. Do so.
+        for cur in covered:
+            self._forgetItem(cur)
+            self.producer.unscheduleItem(cur)
+        if covered:
+            self._index.removeMany(covered)
+        self._index.insert(newitem)
 
         # update links.
+        newitem.prev = prev
+        newitem.next = next
         if prev:
             prev.next = newitem
-            newitem.prev = prev
         else:
             self.items = newitem
-
         if next:
-            newitem.next = next
             next.prev = newitem
 
         # Duration adjustments -> Reflect into gnonlin timeline
@@ -187,7 +454,8 @@ class Playlist(object, log.Loggable):
             ts = newitem.timestamp + newitem.duration
             duration = next.duration - (ts - next.timestamp)
             next.duration = duration
-            next.timestamp = ts
+            # Still between the new item and the one after it
+            self._index.retime(next, ts)
             self.producer.adjustItemScheduling(next)
 
         # Then we need to actually add newitem into the gnonlin timeline
@@ -195,11 +463,16 @@ class Playlist(object, log.Loggable):
             self.debug("Failed to schedule item, unlinking")
             # Failed to schedule it.
             self.unlinkItem(newitem)
+            self._forgetItem(newitem)
             return None
 
         return newitem
 
     def unlinkItem(self, item):
+        if self._index.remove(item):
+            self._unlink(item)
+
+    def _unlink(self, item):
         if item.prev:
             item.prev.next = item.next
         else:
@@ -207,16 +480,37 @@ class Playlist(object, log.Loggable):
 
         if item.next:
             item.next.prev = item.prev
+        item.prev = item.next = None
 
 
 class PlaylistParser(object, log.Loggable):
+    """
+    I discover the files of playlist entries and add them to a playlist.
+
+    Files found in the discovery cache are added right away; the others
+    are discovered by up to maxDiscoverers discoverers at a time.
+
+    @ivar discovered: the number of files discovered, including the ones
+                      found in the discovery cache
+    @type discovered: int
+    """
     logCategory = 'playlist-parse'
 
-    def __init__(self, playlist):
+    def __init__(self, playlist, discoveryCache=None, maxDiscoverers=1):
+        """
+        @param discoveryCache: the cache of discovered files, if any
+        @type  discoveryCache: L{discoverycache.DiscoveryCache}
+        @param maxDiscoverers: how many files to discover at the same time
+        @type  maxDiscoverers: int
+        """
         self.playlist = playlist
+        self.discoveryCache = discoveryCache
+        self.maxDiscoverers = max(1, maxDiscoverers)
+        self.discovered = 0
 
         self._pending_items = []
-        self._discovering = False
+        self._cached_items = [] # [(item, DiscoveredMedia)]
+        self._discovering = 0
         self._discovering_blocked = 0
 
         self._baseDirectory = None
@@ -226,6 +520,13 @@ class PlaylistParser(object, log.Loggable):
             baseDir = baseDir + '/'
         self._baseDirectory = baseDir
 
+    def getPendingCount(self):
+        """
+        @returns: the number of files waiting to be discovered
+        @rtype:   int
+        """
+        return len(self._pending_items) + self._discovering
+
     def blockDiscovery(self):
         """
         Prevent playlist parser from running discoverer on any pending
@@ -257,24 +558,47 @@ class PlaylistParser(object, log.Loggable):
                        chronologically before initiating discovery
         @type  doSort: bool
         """
-        self.log('startDiscovery: discovering: %s, block: %d, pending: %d' %
-                 (self._discovering, self._discovering_blocked,
-                  len(self._pending_items)))
-        if not self._discovering and self._discovering_blocked < 1 \
-               and self._pending_items:
+        self.log('startDiscovery: discovering: %d, block: %d, pending: %d, '
+                 'cached: %d' % (self._discovering, self._discovering_blocked,
+                                 len(self._pending_items),
+                                 len(self._cached_items)))
+        if self._discovering_blocked > 0:
+            return
+        if self._cached_items or (self._pending_items and
+                                  self._discovering < self.maxDiscoverers):
             if doSort:
                 self._sortPending()
             self._discoverPending()
 
     def _sortPending(self):
         self.debug('sort pending: %d' % len(self._pending_items))
-        if not self._pending_items:
-            return
-        sortlist = [(elt[1], elt) for elt in self._pending_items]
-        sortlist.sort()
-        self._pending_items = [elt for (ts, elt) in sortlist]
+        if self._pending_items:
+            sortlist = [(elt[1], elt) for elt in self._pending_items]
+            sortlist.sort()
+            self._pending_items = [elt for (ts, elt) in sortlist]
+        if self._cached_items:
+            sortlist = [(elt[0][1], i, elt)
+                        for i, elt in enumerate(self._cached_items)]
+            sortlist.sort()
+            self._cached_items = [elt for (ts, i, elt) in sortlist]
 
     def _discoverPending(self):
+        if self._discovering_blocked > 0:
+            self.debug("Discovering blocked: %d" % self._discovering_blocked)
+            return
+
+        cached, self._cached_items = self._cached_items, []
+        for item, media in cached:
+            self._addDiscovered(item, media)
+
+        while self._pending_items and \
+                self._discovering < self.maxDiscoverers:
+            self._discover(self._pending_items.pop(0))
+
+        if not self._pending_items and not self._discovering:
+            self.debug("No more files to discover")
+
+    def _discover(self, item):
 
         def _discovered(disc, is_media):
             self.debug("Discovered! is media: %d mime type %s", is_media,
@@ -282,58 +606,19 @@ class PlaylistParser(object, log.Loggable):
             reactor.callFromThread(_discoverer_done, disc, is_media)
 
         def _discoverer_done(disc, is_media):
-            if is_media:
-                self.debug("Discovery complete, media found")
-                # FIXME: does item exist because it is popped below ?
-                # if so, that's ugly and non-obvious and should be fixed
-                uri = "file://" + item[0]
-                timestamp = item[1]
-                duration = item[2]
-                offset = item[3]
-                piid = item[4]
-
-                hasA = disc.is_audio
-                hasV = disc.is_video
-                durationDiscovered = 0
-                if hasA and hasV:
-                    durationDiscovered = min(disc.audiolength,
-                        disc.videolength)
-                elif hasA:
-                    durationDiscovered = disc.audiolength
-                elif hasV:
-                    durationDiscovered = disc.videolength
-                if not duration or duration > durationDiscovered:
-                    duration = durationDiscovered
-
-                if duration + offset > durationDiscovered:
-                    offset = 0
-
-                if duration > 0:
-                    self.playlist.addItem(piid, timestamp, uri,
-                        offset, duration, hasA, hasV)
-                else:
-                    self.warning("Duration of item is zero, not adding")
-            else:
-                self.warning("Discover failed to find media in %s", item[0])
+            self._discovering -= 1
+            media = discoverycache.DiscoveredMedia.fromDiscoverer(disc,
+                                                                  is_media)
+            if self.discoveryCache is not None:
+                self.discoveryCache.store(item[0], media)
+            self._addDiscovered(item, media)
 
             # We don't want to burn too much cpu discovering all the files;
             # this throttles the discovery rate to a reasonable level
             self.debug("Continuing on to next file in one second")
             reactor.callLater(1, self._discoverPending)
 
-        if not self._pending_items:
-            self.debug("No more files to discover")
-            self._discovering = False
-            return
-
-        if self._discovering_blocked > 0:
-            self.debug("Discovering blocked: %d" % self._discovering_blocked)
-            self._discovering = False
-            return
-
-        self._discovering = True
-
-        item = self._pending_items.pop(0)
+        self._discovering += 1
 
         self.debug("Discovering file %s", item[0])
         disc = discoverer.Discoverer(item[0])
@@ -341,6 +626,38 @@ class PlaylistParser(object, log.Loggable):
         disc.connect('discovered', _discovered)
         disc.discover()
 
+    def _addDiscovered(self, item, media):
+        self.discovered += 1
+        if not media.is_media:
+            self.warning("Discover failed to find media in %s", item[0])
+            return
+
+        self.debug("Discovery complete, media found")
+        filename, timestamp, duration, offset, piid = item
+        uri = "file://" + filename
+
+        hasA = media.is_audio
+        hasV = media.is_video
+        durationDiscovered = 0
+        if hasA and hasV:
+            durationDiscovered = min(media.audiolength,
+                media.videolength)
+        elif hasA:
+            durationDiscovered = media.audiolength
+        elif hasV:
+            durationDiscovered = media.videolength
+        if not duration or duration > durationDiscovered:
+            duration = durationDiscovered
+
+        if duration + offset > durationDiscovered:
+            offset = 0
+
+        if duration > 0:
+            self.playlist.addItem(piid, timestamp, uri,
+                offset, duration, hasA, hasV)
+        else:
+            self.warning("Duration of item is zero, not adding")
+
     def addItemToPlaylist(self, filename, timestamp, duration, offset, piid):
         # We only want to add it if it's plausibly schedulable.
         end = timestamp
@@ -353,8 +670,14 @@ class PlaylistParser(object, log.Loggable):
         if filename[0] != '/' and self._baseDirectory:
             filename = self._baseDirectory + filename
 
-        self._pending_items.append((filename, timestamp, duration, offset,
-            piid))
+        item = (filename, timestamp, duration, offset, piid)
+        media = None
+        if self.discoveryCache is not None:
+            media = self.discoveryCache.lookup(filename)
+        if media is not None:
+            self._cached_items.append((item, media))
+        else:
+            self._pending_items.append(item)
 
         # Now launch the discoverer for any pending items
         self.startDiscovery()
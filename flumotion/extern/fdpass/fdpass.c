@@ -32,7 +32,8 @@
  * ([fd], buffer) = fdpass.readfds(socket, size)
  *
  * Write a socket message on fd 'socket', containing one or more fds and a
- * message buffer.
+ * message buffer. All the fds are sent in a single SCM_RIGHTS control
+ * message. Returns the number of bytes of the buffer written.
  * fdpass.writefds(socket, [fd], buffer)
  */
 
@@ -46,7 +47,8 @@
 static PyObject *
 readfds(PyObject *self, PyObject *args)
 {
-  int sockfd, fd, size;
+  int sockfd, size, numfds, i;
+  int *fdptr;
   PyObject *fdobj, *list = NULL, *ret = NULL;
   struct msghdr msg;
   struct iovec iov[1];
@@ -75,6 +77,7 @@ readfds(PyObject *self, PyObject *args)
 
   msg.msg_iov = iov;
   msg.msg_iovlen = 1;
+  msg.msg_flags = 0;
 
   Py_BEGIN_ALLOW_THREADS
   n = recvmsg (sockfd, &msg, 0);
@@ -89,7 +92,7 @@ readfds(PyObject *self, PyObject *args)
 
   msgptr = CMSG_FIRSTHDR (&msg);
   while (msgptr != NULL) {
-    if (msgptr->cmsg_len != CMSG_LEN (sizeof (int)) ||
+    if (msgptr->cmsg_len < CMSG_LEN (sizeof (int)) ||
         msgptr->cmsg_level != SOL_SOCKET ||
         msgptr->cmsg_type != SCM_RIGHTS)
     {
@@ -98,11 +101,14 @@ readfds(PyObject *self, PyObject *args)
       goto done;
     }
 
-    fd = *((int *) CMSG_DATA (msgptr));
-
-    fdobj = PyInt_FromLong ((long)fd);
-    PyList_Append (list, fdobj);
-    Py_DECREF (fdobj);
+    /* A single control message can carry several fds */
+    numfds = (msgptr->cmsg_len - CMSG_LEN (0)) / sizeof (int);
+    fdptr = (int *) CMSG_DATA (msgptr);
+    for (i = 0; i < numfds; i++) {
+      fdobj = PyInt_FromLong ((long)fdptr[i]);
+      PyList_Append (list, fdobj);
+      Py_DECREF (fdobj);
+    }
 
     msgptr = CMSG_NXTHDR (&msg, msgptr);
   }
@@ -137,6 +143,10 @@ writefds(PyObject *self, PyObject *args)
     return NULL;
 
   numfds = PyList_Size (list);
+  if (numfds < 1) {
+    PyErr_SetString(PyExc_ValueError, "No file descriptors to send");
+    return NULL;
+  }
 
   /* Stevens: Unix Network Programming, 3rd Ed. p 428.
    *
@@ -149,25 +159,29 @@ writefds(PyObject *self, PyObject *args)
     struct iovec iov[1];
     struct cmsghdr *msgptr;
     PyObject *fdobj;
-    int fd, i;
+    int *fdptr;
+    int i;
 
     msg.msg_controllen = CMSG_SPACE (sizeof (int) * numfds);
-    msg.msg_control = malloc (msg.msg_controllen);
+    msg.msg_control = calloc (1, msg.msg_controllen);
     if (msg.msg_control == NULL) {
       return PyErr_NoMemory();
     }
 
+    /* All the fds go in a single control message; the kernel would merge
+     * several SCM_RIGHTS messages anyway */
     msgptr = CMSG_FIRSTHDR (&msg);
+    msgptr->cmsg_len = CMSG_LEN (sizeof (int) * numfds);
+    msgptr->cmsg_level = SOL_SOCKET;
+    /* The control message type for FD-passing is called SCM_RIGHTS for some
+     * reason */
+    msgptr->cmsg_type = SCM_RIGHTS;
+
+    fdptr = (int *) CMSG_DATA (msgptr);
     for (i = 0; i < numfds; i++)
     {
-      msgptr->cmsg_len = CMSG_LEN (sizeof(int));
-      msgptr->cmsg_level = SOL_SOCKET;
-      /* The control message type for FD-passing is called SCM_RIGHTS for some
-       * reason */
-      msgptr->cmsg_type = SCM_RIGHTS;
-
-      /* And the actual data: a single int, our passed fd. Convert from python
-       * first, checking that it's valid.
+      /* And the actual data: our passed fds. Convert from python first,
+       * checking that they're valid.
        */
       fdobj = PyList_GetItem (list, i);
       if (!PyInt_Check (fdobj))
@@ -176,11 +190,7 @@ writefds(PyObject *self, PyObject *args)
         free (msg.msg_control);
         return NULL;
       }
-      fd = (int) PyInt_AsLong (fdobj);
-
-      *((int *) CMSG_DATA (msgptr)) = fd;
-
-      msgptr = CMSG_NXTHDR (&msg, msgptr);
+      fdptr[i] = (int) PyInt_AsLong (fdobj);
     }
 
     /* These are used for sending control messages on unconnected sockets; we
@@ -196,6 +206,7 @@ writefds(PyObject *self, PyObject *args)
     iov[0].iov_len = msglen;
     msg.msg_iov = iov;
     msg.msg_iovlen = 1;
+    msg.msg_flags = 0;
 
     Py_BEGIN_ALLOW_THREADS
     ret = sendmsg (sockfd, &msg, 0);
@@ -34,7 +34,7 @@ import sys
 
 from twisted.cred import credentials
 from twisted.internet import reactor, defer
-from twisted.python import failure
+from twisted.python import failure, reflect
 from twisted.spread import pb
 from zope.interface import implements
 
@@ -123,6 +123,23 @@ class JobMedium(medium.BaseMedium):
     def remote_getPid(self):
         return os.getpid()
 
+    def remote_preload(self, moduleNames):
+        """
+        I am called on by the worker's JobAvatar when this job is started
+        ahead of time, to import the modules most components need before
+        being asked to create one.
+
+        @param moduleNames: names of the modules to import
+        @type  moduleNames: list of str
+        """
+        for moduleName in moduleNames:
+            self.debug('preloading module %s', moduleName)
+            try:
+                reflect.namedModule(moduleName)
+            except Exception, e:
+                self.warning('Failed to preload module %s: %s', moduleName,
+                             log.getExceptionMessage(e))
+
     def remote_runFunction(self, moduleName, methodName, *args, **kwargs):
         """
         I am called on by the worker's JobAvatar to run a function,
@@ -287,6 +287,34 @@ class ManagerAvatar(fpb.PingableAvatar, log.Loggable):
         bouncerAvatar = self.heaven.getAvatar(avatarId)
         return bouncerAvatar.authenticate(keycard)
 
+    def perspective_authenticateMany(self, bouncerName, keycards):
+        """
+        Authenticate the given keycards in one call, see
+        L{perspective_authenticate}.
+
+        @param bouncerName: the name of the atmosphere bouncer, or None
+        @type  bouncerName: str or None
+        @param keycards:    the keycards to authenticate
+        @type  keycards:    list of L{flumotion.common.keycards.Keycard}
+
+        @returns: a deferred, returning the list of keycards or None, in the
+                  same order as keycards.
+        """
+        if not bouncerName:
+            self.debug('asked to authenticate %d keycards using manager '
+                       'bouncer', len(keycards))
+            return self.vishnu.bouncer.authenticateMany(keycards)
+
+        self.debug('asked to authenticate %d keycards using bouncer %s',
+                   len(keycards), bouncerName)
+        avatarId = common.componentId('atmosphere', bouncerName)
+        if not self.heaven.hasAvatar(avatarId):
+            self.warning('No bouncer with id %s registered' % avatarId)
+            raise errors.UnknownComponentError(avatarId)
+
+        bouncerAvatar = self.heaven.getAvatar(avatarId)
+        return bouncerAvatar.authenticateMany(keycards)
+
     def perspective_keepAlive(self, bouncerName, issuerName, ttl):
         """
         Resets the expiry timeout for keycards issued by issuerName. See
@@ -431,6 +431,16 @@ class ComponentAvatar(base.ManagerAvatar):
         """
         return self.mindCallRemote('authenticate', keycard)
 
+    def authenticateMany(self, keycards):
+        """
+        Authenticate the given keycards in one call.
+        Gets proxied to L{flumotion.component.bouncers.bouncer.""" \
+        """BouncerMedium.remote_authenticateMany}
+
+        @type  keycards: list of L{flumotion.common.keycards.Keycard}
+        """
+        return self.mindCallRemote('authenticateMany', keycards)
+
     def removeKeycardId(self, keycardId):
         """
         Remove a keycard managed by this bouncer because the requester
@@ -97,6 +97,24 @@ class TrivialBouncerTest(testsuite.TestCase):
         d.addCallback(self.assertAttr, 'state', keycards.AUTHENTICATED)
         return d
 
+    def testAuthenticateMany(self):
+
+        def authenticated(result):
+            self.assertEquals(len(result), 3)
+            self.assertIdentical(result[0], k1)
+            self.assertIdentical(result[1], None)
+            self.assertIdentical(result[2], k3)
+            self.assertEquals(k1.state, keycards.AUTHENTICATED)
+            self.assertEquals(k3.state, keycards.AUTHENTICATED)
+
+        k1 = keycards.KeycardGeneric()
+        # not a keycard class the trivial bouncer accepts
+        k2 = keycards.KeycardUACPP('user', 'test', '127.0.0.1')
+        k3 = keycards.KeycardGeneric()
+        d = self.obj.authenticateMany([k1, k2, k3])
+        d.addCallback(authenticated)
+        return d
+
     def setKeycardExpireInterval(self, interval):
         # can be overridden
         self.obj._expirer.timeout = interval
@@ -106,7 +124,7 @@ class TrivialBouncerTest(testsuite.TestCase):
         # the plan: make a keycard that expires in 0.75 seconds, and
         # set up the component such that it checks for expired keycards
         # every half second. this test will check the keycard's
-        # ttl value at 0.25 seconds and 0.75 seconds, and will
+        # remaining ttl at 0.25 seconds and 0.75 seconds, and will
         # make sure that at 1.25 seconds that the keycard is out of the
         # bouncer.
 
@@ -116,9 +134,10 @@ class TrivialBouncerTest(testsuite.TestCase):
         def checkTimeout(k):
 
             def check(expected, inBouncer, furtherChecks):
-                if k.ttl != expected:
+                ttl = self.obj.getKeycardTTL(k)
+                if ttl != expected:
                     d.errback(AssertionError('ttl %r != expected %r'
-                                             % (k.ttl, expected)))
+                                             % (ttl, expected)))
                     return
                 if inBouncer:
                     if not self.obj.hasKeycard(k):
@@ -138,7 +157,7 @@ class TrivialBouncerTest(testsuite.TestCase):
                     d.callback('success')
             reactor.callLater(0.25, check, 0.75, True,
                               [(0.5, check, 0.25, True),
-                               (0.5, check, -0.25, False)])
+                               (0.5, check, None, False)])
             d = defer.Deferred()
             return d
 
@@ -160,11 +179,11 @@ class TrivialBouncerTest(testsuite.TestCase):
     def testKeepAlive(self):
 
         def adjustTTL(_):
-            self.assertEquals(k.ttl, 0.75)
+            self.assertEquals(self.obj.getKeycardTTL(k), 0.75)
             self.obj.keepAlive('bar', 10)
-            self.assertEquals(k.ttl, 0.75)
+            self.assertEquals(self.obj.getKeycardTTL(k), 0.75)
             self.obj.keepAlive('foo', 10)
-            self.assertEquals(k.ttl, 10)
+            self.assertEquals(self.obj.getKeycardTTL(k), 10)
 
         k = keycards.KeycardGeneric()
         k.ttl = 0.75
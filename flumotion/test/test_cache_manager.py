@@ -416,6 +416,60 @@ class TestCacheManager(testsuite.TestCase):
 
         return d
 
+    def testIndexOrder(self):
+        index = cachemanager.CacheIndex()
+        index.add("a", 100, 1)
+        index.add("b", 200, 2)
+        index.add("c", 300, 3)
+        self.assertEquals(index.usage, 600)
+
+        self.failUnless(index.touch("a", 4))
+        # not accessed long enough after the last access
+        self.failIf(index.touch("b", 5, 60))
+        self.failIf(index.touch("missing", 5))
+
+        self.assertEquals(index.popOldest(), ("b", 200))
+        self.assertEquals(index.popOldest(), ("c", 300))
+        self.assertEquals(index.remove("a"), 100)
+        self.assertEquals(index.popOldest(), None)
+        self.assertEquals(index.usage, 0)
+        self.assertEquals(len(index), 0)
+
+    def testJournalReplay(self):
+        m = cachemanager.CacheManager(self.stats, self.path,
+                                      CACHE_SIZE, True, 0.5, 0.2)
+        journal = open(m._journalPath, "wb")
+        journal.write("+ aaa 100 1\n"
+                      "+ bbb 200 2\n"
+                      "- aaa\n"
+                      "+ ccc 300 3\n"
+                      "* bbb 4\n"
+                      "+ ddd 4") # truncated record
+        journal.close()
+
+        d = m.updateCacheUsage()
+        d.addCallback(lambda u: self.assertEquals(u, 500))
+        d.addCallback(lambda _: self.assertEquals(len(m._index), 2))
+        d.addCallback(lambda _: m._index.popOldest())
+        d.addCallback(lambda o: self.assertEquals(o, ("ccc", 300)))
+        return d
+
+    def testIndexUsage(self):
+        m = cachemanager.CacheManager(self.stats, self.path,
+                                      CACHE_SIZE, False, 0.5, 0.2)
+
+        d = m.newTempFile("indexed", 1024)
+        d.addCallback(self.completeAndClose, m)
+        d.addCallback(lambda _: m.updateCacheUsage())
+        d.addCallback(lambda u: self.assertEquals(u, 1024))
+        d.addCallback(lambda _: self.assertEquals(m._reservedSize, 0))
+
+        d.addCallback(lambda _: m.openCacheFile("indexed"))
+        d.addCallback(lambda c: c.unlink())
+        d.addCallback(lambda _: m.updateCacheUsage())
+        d.addCallback(lambda u: self.assertEquals(u, 0))
+        return d
+
     def testMultiThread(self):
         # FIXME: this test can deadlock....
         return
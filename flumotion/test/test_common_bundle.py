@@ -92,6 +92,18 @@ class TestBundler(testsuite.TestCase):
         self.failUnless(data)
         self.assertEquals(md5sum, python.md5(data).hexdigest())
 
+    def testBundlerCachesZip(self):
+        b = self.bundler.bundle()
+        zip = b.getZip()
+        self.assertIdentical(self.bundler.bundle().getZip(), zip)
+        # files are only read again once they are modified
+        bundledFile = self.bundler._bundledFiles[self.filename]
+        bundledFile._md5sum = 'cached'
+        self.assertEquals(bundledFile.md5sum(), 'cached')
+        os.utime(self.filename, (0, 0))
+        self.assertEquals(bundledFile.md5sum(),
+                          python.md5("this is a test file").hexdigest())
+
     # create a bundle of two files then update one of them and check
     # the md5sum changes
 
@@ -176,6 +188,37 @@ class TestUnbundler(testsuite.TestCase):
         two = open(newfile, "r").read()
         self.assertEquals(one, two)
 
+    def testIsUnbundled(self):
+        bundler = bundle.Bundler("test")
+        bundler.add(self.filename, 'this/is/a/test.py')
+        b = bundler.bundle()
+        unbundler = bundle.Unbundler(self.tempdir)
+        self.failIf(unbundler.isUnbundled('test', b.md5sum))
+
+        dir = unbundler.unbundle(b)
+        self.failUnless(unbundler.isUnbundled('test', b.md5sum))
+        self.failIf(unbundler.isUnbundled('test', 'another sum'))
+
+        # a damaged file needs the bundle to be unbundled again
+        newfile = os.path.join(dir, 'this/is/a/test.py')
+        handle = open(newfile, 'w')
+        handle.write('this is not a test file')
+        handle.close()
+        self.failIf(unbundler.isUnbundled('test', b.md5sum))
+        unbundler.unbundle(b)
+        self.failUnless(unbundler.isUnbundled('test', b.md5sum))
+
+        # as does a bundle left without manifest
+        os.unlink(dir + '.manifest')
+        self.failIf(unbundler.isUnbundled('test', b.md5sum))
+
+    def testUnbundleEmpty(self):
+        b = bundle.Bundler("empty").bundle()
+        unbundler = bundle.Unbundler(self.tempdir)
+        dir = unbundler.unbundle(b)
+        self.failUnless(os.path.isdir(dir))
+        self.failUnless(unbundler.isUnbundled('empty', b.md5sum))
+
 
 class TestBundlerBasket(testsuite.TestCase):
     # everything we need to set up the test environment
@@ -0,0 +1,107 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_expiry -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import random
+
+from flumotion.common import testsuite
+from flumotion.common.expiry import ExpiryQueue
+
+
+class TestExpiryQueue(testsuite.TestCase):
+
+    def testExpiry(self):
+        queue = ExpiryQueue()
+        queue.add('a', 3)
+        queue.add('b', 1)
+        queue.add('c', None)
+        self.assertEquals(len(queue), 3)
+        self.assertEquals(queue.getTTL('a'), 3)
+        self.assertEquals(queue.getTTL('c'), None)
+        self.assertEquals(queue.advance(1), ['b'])
+        self.assertEquals(queue.getTTL('a'), 2)
+        self.assertEquals(queue.getTTL('b'), None)
+        self.assertEquals(queue.advance(1), [])
+        self.assertEquals(queue.advance(5), ['a'])
+        self.assertEquals(list(queue._entries), ['c'])
+
+    def testDiscardAndReAdd(self):
+        queue = ExpiryQueue()
+        queue.add('a', 1)
+        queue.discard('a')
+        queue.discard('a')
+        self.failIf('a' in queue)
+        queue.add('b', 1)
+        queue.add('b', 5)
+        self.assertEquals(queue.advance(2), [])
+        self.assertEquals(queue.advance(3), ['b'])
+
+    def testKeepAlive(self):
+        queue = ExpiryQueue()
+        queue.add('a', 1, 'issuer')
+        queue.add('b', 2, 'issuer')
+        queue.add('c', 1, 'other')
+        queue.add('d', None, 'issuer')
+        queue.keepAlive('issuer', 10)
+        queue.keepAlive('unknown', 10)
+        self.assertEquals(queue.getTTL('a'), 10)
+        self.assertEquals(queue.getTTL('d'), 10)
+        # added after the keepAlive, keeps its own ttl
+        queue.add('e', 1, 'issuer')
+        self.assertEquals(queue.advance(1), ['c', 'e'])
+        self.assertEquals(queue.getTTL('b'), 9)
+        self.assertEquals(sorted(queue.advance(9)), ['a', 'b', 'd'])
+        self.assertEquals(len(queue), 0)
+        self.assertEquals(queue._groups, {})
+
+    def testRandomAgainstNaive(self):
+        rand = random.Random(42)
+        queue = ExpiryQueue()
+        ttls = {} # key -> (ttl, group)
+        for i in range(5000):
+            action = rand.random()
+            if action < 0.5:
+                key = rand.randint(0, 300)
+                group = rand.choice([None, 'x', 'y'])
+                ttls[key] = (rand.randint(1, 50), group)
+                queue.add(key, *ttls[key])
+            elif action < 0.6 and ttls:
+                key = rand.choice(ttls.keys())
+                del ttls[key]
+                queue.discard(key)
+            elif action < 0.7:
+                group = rand.choice(['x', 'y'])
+                ttl = rand.randint(1, 50)
+                for key, (_, g) in ttls.items():
+                    if g == group:
+                        ttls[key] = (ttl, g)
+                queue.keepAlive(group, ttl)
+            else:
+                expected = []
+                for key, (ttl, g) in ttls.items():
+                    ttl -= 1
+                    ttls[key] = (ttl, g)
+                    if ttl <= 0:
+                        expected.append(key)
+                        del ttls[key]
+                self.assertEquals(sorted(queue.advance(1)), sorted(expected))
+            self.assertEquals(len(queue), len(ttls))
+            for key, (ttl, g) in ttls.items():
+                self.assertEquals(queue.getTTL(key), ttl)
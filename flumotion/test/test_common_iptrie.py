@@ -0,0 +1,133 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_iptrie -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import random
+
+from flumotion.common import iptrie
+from flumotion.common import testsuite
+from flumotion.common.netutils import ipv4StringToInt
+
+
+def net(s):
+    ip, bits = s.split('/')
+    return ipv4StringToInt(ip), int(bits)
+
+
+class TestIPTrie(testsuite.TestCase):
+
+    def naiveMatches(self, keys, address, width):
+        found = [(bits, n) for n, bits in keys
+                 if address >> (width - bits) == n >> (width - bits)]
+        found.sort(reverse=True)
+        return [(n, bits) for bits, n in found]
+
+    def testEmpty(self):
+        trie = iptrie.IPTrie()
+        self.assertEquals(len(trie), 0)
+        self.assertEquals(trie.longestPrefix(0), None)
+        self.assertEquals(trie.longestPrefixValue(0, 'x'), 'x')
+        self.assertEquals(list(trie.iterMatches(0)), [])
+        self.assertRaises(KeyError, trie.__getitem__, (0, 0))
+        self.assertRaises(KeyError, trie.__delitem__, (0, 0))
+
+    def testSetGet(self):
+        trie = iptrie.IPTrie()
+        trie[net('192.168.1.0/24')] = 'a'
+        trie[net('192.168.0.0/16')] = 'b'
+        trie[net('192.168.1.128/25')] = 'c'
+        trie[net('0.0.0.0/0')] = 'd'
+        self.assertEquals(len(trie), 4)
+        self.assertEquals(trie[net('192.168.1.0/24')], 'a')
+        self.assertEquals(trie[net('0.0.0.0/0')], 'd')
+        self.failIf(net('192.168.1.0/25') in trie)
+        self.assertEquals(trie.get(net('192.168.0.0/24'), 'x'), 'x')
+        trie[net('192.168.1.0/24')] = 'e'
+        self.assertEquals(len(trie), 4)
+        self.assertEquals(sorted(trie.keys()),
+                          sorted([net('192.168.1.0/24'),
+                                  net('192.168.0.0/16'),
+                                  net('192.168.1.128/25'),
+                                  net('0.0.0.0/0')]))
+
+    def testInvalidKeys(self):
+        trie = iptrie.IPTrie()
+        self.assertRaises(ValueError, trie.__setitem__,
+                          net('192.168.1.1/24'), 'a')
+        self.assertRaises(ValueError, trie.__setitem__, (0, 33), 'a')
+        self.assertRaises(ValueError, trie.__setitem__, (1 << 32, 32), 'a')
+
+    def testMatches(self):
+        trie = iptrie.IPTrie()
+        trie[net('192.168.1.0/24')] = 'a'
+        trie[net('192.168.0.0/16')] = 'b'
+        trie[net('192.168.1.1/32')] = 'c'
+        ip = ipv4StringToInt('192.168.1.1')
+        self.assertEquals([v for k, v in trie.iterMatches(ip)],
+                          ['c', 'a', 'b'])
+        self.assertEquals(trie.longestPrefix(ip),
+                          (net('192.168.1.1/32'), 'c'))
+        ip = ipv4StringToInt('192.168.2.1')
+        self.assertEquals(trie.longestPrefixValue(ip), 'b')
+        self.assertEquals(trie.longestPrefix(ipv4StringToInt('10.0.0.1')),
+                          None)
+
+    def testIPv6(self):
+        trie = iptrie.IPTrie(128)
+        trie[0x20010db8 << 96, 32] = 'doc'
+        trie[0x20010db8000000010000000000000000, 64] = 'subnet'
+        self.assertEquals(trie.longestPrefixValue(
+            0x20010db8000000010000000000000001), 'subnet')
+        self.assertEquals(trie.longestPrefixValue(
+            0x20010db8000000020000000000000001), 'doc')
+        self.assertEquals(trie.longestPrefixValue(1), None)
+
+    def testBitLength(self):
+        self.assertEquals(iptrie._bitLength(0), 0)
+        self.assertEquals(iptrie._bitLength(1), 1)
+        self.assertEquals(iptrie._bitLength(255), 8)
+        self.assertEquals(iptrie._bitLength(256), 9)
+        self.assertEquals(iptrie._bitLength(0xffffffffL), 32)
+        self.assertEquals(iptrie._bitLength(1L << 127), 128)
+
+    def testRandomAgainstNaive(self):
+        rand = random.Random(42)
+        width = 16
+
+        def randomNet():
+            bits = rand.randint(0, width)
+            address = rand.randint(0, (1 << width) - 1)
+            return (address >> (width - bits)) << (width - bits), bits
+
+        trie = iptrie.IPTrie(width)
+        keys = set()
+        for _ in range(3000):
+            key = randomNet()
+            if key in keys and rand.random() < 0.5:
+                keys.remove(key)
+                del trie[key]
+            else:
+                keys.add(key)
+                trie[key] = key
+            self.assertEquals(len(trie), len(keys))
+            address = rand.randint(0, (1 << width) - 1)
+            self.assertEquals([k for k, v in trie.iterMatches(address)],
+                              self.naiveMatches(keys, address, width))
+        self.assertEquals(sorted(trie.keys()), sorted(keys))
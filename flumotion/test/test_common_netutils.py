@@ -126,6 +126,21 @@ class TestRoutingTable(testsuite.TestCase):
             results = [result for result in net.route_iter(ip)]
             self.assertEquals(expected, results)
 
+    def testRouteIterationSameSubnet(self):
+        net = RoutingTable()
+        net.addSubnet('a', '10.0.0.0', 8)
+        net.addSubnet('c', '10.0.0.0', 8)
+        net.addSubnet('b', '10.0.0.0', 8)
+        net.addSubnet('d', '10.1.0.0', 16)
+        self.assertEquals(list(net.route_iter('10.1.2.3')),
+                          ['d', 'c', 'b', 'a', None])
+        self.assertEquals(net.route('10.2.0.0'), 'c')
+        net.removeSubnet('c', '10.0.0.0', 8)
+        self.assertEquals(net.route('10.2.0.0'), 'b')
+        net.removeSubnet('d', '10.1.0.0', 16)
+        self.assertEquals(list(net.route_iter('10.1.2.3')),
+                          ['b', 'a', None])
+
     def testRoutingPrecedence(self):
         net = RoutingTable()
 
@@ -0,0 +1,126 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_pathtree -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import random
+
+from flumotion.common import pathtree
+from flumotion.common import testsuite
+
+
+class TestPathTree(testsuite.TestCase):
+
+    def naivePrefix(self, keys, path):
+        found = None
+        for key in keys:
+            if path.startswith(key) and (found is None
+                                         or len(found) < len(key)):
+                found = key
+        return found
+
+    def testEmpty(self):
+        tree = pathtree.PathTree()
+        self.assertEquals(len(tree), 0)
+        self.failIf('/' in tree)
+        self.assertEquals(tree.longestPrefix('/foo'), None)
+        self.assertEquals(tree.longestPrefixValue('/foo', 'x'), 'x')
+        self.assertRaises(KeyError, tree.__getitem__, '/')
+        self.assertRaises(KeyError, tree.__delitem__, '/')
+
+    def testSetGet(self):
+        tree = pathtree.PathTree()
+        tree['/live/'] = 1
+        tree['/live/hd'] = 2
+        tree['/lives'] = 3
+        tree['/l'] = 4
+        self.assertEquals(len(tree), 4)
+        self.assertEquals(tree['/live/'], 1)
+        self.assertEquals(tree['/live/hd'], 2)
+        self.assertEquals(tree['/lives'], 3)
+        self.assertEquals(tree['/l'], 4)
+        self.failIf('/live' in tree)
+        self.failIf('/' in tree)
+        self.assertEquals(tree.get('/live', 'x'), 'x')
+
+        tree['/live/'] = 5
+        self.assertEquals(len(tree), 4)
+        self.assertEquals(tree['/live/'], 5)
+        self.assertEquals(sorted(tree.keys()),
+                          ['/l', '/live/', '/live/hd', '/lives'])
+
+    def testLongestPrefix(self):
+        tree = pathtree.PathTree([('/', 'root'), ('/files/', 'files'),
+                                  ('/files/big/', 'big')])
+        self.assertEquals(tree.longestPrefix('/'), ('/', 'root'))
+        self.assertEquals(tree.longestPrefix('/other'), ('/', 'root'))
+        self.assertEquals(tree.longestPrefix('/files'), ('/', 'root'))
+        self.assertEquals(tree.longestPrefix('/files/a'),
+                          ('/files/', 'files'))
+        self.assertEquals(tree.longestPrefixValue('/files/big/a/b'), 'big')
+        self.assertEquals(tree.longestPrefixValue('/files/bigger'), 'files')
+        self.assertEquals(tree.longestPrefix(''), None)
+
+        tree[''] = 'empty'
+        self.assertEquals(tree.longestPrefix('nothing'), ('', 'empty'))
+
+    def testDelete(self):
+        tree = pathtree.PathTree()
+        for key in ['/a', '/ab', '/abc', '/abd', '/b']:
+            tree[key] = key
+        del tree['/ab']
+        self.failIf('/ab' in tree)
+        self.assertEquals(tree.longestPrefixValue('/abx'), '/a')
+        self.assertEquals(tree['/abc'], '/abc')
+        del tree['/abc']
+        self.assertEquals(tree['/abd'], '/abd')
+        self.assertRaises(KeyError, tree.__delitem__, '/abc')
+        self.assertRaises(KeyError, tree.__delitem__, '/ab')
+        del tree['/abd']
+        del tree['/a']
+        self.assertEquals(tree.keys(), ['/b'])
+        self.assertEquals(len(tree), 1)
+        self.assertEquals(tree.longestPrefix('/abd'), None)
+
+    def testRandomAgainstNaive(self):
+        rand = random.Random(42)
+
+        def randomPath():
+            return '/' + '/'.join([rand.choice(['a', 'ab', 'b', 'abc'])
+                                   for _ in range(rand.randint(0, 4))])
+
+        tree = pathtree.PathTree()
+        keys = set()
+        for _ in range(2000):
+            key = randomPath()
+            if key in keys and rand.random() < 0.5:
+                keys.remove(key)
+                del tree[key]
+            else:
+                keys.add(key)
+                tree[key] = key
+            self.assertEquals(len(tree), len(keys))
+            path = randomPath() + rand.choice(['', 'x'])
+            found = tree.longestPrefix(path)
+            expected = self.naivePrefix(keys, path)
+            if expected is None:
+                self.assertEquals(found, None)
+            else:
+                self.assertEquals(found, (expected, expected))
+        self.assertEquals(sorted(tree.keys()), sorted(keys))
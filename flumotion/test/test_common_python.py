@@ -0,0 +1,77 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+from flumotion.common import python
+from flumotion.common import testsuite
+
+
+class _OrderedDictTests:
+    orderedDict = None
+
+    def setUp(self):
+        self.dict = self.orderedDict()
+        for key in 'cab':
+            self.dict[key] = key.upper()
+
+    def testOrder(self):
+        self.assertEquals(self.dict.keys(), ['c', 'a', 'b'])
+        self.assertEquals(self.dict.values(), ['C', 'A', 'B'])
+        self.assertEquals(list(self.dict.iteritems()),
+                          [('c', 'C'), ('a', 'A'), ('b', 'B')])
+        # Replacing a value keeps the key in place
+        self.dict['c'] = 'X'
+        self.assertEquals(list(self.dict), ['c', 'a', 'b'])
+
+    def testRemove(self):
+        del self.dict['a']
+        self.assertEquals(self.dict.pop('c'), 'C')
+        self.assertEquals(self.dict.pop('c', None), None)
+        self.assertRaises(KeyError, self.dict.pop, 'c')
+        self.dict['a'] = 'A'
+        self.assertEquals(self.dict.keys(), ['b', 'a'])
+        self.assertEquals(len(self.dict), 2)
+        self.failIf('c' in self.dict)
+
+    def testPopItem(self):
+        self.assertEquals(self.dict.popitem(last=False), ('c', 'C'))
+        self.assertEquals(self.dict.popitem(), ('b', 'B'))
+        self.assertEquals(self.dict.popitem(), ('a', 'A'))
+        self.assertRaises(KeyError, self.dict.popitem)
+
+    def testMoveToEnd(self):
+        self.dict['c'] = self.dict.pop('c')
+        self.assertEquals(self.dict.keys(), ['a', 'b', 'c'])
+        self.assertEquals(self.dict.itervalues().next(), 'A')
+
+    def testClear(self):
+        self.dict.clear()
+        self.assertEquals(self.dict.keys(), [])
+        self.dict['d'] = 'D'
+        self.assertEquals(self.dict.items(), [('d', 'D')])
+
+
+class TestOrderedDict(_OrderedDictTests, testsuite.TestCase):
+    orderedDict = python.OrderedDict
+
+
+class TestCompatOrderedDict(_OrderedDictTests, testsuite.TestCase):
+    # The implementation used before python 2.7
+    orderedDict = python._OrderedDict
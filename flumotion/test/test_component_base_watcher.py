@@ -22,10 +22,14 @@
 from twisted.internet import reactor, defer
 from flumotion.common import testsuite
 from flumotion.component.base import watcher
+from flumotion.twisted import inotify
 import tempfile
 import os
+import shutil
 import time
 
+FILE_COUNT = 100000
+
 
 class WatcherTest(testsuite.TestCase):
 
@@ -57,3 +61,120 @@ class WatcherTest(testsuite.TestCase):
         os.write(fd, "test")
         os.close(fd)
         return d
+
+
+class _DirectoryWatcherTests:
+    # Mixed with TestCase below, with and without inotify
+
+    useInotify = None
+    fileCount = None
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.changed = []
+        self.deleted = []
+        self.watcher = watcher.DirectoryWatcher(self.path, timeout=0.5)
+        self.watcher.useInotify = self.useInotify
+        self.watcher.subscribe(fileChanged=self.changed.append,
+                               fileDeleted=self.deleted.append)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def getPath(self, i, prefix='file'):
+        return os.path.join(self.path, '%s%06d' % (prefix, i))
+
+    def waitFor(self, events, count, timeout=120.0):
+        # Fires when the list of events has count distinct files
+        d = defer.Deferred()
+        deadline = time.time() + timeout
+
+        def check():
+            if len(set(events)) >= count:
+                d.callback(None)
+            elif time.time() > deadline:
+                d.errback(AssertionError("only %d of %d events after %fs"
+                                         % (len(set(events)), count,
+                                            timeout)))
+            else:
+                reactor.callLater(0.05, check)
+        check()
+        return d
+
+    def testLifecycle(self):
+        n = self.fileCount
+        for i in range(n):
+            f = open(self.getPath(i), 'w')
+            f.write('x')
+            f.close()
+        d = self.waitFor(self.changed, n)
+
+        def checkCreated(_):
+            self.assertEquals(set(self.changed),
+                              set([self.getPath(i) for i in range(n)]))
+            self.assertEquals(self.deleted, [])
+            del self.changed[:]
+            # modify a tenth of the files
+            for i in range(0, n, 10):
+                f = open(self.getPath(i), 'a')
+                f.write('more')
+                f.close()
+            return self.waitFor(self.changed, n / 10)
+
+        def checkModified(_):
+            self.assertEquals(set(self.changed),
+                              set([self.getPath(i)
+                                   for i in range(0, n, 10)]))
+            del self.changed[:]
+            # rename another tenth
+            for i in range(1, n, 10):
+                os.rename(self.getPath(i), self.getPath(i, 'renamed'))
+            return defer.DeferredList([self.waitFor(self.changed, n / 10),
+                                       self.waitFor(self.deleted, n / 10)],
+                                      fireOnOneErrback=True)
+
+        def checkRenamed(_):
+            self.assertEquals(set(self.changed),
+                              set([self.getPath(i, 'renamed')
+                                   for i in range(1, n, 10)]))
+            self.assertEquals(set(self.deleted),
+                              set([self.getPath(i)
+                                   for i in range(1, n, 10)]))
+            del self.changed[:]
+            del self.deleted[:]
+            # and delete another tenth
+            for i in range(2, n, 10):
+                os.remove(self.getPath(i))
+            return self.waitFor(self.deleted, n / 10)
+
+        def checkDeleted(_):
+            self.assertEquals(set(self.deleted),
+                              set([self.getPath(i)
+                                   for i in range(2, n, 10)]))
+            self.assertEquals(self.changed, [])
+
+        d.addCallback(checkCreated)
+        d.addCallback(checkModified)
+        d.addCallback(checkRenamed)
+        d.addCallback(checkDeleted)
+        return d
+    testLifecycle.timeout = 600
+
+
+class InotifyDirectoryWatcherTest(_DirectoryWatcherTests,
+                                  testsuite.TestCase):
+
+    useInotify = True
+    fileCount = FILE_COUNT
+
+    if not inotify.HAS_INOTIFY:
+        skip = "inotify is not available"
+
+
+class PollingDirectoryWatcherTest(_DirectoryWatcherTests,
+                                  testsuite.TestCase):
+
+    useInotify = False
+    fileCount = 1000
@@ -19,6 +19,7 @@
 
 # Headers in this file shall remain intact.
 
+import errno
 import os
 import shutil
 import tempfile
@@ -32,8 +33,11 @@ from twisted.web.static import Data
 
 from flumotion.common import log
 from flumotion.common import testsuite
+from flumotion.component.base import timerwheel
+from flumotion.component.misc.httpserver import fileprovider
 from flumotion.component.misc.httpserver import httpfile, httpserver
-from flumotion.component.misc.httpserver import localprovider
+from flumotion.component.misc.httpserver import localprovider, mp4cache
+from flumotion.component.misc.httpserver import serverstats
 from flumotion.component.plugs.base import ComponentPlug
 from flumotion.component.plugs.cortado import cortado
 from flumotion.test import test_http
@@ -179,6 +183,25 @@ class MountTest(testsuite.TestCase):
         d3.addErrback(lambda f: f.trap(error.Error))
         return defer.DeferredList([d1, d2, d3], fireOnOneErrback=True)
 
+    def testStopRemovesTimeouts(self):
+        properties = {
+            u'mount-point': '/',
+            u'path': self.path,
+            u'port': 0,
+        }
+        self.makeComponent(properties)
+
+        request = FakeRequest(transport=FakeTransport(100))
+        request.channel = request
+        self.component.requestStarted(request)
+        wheel = timerwheel.getTimerWheel()
+        self.failUnless(request in wheel)
+
+        # The client is not gone yet, but its timeout is
+        self.component.stop()
+        self.failIf(request in wheel)
+        self.component = None
+
 
 class _Resource(Resource):
 
@@ -351,6 +374,11 @@ class PlugTest(testsuite.TestCase):
         return d
 
 
+class FakeTransport(test_http.FakeFdTransport):
+
+    def loseConnection(self):
+        pass
+
 # FIXME: maybe merge into test_http's fake request ?
 
 
@@ -579,10 +607,12 @@ class FakeSplitter(object):
     CHUNK_SIZE = 3
     HEADER = 'fake header'
     failure = None
+    created = 0
 
     def __init__(self, t):
         self.t = t
         self.data = StringIO()
+        FakeSplitter.created += 1
 
     def start(self, data_cb):
         self.data_cb = data_cb
@@ -813,6 +843,205 @@ class TestDirectory(testsuite.TestCase):
         fr.finishDeferred.addCallback(finish)
         return fr.finishDeferred
 
+    def requestMP4(self, resource, start):
+        fr = FakeRequest(args={'start': [start]})
+        self.assertEquals(resource.getChild('test.mp4', fr).render(fr),
+            server.NOT_DONE_YET)
+
+        def finish(result):
+            expected = (FakeSplitter.HEADER +
+                        'a fake MP4 file'[FakeSplitter.OFFSET:])
+            self.assertEquals(fr.data, expected)
+            self.assertEquals(fr.getHeader('Content-Length'),
+                str(len(expected)))
+        fr.finishDeferred.addCallback(finish)
+        return fr.finishDeferred
+
+    def testMP4SeekIndexCache(self):
+        cache = mp4cache.SeekIndexCache(1024)
+        resource = httpfile.File(self.component.getRoot(), self.component,
+            {'video/mp4': httpfile.MP4File}, seekIndexCache=cache)
+        created = FakeSplitter.created
+
+        d = self.requestMP4(resource, 2)
+        d.addCallback(lambda _: self.requestMP4(resource, 2))
+
+        def checkSameStart(_):
+            self.assertEquals(FakeSplitter.created, created + 1)
+            self.assertEquals((cache.hits, cache.misses), (1, 1))
+            self.assertEquals(cache.usage, FakeSplitter.CHUNK_SIZE +
+                              len(FakeSplitter.HEADER))
+
+        d.addCallback(checkSameStart)
+        # Another start is parsed again, from the data kept in memory
+        d.addCallback(lambda _: self.requestMP4(resource, 4))
+
+        def checkOtherStart(_):
+            self.assertEquals(FakeSplitter.created, created + 2)
+            self.assertEquals((cache.hits, cache.misses), (1, 2))
+            self.assertEquals(cache.usage, FakeSplitter.CHUNK_SIZE +
+                              2 * len(FakeSplitter.HEADER))
+
+        d.addCallback(checkOtherStart)
+        return d
+
+
+class TestSeekIndexCache(testsuite.TestCase):
+
+    def setUp(self):
+        self.cache = mp4cache.SeekIndexCache(100, maxSeekPoints=2)
+
+    def testSeekPoints(self):
+        key = ('/a.mp4', 1, 1000)
+        self.assertEquals(self.cache.getSeekPoint(key, 1.0), None)
+        self.cache.addSeekPoint(key, 1.0, 'header1', 10)
+        self.cache.addSeekPoint(key, 2.0, 'header2', 20)
+        self.assertEquals(self.cache.getSeekPoint(key, 1.0),
+                          ('header1', 10))
+        # Only the most recent seek points are kept
+        self.cache.addSeekPoint(key, 3.0, 'header3', 30)
+        self.assertEquals(self.cache.getSeekPoint(key, 2.0), None)
+        self.assertEquals(self.cache.getSeekPoint(key, 1.0),
+                          ('header1', 10))
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 2))
+        self.assertEquals(self.cache.usage, 14)
+
+    def testChanged(self):
+        self.cache.addChunk(('/a.mp4', 1, 1000), 0, 'moov')
+        self.assertEquals(self.cache.getChunk(('/a.mp4', 1, 1000), 0, 4),
+                          'moov')
+        self.assertEquals(self.cache.getChunk(('/a.mp4', 2, 1000), 0, 4),
+                          None)
+        self.assertEquals(self.cache.usage, 0)
+
+    def testEviction(self):
+        self.cache.addChunk(('/a.mp4', 1, 1000), 0, 'a' * 60)
+        self.cache.addChunk(('/b.mp4', 1, 1000), 0, 'b' * 30)
+        self.cache.getChunk(('/a.mp4', 1, 1000), 0, 60)
+        self.cache.addChunk(('/c.mp4', 1, 1000), 0, 'c' * 30)
+        self.assertEquals(self.cache.getChunk(('/b.mp4', 1, 1000), 0, 30),
+                          None)
+        self.assertEquals(self.cache.usage, 90)
+        # Too big to be kept at all
+        self.cache.addChunk(('/d.mp4', 1, 1000), 0, 'd' * 200)
+        self.assertEquals(self.cache.usage, 90)
+
+
+class FakeSendfileProvider(fileprovider.File):
+    """
+    A file provider whose sendfile() replays the given outcomes: a size
+    to send, EAGAIN to raise, or None when sendfile cannot be used.
+    """
+
+    def __init__(self, data, outcomes):
+        self.data = data
+        self.outcomes = list(outcomes)
+        self.position = 0
+        self.closed = False
+
+    def tell(self):
+        return self.position
+
+    def read(self, size):
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return defer.succeed(data)
+
+    def sendfile(self, fd, size):
+        outcome = self.outcomes.pop(0)
+        if outcome == errno.EAGAIN:
+            raise OSError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        if outcome is None:
+            return None
+        sent = min(outcome, size, len(self.data) - self.position)
+        self.position += sent
+        return sent
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSocketTransport(object):
+
+    def __init__(self):
+        self.writing = 0
+
+    def fileno(self):
+        return 42
+
+    def startWriting(self):
+        self.writing += 1
+
+
+class ZeroCopyRequest(FakeRequest):
+
+    def __init__(self, **kwargs):
+        FakeRequest.__init__(self, **kwargs)
+        self.transport = FakeSocketTransport()
+        self.writes = []
+        self.serverStats = serverstats.ServerStatistics()
+        self.stats = serverstats.RequestStatistics(self.serverStats)
+
+    def registerProducer(self, producer, streaming):
+        # The test resumes the producer like the transport would
+        self.producer = producer
+
+    def write(self, data):
+        FakeRequest.write(self, data)
+        self.writes.append(data)
+        self.stats.onDataSent(len(data))
+
+    def wroteDirectly(self, size):
+        self.stats.onDataSent(size, zeroCopy=True)
+
+
+class TestFileTransfer(testsuite.TestCase):
+
+    def transfer(self, data, outcomes):
+        self.provider = FakeSendfileProvider(data, outcomes)
+        self.request = ZeroCopyRequest()
+        return httpfile.FileTransfer(self.provider, len(data), self.request,
+                                     zeroCopy=True)
+
+    def testSendfile(self):
+        transfer = self.transfer('0123456789', [4, errno.EAGAIN, 6])
+        # The headers are flushed first, without sending the file
+        transfer.resumeProducing()
+        self.assertEquals(self.request.writes, [''])
+        self.assertEquals(self.provider.position, 0)
+        self.assertEquals(self.request.transport.writing, 1)
+
+        transfer.resumeProducing()
+        self.assertEquals(self.provider.position, 4)
+        # A full socket waits for the transport to resume the transfer
+        transfer.resumeProducing()
+        self.assertEquals(self.provider.position, 4)
+        self.assertEquals(self.request.transport.writing, 3)
+        transfer.resumeProducing()
+        self.assertEquals(self.provider.position, 10)
+        self.failIf(self.request.finishDeferred.called)
+
+        transfer.resumeProducing()
+        self.failUnless(self.request.finishDeferred.called)
+        self.failUnless(self.provider.closed)
+        self.assertEquals(transfer.bytesWritten, 10)
+        self.assertEquals(self.request.writes, [''])
+        self.assertEquals(self.request.serverStats.totalBytesSent, 10)
+        self.assertEquals(self.request.serverStats.totalBytesSentZeroCopy,
+                          10)
+
+    def testFallback(self):
+        transfer = self.transfer('0123456789', [None])
+        transfer.resumeProducing()
+        # The file cannot be sent with sendfile, it is copied instead
+        transfer.resumeProducing()
+        self.failUnless(self.request.finishDeferred.called)
+        self.assertEquals(self.request.data, '0123456789')
+        self.assertEquals(transfer.bytesWritten, 10)
+        self.assertEquals(self.request.serverStats.totalBytesSent, 10)
+        self.assertEquals(self.request.serverStats.totalBytesSentZeroCopy,
+                          0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,238 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import testsuite
+from flumotion.component.misc.httpserver import fileprovider
+from flumotion.component.misc.httpserver.httpcached import block_cache
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import http_utils
+
+BLOCK_SIZE = 1024
+DATA_SIZE = BLOCK_SIZE * 10 + BLOCK_SIZE / 2
+MTIME = 1234567890
+IDENT = "dummy"
+URL = http_utils.Url.fromString("http://www.flumotion.net/dummy")
+
+
+class FakeOrigin(object):
+    """
+    Serves range requests for a single resource,
+    counting the requests and the bytes sent.
+    """
+
+    def __init__(self, data, mtime):
+        self.data = data
+        self.mtime = mtime
+        self.requests = []
+        self.bytes = 0
+
+    def retrieve(self, consumer, url, start=None, size=None,
+                 ifModifiedSince=None, ifUnmodifiedSince=None):
+        self.requests.append((start, size))
+        reactor.callLater(0.001, self._reply, consumer, start, size,
+                          ifUnmodifiedSince)
+
+    def _reply(self, consumer, start, size, ifUnmodifiedSince):
+        if ifUnmodifiedSince and ifUnmodifiedSince < self.mtime:
+            consumer.conditionFail(self, common.STREAM_MODIFIED,
+                                   "Modified")
+            return
+        if start >= len(self.data):
+            consumer.serverError(self, common.RANGE_NOT_SATISFIABLE,
+                                 "Range not satisfiable")
+            return
+        data = self.data[start:start + size]
+        self.bytes += len(data)
+        consumer.onData(self, data)
+        consumer.streamDone(self)
+
+
+class TestBlockCache(testsuite.TestCase):
+
+    def setUp(self):
+        from twisted.python import threadpool
+        reactor.threadpool = threadpool.ThreadPool(0, 10)
+        reactor.threadpool.start()
+
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.data = os.urandom(DATA_SIZE)
+        self.origin = FakeOrigin(self.data, MTIME)
+        self.cache = self._newCache()
+        return self.cache.setup()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+        reactor.threadpool.stop()
+        reactor.threadpool = None
+
+    def _newCache(self, maxSize=DATA_SIZE * 4):
+        return block_cache.BlockCache(self.origin, self.path, maxSize,
+                                      BLOCK_SIZE)
+
+    def _read(self, offset, size, ident=IDENT, mtime=MTIME, cache=None):
+        cache = cache or self.cache
+        d = cache.read(ident, URL, offset, size, DATA_SIZE, mtime)
+        d.addCallback(self._checkData, offset, size)
+        return d
+
+    def _checkData(self, data, offset, size):
+        self.assertEquals(data, self.data[offset:offset + size])
+        return data
+
+    def testCoalescing(self):
+        # Overlapping requests share the same upstream retrieval
+        d = defer.gatherResults([self._read(100, BLOCK_SIZE * 3),
+                                 self._read(BLOCK_SIZE, BLOCK_SIZE * 2),
+                                 self._read(BLOCK_SIZE * 2 + 10, 20)])
+
+        def check(_):
+            self.assertEquals(self.origin.requests, [(0, BLOCK_SIZE * 4)])
+            self.assertEquals(self.origin.bytes, BLOCK_SIZE * 4)
+            self.assertEquals(self.cache.usage, BLOCK_SIZE * 4)
+
+        d.addCallback(check)
+        return d
+
+    def testSparseFilling(self):
+        d = self._read(BLOCK_SIZE * 2, BLOCK_SIZE)
+        d.addCallback(lambda _: self._read(BLOCK_SIZE * 6 + 10, 30))
+        # Only the missing blocks are retrieved
+        d.addCallback(lambda _: self._read(BLOCK_SIZE, BLOCK_SIZE * 7))
+
+        def check(_):
+            self.assertEquals(self.origin.requests,
+                              [(BLOCK_SIZE * 2, BLOCK_SIZE),
+                               (BLOCK_SIZE * 6, BLOCK_SIZE),
+                               (BLOCK_SIZE, BLOCK_SIZE),
+                               (BLOCK_SIZE * 3, BLOCK_SIZE * 3),
+                               (BLOCK_SIZE * 7, BLOCK_SIZE)])
+            self.assertEquals(self.origin.bytes, BLOCK_SIZE * 7)
+
+        d.addCallback(check)
+        # Everything is cached now
+        d.addCallback(lambda _: self._read(BLOCK_SIZE, BLOCK_SIZE * 7))
+        d.addCallback(lambda _: self.assertEquals(self.origin.bytes,
+                                                  BLOCK_SIZE * 7))
+        return d
+
+    def testLastBlock(self):
+        d = self._read(DATA_SIZE - 10, BLOCK_SIZE)
+        d.addCallback(lambda _: self._read(DATA_SIZE - 100, BLOCK_SIZE))
+        d.addCallback(lambda _: self.assertEquals(self.origin.bytes,
+                                                  BLOCK_SIZE / 2))
+        d.addCallback(lambda _: self.cache.read(IDENT, URL, DATA_SIZE,
+                                                BLOCK_SIZE, DATA_SIZE,
+                                                MTIME))
+        d.addCallback(self.assertEquals, "")
+        return d
+
+    def testPersistence(self):
+        d = self._read(0, BLOCK_SIZE * 3)
+
+        def reload(_):
+            self.cache = self._newCache()
+            return self.cache.setup()
+
+        d.addCallback(reload)
+        d.addCallback(lambda _: self.assertEquals(self.cache.usage,
+                                                  BLOCK_SIZE * 3))
+        # Only the fourth block is missing
+        d.addCallback(lambda _: self._read(10, BLOCK_SIZE * 3))
+        d.addCallback(lambda _: self.assertEquals(self.origin.bytes,
+                                                  BLOCK_SIZE * 4))
+        d.addCallback(lambda _: self.assertEquals(self.cache.usage,
+                                                  BLOCK_SIZE * 4))
+        return d
+
+    def testModified(self):
+        d = self._read(0, BLOCK_SIZE * 2)
+
+        def modify(_):
+            self.data = os.urandom(DATA_SIZE)
+            self.origin.data = self.data
+            self.origin.mtime = MTIME + 1
+
+        d.addCallback(modify)
+        # The cached blocks are dropped when the resource changes
+        d.addCallback(lambda _: self._read(0, BLOCK_SIZE, mtime=MTIME + 1))
+        d.addCallback(lambda _: self.assertEquals(self.cache.usage,
+                                                  BLOCK_SIZE))
+        # Retrieving with an old modification time fails
+        d.addCallback(lambda _: self.cache.read("other", URL, 0, 10,
+                                                DATA_SIZE, MTIME))
+        d.addCallbacks(lambda _: self.fail("Success not expected"),
+                       lambda f: f.trap(fileprovider.FileOutOfDate))
+        d.addCallback(lambda _: self.assertEquals(self.cache.usage,
+                                                  BLOCK_SIZE))
+        return d
+
+    def testEviction(self):
+        self.cache.maxSize = DATA_SIZE
+        d = self._read(0, DATA_SIZE, ident="first")
+        d.addCallback(lambda _: self.assertEquals(self.cache.usage,
+                                                  DATA_SIZE))
+        d.addCallback(lambda _: self._read(0, BLOCK_SIZE * 2, ident="second"))
+
+        def check(_):
+            self.assertEquals(self.cache.usage, BLOCK_SIZE * 2)
+            self.failIf(os.path.exists(os.path.join(self.path,
+                                                    "first.map")))
+
+        d.addCallback(check)
+        # Objects bigger than the cache are retrieved directly
+        d.addCallback(lambda _: self._read(0, BLOCK_SIZE * 2, ident="big",
+                                           cache=self._newCache(BLOCK_SIZE)))
+        return d
+
+    def testReadError(self):
+        d = self._read(0, BLOCK_SIZE * 2)
+
+        def truncate(_):
+            open(os.path.join(self.path, IDENT + ".blocks"), "wb").close()
+
+        d.addCallback(truncate)
+        # Unreadable blocks are dropped and the data retrieved again
+        d.addCallback(lambda _: self._read(0, BLOCK_SIZE * 2))
+
+        def check(_):
+            self.assertEquals(self.origin.bytes, BLOCK_SIZE * 4)
+            self.assertEquals(self.cache.usage, 0)
+
+        d.addCallback(check)
+        return d
+
+    def testForget(self):
+        d = self._read(0, BLOCK_SIZE)
+
+        def forget(_):
+            self.cache.forget(IDENT)
+            self.assertEquals(self.cache.usage, 0)
+            self.assertEquals(os.listdir(self.path), [])
+
+        d.addCallback(forget)
+        return d
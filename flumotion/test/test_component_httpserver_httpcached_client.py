@@ -0,0 +1,154 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+from twisted.internet import reactor, defer, error
+from twisted.web import resource, server, static
+
+from flumotion.common import testsuite
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import http_client
+from flumotion.component.misc.httpserver.httpcached import http_utils
+
+CONTENT = "some content"
+
+
+class CountingSite(server.Site):
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+class DummyConsumer(common.StreamConsumer):
+
+    def __init__(self):
+        self.deferred = defer.Deferred()
+        self.data = []
+
+    def serverError(self, getter, code, message):
+        self.deferred.errback(Exception("%s (%s)" % (message, code)))
+
+    def onData(self, getter, data):
+        self.data.append(data)
+
+    def streamDone(self, getter):
+        self.deferred.callback("".join(self.data))
+
+
+class TestConnectionPool(testsuite.TestCase):
+
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild("file", static.Data(CONTENT, "text/plain"))
+        self.site = CountingSite(root)
+        self.port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.requester = None
+
+    def tearDown(self):
+        d = defer.succeed(None)
+        if self.requester is not None:
+            d.addCallback(lambda _: self.requester.cleanup())
+        # Let the server notice the connections were closed
+        d.addCallback(lambda _: self._delay(0.1))
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    def testKeepAlive(self):
+        self.requester = http_client.StreamRequester(2, 5, 2)
+        d = self._retrieve()
+        d.addCallback(lambda _: self._retrieve())
+        d.addCallback(lambda _: self._retrieve())
+        d.addCallback(lambda _: self.assertEquals(self.site.connections, 1))
+        return d
+
+    def testNoKeepAlive(self):
+        self.requester = http_client.StreamRequester(2, 5, 0)
+        d = self._retrieve()
+        d.addCallback(lambda _: self._retrieve())
+        d.addCallback(lambda _: self.assertEquals(self.site.connections, 2))
+        return d
+
+    def testMaxConnections(self):
+        self.requester = http_client.StreamRequester(2, 5, 1, 4, 1)
+        # The second request waits for the connection of the first one
+        d = defer.gatherResults([self._retrieve(), self._retrieve()])
+        d.addCallback(lambda _: self.assertEquals(self.site.connections, 1))
+        return d
+
+    def testWaitTimeout(self):
+        pool = http_client.ConnectionPool(1, 5, 1)
+        port = self.port.getHost().port
+        d1 = pool.getConnection("127.0.0.1", port, 5)
+        # Nobody releases the first connection
+        d2 = pool.getConnection("127.0.0.1", port, 0.1)
+        d = self.assertFailure(d2, error.TimeoutError)
+        d.addCallback(lambda _: self.assertEquals(pool._waiting, {}))
+        d.addCallback(lambda _: d1)
+        d.addCallback(lambda _: pool.shutdown())
+        return d
+
+    def testIdleTimeout(self):
+        self.requester = http_client.StreamRequester(2, 5, 2, 0.1)
+        d = self._retrieve()
+        d.addCallback(lambda _: self._delay(0.3))
+        d.addCallback(lambda _: self.assertEquals(self.requester.pool._idle,
+                                                  {}))
+        d.addCallback(lambda _: self._retrieve())
+        d.addCallback(lambda _: self.assertEquals(self.site.connections, 2))
+        return d
+
+    def testShutdown(self):
+        self.requester = http_client.StreamRequester(2, 5, 2)
+        pool = self.requester.pool
+        d = self._retrieve()
+
+        def shutdown(_):
+            connection = pool._idle.values()[0][0]
+            d = self.requester.cleanup()
+            # The idle timeout is canceled right away
+            self.assertEquals(connection._idleTimeout, None)
+            return d
+
+        def closed(_):
+            self.assertEquals(pool._idle, {})
+            self.assertEquals(pool._connections, set())
+            # New requests fail instead of opening connections
+            return self.assertFailure(self._retrieve(), Exception)
+
+        d.addCallback(shutdown)
+        d.addCallback(closed)
+        d.addCallback(lambda _: self.assertEquals(self.site.connections, 1))
+        return d
+
+    def _retrieve(self):
+        consumer = DummyConsumer()
+        port = self.port.getHost().port
+        url = http_utils.Url(hostname="localhost", port=port, path="/file")
+        self.requester.retrieve(consumer, url, "127.0.0.1", port)
+        consumer.deferred.addCallback(self.assertEquals, CONTENT)
+        return consumer.deferred
+
+    def _delay(self, t):
+        d = defer.Deferred()
+        reactor.callLater(t, d.callback, None)
+        return d
@@ -96,6 +96,8 @@ class TestHTTPCachedPlugStats(TestCase):
 
     def tearDown(self):
         d = self.plug.stop(None)
+        # Let the server notice the kept-alive connections were closed
+        d.addCallback(delay, 0.1)
 
         def finish_cleanup(_):
             self.plug.stopStatsUpdates()
@@ -0,0 +1,169 @@
+# -*- test-case-name: flumotion.test.test_component_httpserver_memorycache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer
+
+from flumotion.common import testsuite
+from flumotion.component.misc.httpserver import localprovider
+from flumotion.component.misc.httpserver import memorycache
+from flumotion.component.misc.httpserver.fileprovider import NotFoundError
+
+
+class FakeFile(object):
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def getLogFields(self):
+        return self.fields
+
+
+class MemoryPathTest(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self._write('a', 'test file a')
+        self._write('b', 'test file b')
+        self._write('big', 'a file too big to be kept')
+        self.cache = memorycache.MemoryCache(20, 16, 60)
+        self.root = memorycache.MemoryPath(
+            self.cache, localprovider.LocalPath(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def _write(self, name, data, mtime=None):
+        path = os.path.join(self.path, name)
+        open(path, "w").write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def _read(self, name):
+        d = defer.maybeDeferred(self.root.child(name).open)
+
+        def gotFile(f):
+            d = f.read(f.getsize())
+            d.addCallback(lambda data: (f, data))
+            return d
+        return d.addCallback(gotFile)
+
+    def testHit(self):
+        d = self._read('a')
+
+        def firstRead((f, data)):
+            self.assertEquals(data, 'test file a')
+            self.failUnless(isinstance(f, memorycache.MemoryFile))
+            self.assertEquals((self.cache.hits, self.cache.misses), (0, 1))
+            self.assertEquals(self.cache.usage, 11)
+            # changes are only noticed once the entry is revalidated
+            self._write('a', 'changed')
+            return self._read('a')
+
+        def secondRead((f, data)):
+            self.assertEquals(data, 'test file a')
+            self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+            self.assertEquals(self.cache.hitRatio, 0.5)
+        d.addCallback(firstRead)
+        d.addCallback(secondRead)
+        return d
+
+    def testLogFields(self):
+        d = self._read('a')
+
+        def firstRead((f, data)):
+            # the fields come from the file the content was read from
+            self.assertEquals(f.getLogFields(), {})
+            entry = self.cache.get(('a', ))
+            source = FakeFile({'cache-status': 'cache-hit'})
+            f = memorycache.MemoryFile(entry, 'text/plain', source)
+            self.assertEquals(f.getLogFields(),
+                              {'cache-status': 'cache-hit'})
+            return self._read('a')
+
+        def secondRead((f, data)):
+            # served from memory without opening the file
+            self.assertEquals(f.getLogFields(), {})
+        d.addCallback(firstRead)
+        d.addCallback(secondRead)
+        return d
+
+    def testRange(self):
+        d = self._read('a')
+
+        def gotFile((f, data)):
+            f = self.root.child('a').open()
+            f.seek(5)
+            return f.read(4)
+        d.addCallback(gotFile)
+        d.addCallback(self.assertEquals, 'file')
+        return d
+
+    def testEviction(self):
+        d = self._read('a')
+        d.addCallback(lambda _: self._read('b'))
+
+        def gotFiles(_):
+            self.assertEquals(self.cache.usage, 11)
+            self.assertEquals(self.cache.get(('a', )), None)
+            self.failIf(self.cache.get(('b', )) is None)
+        d.addCallback(gotFiles)
+        return d
+
+    def testTooBig(self):
+        d = self._read('big')
+
+        def gotFile((f, data)):
+            self.assertEquals(data, 'a file too big to be kept')
+            self.failUnless(isinstance(f, localprovider.LocalFile))
+            self.assertEquals(self.cache.usage, 0)
+            f.close()
+        d.addCallback(gotFile)
+        return d
+
+    def testRevalidate(self):
+        self.cache.revalidate = 0
+        self._write('a', 'test file a', 1000)
+        d = self._read('a')
+
+        def unchanged(_):
+            return self._read('a')
+
+        def changed((f, data)):
+            self.assertEquals(data, 'test file a')
+            self._write('a', 'changed', 2000)
+            return self._read('a')
+
+        def removed((f, data)):
+            self.assertEquals(data, 'changed')
+            self.assertEquals(self.cache.usage, 7)
+            os.unlink(os.path.join(self.path, 'a'))
+            return self._read('a')
+
+        d.addCallback(unchanged)
+        d.addCallback(changed)
+        d.addCallback(removed)
+        d = self.assertFailure(d, NotFoundError)
+        d.addCallback(lambda _: self.assertEquals(self.cache.usage, 0))
+        return d
@@ -19,12 +19,16 @@
 
 # Headers in this file shall remain intact.
 
+import os
+import random
+import shutil
 import time
 import tempfile
 import gst
 
 from twisted.trial import unittest
 
+from flumotion.component.producers.playlist import discoverycache
 from flumotion.component.producers.playlist import playlistparser
 from flumotion.common import fxml
 from flumotion.common import testsuite
@@ -47,11 +51,31 @@ class FakeProducer(object):
         return self.position
 
 
+class FakeClock(object):
+
+    def __init__(self, time):
+        self.time = time
+
+    def get_time(self):
+        return self.time
+
+
+class FakePipeline(object):
+
+    def __init__(self, time):
+        self.clock = FakeClock(time)
+
+    def get_clock(self):
+        return self.clock
+
+
 class FakeDiscoverer(object):
     filename = None
+    filenames = []
 
     def __init__(self, filename):
         FakeDiscoverer.filename = filename
+        FakeDiscoverer.filenames.append(filename)
 
     def noop(self, *a, **kw):
         pass
@@ -85,6 +109,20 @@ class TestPlaylist(testsuite.TestCase):
             cur = cur.next
 
         self.assertEquals(l, expectedlen)
+        self.assertEquals(len(self.playlist), expectedlen)
+
+        # The index matches the links, and items don't overlap
+        index = self.playlist._index
+        self.assertEquals(list(index), all)
+        self.assertEquals(len(index._firsts), len(index._chunks))
+        for chunk, keys, first in zip(index._chunks, index._keys,
+                                      index._firsts):
+            self.failUnless(chunk)
+            self.failIf(len(chunk) > 2 * index.chunkSize)
+            self.assertEquals(keys, [item.timestamp for item in chunk])
+            self.assertEquals(first, keys[0])
+        for prev, next in zip(all, all[1:]):
+            self.failUnless(prev.timestamp + prev.duration <= next.timestamp)
 
         itemsbyidtotal = 0
 
@@ -176,6 +214,108 @@ class TestPlaylist(testsuite.TestCase):
                               0, 100, True, True)
         self.checkItems(2)
 
+    def testAddOverFirstItems(self):
+        first = self.playlist.addItem('id1', 100, "file:///testuri", 0, 100,
+            True, True)
+        second = self.playlist.addItem('id1', 200, "file:///testuri", 0, 100,
+            True, True)
+        third = self.playlist.addItem('id2', 0, "file:///testuri", 0, 250,
+            True, True)
+
+        # First should have been deleted, second shortened
+        self.assertEquals(self.playlist._itemsById['id1'], [second])
+        self.checkItems(2)
+        self.assertEquals(self.playlist.items, third)
+        self.assertEquals(second.timestamp, 250)
+        self.assertEquals(second.duration, 50)
+
+    def testFindItem(self):
+        first = self.playlist.addItem('id1', 0, "file:///testuri", 0, 100,
+            True, True)
+        second = self.playlist.addItem('id1', 100, "file:///testuri", 0, 100,
+            True, True)
+        third = self.playlist.addItem('id1', 300, "file:///testuri", 0, 50,
+            True, True)
+
+        self.assertEquals(self.playlist._findItem(50), first)
+        self.assertEquals(self.playlist._findItem(100), None)
+        self.assertEquals(self.playlist._findItem(150), second)
+        self.assertEquals(self.playlist._findItem(250), None)
+        self.assertEquals(self.playlist._findItem(320), third)
+        self.assertEquals(self.playlist._findItem(400), None)
+
+    def testGetItemsInRange(self):
+        first = self.playlist.addItem('id1', 0, "file:///testuri", 0, 100,
+            True, True)
+        second = self.playlist.addItem('id1', 100, "file:///testuri", 0, 100,
+            True, True)
+        third = self.playlist.addItem('id1', 300, "file:///testuri", 0, 50,
+            True, True)
+
+        self.assertEquals(self.playlist.getItemsInRange(50, 120),
+                          [first, second])
+        self.assertEquals(self.playlist.getItemsInRange(200, 300), [])
+        self.assertEquals(self.playlist.getItemsInRange(200, 301), [third])
+        self.assertEquals(self.playlist.getItemsInRange(349, 1000), [third])
+        self.assertEquals(self.playlist.getItemsInRange(0, 1000),
+                          [first, second, third])
+
+    def testPastItemsDropped(self):
+        self.playlist.addItem('id1', 0, "file:///testuri", 0, 100,
+            True, True)
+        second = self.playlist.addItem('id2', 100, "file:///testuri", 0, 100,
+            True, True)
+        self.playlist.producer.pipeline = FakePipeline(150)
+        third = self.playlist.addItem('id2', 200, "file:///testuri", 0, 100,
+            True, True)
+
+        self.assertEquals(self.playlist.items, second)
+        self.failIf('id1' in self.playlist._itemsById)
+        self.checkItems(2)
+
+        # The current item is kept
+        self.playlist.removeItems('id2')
+        self.assertEquals(self.playlist.items, second)
+        self.checkItems(1)
+
+    def testPastItemsDroppedFromChunks(self):
+        self.playlist._index = playlistparser._SortedItems(4)
+        for i in range(40):
+            self.playlist.addItem('id%d' % i, i * 100, "file:///testuri", 0,
+                                  100, True, True)
+        self.playlist.producer.pipeline = FakePipeline(2050)
+        self.playlist.addItem('id40', 4000, "file:///testuri", 0, 100,
+            True, True)
+
+        self.assertEquals(self.playlist.items.timestamp, 2000)
+        self.checkItems(21)
+
+    def testRemoveManyItems(self):
+        self.playlist._index = playlistparser._SortedItems(4)
+        count = 50
+        for i in range(count * 2):
+            self.playlist.addItem('id%d' % (i % 2), i * 100,
+                                  "file:///testuri", 0, 100, True, True)
+        self.checkItems(count * 2)
+
+        self.playlist.removeItems('id0')
+        self.checkItems(count)
+        self.assertEquals(self.playlist.items.timestamp, 100)
+
+    def testRandomEdits(self):
+        # small chunks, so they get split and merged
+        self.playlist._index = playlistparser._SortedItems(4)
+        rand = random.Random(0)
+        for i in range(500):
+            piid = 'id%d' % rand.randint(0, 20)
+            if rand.random() < 0.1:
+                self.playlist.removeItems(piid)
+            else:
+                self.playlist.addItem(piid, rand.randint(0, 10000),
+                                      "file:///testuri", 0,
+                                      rand.randint(1, 200), True, True)
+        self.checkItems(len(self.playlist))
+
 
 class TestPlaylistXMLParser(testsuite.TestCase):
 
@@ -185,6 +325,7 @@ class TestPlaylistXMLParser(testsuite.TestCase):
         from gst.extend import discoverer
         self.old_discoverer = discoverer.Discoverer
         discoverer.Discoverer = FakeDiscoverer
+        FakeDiscoverer.filenames = []
 
         producer = FakeProducer()
 
@@ -253,6 +394,14 @@ class TestPlaylistXMLParser(testsuite.TestCase):
         self.pl2.close()
         self.pl3.close()
 
+    def _getItemFiles(self):
+        files = []
+        cur = self.playlist.items
+        while cur:
+            files.append(cur.uri)
+            cur = cur.next
+        return files
+
     def testItemsSortedSingle(self):
         self.xmlparser.parseFile(self.pl1.name)
 
@@ -290,5 +439,114 @@ class TestPlaylistXMLParser(testsuite.TestCase):
                           ['temp2.ogg', 'temp6.ogg'])
         self.assertEquals(FakeDiscoverer.filename, 'temp1.ogg')
 
+    def testParallelDiscovery(self):
+        self.xmlparser = playlistparser.PlaylistXMLParser(self.playlist,
+                                                          maxDiscoverers=2)
+        self.xmlparser.parseFile(self.pl1.name)
+
+        self.assertEquals(FakeDiscoverer.filenames,
+                          ['temp3.ogg', 'temp4.ogg'])
+        self.assertEquals([it[0] for it in self.xmlparser._pending_items],
+                          ['temp5.ogg'])
+        self.assertEquals(self.xmlparser.getPendingCount(), 3)
+
+    def testCachedItemsAdded(self):
+        directory = tempfile.mkdtemp(suffix=".flumotion.test")
+        try:
+            cache = discoverycache.DiscoveryCache(None)
+            media = discoverycache.DiscoveredMedia(True, True, True,
+                                                   200 * gst.SECOND,
+                                                   200 * gst.SECOND)
+            for name in ['temp3.ogg', 'temp5.ogg']:
+                path = os.path.join(directory, name)
+                open(path, 'w').write(name)
+                cache.store(path, media)
+
+            self.xmlparser = playlistparser.PlaylistXMLParser(self.playlist,
+                                                              cache)
+            self.xmlparser.setBaseDirectory(directory)
+            self.xmlparser.parseFile(self.pl1.name)
+        finally:
+            shutil.rmtree(directory)
+
+        # The cached files are added without waiting for the discoverer
+        self.assertEquals(self._getItemFiles(),
+                          ['file://%s/temp3.ogg' % directory,
+                           'file://%s/temp5.ogg' % directory])
+        self.assertEquals(FakeDiscoverer.filenames,
+                          [os.path.join(directory, 'temp4.ogg')])
+        self.assertEquals(self.xmlparser.discovered, 2)
+        self.assertEquals((cache.hits, cache.misses), (2, 1))
+
+
+class TestDiscoveryCache(testsuite.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.path = os.path.join(self.directory, 'cache', 'discovery.cache')
+        self.media = os.path.join(self.directory, 'media file.ogg')
+        self._writeMedia('data')
+        self.cache = discoverycache.DiscoveryCache(self.path)
+
+    def tearDown(self):
+        self.cache.save()
+        shutil.rmtree(self.directory)
+
+    def _writeMedia(self, data):
+        f = open(self.media, 'w')
+        f.write(data)
+        f.close()
+
+    def _store(self, cache, is_media=True):
+        media = discoverycache.DiscoveredMedia(is_media, True, False,
+                                               10 * gst.SECOND, 0)
+        cache.store(self.media, media)
+
+    def testLookup(self):
+        self.assertEquals(self.cache.lookup(self.media), None)
+        self._store(self.cache)
+        media = self.cache.lookup(self.media)
+        self.failUnless(media.is_media)
+        self.failUnless(media.is_audio)
+        self.failIf(media.is_video)
+        self.assertEquals(media.audiolength, 10 * gst.SECOND)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEquals(self.cache.hitRatio, 0.5)
+        self.assertEquals(self.cache.lookup('/does/not/exist'), None)
+
+    def testPersistence(self):
+        self._store(self.cache)
+        self.cache.save()
+        self.failUnless(os.path.exists(self.path))
+
+        cache = discoverycache.DiscoveryCache(self.path)
+        cache.load()
+        self.assertEquals(len(cache), 1)
+        media = cache.lookup(self.media)
+        self.failUnless(media.is_audio)
+        self.assertEquals(media.audiolength, 10 * gst.SECOND)
+
+    def testNotMedia(self):
+        self._store(self.cache, is_media=False)
+        self.cache.save()
+
+        cache = discoverycache.DiscoveryCache(self.path)
+        cache.load()
+        self.failIf(cache.lookup(self.media).is_media)
+
+    def testModified(self):
+        self._store(self.cache)
+        self._writeMedia('other data')
+        self.assertEquals(self.cache.lookup(self.media), None)
+
+    def testCorrupted(self):
+        os.makedirs(os.path.dirname(self.path))
+        f = open(self.path, 'w')
+        f.write('garbage\n1\t2\tx\n')
+        f.close()
+        self.cache.load()
+        self.assertEquals(len(self.cache), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,137 @@
+# -*- test-case-name: flumotion.test.test_component_plugs_request -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from flumotion.common import testsuite
+from flumotion.component.plugs import request
+
+
+def makeArgs(uri):
+    return {'ip': '127.0.0.1',
+            'time': time.gmtime(0),
+            'method': 'GET',
+            'uri': uri,
+            'username': '-',
+            'get-parameters': {},
+            'clientproto': 'HTTP/1.0',
+            'response': 200,
+            'bytes-sent': 1000,
+            'referer': None,
+            'user-agent': 'test',
+            'time-connected': 10}
+
+
+class BlockingFile:
+    """
+    A file whose writes wait until they are released.
+    """
+
+    def __init__(self):
+        self.data = ''
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def write(self, data):
+        self.entered.set()
+        self.released.wait(5)
+        self.data += data
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TestRequestLoggerFilePlug(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.logfile = os.path.join(self.path, 'access.log')
+        self.plug = None
+
+    def tearDown(self):
+        if self.plug:
+            self.plug.stop()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def startPlug(self, **properties):
+        properties['logfile'] = self.logfile
+        self.plug = request.RequestLoggerFilePlug(
+            {'socket': 'flumotion.component.plugs.request.RequestLoggerPlug',
+             'type': 'requestlogger-file',
+             'properties': properties})
+        self.plug.start()
+
+    def log(self, uri):
+        self.plug.event('http_session_completed', makeArgs(uri))
+
+    def readLog(self, path=None):
+        lines = open(path or self.logfile).readlines()
+        return [line.split()[6] for line in lines]
+
+    def testWrittenOnStop(self):
+        self.startPlug(**{'flush-interval': 60.0})
+        for i in range(10):
+            self.log('/%d' % i)
+        self.plug.stop()
+        self.assertEquals(self.readLog(), ['/%d' % i for i in range(10)])
+
+    def testFlushSize(self):
+        self.startPlug(**{'flush-interval': 60.0, 'flush-size': 2})
+        self.log('/a')
+        self.log('/b')
+        for i in range(50):
+            if os.path.getsize(self.logfile):
+                break
+            time.sleep(0.1)
+        self.assertEquals(self.readLog(), ['/a', '/b'])
+
+    def testDropWhenFull(self):
+        self.startPlug(**{'flush-size': 1, 'queue-size': 2})
+        blocking = BlockingFile()
+        self.plug.file = blocking
+        self.log('/a')
+        # The writer thread took the first line and is stuck writing it
+        self.failUnless(blocking.entered.wait(5) or blocking.entered.isSet())
+        self.log('/b')
+        self.log('/c')
+        self.log('/d')
+        self.assertEquals(self.plug.lost, 1)
+        blocking.released.set()
+        self.plug.stop()
+        self.assertEquals(blocking.data.count('GET'), 3)
+        self.failIf('/d' in blocking.data)
+
+    def testRotate(self):
+        self.startPlug(**{'flush-interval': 60.0})
+        self.log('/before')
+        os.rename(self.logfile, self.logfile + '.1')
+        self.plug.rotate()
+        self.log('/after')
+        self.plug.stop()
+        self.assertEquals(self.readLog(self.logfile + '.1'), ['/before'])
+        self.assertEquals(self.readLog(), ['/after'])
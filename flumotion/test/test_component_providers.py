@@ -20,6 +20,7 @@
 
 import os
 import shutil
+import socket
 import tempfile
 
 from twisted.internet import defer, reactor
@@ -35,6 +36,7 @@ from flumotion.common import testsuite
 from flumotion.component.misc.httpserver import localpath
 from flumotion.component.misc.httpserver import localprovider
 from flumotion.component.misc.httpserver import cachedprovider
+from flumotion.component.misc.httpserver import fileprovider
 from flumotion.component.misc.httpserver.fileprovider \
     import InsecureError, NotFoundError, CannotOpenError
 
@@ -224,6 +226,23 @@ class LocalPathLocalProvider(testsuite.TestCase):
         child = self.local.child('foo').child('bar')
         self.assertRaises(NotFoundError, child.open)
 
+    def testSendfile(self):
+        if fileprovider.sendfile is None:
+            raise unittest.SkipTest("sendfile(2) is not available")
+        f = self.local.child('a').open()
+        f.seek(5)
+        out, client = socket.socketpair()
+        try:
+            self.assertEquals(f.sendfile(out.fileno(), 4), 4)
+            self.assertEquals(f.tell(), 9)
+            self.assertEquals(client.recv(16), 'file')
+            self.assertEquals(f.sendfile(out.fileno(), 16), 2)
+            self.assertEquals(client.recv(16), ' a')
+        finally:
+            out.close()
+            client.close()
+            f.close()
+
 
 class CachedProviderFileTest(testsuite.TestCase):
 
@@ -333,6 +352,107 @@ class CachedProviderFileTest(testsuite.TestCase):
         return self.cachedFile.read(size)
 
 
+class DummyCopySession(object):
+
+    def __init__(self, order, steps, delay=0):
+        self.order = order
+        self.steps = steps
+        self.delay = delay
+        self.calls = 0
+        self.running = False
+        self.overlapped = False
+
+    def doWork(self):
+        if self.running:
+            self.overlapped = True
+        self.running = True
+        self.order.append(self)
+        self.calls += 1
+        self.running = False
+        if self.calls >= self.steps:
+            return None
+        return self.delay
+
+
+class CopySchedulerTest(testsuite.TestCase):
+
+    def setUp(self):
+        self.order = []
+        self.scheduler = cachedprovider.CopyScheduler(2)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def testOnlyScheduledSessions(self):
+        busy = DummyCopySession(self.order, 5)
+        idle = DummyCopySession(self.order, 5)
+        self.scheduler.start()
+        self.scheduler.schedule(busy)
+
+        def check(_):
+            self.assertEquals(busy.calls, 5)
+            self.assertEquals(idle.calls, 0)
+            self.failIf(busy.overlapped)
+            # Scheduling a session again runs it again
+            self.scheduler.schedule(busy)
+            return delay(None, 0.2)
+
+        d = delay(None, 0.2)
+        d.addCallback(check)
+        d.addCallback(lambda _: self.assertEquals(busy.calls, 6))
+        return d
+
+    def testUrgent(self):
+        first = DummyCopySession(self.order, 1)
+        second = DummyCopySession(self.order, 1)
+        urgent = DummyCopySession(self.order, 1)
+        self.scheduler = cachedprovider.CopyScheduler(1)
+        self.scheduler.schedule(first)
+        self.scheduler.schedule(second)
+        self.scheduler.schedule(urgent, urgent=True)
+        self.scheduler.start()
+
+        d = delay(None, 0.2)
+        d.addCallback(lambda _: self.assertEquals(self.order,
+                                                  [urgent, first, second]))
+        return d
+
+    def testUrgentAgain(self):
+        first = DummyCopySession(self.order, 1)
+        second = DummyCopySession(self.order, 1)
+        self.scheduler = cachedprovider.CopyScheduler(1)
+        self.scheduler.schedule(first)
+        self.scheduler.schedule(second)
+        # Moves the queued session first, it still runs only once
+        self.scheduler.schedule(second, urgent=True)
+        self.scheduler.start()
+
+        d = delay(None, 0.2)
+        d.addCallback(lambda _: self.assertEquals(self.order,
+                                                  [second, first]))
+        return d
+
+    def testDelayed(self):
+        throttled = DummyCopySession(self.order, 3, 0.3)
+        other = DummyCopySession(self.order, 1)
+        self.scheduler = cachedprovider.CopyScheduler(1)
+        self.scheduler.start()
+        self.scheduler.schedule(throttled)
+
+        def check(_, calls):
+            self.assertEquals(throttled.calls, calls)
+
+        d = delay(None, 0.1)
+        d.addCallback(check, 1)
+        # A delayed session does not hold the thread
+        d.addCallback(lambda _: self.scheduler.schedule(other))
+        d.addCallback(delay, 0.1)
+        d.addCallback(lambda _: self.assertEquals(other.calls, 1))
+        d.addCallback(delay, 0.8)
+        d.addCallback(check, 3)
+        return d
+
+
 def pass_through(result, fun, *args, **kwargs):
     fun(*args, **kwargs)
     return result
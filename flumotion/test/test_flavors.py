@@ -85,6 +85,18 @@ class TestRoot(testsuite.TestManagerRoot):
     def remote_haveAdopted(self, name):
         return self.state.remove('children', name)
 
+    def remote_batch(self):
+        self.state.setBatching()
+
+    def remote_family(self):
+        self.state.set('name', 'clark')
+        self.state.append('children', 'robin')
+        self.state.set('name', 'lana')
+        self.state.set('name', 'lois')
+        self.state.setitem('nationalities', 'robin', 'krypton')
+        self.state.remove('children', 'robin')
+        return self.state.append('children', 'batman')
+
 
 class StateTest(testsuite.TestCase):
 
@@ -289,6 +301,117 @@ class TestStateSet(StateTest):
         return d
 
 
+class TestBatchedState(StateTest):
+
+    def testStateDelta(self):
+        d = self.runClient()
+        d.addCallback(lambda _: self.perspective.callRemote('getState'))
+
+        def batch(state):
+            d.state = state
+            self.changes = []
+
+            def event(type):
+                return lambda *x: self.changes.append((type, ) + x)
+            state.addListener(self, set_=event('set'),
+                              append=event('append'),
+                              remove=event('remove'),
+                              setitem=event('setitem'))
+            return self.perspective.callRemote('batch')
+
+        def check(_):
+            state = d.state
+            self.assertEquals(state.get('name'), 'lois')
+            self.assertEquals(state.get('children'), ['batman'])
+            self.assertEquals(state.get('nationalities'),
+                              {'robin': 'krypton'})
+            # the name is back to what the client had
+            self.assertEquals(self.changes,
+                              [('append', state, 'children', 'robin'),
+                               ('setitem', state, 'nationalities', 'robin',
+                                'krypton'),
+                               ('remove', state, 'children', 'robin'),
+                               ('append', state, 'children', 'batman')])
+            return self.stopClient()
+
+        d.addCallback(batch)
+        d.addCallback(lambda _: self.perspective.callRemote('family'))
+        d.addCallback(check)
+        return d
+
+
+class FakeObserver:
+
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, name, *args):
+        self.calls.append((name, ) + args)
+        return defer.succeed(None)
+
+
+class TestStateBatching(testsuite.TestCase):
+
+    def setUp(self):
+        self.state = flavors.StateCacheable()
+        self.state.addKey('name', 'lois')
+        self.state.addKey('age', 20)
+        self.state.addListKey('children')
+        self.observer = FakeObserver()
+        self.state.getStateToCacheAndObserveFor(None, self.observer)
+        self.state.setBatching(0.1)
+
+    def tearDown(self):
+        self.state.setBatching(None)
+
+    def testCollapse(self):
+        self.state.set('age', 21)
+        self.state.set('name', 'lana')
+        self.state.set('age', 22)
+        self.state.append('children', 'robin')
+        self.state.set('age', 23)
+        self.assertEquals(self.observer.calls, [])
+        d = self.state.flushDelta()
+        self.assertEquals(self.observer.calls,
+                          [('delta', [('set', 'name', 'lana'),
+                                      ('append', 'children', 'robin'),
+                                      ('set', 'age', 23)])])
+        return d
+
+    def testNoOpSets(self):
+        self.state.set('name', 'lois')
+        self.state.set('age', 21)
+        self.state.set('age', 20)
+        self.state.flushDelta()
+        self.assertEquals(self.observer.calls, [])
+        self.assertEquals(self.state.get('age'), 20)
+
+    def testDeferred(self):
+        d = self.state.set('age', 21)
+        self.failIf(d.called)
+        self.state.flushDelta()
+        self.failUnless(d.called)
+        return d
+
+    def testNewObserver(self):
+        self.state.set('age', 21)
+        other = FakeObserver()
+        cached = self.state.getStateToCacheAndObserveFor(None, other)
+        self.assertEquals(cached['age'], 21)
+        # changes made before observing were flushed to the others only
+        self.assertEquals(self.observer.calls,
+                          [('delta', [('set', 'age', 21)])])
+        self.state.set('age', 22)
+        self.state.flushDelta()
+        self.assertEquals(other.calls, [('delta', [('set', 'age', 22)])])
+
+    def testTimer(self):
+        d = self.state.set('age', 21)
+        d.addCallback(lambda _: self.assertEquals(
+            self.observer.calls, [('delta', [('set', 'age', 21)])]))
+        return d
+
+
 class TestFullListener(StateTest):
 
     def testStateSetListener(self):
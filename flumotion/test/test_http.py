@@ -19,10 +19,11 @@
 
 # Headers in this file shall remain intact.
 
-from twisted.internet import defer
+from twisted.internet import abstract, defer, reactor
 from twisted.web import http, server
 
-from flumotion.component.base.http import HTTPAuthentication
+from flumotion.component.base import timerwheel
+from flumotion.component.base.http import HTTPAuthentication, KeycardCache
 from flumotion.component.consumers.httpstreamer import resources
 from flumotion.common import keycards, log, errors
 from flumotion.common import testsuite
@@ -58,6 +59,23 @@ class PipeTransport:
                 break
         return data
 
+
+class PipeWriter(abstract.FileDescriptor):
+    # a transport on the write end of a PipeTransport's pipe, which the
+    # reactor can watch
+
+    def __init__(self, pipe):
+        abstract.FileDescriptor.__init__(self, reactor)
+        self.pipe = pipe
+        self.connected = 1
+
+    def fileno(self):
+        return self.pipe.wfd
+
+    def writeSomeData(self, data):
+        # the headers are written to the fd directly, never through here
+        return 0
+
 # a mockery of twisted.web.http.Request
 
 
@@ -141,6 +159,48 @@ class FakeTokenMedium:
         return defer.succeed(None)
 
 
+class FakeCountingTokenMedium(FakeTokenMedium):
+    # this medium also records the calls made to the bouncer
+
+    def __init__(self):
+        FakeTokenMedium.__init__(self)
+        self.authenticated = 0
+        self.removed = []
+
+    def authenticate(self, bouncerName, keycard):
+        self.authenticated += 1
+        return FakeTokenMedium.authenticate(self, bouncerName, keycard)
+
+    def removeKeycardId(self, bouncerName, keycardId):
+        self.removed.append(keycardId)
+        return defer.succeed(None)
+
+
+class FakeBatchTokenMedium(FakeTokenMedium):
+    # this medium also authenticates batches of keycards
+
+    def __init__(self):
+        FakeTokenMedium.__init__(self)
+        self.batches = []
+
+    def authenticate(self, bouncerName, keycard):
+        raise AssertionError("keycard not batched")
+
+    def authenticateMany(self, bouncerName, keycards):
+        self.batches.append(len(keycards))
+        return defer.succeed([FakeTokenMedium.authenticate(
+            self, bouncerName, k).result for k in keycards])
+
+
+class FakeFdTransport:
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
 class FakeStreamer:
     caps = None
     mime = 'application/octet-stream'
@@ -332,6 +392,154 @@ class TestHTTPStreamingResource(testsuite.TestCase):
         #assert request.headers['Content-Type'] == 'application/x-ogg'
 
 
+class FakeModifier:
+
+    def modify(self, request):
+        request.setHeader('Content-Disposition', 'attachment')
+
+
+class TestWriteHeaders(testsuite.TestCase):
+
+    def setUp(self):
+        self.streamer = FakeStreamer()
+        self.streamer.caps = True
+        self.streamer.mime = 'application/ogg'
+        httpauth = HTTPAuthentication(self.streamer)
+        self.resource = resources.HTTPStreamingResource(self.streamer,
+                                                        httpauth)
+        self.transport = PipeTransport()
+
+    def tearDown(self):
+        os.close(self.transport.rfd)
+        os.close(self.transport.wfd)
+
+    def makeRequest(self, **kwargs):
+        # the headers Twisted sets when processing a request
+        headers = {'server': 'TwistedWeb', 'date': 'FakeDate',
+                   'content-type': 'text/html'}
+        return FakeRequest(transport=self.transport, headers=headers,
+                           fdIncoming=self.transport.wfd, cookies=[],
+                           **kwargs)
+
+    def parse(self, data):
+        self.failUnless(data.endswith('\r\n\r\n'))
+        lines = data[:-4].split('\r\n')
+        self.assertEquals(lines[0], 'HTTP/1.0 200 OK')
+        return dict([line.split(': ', 1) for line in lines[1:]])
+
+    def writeHeaders(self, request):
+        d = self.resource._writeHeaders(request)
+        d.addCallback(self.failUnless)
+        d.addCallback(lambda _: self.failUnless(request.startedWriting))
+        d.addCallback(lambda _: self.parse(self.transport.readall()))
+        return d
+
+    def testHeaders(self):
+        request = self.makeRequest()
+        request.cookies.append('id=1')
+        d = self.writeHeaders(request)
+
+        def check(headers):
+            self.assertEquals(headers['Server'], resources.HTTP_SERVER)
+            self.assertEquals(headers['Connection'], 'close')
+            self.assertEquals(headers['Cache-control'], 'private')
+            self.assertEquals(headers['Content-type'], 'application/ogg')
+            self.assertEquals(headers['Set-Cookie'], 'id=1')
+            self.assertNotEquals(headers['Date'], 'FakeDate')
+            self.assertEquals(len(headers), 6)
+
+        d.addCallback(check)
+        return d
+
+    def testContentTypeChanged(self):
+        d = self.writeHeaders(self.makeRequest())
+
+        def changeCaps(_):
+            self.streamer.mime = 'video/webm'
+            return self.writeHeaders(self.makeRequest())
+
+        d.addCallback(changeCaps)
+        d.addCallback(lambda h: self.assertEquals(h['Content-type'],
+                                                  'video/webm'))
+        return d
+
+    def testModifiers(self):
+        self.resource.modifiers = [FakeModifier()]
+        d = self.writeHeaders(self.makeRequest())
+        d.addCallback(lambda h: self.assertEquals(h['Content-disposition'],
+                                                  'attachment'))
+        return d
+
+    def testModifierOverrides(self):
+
+        class CacheModifier:
+
+            def modify(self, request):
+                request.setHeader('cache-control', 'public')
+
+        self.resource.modifiers = [CacheModifier()]
+        d = self.writeHeaders(self.makeRequest())
+        d.addCallback(lambda h: self.assertEquals(h['Cache-control'],
+                                                  'public'))
+        # The cached template is left untouched
+        d.addCallback(lambda _: setattr(self.resource, 'modifiers', []))
+        d.addCallback(lambda _: self.writeHeaders(self.makeRequest()))
+        d.addCallback(lambda h: self.assertEquals(h['Cache-control'],
+                                                  'private'))
+        return d
+
+    def fillPipe(self):
+        fcntl.fcntl(self.transport.wfd, fcntl.F_SETFL, os.O_NONBLOCK)
+        while True:
+            try:
+                os.write(self.transport.wfd, ' ' * 4096)
+            except OSError:
+                break
+
+    def testSocketFull(self):
+        self.fillPipe()
+        request = self.makeRequest()
+        request.transport = PipeWriter(self.transport)
+        d = self.resource._writeHeaders(request)
+        self.failIf(d.called)
+        # Waits for the reactor to find the pipe writable
+        self.failIf(request.transport.producer is None)
+        # Let the client read what was sent before
+        self.transport.readall()
+        d.addCallback(self.failUnless)
+        d.addCallback(lambda _: self.transport.readall())
+        d.addCallback(self.parse)
+        d.addCallback(lambda _: self.assertEquals(request.transport.producer,
+                                                  None))
+        return d
+
+    def testClientGoneWhileWriting(self):
+        self.fillPipe()
+        request = self.makeRequest()
+        request.transport = PipeWriter(self.transport)
+        d = self.resource._writeHeaders(request)
+        self.failIf(d.called)
+        request.transport.connectionLost(None)
+        self.failUnless(d.called)
+        d.addCallback(self.failIf)
+        return d
+
+    def testTimeout(self):
+        self.fillPipe()
+        request = self.makeRequest()
+        request.transport = PipeWriter(self.transport)
+        timeout = resources.HEADER_WRITE_TIMEOUT
+        resources.HEADER_WRITE_TIMEOUT = 0.1
+        try:
+            d = self.resource._writeHeaders(request)
+        finally:
+            resources.HEADER_WRITE_TIMEOUT = timeout
+        d.addCallback(self.failIf)
+        d.addCallback(lambda _: self.assertEquals(request.transport.producer,
+                                                  None))
+        return d
+
+
 class TestHTTPRoot(testsuite.TestCase):
 
     def testRenderRootStreamer(self):
@@ -414,3 +622,170 @@ class TestHTTPRoot(testsuite.TestCase):
         self.assertEquals(r, resource)
         output = r.render(request)
         self.assertEquals(output, server.NOT_DONE_YET)
+
+
+class TestKeycardCache(testsuite.TestCase):
+
+    def setUp(self):
+        self.streamer = FakeStreamer(mediumClass=FakeCountingTokenMedium)
+        self.removedClients = []
+        self.streamer.remove_client = self.removedClients.append
+        self.medium = self.streamer.medium
+        self.httpauth = HTTPAuthentication(self.streamer)
+        self.httpauth.setIssuerClass('HTTPTokenIssuer')
+        self.httpauth.setBouncerName('fakebouncer')
+        self.httpauth.setKeycardCache(10)
+
+    def admit(self, fd, token='LETMEIN', ip='127.0.0.1'):
+        request = FakeRequest(ip=ip, args={'token': [token]},
+                              transport=FakeFdTransport(fd))
+        results = []
+        d = self.httpauth.startAuthentication(request)
+        d.addCallbacks(lambda _: results.append(True),
+                       lambda _: results.append(False))
+        return results[0]
+
+    def testSharedKeycard(self):
+        self.failUnless(self.admit(10))
+        self.failUnless(self.admit(11))
+        self.assertEquals(self.medium.authenticated, 1)
+        # another address is a different decision
+        self.failUnless(self.admit(12, ip='127.0.0.2'))
+        self.assertEquals(self.medium.authenticated, 2)
+
+        # the keycard is only removed from the bouncer with its last client
+        self.httpauth.cleanupAuth(10)
+        self.assertEquals(self.medium.removed, [])
+        self.httpauth.cleanupAuth(11)
+        self.assertEquals(self.medium.removed, [0])
+
+        # and then the bouncer has to decide again
+        self.failUnless(self.admit(13))
+        self.assertEquals(self.medium.authenticated, 3)
+
+    def testRefusalCached(self):
+        self.failIf(self.admit(10, token='WRONG'))
+        self.failIf(self.admit(11, token='WRONG'))
+        self.assertEquals(self.medium.authenticated, 1)
+
+    def testExpireKeycard(self):
+        self.failUnless(self.admit(10))
+        self.failUnless(self.admit(11))
+        self.assertEquals(self.httpauth.expireKeycards([0]), 1)
+        self.assertEquals(sorted(self.removedClients), [10, 11])
+
+        # the revocation also dropped the cached decision
+        self.failUnless(self.admit(12))
+        self.assertEquals(self.medium.authenticated, 2)
+
+    def testDisabled(self):
+        self.httpauth.setKeycardCache(0)
+        self.failUnless(self.admit(10))
+        self.failUnless(self.admit(11))
+        self.assertEquals(self.medium.authenticated, 2)
+
+    def testStopExpirations(self):
+        self.httpauth.setDefaultDuration(60)
+        self.failUnless(self.admit(10))
+        wheel = timerwheel.getTimerWheel()
+        self.failUnless((self.httpauth, 10) in wheel)
+        self.httpauth.stopExpirations()
+        self.failIf((self.httpauth, 10) in wheel)
+
+
+class FakeKeycard:
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TestKeycardCacheEviction(testsuite.TestCase):
+
+    def testLeastRecentlyUsed(self):
+        cache = KeycardCache(2, 60)
+        cache.put('a', FakeKeycard(1))
+        cache.put('b', None)
+        self.assertEquals(cache.get('a')[0].id, 1)
+        cache.put('c', FakeKeycard(3))
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('b'), None)
+        self.failIf(cache.get('a') is None)
+        self.failIf(cache.get('c') is None)
+        self.assertEquals((cache.hits, cache.misses), (3, 1))
+
+    def testExpiration(self):
+        cache = KeycardCache(2, 0)
+        cache.put('a', FakeKeycard(1))
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 0)
+
+    def testRemoveKeycardId(self):
+        cache = KeycardCache(2, 60)
+        cache.put('a', FakeKeycard(1))
+        cache.removeKeycardId(1)
+        self.assertEquals(cache.get('a'), None)
+
+
+class TestKeycardBatching(testsuite.TestCase):
+
+    def setUp(self):
+        self.streamer = FakeStreamer(mediumClass=FakeBatchTokenMedium)
+        self.medium = self.streamer.medium
+        self.httpauth = HTTPAuthentication(self.streamer)
+        self.httpauth.setIssuerClass('HTTPTokenIssuer')
+        self.httpauth.setBouncerName('fakebouncer')
+
+    def authenticate(self, fd, token='LETMEIN'):
+        request = FakeRequest(ip='127.0.0.1', args={'token': [token]},
+                              transport=FakeFdTransport(fd))
+        return self.httpauth.authenticate(request)
+
+    def testBatch(self):
+        self.httpauth.setKeycardBatching(0.01, 3)
+        ds = [self.authenticate(fd, token)
+              for fd, token in [(10, 'LETMEIN'), (11, 'WRONG'),
+                                (12, 'LETMEIN'), (13, 'LETMEIN')]]
+        # the first three filled a batch
+        self.assertEquals(self.medium.batches, [3])
+
+        def check(results):
+            self.assertEquals(self.medium.batches, [3, 1])
+            keycards = [result for _, result in results]
+            self.assertEquals(keycards[1], None)
+            self.assertEquals([k._fd for k in keycards if k],
+                              [10, 12, 13])
+        d = defer.DeferredList(ds)
+        d.addCallback(check)
+        return d
+
+    def testBatchFailure(self):
+        self.httpauth.setKeycardBatching(0.01)
+        self.medium.authenticateMany = lambda *args: defer.fail(
+            errors.UnknownComponentError('fakebouncer'))
+        d = self.authenticate(10)
+        return self.assertFailure(d, errors.UnknownComponentError)
+
+    def testBatchMissingResults(self):
+        self.httpauth.setKeycardBatching(0.01)
+        # one result for two keycards
+        self.medium.authenticateMany = lambda name, keycards: \
+            defer.succeed(keycards[:1])
+        ds = [self.assertFailure(self.authenticate(fd),
+                                 errors.FlumotionError) for fd in (10, 11)]
+        return defer.gatherResults(ds)
+
+    def testBatchNoResults(self):
+        self.httpauth.setKeycardBatching(0.01)
+        self.medium.authenticateMany = lambda *args: defer.succeed(None)
+        d = self.authenticate(10)
+        return self.assertFailure(d, errors.FlumotionError)
+
+    def testStop(self):
+        self.httpauth.setKeycardBatching(10)
+        d = self.authenticate(10)
+        self.httpauth.stopKeycardBatching()
+        # sent right away, without waiting for the window to end
+        self.assertEquals(self.medium.batches, [1])
+        self.failUnless(d.called)
+        self.assertEquals(self.httpauth._batcher, None)
+        return d
@@ -52,3 +52,15 @@ class TestLogFilter(testsuite.TestCase):
             "192.168.0.0/33")
         self.assertRaises(errors.ConfigError, filter.addIPFilter,
             "192.168.0.0/30/1")
+
+    def testIPv6Filter(self):
+        filter = http.LogFilter()
+        filter.addIPFilter("2001:db8::/32")
+        filter.addIPFilter("10.0.0.0/8")
+
+        self.failUnless(filter.isInRange("2001:db8::1"))
+        self.failIf(filter.isInRange("2001:db9::1"))
+        self.failUnless(filter.isInRange("::ffff:10.1.2.3"))
+        self.failIf(filter.isInRange("::1"))
+        self.assertRaises(errors.ConfigError, filter.addIPFilter,
+            "2001:db8::/129")
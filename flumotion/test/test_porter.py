@@ -24,7 +24,10 @@ import errno
 import string
 from urllib2 import urlparse
 
+from twisted.internet import defer
+
 from flumotion.common import testsuite
+from flumotion.component.base import timerwheel
 from flumotion.component.misc.porter import porter
 
 
@@ -41,9 +44,14 @@ class FakeTransport:
         self.connected = False
         self.protocol.connectionLost(None)
 
-    def sendFileDescriptor(self, fd, data):
+    def queueFileDescriptor(self, fd, data):
         if self.overloaded:
-            raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+            return defer.fail(OSError(errno.EAGAIN,
+                                      'Resource temporarily unavailable'))
+        return defer.succeed(0.0)
+
+    def stopReading(self):
+        pass
 
     def write(self, data):
         self.written += data
@@ -54,6 +62,19 @@ class FakeTransport:
 
 class FakePorter:
     foundDestination = False
+    clientTimeout = 30
+    maxPendingBytes = None
+
+    def __init__(self):
+        self.pendingBytes = 0
+
+    def addPendingBytes(self, count):
+        self.pendingBytes += count
+        return (self.maxPendingBytes is None or
+                self.pendingBytes <= self.maxPendingBytes)
+
+    def removePendingBytes(self, count):
+        self.pendingBytes -= count
 
     def findDestination(self, path):
         self.foundDestination = True
@@ -109,6 +130,45 @@ class TestPorterProtocol(testsuite.TestCase):
         self.pp.dataReceived('\r')
         self.pp.dataReceived('\n')
         self.failIf(self.t.connected)
+        self.assertEquals(self.p.pendingBytes, 0)
+
+    def testTooLong(self):
+        for i in range(porter.PorterProtocol.MAX_SIZE / 8):
+            self.pp.dataReceived('G' * 8)
+        self.failUnless(self.t.connected)
+        self.assertEquals(self.p.pendingBytes, porter.PorterProtocol.MAX_SIZE)
+        self.pp.dataReceived('G')
+        self.failIf(self.t.connected)
+        self.assertEquals(self.p.pendingBytes, 0)
+
+    def testPendingBytesLimit(self):
+        self.p.maxPendingBytes = 10
+        other = porter.HTTPPorterProtocol(self.p)
+        otherTransport = FakeTransport(other)
+        other.transport = otherTransport
+
+        self.pp.dataReceived('GET /e')
+        self.assertEquals(self.p.pendingBytes, 6)
+        other.dataReceived('GET ')
+        self.failUnless(otherTransport.connected)
+        other.dataReceived('/')
+        self.failIf(otherTransport.connected)
+        self.failUnless(self.t.connected)
+        self.assertEquals(self.p.pendingBytes, 6)
+
+        self.pp.dataReceived('xisting HTTP/1.0\r\n')
+        self.failIf(self.t.connected)
+        self.assertEquals(self.p.pendingBytes, 0)
+
+    def testTimeout(self):
+        self.pp.dataReceived('GET /')
+        self.failUnless(self.pp in timerwheel.getTimerWheel())
+        timerwheel.getTimerWheel().remove(self.pp)
+        self.pp._timeout()
+        self.failIf(self.t.connected)
+        self.assertEquals(self.p.pendingBytes, 0)
+        self.pp.dataReceived('existing HTTP/1.0\r\n')
+        self.failIf(self.p.foundDestination)
 
 
 class TestHTTPPorterProtocol(testsuite.TestCase):
@@ -148,6 +208,30 @@ class TestHTTPPorterProtocol(testsuite.TestCase):
         self.failUnless(self.p.foundDestination)
         self.failIf(self.t.written)
 
+    def testTrickledRequest(self):
+        self.pp.requestId = 'ID'
+        request = 'GET /existing?a=b HTTP/1.0\r\nHost: localhost\r\n\r\n'
+        for c in request:
+            self.pp.dataReceived(c)
+            if not self.t.connected:
+                break
+        self.failIf(self.t.connected)
+        self.failUnless(self.p.foundDestination)
+        self.failIf(self.t.written)
+        line, rest = self.pp._buffer.split('\r', 1)
+        self.assertEquals(line, 'GET /existing?a=b&%s=ID HTTP/1.0' %
+                          self.pp.requestIdParameter)
+        self.assertEquals(rest, '')
+
+    def testRequestInChunks(self):
+        self.pp.dataReceived('GET /exis')
+        self.pp.dataReceived('ting HTTP/1.1\r\nHost: local')
+        self.failIf(self.t.connected)
+        self.failUnless(self.p.foundDestination)
+        line, rest = self.pp._buffer.split('\r\n', 1)
+        self.failUnless(line.endswith(' HTTP/1.1'))
+        self.assertEquals(rest, 'Host: local')
+
     def testErrorSendingFileDescriptors(self):
         self.pp.dataReceived('GET ')
         self.failUnless(self.t.connected)
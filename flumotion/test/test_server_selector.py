@@ -26,6 +26,7 @@ import twisted
 
 from twisted.internet import defer, threads, reactor
 from flumotion.common import testsuite, errors
+from flumotion.component.misc.httpserver.httpcached import common
 from flumotion.component.misc.httpserver.httpcached import server_selection
 
 attr = testsuite.attr
@@ -164,6 +165,70 @@ class TestServerSelector(testsuite.TestCase):
         return result
 
 
+class TestServerHealth(testsuite.TestCase):
+
+    def setUp(self):
+        self.ss = server_selection.ServerSelector(None)
+        self.a = server_selection.Server("10.0.0.1", 80, 1.0)
+        self.b = server_selection.Server("10.0.0.2", 80, 1.0)
+        self.ss.servers[1.0] = [self.a, self.b]
+
+    def _fail(self, server, code=common.SERVER_UNAVAILABLE):
+        server.requestStarted()
+        server.reportError(code)
+        server.requestEnded()
+
+    def testEjection(self):
+        for i in range(server_selection.EJECTION_ERRORS):
+            self.failIf(self.a.isEjected())
+            self._fail(self.a)
+        self.failUnless(self.a.isEjected())
+        self.failIf(self.a.shouldProbe())
+        self.assertEquals(list(self.ss.getServers()), [self.b, self.a])
+
+        # once the ejection time is over, one probe request is sent
+        self.a.ejectedUntil = time.time() - 1
+        self.failUnless(self.a.shouldProbe())
+        self.assertEquals(list(self.ss.getServers()), [self.a, self.b])
+        self.failIf(self.a.shouldProbe())
+
+        # and the server is reinstated if it answers
+        self.a.reportLatency(0.1)
+        self.failIf(self.a.isEjected())
+
+    def testFailedProbe(self):
+        for i in range(server_selection.EJECTION_ERRORS):
+            self._fail(self.a)
+        self.a.ejectedUntil = time.time() - 1
+        self.ss.getServers().next().requestStarted()
+        self.a.reportError(common.SERVER_TIMEOUT)
+        self.a.requestEnded()
+        self.failUnless(self.a.isEjected())
+        self.failIf(self.a.shouldProbe())
+
+    def testNotHealthErrors(self):
+        for i in range(server_selection.EJECTION_ERRORS):
+            self._fail(self.a, common.RANGE_NOT_SATISFIABLE)
+        self.failIf(self.a.isEjected())
+        self.assertEquals(self.a.errorCount, 0)
+
+    def testLoad(self):
+        self.a.reportLatency(1.0)
+        self.b.reportLatency(0.1)
+        self.assertEquals(list(self.ss.getServers()), [self.b, self.a])
+
+        # the fast server is much busier
+        for i in range(20):
+            self.b.requestStarted()
+        self.assertEquals(list(self.ss.getServers()), [self.a, self.b])
+
+    def testStatistics(self):
+        self._fail(self.a)
+        stats = self.ss.getStatistics()
+        self.assertEquals(stats["10.0.0.1:80"]["error-count"], 1)
+        self.assertEquals(stats["10.0.0.2:80"]["request-count"], 0)
+
+
 class DummySocketDNS:
 
     def __init__(self, table):
@@ -0,0 +1,121 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_timerwheel -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+from twisted.internet import task
+
+from flumotion.common import testsuite
+from flumotion.component.base import timerwheel
+
+
+class TestTimerWheel(testsuite.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.wheel = timerwheel.TimerWheel(1.0, 8, self.clock)
+        self.expired = []
+
+    def tick(self, count):
+        for i in range(count):
+            self.clock.advance(1)
+
+    def testExpire(self):
+        self.wheel.add('a', 3, self.expired.append, 'a')
+        self.wheel.add('b', 5, self.expired.append, 'b')
+        self.assertEquals(len(self.wheel), 2)
+        self.tick(2)
+        self.assertEquals(self.expired, [])
+        self.tick(2)
+        self.assertEquals(self.expired, ['a'])
+        self.tick(2)
+        self.assertEquals(self.expired, ['a', 'b'])
+        self.assertEquals(len(self.wheel), 0)
+        # Nothing left to do, no delayed call
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testTouch(self):
+        self.wheel.add('a', 3, self.expired.append, 'a')
+        self.tick(2)
+        self.failUnless(self.wheel.touch('a', 3))
+        self.tick(2)
+        self.assertEquals(self.expired, [])
+        self.tick(2)
+        self.assertEquals(self.expired, ['a'])
+        self.failIf(self.wheel.touch('a', 3))
+
+    def testTouchEarlier(self):
+        self.wheel.add('a', 6, self.expired.append, 'a')
+        self.wheel.touch('a', 1)
+        self.tick(2)
+        self.assertEquals(self.expired, ['a'])
+
+    def testRemove(self):
+        self.wheel.add('a', 3, self.expired.append, 'a')
+        self.failUnless('a' in self.wheel)
+        self.failUnless(self.wheel.remove('a'))
+        self.failIf(self.wheel.remove('a'))
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.tick(5)
+        self.assertEquals(self.expired, [])
+
+    def testReplace(self):
+        self.wheel.add('a', 2, self.expired.append, 'first')
+        self.wheel.add('a', 4, self.expired.append, 'second')
+        self.tick(5)
+        self.assertEquals(self.expired, ['second'])
+
+    def testLongTimeout(self):
+        # More than a whole ring of slots
+        self.wheel.add('a', 20, self.expired.append, 'a')
+        self.tick(19)
+        self.assertEquals(self.expired, [])
+        self.tick(2)
+        self.assertEquals(self.expired, ['a'])
+
+    def testBatch(self):
+        for i in range(100):
+            self.wheel.add(i, 3, self.expired.append, i)
+        self.tick(4)
+        self.assertEquals(sorted(self.expired), range(100))
+
+    def testLateTick(self):
+        self.wheel.add('a', 3, self.expired.append, 'a')
+        self.wheel.add('b', 30, self.expired.append, 'b')
+        # The reactor was busy for a while
+        self.clock.advance(15)
+        self.assertEquals(self.expired, ['a'])
+        self.tick(16)
+        self.assertEquals(self.expired, ['a', 'b'])
+
+    def testCallbackAdds(self):
+
+        def expired(key):
+            self.expired.append(key)
+            if key == 'a':
+                self.wheel.add('b', 1, expired, 'b')
+
+        self.wheel.add('a', 1, expired, 'a')
+        self.tick(4)
+        self.assertEquals(self.expired, ['a', 'b'])
+
+    def testShared(self):
+        self.assertIdentical(timerwheel.getTimerWheel(),
+                             timerwheel.getTimerWheel())
@@ -0,0 +1,251 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_twisted_fdserver -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# (www.fluendo.com). All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+import os
+import tempfile
+
+from twisted.internet import defer, protocol, reactor
+
+from flumotion.common import testsuite
+from flumotion.twisted import fdserver
+
+
+class FDReceiver(protocol.Protocol):
+
+    def __init__(self):
+        self.received = []
+        self.data = ''
+        self.waiting = None
+
+    def fileDescriptorsReceived(self, fds, message):
+        self.received.append((fds, message))
+        self._check()
+
+    def dataReceived(self, data):
+        self.data += data
+        self._check()
+
+    def waitFor(self, count, data=''):
+        self.waiting = count, data, defer.Deferred()
+        self._check()
+        return self.waiting[2]
+
+    def _check(self):
+        if not self.waiting:
+            return
+        count, data, d = self.waiting
+        if len(self.received) >= count and len(self.data) >= len(data):
+            self.waiting = None
+            d.callback(None)
+
+
+class FDSender(protocol.Protocol):
+
+    def connectionMade(self):
+        self.factory.connected.callback(self)
+
+
+class TestFDPassing(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp('.socket', 'flumotion.test.')
+        serverFactory = protocol.ServerFactory()
+        serverFactory.protocol = FDSender
+        serverFactory.connected = defer.Deferred()
+        self.port = reactor.listenWith(fdserver.FDPort, self.path,
+                                       serverFactory)
+
+        self.receiver = FDReceiver()
+        clientFactory = protocol.ClientFactory()
+        clientFactory.buildProtocol = lambda addr: self.receiver
+        self.connector = reactor.connectWith(fdserver.FDConnector,
+                                             self.path, clientFactory, 10,
+                                             checkPID=False)
+        self.pipes = []
+
+        def connected(sender):
+            self.sender = sender
+        return serverFactory.connected.addCallback(connected)
+
+    def tearDown(self):
+        for fds, message in self.receiver.received:
+            for fd in fds:
+                os.close(fd)
+        for r, w in self.pipes:
+            os.close(r)
+            os.close(w)
+        self.connector.disconnect()
+        return self.port.stopListening()
+
+    def makePipe(self, content):
+        r, w = os.pipe()
+        os.write(w, content)
+        self.pipes.append((r, w))
+        return r
+
+    def assertReceived(self, expected):
+        received = []
+        for fds, message in self.receiver.received:
+            self.assertEquals(len(fds), 1)
+            received.append((os.read(fds[0], 100), message))
+        self.assertEquals(received, expected)
+
+    def testQueueBatch(self):
+        transport = self.sender.transport
+        expected = []
+        sent = []
+        for i in range(40):
+            data = 'message %d' % i
+            sent.append(transport.queueFileDescriptor(
+                self.makePipe('pipe %d' % i), data))
+            expected.append(('pipe %d' % i, data))
+        transport.write('some data')
+        self.assertEquals(transport.getQueuedFileDescriptors(), 40)
+
+        d = defer.DeferredList(sent, fireOnOneErrback=True)
+        d.addCallback(lambda _: self.receiver.waitFor(40, 'some data'))
+
+        def check(_):
+            self.assertReceived(expected)
+            self.assertEquals(self.receiver.data, 'some data')
+            self.assertEquals(transport.getQueuedFileDescriptors(), 0)
+            count, total, maximum = transport.popHandoffStats()
+            self.assertEquals(count, 40)
+            self.failIf(total < maximum)
+            self.assertEquals(transport.popHandoffStats(), (0, 0.0, 0.0))
+        d.addCallback(check)
+        return d
+
+    def testSendSynchronously(self):
+        self.sender.transport.sendFileDescriptor(self.makePipe('pipe'),
+                                                 'message')
+        d = self.receiver.waitFor(1)
+        d.addCallback(lambda _: self.assertReceived([('pipe', 'message')]))
+        return d
+
+    def testQueueFull(self):
+        transport = self.sender.transport
+        transport.maxQueuedFileDescriptors = 1
+        d1 = transport.queueFileDescriptor(self.makePipe('pipe 1'), 'm1')
+        d2 = transport.queueFileDescriptor(self.makePipe('pipe 2'), 'm2')
+        d2 = self.assertFailure(d2, OSError)
+        return defer.DeferredList([d1, d2], fireOnOneErrback=True)
+
+
+class TestFDClientSplitMessages(testsuite.TestCase):
+
+    def setUp(self):
+        self.receiver = FDReceiver()
+        self.client = fdserver.FDClient.__new__(fdserver.FDClient)
+        self.client.protocol = self.receiver
+
+    def testSplitBatch(self):
+        message = (fdserver._frame('first') + fdserver._frame('second') +
+                   'trailing')
+        self.client._fileDescriptorsReceived([3, 4], message[:30])
+        self.failIf(self.receiver.received)
+        self.client._fileDescriptorsReceived(
+            self.client._pendingFDs,
+            self.client._pendingMessage + message[30:])
+        self.assertEquals(self.receiver.received,
+                          [([3], 'first'), ([4], 'second')])
+        self.assertEquals(self.receiver.data, 'trailing')
+
+    def testSingleBlockForSeveralFDs(self):
+        trailing = 'trailing data, not a message block'
+        message = fdserver._frame('only') + trailing
+        self.client._fileDescriptorsReceived([3, 4], message)
+        self.assertEquals(self.receiver.received, [([3, 4], 'only')])
+        self.assertEquals(self.receiver.data, trailing)
+
+
+class Closer(protocol.Protocol):
+
+    def connectionMade(self):
+        self.factory.accepted += 1
+        self.transport.loseConnection()
+
+
+class ClosedWaiter(protocol.Protocol):
+
+    def __init__(self):
+        self.closed = defer.Deferred()
+
+    def connectionLost(self, reason):
+        self.closed.callback(None)
+
+
+class TestReusePort(testsuite.TestCase):
+
+    if not fdserver.canReusePort():
+        skip = 'SO_REUSEPORT is not supported'
+
+    def testShareListeningPort(self):
+        factory = protocol.ServerFactory()
+        first = reactor.listenWith(fdserver.PassableServerPort, 0, factory,
+                                   interface='127.0.0.1', reusePort=True)
+        port = first.getHost().port
+        second = reactor.listenWith(fdserver.PassableServerPort, port,
+                                    factory, interface='127.0.0.1',
+                                    reusePort=True)
+        self.assertEquals(second.getHost().port, port)
+        return defer.DeferredList([defer.maybeDeferred(first.stopListening),
+                                   defer.maybeDeferred(second.stopListening)])
+
+    def testSpreadConnections(self):
+        factories = []
+        ports = []
+        port = 0
+        for i in range(2):
+            factory = protocol.ServerFactory()
+            factory.protocol = Closer
+            factory.accepted = 0
+            listening = reactor.listenWith(fdserver.PassableServerPort,
+                                           port, factory,
+                                           interface='127.0.0.1',
+                                           reusePort=True)
+            port = listening.getHost().port
+            factories.append(factory)
+            ports.append(listening)
+
+        clients = []
+        for i in range(32):
+            client = ClosedWaiter()
+            clients.append(client)
+            creator = protocol.ClientCreator(reactor, lambda c=client: c)
+            creator.connectTCP('127.0.0.1', port)
+
+        def check(_):
+            accepted = [f.accepted for f in factories]
+            self.assertEquals(sum(accepted), 32)
+            # The kernel gave connections to both listening sockets
+            self.failIf(0 in accepted, accepted)
+
+        def stop(result):
+            d = defer.DeferredList([defer.maybeDeferred(p.stopListening)
+                                    for p in ports])
+            d.addCallback(lambda _: result)
+            return d
+
+        d = defer.DeferredList([c.closed for c in clients])
+        d.addCallback(check)
+        d.addBoth(stop)
+        return d
@@ -46,3 +46,17 @@ class WorkerConfigTest(testsuite.TestCase):
 </worker>
 """)
         self.failUnless(conf.randomFeederports)
+
+    def testJobPool(self):
+        conf = config.WorkerConfigXML(None, string="""
+<worker>
+  <job-pool>2</job-pool>
+</worker>
+""")
+        self.assertEquals(conf.jobPool, 2)
+
+        conf = config.WorkerConfigXML(None, string="<worker/>")
+        self.assertEquals(conf.jobPool, None)
+
+        self.assertRaises(config.ConfigError, config.WorkerConfigXML, None,
+                          string="<worker><job-pool>x</job-pool></worker>")
@@ -23,7 +23,7 @@ from twisted.trial import unittest
 from twisted.internet import reactor, defer
 
 from flumotion.common import testsuite
-from flumotion.worker import worker
+from flumotion.worker import base, worker
 
 
 class FakeOptions:
@@ -32,6 +32,57 @@ class FakeOptions:
         self.name = 'fakeworker'
         self.feederports = []
         self.randomFeederports = False
+        self.jobPool = 0
+
+
+class FakeJobAvatar:
+
+    def __init__(self, avatarId, pid):
+        self.avatarId = self.logName = avatarId
+        self.pid = pid
+        self.mind = object()
+        self.created = None
+
+    def createComponent(self, jobInfo):
+        self.created = jobInfo
+
+
+class FakeProcessProtocol:
+
+    def setAvatarId(self, avatarId):
+        self.avatarId = avatarId
+
+
+class TestComponentJobHeaven(testsuite.TestCase):
+
+    def setUp(self):
+        self.brain = worker.WorkerBrain(FakeOptions())
+        self.jobHeaven = self.brain.jobHeaven
+
+    def testSpawnInIdleJob(self):
+        heaven = self.jobHeaven
+        idle = FakeJobAvatar('job-pool-0', 1234)
+        process = FakeProcessProtocol()
+        heaven.avatars[idle.avatarId] = idle
+        heaven.addJobInfo(1234, base.JobInfo(1234, idle.avatarId, None,
+                                             None, None, None, []))
+        heaven._poolProcesses[1234] = process
+        heaven.jobPool.append(idle)
+        self.assertEquals(heaven.getJobInfos(), [])
+
+        heaven.spawn('/default/producer', 'producer', 'module', 'method',
+                     0, [], {})
+        self.assertEquals(heaven.jobPool, [])
+        self.assertEquals(heaven.avatars.keys(), ['/default/producer'])
+        self.assertEquals(idle.avatarId, '/default/producer')
+        self.assertEquals(process.avatarId, '/default/producer')
+        self.assertEquals(idle.created.avatarId, '/default/producer')
+        self.assertEquals(heaven.getJobInfos(), [idle.created])
+
+        # let the pool be filled again, which is a no-op without a size
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        return d
 
 
 class TestCheckJobHeaven(testsuite.TestCase):
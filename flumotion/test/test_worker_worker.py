@@ -31,6 +31,7 @@ class FakeOptions:
         self.transport = 'TCP'
         self.feederports = [9998]
         self.randomFeederports = False
+        self.jobPool = 0
         self.name = 'fakeworker'
 
 
@@ -22,7 +22,7 @@
 from flumotion.common import log
 from flumotion.extern.fdpass import fdpass
 
-from twisted.internet import unix, main, address, tcp
+from twisted.internet import unix, main, address, tcp, defer
 from twisted.spread import pb
 
 import errno
@@ -47,15 +47,147 @@ __version__ = "$Rev$"
 #
 # map() instead of a string to workaround gettext encoding problems.
 #
+# Several file descriptors can be passed in a single message, in which case
+# the message is made of one such block per file descriptor, in the same
+# order as the file descriptors.
+#
 MAGIC_SIGNATURE = ''.join(map(chr, [253, 252, 142, 127, 7, 71, 185, 234,
                                     161, 117, 238, 216, 220, 54, 200, 163]))
+HEADER_SIZE = struct.calcsize("@16sI")
+
+# The maximum number of FDs and bytes passed in a single message; the
+# receiving end reads at most this many of each at once (see fdpass.c and
+# FDClient.doRead)
+MAX_MESSAGE_FDS = 32
+MAX_MESSAGE_SIZE = 64 * 1024
+
+
+def _frame(data):
+    return struct.pack("@16sI", MAGIC_SIGNATURE, len(data)) + data
 
 
 class FDServer(unix.Server):
+    """
+    A UNIX socket connection over which we can pass file descriptors.
+
+    File descriptors can either be sent synchronously with
+    L{sendFileDescriptor}, or queued with L{queueFileDescriptor}; queued
+    descriptors are sent when the socket becomes writable, batching as many
+    of them as possible in each message, so that a slow receiver never
+    blocks us.
+
+    @cvar maxQueuedFileDescriptors: the maximum number of file descriptors
+                                    waiting to be sent
+    """
+
+    maxQueuedFileDescriptors = 1024
+
+    _fdQueue = None
+    _fdTail = ''
+    _fdsSent = 0
+    _fdWaitTotal = 0.0
+    _fdWaitMax = 0.0
 
     def sendFileDescriptor(self, fileno, data=""):
-        message = struct.pack("@16sI", MAGIC_SIGNATURE, len(data)) + data
-        return fdpass.writefds(self.fileno(), [fileno], message)
+        return fdpass.writefds(self.fileno(), [fileno], _frame(data))
+
+    def queueFileDescriptor(self, fileno, data=""):
+        """
+        Queue a file descriptor to be passed, along with some data, without
+        blocking. The file descriptor must be kept open until the returned
+        deferred fires.
+
+        @returns: a deferred firing with the time in seconds the file
+                  descriptor waited in the queue once it has been passed,
+                  or failing if it could not be passed
+        @rtype:   L{twisted.internet.defer.Deferred}
+        """
+        if self._fdQueue is None:
+            self._fdQueue = []
+        if len(self._fdQueue) >= self.maxQueuedFileDescriptors:
+            return defer.fail(OSError(errno.EAGAIN,
+                                      'Too many queued file descriptors'))
+        d = defer.Deferred()
+        self._fdQueue.append((fileno, _frame(data), time.time(), d))
+        self.startWriting()
+        return d
+
+    def getQueuedFileDescriptors(self):
+        """
+        @returns: the number of file descriptors waiting to be passed
+        @rtype:   int
+        """
+        return len(self._fdQueue or [])
+
+    def popHandoffStats(self):
+        """
+        Return statistics about queued file descriptors passed since the
+        last call, and reset them.
+
+        @returns: the number of file descriptors passed, and the total and
+                  maximum time in seconds they waited in the queue
+        @rtype:   tuple of (int, float, float)
+        """
+        stats = (self._fdsSent, self._fdWaitTotal, self._fdWaitMax)
+        self._fdsSent = 0
+        self._fdWaitTotal = self._fdWaitMax = 0.0
+        return stats
+
+    def _writeFileDescriptors(self):
+        # Write as much of the queue as we can, return True when it has
+        # been completely written
+        if self._fdTail:
+            # the end of a partially written message must go out before
+            # anything else
+            sent = os.write(self.fileno(), self._fdTail)
+            self._fdTail = self._fdTail[sent:]
+            if self._fdTail:
+                return False
+
+        queue = self._fdQueue
+        while queue:
+            fds, frames, size = [], [], 0
+            for fileno, frame, queued, d in queue[:MAX_MESSAGE_FDS]:
+                if frames and size + len(frame) > MAX_MESSAGE_SIZE:
+                    break
+                fds.append(fileno)
+                frames.append(frame)
+                size += len(frame)
+            message = ''.join(frames)
+
+            sent = fdpass.writefds(self.fileno(), fds, message)
+
+            # The descriptors went along with the first byte
+            batch = queue[:len(fds)]
+            del queue[:len(fds)]
+            now = time.time()
+            for fileno, frame, queued, d in batch:
+                wait = now - queued
+                self._fdsSent += 1
+                self._fdWaitTotal += wait
+                self._fdWaitMax = max(self._fdWaitMax, wait)
+                d.callback(wait)
+            if sent < len(message):
+                self._fdTail = message[sent:]
+                return False
+        return True
+
+    def doWrite(self):
+        if self._fdQueue or self._fdTail:
+            try:
+                if not self._writeFileDescriptors():
+                    return None
+            except OSError, e:
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return None
+                return main.CONNECTION_LOST
+        return unix.Server.doWrite(self)
+
+    def connectionLost(self, reason):
+        queue, self._fdQueue = self._fdQueue or [], None
+        for fileno, frame, queued, d in queue:
+            d.errback(OSError(errno.EPIPE, 'Connection lost'))
+        unix.Server.connectionLost(self, reason)
 
 
 class FDPort(unix.Port):
@@ -64,11 +196,16 @@ class FDPort(unix.Port):
 
 class FDClient(unix.Client): #, log.Loggable):
 
+    # FDs received along with an incomplete message, and the part of the
+    # message received so far
+    _pendingFDs = None
+    _pendingMessage = ''
+
     def doRead(self):
         if not self.connected:
             return
         try:
-            (fds, message) = fdpass.readfds(self.fileno(), 64 * 1024)
+            (fds, message) = fdpass.readfds(self.fileno(), MAX_MESSAGE_SIZE)
         except OSError, e:
             if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
                 return
@@ -78,6 +215,14 @@ class FDClient(unix.Client): #, log.Loggable):
             if not message:
                 return main.CONNECTION_DONE
 
+            if self._pendingFDs:
+                # The rest of a message that was split
+                fds = self._pendingFDs + fds
+                message = self._pendingMessage + message
+                self._pendingFDs = None
+                self._pendingMessage = ''
+                return self._fileDescriptorsReceived(fds, message)
+
             if len(fds) > 0:
                 # Look for our magic cookie in (possibly) the midst of other
                 # data. Pass surrounding chunks, if any, onto dataReceived(),
@@ -96,20 +241,47 @@ class FDClient(unix.Client): #, log.Loggable):
                     if ret:
                         return ret
 
-                msglen = struct.unpack("@I", message[offset+16:offset+20])[0]
-                offset += 20
-                ret = self.protocol.fileDescriptorsReceived(fds,
-                    message[offset:offset+msglen])
-                if ret:
-                    return ret
-
-                if offset+msglen < len(message):
-                    return self.protocol.dataReceived(message[offset+msglen:])
-                return ret
+                return self._fileDescriptorsReceived(fds, message[offset:])
             else:
               #  self.debug("No FDs, passing to dataReceived")
                 return self.protocol.dataReceived(message)
 
+    def _fileDescriptorsReceived(self, fds, message):
+        # message starts with one block per fd; if we didn't get all of
+        # them yet, keep what we have until the rest arrives
+        blocks = []
+        offset = 0
+        while len(blocks) < len(fds):
+            header = message[offset:offset+HEADER_SIZE]
+            if len(header) < HEADER_SIZE:
+                break
+            magic, msglen = struct.unpack("@16sI", header)
+            if blocks and magic != MAGIC_SIGNATURE:
+                # Not one block per fd; pass the remaining fds along with
+                # the last block
+                lastfds, data = blocks.pop()
+                blocks.append((lastfds + fds[len(blocks)+1:], data))
+                break
+            if offset + HEADER_SIZE + msglen > len(message):
+                break
+            offset += HEADER_SIZE
+            blocks.append(([fds[len(blocks)]],
+                           message[offset:offset+msglen]))
+            offset += msglen
+
+        if sum([len(fdlist) for fdlist, data in blocks]) < len(fds):
+            self._pendingFDs = fds
+            self._pendingMessage = message
+            return
+
+        for fdlist, data in blocks:
+            ret = self.protocol.fileDescriptorsReceived(fdlist, data)
+            if ret:
+                return ret
+
+        if offset < len(message):
+            return self.protocol.dataReceived(message[offset:])
+
 
 class FDConnector(unix.Connector):
 
@@ -200,5 +372,38 @@ class PassableServerConnection(_SocketMaybeCloser, tcp.Server):
     pass
 
 
+# Not exposed by the socket module; this is the Linux value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def canReusePort():
+    """
+    Check whether several processes can listen on the same TCP port, with
+    the kernel distributing incoming connections among them.
+
+    @rtype: bool
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        try:
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        except socket.error:
+            return False
+        return True
+    finally:
+        s.close()
+
+
 class PassableServerPort(tcp.Port):
     transport = PassableServerConnection
+
+    def __init__(self, *args, **kwargs):
+        self.reusePort = kwargs.pop('reusePort', False)
+        tcp.Port.__init__(self, *args, **kwargs)
+
+    def createInternetSocket(self):
+        s = tcp.Port.createInternetSocket(self)
+        if self.reusePort:
+            # let other processes listen on the same port, see canReusePort()
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
@@ -25,7 +25,7 @@ Flumotion Twisted-like flavors
 Inspired by L{twisted.spread.flavors}
 """
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.spread import pb
 from zope.interface import Interface
 from flumotion.common import log
@@ -35,6 +35,14 @@ __version__ = "$Rev$"
 
 ### Generice Cacheable/RemoteCache for state objects
 
+# values for which setting a key to an equal value cannot be told apart
+# from not setting it
+_IMMUTABLE_TYPES = (bool, int, long, float, str, unicode, type(None))
+
+# index of the listener procedures for each kind of change
+_CHANGE_INDEX = {'set': 0, 'append': 1, 'remove': 2, 'setitem': 3,
+                 'delitem': 4}
+
 
 class IStateListener(Interface):
     """
@@ -107,12 +115,22 @@ class StateCacheable(pb.Cacheable):
 
     I cache key-value pairs, where values can be either single objects
     or list of objects.
+
+    By default every change is sent to the observers as it happens. With
+    L{setBatching}, changes are instead collected and sent as one delta
+    message per observer.
     """
 
+    _batchInterval = None
+
     def __init__(self):
         self._observers = []
         self._hooks = []
         self._dict = {}
+        self._delta = [] # changes not yet sent, None for collapsed ones
+        self._deltaSets = {} # key -> (index in _delta, value observed)
+        self._deltaWaiters = []
+        self._deltaCall = None
 
     # our methods
 
@@ -174,6 +192,11 @@ class StateCacheable(pb.Cacheable):
         if not key in self._dict.keys():
             raise KeyError('%s in %r' % (key, self))
 
+        if self._batchInterval is not None:
+            old = self._dict[key]
+            self._dict[key] = value
+            return self._batchSet(key, old, value)
+
         self._dict[key] = value
         dList = [o.callRemote('set', key, value) for o in self._observers]
         return defer.DeferredList(dList)
@@ -187,6 +210,8 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key].append(value)
+        if self._batchInterval is not None:
+            return self._batch(('append', key, value))
         dList = [o.callRemote('append', key, value) for o in self._observers]
         return defer.DeferredList(dList)
 
@@ -203,6 +228,8 @@ class StateCacheable(pb.Cacheable):
         except ValueError:
             raise ValueError('value %r not in list %r for key %r' % (
                 value, self._dict[key], key))
+        if self._batchInterval is not None:
+            return self._batch(('remove', key, value))
         dList = [o.callRemote('remove', key, value) for o in self._observers]
         dl = defer.DeferredList(dList)
         return dl
@@ -216,6 +243,8 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key][subkey] = value
+        if self._batchInterval is not None:
+            return self._batch(('setitem', key, subkey, value))
         dList = [o.callRemote('setitem', key, subkey, value)
                 for o in self._observers]
         return defer.DeferredList(dList)
@@ -234,14 +263,115 @@ class StateCacheable(pb.Cacheable):
         except KeyError:
             raise KeyError('key %r not in dict %r for key %r' % (
                 subkey, self._dict[key], key))
+        if self._batchInterval is not None:
+            return self._batch(('delitem', key, subkey, value))
         dList = [o.callRemote('delitem', key, subkey, value) for o in
                 self._observers]
         dl = defer.DeferredList(dList)
         return dl
 
+    def setBatching(self, interval=0):
+        """
+        Collect changes and send them to each observer as one delta
+        message, at most every interval seconds. Setting a key to the
+        value observers already have is not sent at all, and only the
+        last of several sets of a key is.
+
+        The deferreds returned by the methods changing the state fire
+        once the delta including the change has been sent.
+
+        @param interval: the time to collect changes for, 0 to send them
+                         on the next reactor iteration, or None to stop
+                         batching changes
+        @type  interval: float or None
+        """
+        self._batchInterval = interval
+        if interval is None:
+            self.flushDelta()
+
+    def flushDelta(self):
+        """
+        Send the changes collected in batching mode to the observers now.
+
+        @rtype: L{twisted.internet.defer.Deferred}
+        """
+        if self._deltaCall is not None:
+            if self._deltaCall.active():
+                self._deltaCall.cancel()
+            self._deltaCall = None
+        delta = [change for change in self._delta if change is not None]
+        waiters = self._deltaWaiters
+        self._delta = []
+        self._deltaSets = {}
+        self._deltaWaiters = []
+
+        dList = []
+        if delta:
+            dList = [o.callRemote('delta', delta) for o in self._observers]
+        d = defer.DeferredList(dList)
+
+        def fireWaiters(result):
+            for waiter in waiters:
+                waiter.callback(result)
+            return result
+        d.addCallback(fireWaiters)
+        return d
+
+    def _batchWaiter(self):
+        if self._deltaCall is None:
+            self._deltaCall = reactor.callLater(self._batchInterval,
+                                                self.flushDelta)
+        d = defer.Deferred()
+        self._deltaWaiters.append(d)
+        return d
+
+    def _batch(self, change):
+        if not self._observers:
+            return defer.succeed([])
+        # a set of the key followed by this change can no longer be
+        # collapsed with a later set
+        self._deltaSets.pop(change[1], None)
+        self._delta.append(change)
+        return self._batchWaiter()
+
+    def _batchSet(self, key, old, value):
+        if not self._observers:
+            return defer.succeed([])
+
+        index, observed = self._deltaSets.get(key, (None, old))
+        if index is not None:
+            self._delta[index] = None
+            del self._deltaSets[key]
+        if (type(value) in _IMMUTABLE_TYPES and type(value) == type(observed)
+            and value == observed):
+            return defer.succeed([])
+
+        self._deltaSets[key] = (len(self._delta), observed)
+        self._delta.append(('set', key, value))
+        return self._batchWaiter()
+
+    def _sendDelta(self, delta, old):
+        # forward a delta received as a proxy, already applied; old has
+        # the previous values of the keys set by it
+        if self._batchInterval is None:
+            dList = [o.callRemote('delta', delta) for o in self._observers]
+            return defer.DeferredList(dList)
+        if not self._observers:
+            return defer.succeed([])
+        for change, previous in zip(delta, old):
+            if change[0] == 'set':
+                self._batchSet(change[1], previous, change[2])
+            else:
+                self._batch(change)
+        return self._batchWaiter()
+
     # pb.Cacheable methods
 
     def getStateToCacheAndObserveFor(self, perspective, observer):
+        # the new observer gets the current state, including any changes
+        # not yet sent to the others
+        if self._delta:
+            self.flushDelta()
         self._observers.append(observer)
         for hook in self._hooks:
             hook.observerAppend(observer, len(self._observers))
@@ -478,6 +608,42 @@ class StateRemoteCache(pb.RemoteCache):
 
         self._notifyListeners(4, key, subkey, value)
 
+    def observe_delta(self, delta):
+        # all the changes are applied before any listener gets notified;
+        # listeners then get notified in the order of the changes
+        old = []
+        for change in delta:
+            name, key, args = change[0], change[1], change[2:]
+            old.append(None)
+            if name == 'set':
+                old[-1] = self._dict[key]
+                self._dict[key] = args[0]
+            elif name == 'append':
+                self._dict[key].append(args[0])
+            elif name == 'remove':
+                try:
+                    self._dict[key].remove(args[0])
+                except ValueError:
+                    raise ValueError("value %r not under key %r with values "
+                                     "%r" % (args[0], key, self._dict[key]))
+            elif name == 'setitem':
+                self._dict[key][args[0]] = args[1]
+            elif name == 'delitem':
+                try:
+                    del self._dict[key][args[0]]
+                except KeyError:
+                    raise KeyError("key %r not in dict %r for state dict %r" %
+                        (args[0], self._dict[key], self._dict))
+            else:
+                raise ValueError('unknown state change %r' % (name, ))
+
+        # if we also subclass from Cacheable, then we're a proxy, so proxy
+        if hasattr(self, 'set'):
+            StateCacheable._sendDelta(self, delta, old)
+
+        for change in delta:
+            self._notifyListeners(_CHANGE_INDEX[change[0]], *change[1:])
+
     def invalidate(self):
         """Invalidate this StateRemoteCache.
 
@@ -0,0 +1,226 @@
+# -*- test-case-name: flumotion.test.test_component_base_watcher -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008 Fluendo, S.L. (www.fluendo.com).
+# All rights reserved.
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+# Licensees having purchased or holding a valid Flumotion Advanced
+# Streaming Server license may use this file in accordance with the
+# Flumotion Advanced Streaming Server Commercial License Agreement.
+# See "LICENSE.Flumotion" in the source distribution for more information.
+
+# Headers in this file shall remain intact.
+
+"""
+Linux inotify file change notifications, read from the reactor
+"""
+
+import errno
+import fcntl
+import os
+import struct
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadDescriptor
+from zope.interface import implements
+
+from flumotion.common import log
+
+__version__ = "$Rev$"
+
+# inotify is used through ctypes, it is not available on other systems
+# than Linux, nor with Python older than 2.6
+HAS_INOTIFY = False
+_libc = None
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _libc.inotify_init
+    _libc.inotify_add_watch
+    _libc.inotify_rm_watch
+    HAS_INOTIFY = True
+except (ImportError, OSError, AttributeError, TypeError):
+    _libc = None
+
+# from sys/inotify.h
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = "=iIII"
+_EVENT_HEADER_SIZE = struct.calcsize(_EVENT_HEADER)
+_READ_SIZE = 64 * 1024
+
+
+class INotifyError(Exception):
+    """
+    inotify could not be used.
+    """
+
+
+class INotify(log.Loggable):
+    """
+    I watch directories and files with inotify, calling a function
+    for each event, from the reactor when the inotify file descriptor
+    is readable.
+
+    The function is called with the watched path, the name of the file
+    in the watched directory or None, the event mask and the cookie
+    relating moves. When the kernel queue overflowed, it is called once
+    with a None path and the IN_Q_OVERFLOW mask.
+    """
+
+    implements(IReadDescriptor)
+
+    logCategory = 'inotify'
+
+    def __init__(self, callback):
+        """
+        @param callback: the function called for each event
+        @type  callback: callable(path, name, mask, cookie)
+
+        @raises INotifyError: if inotify is not available
+        """
+        if not HAS_INOTIFY:
+            raise INotifyError("inotify is not available")
+        fd = _libc.inotify_init()
+        if fd < 0:
+            raise INotifyError(os.strerror(ctypes.get_errno()))
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self._fd = fd
+        self._callback = callback
+        self._paths = {} # watch descriptor -> path
+        self._buffer = ''
+        self._reading = False
+
+    def watch(self, path, mask):
+        """
+        Starts watching a file or a directory.
+
+        @param path: the path of the file or directory
+        @type  path: str
+        @param mask: the events to watch, IN_* flags
+        @type  mask: int
+
+        @returns: the watch descriptor
+        @rtype:   int
+        @raises INotifyError: if the path cannot be watched
+        """
+        wd = _libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            raise INotifyError("could not watch %s: %s"
+                               % (path, os.strerror(ctypes.get_errno())))
+        self._paths[wd] = path
+        return wd
+
+    def ignore(self, wd):
+        """
+        Stops watching what was watched with the given descriptor.
+        """
+        if self._paths.pop(wd, None) is not None:
+            _libc.inotify_rm_watch(self._fd, wd)
+
+    def startReading(self):
+        if not self._reading:
+            self._reading = True
+            reactor.addReader(self)
+
+    def close(self):
+        """
+        Stops watching everything. Can be called from the callback.
+        """
+        if self._fd is None:
+            return
+        if self._reading:
+            reactor.removeReader(self)
+            self._reading = False
+        os.close(self._fd)
+        self._fd = None
+        self._paths = {}
+        self._buffer = ''
+
+    ### IReadDescriptor Methods ###
+
+    def fileno(self):
+        if self._fd is None:
+            return -1
+        return self._fd
+
+    def doRead(self):
+        while self._fd is not None:
+            try:
+                data = os.read(self._fd, _READ_SIZE)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if not data:
+                return
+            self._buffer += data
+            self._dispatch()
+
+    def connectionLost(self, reason):
+        self.close()
+
+    def logPrefix(self):
+        return 'inotify'
+
+    ### Private Methods ###
+
+    def _dispatch(self):
+        buf = self._buffer
+        pos = 0
+        while self._fd is not None and \
+                len(buf) - pos >= _EVENT_HEADER_SIZE:
+            wd, mask, cookie, size = struct.unpack_from(_EVENT_HEADER,
+                                                        buf, pos)
+            end = pos + _EVENT_HEADER_SIZE + size
+            if end > len(buf):
+                break
+            name = buf[pos + _EVENT_HEADER_SIZE:end].rstrip('\0') or None
+            pos = end
+            if mask & IN_Q_OVERFLOW:
+                path = None
+            else:
+                path = self._paths.get(wd, None)
+                if path is None:
+                    # already ignored
+                    continue
+                if mask & IN_IGNORED:
+                    del self._paths[wd]
+            try:
+                self._callback(path, name, mask, cookie)
+            except Exception, e:
+                self.warning("Error handling inotify event: %s",
+                             log.getExceptionMessage(e))
+        if self._fd is not None:
+            self._buffer = buf[pos:]
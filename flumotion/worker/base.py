@@ -99,6 +99,16 @@ class JobProcessProtocol(worker.ProcessProtocol):
                                         'component',
                                         heaven.getWorkerName())
 
+    def setAvatarId(self, avatarId):
+        """
+        Hand the process over to another avatarId, for which a create
+        deferred has already been registered.
+
+        @type  avatarId: str
+        """
+        self.avatarId = avatarId
+        self._deferredStart = self._startSet.createRegistered(avatarId)
+
     def sendMessage(self, message):
         heaven = self.loggable
         heaven.brain.callRemote('componentAddMessage', self.avatarId,
@@ -228,6 +238,25 @@ class BaseJobHeaven(pb.Root, log.Loggable):
     def getJobPids(self):
         return self._jobInfos.keys()
 
+    def jobStarted(self, avatarId):
+        """
+        Tell that the job with the given avatarId is ready, firing the
+        deferred of its start.
+
+        @type  avatarId: str
+        """
+        self._startSet.createSuccess(avatarId)
+
+    def jobStartFailed(self, avatarId, failure):
+        """
+        Tell that the job with the given avatarId could not be started,
+        failing the deferred of its start.
+
+        @type  avatarId: str
+        @type  failure:  L{twisted.python.failure.Failure}
+        """
+        self._startSet.createFailed(avatarId, failure)
+
     def rotateChildLogFDs(self):
         self.debug('telling kids about new log file descriptors')
         for avatar in self.avatars.values():
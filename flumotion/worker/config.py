@@ -63,6 +63,7 @@ class WorkerConfigXML(log.Loggable):
         self.feederports = None
         self.fludebug = None
         self.randomFeederports = False
+        self.jobPool = None
 
         try:
             if filename != None:
@@ -108,6 +109,8 @@ class WorkerConfigXML(log.Loggable):
             elif node.nodeName == 'feederports':
                 self.feederports, self.randomFeederports = \
                     self.parseFeederports(node)
+            elif node.nodeName == 'job-pool':
+                self.jobPool = self.parseJobPool(node)
             elif node.nodeName == 'debug':
                 self.fludebug = str(node.firstChild.nodeValue)
             else:
@@ -208,3 +211,15 @@ class WorkerConfigXML(log.Loggable):
                 if port not in ports:
                     ports.append(port)
         return (ports, random)
+
+    def parseJobPool(self, node):
+        # <job-pool>size</job-pool>
+        if not node.firstChild:
+            raise ConfigError("<job-pool> value must not be empty")
+        try:
+            size = int(node.firstChild.nodeValue)
+        except ValueError:
+            raise ConfigError("<job-pool> value must be an integer")
+        if size < 0:
+            raise ConfigError("<job-pool> value must not be negative")
+        return size
@@ -43,6 +43,32 @@ class ComponentJobAvatar(base.BaseJobAvatar):
 
     def haveMind(self):
 
+        def gotPid(pid):
+            self.pid = pid
+            job = self._heaven.getJobInfo(pid)
+            if isinstance(job, ComponentJobInfo):
+                return self.createComponent(job)
+            # an idle job for the pool, see ComponentJobHeaven
+            return preload()
+
+        def preload():
+            d = self.mindCallRemote('preload', self._heaven.preloadModules)
+            d.addCallback(lambda _: self._heaven.jobStarted(self.avatarId))
+            d.addErrback(lambda failure:
+                         self._heaven.jobStartFailed(self.avatarId, failure))
+            return d
+
+        d = self.mindCallRemote("getPid")
+        d.addCallback(gotPid)
+        return d
+
+    def createComponent(self, job):
+        """
+        Tell the job to load its bundles and create its component.
+
+        @type  job: L{ComponentJobInfo}
+        """
+
         def bootstrap(*args):
             return self.mindCallRemote('bootstrap', *args)
 
@@ -56,8 +82,7 @@ class ComponentJobAvatar(base.BaseJobAvatar):
         def success(_, avatarId):
             self.debug('job started component with avatarId %s',
                        avatarId)
-            # FIXME: drills down too much?
-            self._heaven._startSet.createSuccess(avatarId)
+            self._heaven.jobStarted(avatarId)
 
         def error(failure, job):
             msg = log.getFailureMessage(failure)
@@ -67,27 +92,20 @@ class ComponentJobAvatar(base.BaseJobAvatar):
             else:
                 self.warning('unhandled error creating component %s: %s',
                              job.avatarId, msg)
-            # FIXME: drills down too much?
-            self._heaven._startSet.createFailed(job.avatarId, failure)
+            self._heaven.jobStartFailed(job.avatarId, failure)
 
-        def gotPid(pid):
-            self.pid = pid
-            info = self._heaven.getManagerConnectionInfo()
-            if info.use_ssl:
-                transport = 'ssl'
-            else:
-                transport = 'tcp'
-            job = self._heaven.getJobInfo(pid)
-            workerName = self._heaven.getWorkerName()
-
-            d = bootstrap(workerName, info.host, info.port, transport,
-                          info.authenticator, job.bundles)
-            d.addCallback(create, job)
-            d.addCallback(success, job.avatarId)
-            d.addErrback(error, job)
-            return d
-        d = self.mindCallRemote("getPid")
-        d.addCallback(gotPid)
+        info = self._heaven.getManagerConnectionInfo()
+        if info.use_ssl:
+            transport = 'ssl'
+        else:
+            transport = 'tcp'
+        workerName = self._heaven.getWorkerName()
+
+        d = bootstrap(workerName, info.host, info.port, transport,
+                      info.authenticator, job.bundles)
+        d.addCallback(create, job)
+        d.addCallback(success, job.avatarId)
+        d.addErrback(error, job)
         return d
 
     def stop(self):
@@ -161,9 +179,56 @@ class ComponentJobInfo(base.JobInfo):
 
 
 class ComponentJobHeaven(base.BaseJobHeaven):
+    """
+    I spawn the jobs running components.
+
+    I can keep a pool of idle jobs started ahead of time, which have
+    already imported the modules most components need. A component
+    started while one of them is available is created in it instead of
+    in a new process, and the pool is filled again in the background.
+
+    @ivar jobPool: idle job avatars ready to be handed a component
+    @type jobPool: list of L{ComponentJobAvatar}
+    """
     avatarClass = ComponentJobAvatar
     logCategory = 'component-job-heaven'
 
+    preloadModules = ['flumotion.component.feedcomponent']
+
+    def __init__(self, brain, poolSize=0):
+        """
+        @param brain:    a reference to the worker brain
+        @type  brain:    L{worker.WorkerBrain}
+        @param poolSize: number of idle jobs to keep started
+        @type  poolSize: int
+        """
+        base.BaseJobHeaven.__init__(self, brain)
+
+        self.jobPool = []
+        self._poolSize = poolSize
+        self._poolCount = 0
+        self._poolStarting = 0
+        self._poolProcesses = {} # processid -> JobProcessProtocol
+
+    def listen(self):
+        base.BaseJobHeaven.listen(self)
+        self._fillPool()
+
+    def shutdown(self):
+        # idle jobs are stopped with the others; don't replace them
+        self._poolSize = 0
+        return base.BaseJobHeaven.shutdown(self)
+
+    def jobStopped(self, pid):
+        self.jobPool = [job for job in self.jobPool if job.pid != pid]
+        self._poolProcesses.pop(pid, None)
+        base.BaseJobHeaven.jobStopped(self, pid)
+
+    def getJobInfos(self):
+        # idle jobs don't run a component (yet)
+        return [jobInfo for jobInfo in base.BaseJobHeaven.getJobInfos(self)
+                if isinstance(jobInfo, ComponentJobInfo)]
+
     def getManagerConnectionInfo(self):
         """
         Gets the L{flumotion.common.connection.PBConnectionInfo}
@@ -178,10 +243,10 @@ class ComponentJobHeaven(base.BaseJobHeaven):
         """
         Spawn a new job.
 
-        This will spawn a new flumotion-job process, running under the
-        requested nice level. When the job logs in, it will be told to
-        load bundles and run a function, which is expected to return a
-        component.
+        This will spawn a new flumotion-job process, or take an idle one
+        from the pool, running under the requested nice level. When the
+        job has logged in, it will be told to load bundles and run a
+        function, which is expected to return a component.
 
         @param avatarId:   avatarId the component should use to log in
         @type  avatarId:   str
@@ -201,6 +266,43 @@ class ComponentJobHeaven(base.BaseJobHeaven):
         """
         d = self._startSet.createStart(avatarId)
 
+        job = None
+        if not self._isValgrindJob(avatarId):
+            job = self._getJobFromPool()
+
+        if job:
+            self.debug('creating component %s in idle job %s', avatarId,
+                       job.avatarId)
+            pid = job.pid
+            del self.avatars[job.avatarId]
+            job.avatarId = job.logName = avatarId
+            self.avatars[avatarId] = job
+            self._poolProcesses.pop(pid).setAvatarId(avatarId)
+
+            jobInfo = ComponentJobInfo(pid, avatarId, type, moduleName,
+                                       methodName, nice, bundles, conf)
+            self.addJobInfo(pid, jobInfo)
+            job.createComponent(jobInfo)
+
+            # replace the job we took
+            reactor.callLater(0, self._fillPool)
+        else:
+            p = self._spawnJob(avatarId)
+            self.addJobInfo(p.pid,
+                            ComponentJobInfo(p.pid, avatarId, type,
+                                             moduleName, methodName, nice,
+                                             bundles, conf))
+        return d
+
+    def _isValgrindJob(self, avatarId):
+        # FLU_VALGRIND_JOB takes a comma-seperated list of full component
+        # avatar IDs.
+        if 'FLU_VALGRIND_JOB' in os.environ:
+            jobnames = os.environ['FLU_VALGRIND_JOB'].split(',')
+            return avatarId in jobnames
+        return False
+
+    def _spawnJob(self, avatarId):
         p = base.JobProcessProtocol(self, avatarId, self._startSet)
         executable = os.path.join(configure.bindir, 'flumotion-job')
         if not os.path.exists(executable):
@@ -212,18 +314,14 @@ class ComponentJobHeaven(base.BaseJobHeaven):
 
         # Run some jobs under valgrind, optionally. Would be nice to have the
         # arguments to run it with configurable, but this'll do for now.
-        # FLU_VALGRIND_JOB takes a comma-seperated list of full component
-        # avatar IDs.
-        if 'FLU_VALGRIND_JOB' in os.environ:
-            jobnames = os.environ['FLU_VALGRIND_JOB'].split(',')
-            if avatarId in jobnames:
-                realexecutable = 'valgrind'
-                # We can't just valgrind flumotion-job, we have to valgrind
-                # python running flumotion-job, otherwise we'd need
-                # --trace-children (not quite sure why), which we don't want
-                argv = ['valgrind', '--leak-check=full', '--num-callers=24',
-                    '--leak-resolution=high', '--show-reachable=yes',
-                    'python'] + argv
+        if self._isValgrindJob(avatarId):
+            realexecutable = 'valgrind'
+            # We can't just valgrind flumotion-job, we have to valgrind
+            # python running flumotion-job, otherwise we'd need
+            # --trace-children (not quite sure why), which we don't want
+            argv = ['valgrind', '--leak-check=full', '--num-callers=24',
+                '--leak-resolution=high', '--show-reachable=yes',
+                'python'] + argv
 
         childFDs = {0: 0, 1: 1, 2: 2}
         env = {}
@@ -233,23 +331,55 @@ class ComponentJobHeaven(base.BaseJobHeaven):
             childFDs=childFDs)
 
         p.setPid(process.pid)
+        return p
 
-        self.addJobInfo(process.pid,
-                        ComponentJobInfo(process.pid, avatarId, type,
-                                         moduleName, methodName, nice,
-                                         bundles, conf))
-        return d
+    def _getJobFromPool(self):
+        while self.jobPool:
+            job = self.jobPool.pop(0)
+            if job.mind:
+                return job
+            self.debug('idle job %s has logged out', job.avatarId)
+        return None
+
+    def _fillPool(self):
+        while len(self.jobPool) + self._poolStarting < self._poolSize:
+            self._spawnPoolJob()
+
+    def _spawnPoolJob(self):
+        avatarId = 'job-pool-%d' % (self._poolCount, )
+        self._poolCount += 1
+
+        self.debug('spawning idle job %s', avatarId)
+        d = self._startSet.createStart(avatarId)
+        p = self._spawnJob(avatarId)
+        self._poolProcesses[p.pid] = p
+        self.addJobInfo(p.pid, base.JobInfo(p.pid, avatarId, None, None,
+                                            None, None, []))
+        self._poolStarting += 1
+
+        def started(_):
+            self._poolStarting -= 1
+            self.debug('idle job %s ready', avatarId)
+            self.jobPool.append(self.avatars[avatarId])
+
+        def failed(failure):
+            # not replaced until the next component is started, so a
+            # broken setup doesn't keep us spawning jobs
+            self._poolStarting -= 1
+            self.warning('idle job %s failed to start: %s', avatarId,
+                         log.getFailureMessage(failure))
+
+        d.addCallbacks(started, failed)
 
 
 class CheckJobAvatar(base.BaseJobAvatar):
 
     def haveMind(self):
-        # FIXME: drills down too much?
 
         def gotPid(pid):
             self.pid = pid
             job = self._heaven.getJobInfo(pid)
-            self._heaven._startSet.createSuccess(job.avatarId)
+            self._heaven.jobStarted(job.avatarId)
 
         d = self.mindCallRemote("getPid")
         d.addCallback(gotPid)
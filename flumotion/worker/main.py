@@ -90,6 +90,10 @@ def _createParser():
                      action="store_true",
                      dest="randomFeederports",
                      help="Use randomly available feeder ports")
+    group.add_option('', '--job-pool',
+                     action="store", type="int", dest="jobPool",
+                     help="number of idle job processes to keep started "
+                          "[default 0]")
 
     parser.add_option_group(group)
 
@@ -148,6 +152,11 @@ def _readConfig(workerFile, options):
     if options.feederports is not None:
         log.debug('worker', 'Using feederports %r' % options.feederports)
 
+    # job pool
+    if options.jobPool is None and cfg.jobPool is not None:
+        options.jobPool = cfg.jobPool
+        log.debug('worker', 'Keeping %d idle jobs' % options.jobPool)
+
     # general
     # command-line debug > environment debug > config file debug
     if not options.debug and cfg.fludebug \
@@ -207,6 +216,9 @@ def main(args):
         log.debug('worker', 'Using default feederports %r' %
             options.feederports)
 
+    if options.jobPool is None:
+        options.jobPool = 0
+
     # check for wrong options/arguments
     if not options.transport in ['ssl', 'tcp']:
         sys.stderr.write('ERROR: wrong transport %s, must be ssl or tcp\n' %
@@ -104,7 +104,7 @@ class WorkerBrain(log.Loggable):
         self.medium = medium.WorkerMedium(self)
 
         # really should be componentJobHeaven, but this is shorter :)
-        self.jobHeaven = job.ComponentJobHeaven(self)
+        self.jobHeaven = job.ComponentJobHeaven(self, options.jobPool)
         # for ephemeral checks
         self.checkHeaven = job.CheckJobHeaven(self)
 
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure the time a bouncer spends on each keycard expiry tick and on
+# each keepAlive call, for an increasing number of live keycards.
+#
+# usage: bouncer-expiry-bench.py [issuers]
+
+import sys
+import time
+
+from flumotion.common import keycards
+from flumotion.component.bouncers import plug
+
+
+def makeBouncer():
+    bouncer = plug.BouncerTrivialPlug(
+        {'socket': 'flumotion.component.bouncers.plug.BouncerPlug',
+         'type': 'bouncer-trivial', 'properties': {}})
+    # expire keycards on demand only
+    bouncer._expirer.stop()
+    return bouncer
+
+
+def main(args):
+    issuers = 10
+    if args:
+        issuers = int(args[0])
+
+    print '%10s %14s %14s' % ('keycards', 'tick (ms)', 'keepAlive (ms)')
+    for count in (1000, 10000, 100000, 300000):
+        bouncer = makeBouncer()
+        for i in range(count):
+            k = keycards.KeycardGeneric()
+            k.ttl = 3600
+            k.issuerName = 'issuer-%d' % (i % issuers, )
+            bouncer.addKeycard(k)
+
+        start = time.time()
+        for _ in range(10):
+            bouncer._expire()
+        tick = (time.time() - start) / 10
+
+        start = time.time()
+        for i in range(issuers):
+            bouncer.keepAlive('issuer-%d' % (i, ), 3600)
+        keepAlive = (time.time() - start) / issuers
+
+        print '%10d %14.3f %14.3f' % (count, tick * 1000, keepAlive * 1000)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
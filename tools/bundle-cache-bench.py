@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure how long the bundle loader takes to set up the bundles of a
+# component, as it does on every job spawn: with an empty cache, fetching
+# every bundle each time as the loader did before it checked the cache,
+# and with a warm cache.  The bundles are built from the flumotion tree
+# itself, one per component package, all depending on flumotion.common.
+# The manager side is called in-process, so the time a real manager takes
+# to send the zips over PB is left out of the fetching cases.
+#
+# usage: bundle-cache-bench.py [loads]
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+
+from flumotion.common import bundle, bundleclient
+from flumotion.configure import configure
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def makeBasket():
+    # one bundle for flumotion.common, and one for every package under
+    # flumotion.component depending on it
+    top = os.path.dirname(os.path.dirname(os.path.abspath(
+        bundleclient.__file__)))
+    basket = bundle.BundlerBasket()
+    names = []
+
+    def addPackage(name, directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.py'):
+                source = os.path.join(directory, filename)
+                destination = os.path.join(
+                    'flumotion', directory[len(top) + 1:], filename)
+                basket.add(name, source, destination)
+
+    addPackage('flumotion-common', os.path.join(top, 'common'))
+    for directory, dirnames, filenames in os.walk(
+        os.path.join(top, 'component')):
+        if '__init__.py' not in filenames:
+            continue
+        name = directory[len(top) + 1:].replace('/', '-')
+        addPackage(name, directory)
+        basket.depend(name, 'flumotion-common')
+        names.append(name)
+    return basket, names
+
+
+class Manager:
+    # answers the bundle calls the way the manager's avatars do
+
+    def __init__(self, basket):
+        self.basket = basket
+
+    def callRemote(self, methodName, *args, **kwargs):
+        return defer.maybeDeferred(getattr(self, 'remote_' + methodName),
+                                   *args, **kwargs)
+
+    def remote_getBundleSums(self, bundleName):
+        return [(name, self.basket.getBundlerByName(name).bundle().md5sum)
+                for name in self.basket.getDependencies(bundleName)]
+
+    def remote_getBundleZips(self, bundles):
+        zips = {}
+        for name in bundles:
+            zips[name] = self.basket.getBundlerByName(name).bundle().getZip()
+        return zips
+
+
+class UncachedUnbundler(bundle.Unbundler):
+
+    def isUnbundled(self, name, md5sum):
+        return False
+
+
+def clear(cachedir):
+    shutil.rmtree(cachedir)
+    os.mkdir(cachedir)
+
+
+def run(manager, names, loads, mode, cachedir):
+    clear(cachedir)
+    loader = bundleclient.BundleLoader(manager.callRemote)
+    if mode == 'fetch':
+        loader._unbundler = UncachedUnbundler(cachedir)
+    elif mode == 'warm':
+        for name in names:
+            loader.getBundles(bundleName=name)
+
+    latencies = []
+    failures = []
+    for i in range(loads):
+        if mode == 'cold':
+            clear(cachedir)
+        start = time.time()
+        # all the calls fire synchronously
+        d = loader.getBundles(bundleName=names[i % len(names)])
+        d.addErrback(failures.append)
+        latencies.append(time.time() - start)
+    if failures:
+        failures[0].raiseException()
+    return latencies
+
+
+def main(args):
+    loads = 200
+    if args:
+        loads = int(args[0])
+
+    basket, names = makeBasket()
+    manager = Manager(basket)
+    # build the zips and sums once, as a running manager has them
+    for name in names:
+        manager.remote_getBundleZips(basket.getDependencies(name))
+
+    # the same for all the runs, as registering another path for a bundle
+    # rebuilds its modules
+    cachedir = tempfile.mkdtemp()
+    configure.cachedir = cachedir
+
+    print '%-24s %10s %10s' % ('', 'p50 ms', 'p99 ms')
+    for name, mode in (('empty cache', 'cold'),
+                       ('always fetching', 'fetch'),
+                       ('warm cache', 'warm')):
+        latencies = run(manager, names, loads, mode, cachedir)
+        print '%-24s %10.2f %10.2f' % (name,
+                                       percentile(latencies, 50) * 1000,
+                                       percentile(latencies, 99) * 1000)
+    shutil.rmtree(cachedir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
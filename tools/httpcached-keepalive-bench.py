@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure how many small requests per second the httpcached client gets
+# through against an origin server in another process, with and without
+# keeping the connections alive, the latency of those requests and how
+# many connections it opens.
+#
+# usage: httpcached-keepalive-bench.py [requests] [concurrency]
+
+import os
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server, static
+
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import http_client
+from flumotion.component.misc.httpserver.httpcached import http_utils
+
+
+class CountingSite(server.Site):
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+class ConnectionCount(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, site):
+        resource.Resource.__init__(self)
+        self.site = site
+
+    def render_GET(self, request):
+        return '%d' % self.site.connections
+
+
+class Consumer(common.StreamConsumer):
+
+    def __init__(self):
+        self.deferred = defer.Deferred()
+        self.data = []
+
+    def serverError(self, getter, code, message):
+        self.deferred.errback(Exception("%s (%s)" % (message, code)))
+
+    def onData(self, getter, data):
+        self.data.append(data)
+
+    def streamDone(self, getter):
+        self.deferred.callback(''.join(self.data))
+
+
+def fetch(requester, port, path):
+    consumer = Consumer()
+    url = http_utils.Url(hostname='localhost', port=port, path=path)
+    requester.retrieve(consumer, url, '127.0.0.1', port)
+    return consumer.deferred
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def worker(requester, port, count, latencies):
+
+    def request(_, i):
+        if i == count:
+            return
+        start = time.time()
+        d = fetch(requester, port, '/file')
+        d.addCallback(lambda _: latencies.append(time.time() - start))
+        d.addCallback(request, i + 1)
+        return d
+
+    return request(None, 0)
+
+
+def run(port, requests, concurrency, keepAlive):
+    requester = http_client.StreamRequester(2, 5, keepAlive)
+    # asks for the count on new connections, the run cannot reuse them
+    counter = http_client.StreamRequester(2, 5, 0)
+    latencies = []
+    result = {}
+
+    def started(before):
+        result['before'] = int(before)
+        result['start'] = time.time()
+        return defer.DeferredList([worker(requester, port,
+                                          requests // concurrency,
+                                          latencies)
+                                   for i in range(concurrency)],
+                                  fireOnOneErrback=True, consumeErrors=True)
+
+    def finished(_):
+        result['elapsed'] = time.time() - result['start']
+        return requester.cleanup()
+
+    def counted(after):
+        # the two connection count requests are not part of the run
+        return (len(latencies) / result['elapsed'], latencies,
+                int(after) - result['before'] - 1)
+
+    d = fetch(counter, port, '/connections')
+    d.addCallback(started)
+    d.addCallback(finished)
+    d.addCallback(lambda _: fetch(counter, port, '/connections'))
+    d.addCallback(counted)
+    return d
+
+
+def bench(port, requests, concurrency):
+
+    def report((rate, latencies, connections), name):
+        print '%-24s %12.0f %10.2f %10.2f %12d' % (
+            name, rate, percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, connections)
+
+    print '%-24s %12s %10s %10s %12s' % ('', 'requests/s', 'p50 ms',
+                                         'p99 ms', 'connections')
+    d = run(port, requests, concurrency, 0)
+    d.addCallback(report, 'no keep-alive')
+    d.addCallback(lambda _: run(port, requests, concurrency, concurrency))
+    d.addCallback(report, 'keep-alive')
+    return d
+
+
+def main(args):
+    requests = 10000
+    concurrency = 10
+    if args:
+        requests = int(args[0])
+    if args[1:]:
+        concurrency = int(args[1])
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # the origin server process
+        root = resource.Resource()
+        site = CountingSite(root)
+        root.putChild('file', static.Data('x' * 1024, 'text/plain'))
+        root.putChild('connections', ConnectionCount(site))
+        server = reactor.listenTCP(0, site, interface='127.0.0.1')
+        os.write(w, '%d\n' % server.getHost().port)
+        reactor.run()
+        os._exit(0)
+    port = int(os.fdopen(r).readline())
+
+    d = bench(port, requests, concurrency)
+    d.addErrback(lambda f: sys.stderr.write(f.getTraceback()))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    os.kill(pid, 15)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
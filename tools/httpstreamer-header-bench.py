@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure how many connections per second the http streamer can write
+# the response headers to, compared to building them header by header.
+#
+# usage: httpstreamer-header-bench.py [connections]
+
+import os
+import socket
+import sys
+import time
+
+from twisted.web import http
+
+from flumotion.component.consumers.httpstreamer import resources
+
+
+class Streamer:
+    caps = True
+    plugs = {}
+
+    def get_content_type(self):
+        return 'application/ogg'
+
+
+class Transport:
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class Request:
+
+    def __init__(self, sock):
+        self.transport = Transport(sock)
+        self.fdIncoming = sock.fileno()
+        # the headers Twisted sets when processing a request
+        self.headers = {'server': 'TwistedWeb', 'date': 'now',
+                        'content-type': 'text/html'}
+        self.cookies = []
+
+    def setHeader(self, name, value):
+        self.headers[name.lower()] = value
+
+
+def naiveWriteHeaders(request):
+    # the algorithm the streamer used before the header template
+    fd = request.transport.fileno()
+    request.setHeader('Server', resources.HTTP_SERVER)
+    request.setHeader('Date', http.datetimeToString())
+    request.setHeader('Connection', 'close')
+    request.setHeader('Cache-Control', 'no-cache')
+    request.setHeader('Cache-Control', 'private')
+    request.setHeader('Content-type', 'application/ogg')
+    headers = []
+    for name, value in request.headers.items():
+        headers.append('%s: %s\r\n' % (name.capitalize(), value))
+    for cookie in request.cookies:
+        headers.append('%s: %s\r\n' % ("Set-Cookie", cookie))
+    os.write(fd, 'HTTP/1.0 200 OK\r\n%s\r\n' % ''.join(headers))
+
+
+def templateWriteHeaders(resource, request):
+    d = resource._writeHeaders(request)
+    assert d.called
+
+
+def bench(writeHeaders, connections):
+    start = time.time()
+    for _ in range(connections):
+        server, client = socket.socketpair()
+        writeHeaders(Request(server))
+        client.recv(4096)
+        server.close()
+        client.close()
+    return connections / (time.time() - start)
+
+
+def main(args):
+    connections = 20000
+    if args:
+        connections = int(args[0])
+
+    resource = resources.HTTPStreamingResource(Streamer(), None)
+    templateRate = bench(lambda r: templateWriteHeaders(resource, r),
+                         connections)
+    naiveRate = bench(naiveWriteHeaders, connections)
+    print '%20s %20s' % ('template conns/s', 'naive conns/s')
+    print '%20.0f %20.0f' % (templateRate, naiveRate)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
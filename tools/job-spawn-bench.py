@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure the latency from asking the worker's job heaven to spawn a
+# component until the component has been created in its job process,
+# with and without a pool of idle jobs.  The component is a bare
+# BaseComponent pointed at a manager port nobody listens on, so the
+# rest of the way to happy (logging in, starting the pipeline), which
+# the pool does not change, is left out.  Needs flumotion-job in the
+# configured bindir.
+#
+# usage: job-spawn-bench.py [spawns] [pool size]
+
+import signal
+import sys
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import connection
+from flumotion.twisted import pb as fpb
+from flumotion.worker import job
+
+
+class Brain:
+    # stands in for the worker brain and its manager connection
+    workerName = 'bench'
+
+    def __init__(self):
+        authenticator = fpb.Authenticator(username='bench',
+                                          password='bench')
+        # nothing listens there; the components keep trying to log in
+        self.managerConnectionInfo = connection.PBConnectionInfo(
+            '127.0.0.1', 1, False, authenticator)
+
+    def callRemote(self, methodName, *args, **kwargs):
+        return defer.succeed(None)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def wait(t):
+    d = defer.Deferred()
+    reactor.callLater(t, d.callback, None)
+    return d
+
+
+def waitForPool(heaven, size):
+    # so the refill of the pool is not measured with the next spawn
+    if len(heaven.jobPool) >= size:
+        return defer.succeed(None)
+    d = wait(0.05)
+    d.addCallback(lambda _: waitForPool(heaven, size))
+    return d
+
+
+def run(poolSize, spawns):
+    heaven = job.ComponentJobHeaven(Brain(), poolSize)
+    heaven.listen()
+    latencies = []
+
+    def spawn(i):
+        avatarId = '/bench/job-%d' % i
+        config = {'name': 'job-%d' % i, 'parent': 'bench',
+                  'avatarId': avatarId, 'type': 'bench',
+                  'properties': {}, 'plugs': {}}
+        start = time.time()
+        d = heaven.spawn(avatarId, 'bench', 'flumotion.component.component',
+                         'BaseComponent', 0, [], config)
+        d.addCallback(lambda _: latencies.append(time.time() - start))
+        d.addCallback(lambda _: heaven.killJob(avatarId, signal.SIGKILL))
+        return d
+
+    def loop(_, i):
+        if i == spawns:
+            return latencies
+        d = waitForPool(heaven, poolSize)
+        d.addCallback(lambda _: spawn(i))
+        d.addCallback(loop, i + 1)
+        return d
+
+    d = loop(None, 0)
+
+    def done(result):
+        d = heaven.shutdown()
+        d.addCallback(lambda _: result)
+        return d
+
+    d.addBoth(done)
+    return d
+
+
+def main(args):
+    spawns = 50
+    poolSize = 2
+    if args:
+        spawns = int(args[0])
+    if args[1:]:
+        poolSize = int(args[1])
+
+    def report(latencies, name):
+        print '%-24s %10.1f %10.1f' % (name,
+                                       percentile(latencies, 50) * 1000,
+                                       percentile(latencies, 99) * 1000)
+
+    print '%-24s %10s %10s' % ('', 'p50 ms', 'p99 ms')
+    d = run(0, spawns)
+    d.addCallback(report, 'no pool')
+    d.addCallback(lambda _: run(poolSize, spawns))
+    d.addCallback(report, 'pool of %d' % poolSize)
+    d.addErrback(lambda f: sys.stderr.write(f.getTraceback()))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
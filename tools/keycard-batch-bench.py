@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure how many clients per second HTTPAuthentication admits against a
+# bouncer in another process reached over PB, with and without keycard
+# batching, when all the clients arrive at once.
+#
+# usage: keycard-batch-bench.py [clients]
+
+import os
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.spread import pb
+
+from flumotion.common import keycards
+from flumotion.component.base import http
+from flumotion.component.bouncers import plug
+
+
+class BouncerRoot(pb.Root):
+    # stands in for the manager and the bouncer component
+
+    def __init__(self):
+        self.bouncer = plug.BouncerTrivialPlug(
+            {'socket': 'flumotion.component.bouncers.plug.BouncerPlug',
+             'type': 'bouncer-trivial', 'properties': {}})
+
+    def remote_authenticate(self, bouncerName, keycard):
+        return self.bouncer.authenticate(keycard)
+
+    def remote_authenticateMany(self, bouncerName, keycards):
+        return self.bouncer.authenticateMany(keycards)
+
+
+class Medium:
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    def authenticate(self, bouncerName, keycard):
+        return self.remote.callRemote('authenticate', bouncerName, keycard)
+
+    def authenticateMany(self, bouncerName, keycards):
+        return self.remote.callRemote('authenticateMany', bouncerName,
+                                      keycards)
+
+
+class Component:
+    plugs = {}
+
+    def __init__(self, remote):
+        self.medium = Medium(remote)
+
+    def getName(self):
+        return 'bench'
+
+
+class Transport:
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+class Request:
+
+    def __init__(self, fd):
+        self.transport = Transport(fd)
+
+    def getClientIP(self):
+        return '127.0.0.1'
+
+
+def admit(httpauth, clients):
+    start = time.time()
+    d = defer.DeferredList([httpauth.authenticate(Request(fd))
+                            for fd in range(clients)],
+                           fireOnOneErrback=True)
+    d.addCallback(lambda _: clients / (time.time() - start))
+    return d
+
+
+@defer.inlineCallbacks
+def bench(remote, clients):
+    print '%-24s %12s' % ('', 'clients/s')
+    for name, window in (('no batching', 0), ('5 ms batches', 0.005),
+                         ('20 ms batches', 0.02)):
+        httpauth = http.HTTPAuthentication(Component(remote))
+        httpauth.setIssuerClass('HTTPGenericIssuer')
+        httpauth.setBouncerName('bouncer')
+        httpauth.setKeycardBatching(window)
+        rate = yield admit(httpauth, clients)
+        print '%-24s %12.0f' % (name, rate)
+
+
+def main(args):
+    clients = 10000
+    if args:
+        clients = int(args[0])
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # the bouncer process
+        server = reactor.listenTCP(0, pb.PBServerFactory(BouncerRoot()),
+                                   interface='127.0.0.1')
+        os.write(w, '%d\n' % server.getHost().port)
+        reactor.run()
+        os._exit(0)
+    port = int(os.fdopen(r).readline())
+
+    factory = pb.PBClientFactory()
+    reactor.connectTCP('127.0.0.1', port, factory)
+    d = factory.getRootObject()
+    d.addCallback(bench, clients)
+    d.addErrback(lambda f: sys.stderr.write(f.getTraceback()))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+    os.kill(pid, 15)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
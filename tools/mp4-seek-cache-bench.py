@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure how many MP4 seek requests per second the http server can
+# prepare, with and without the seek index cache.  Needs mp4seek and a
+# big MP4 file; the seeks are spread over a number of distinct start
+# times, like players seeking around in the same file do.
+#
+# usage: mp4-seek-cache-bench.py file.mp4 [seeks] [seek points] [duration]
+
+import random
+import sys
+import time
+
+from flumotion.component.misc.httpserver import httpfile, mp4cache
+from flumotion.component.misc.httpserver import localprovider
+
+
+def bench(resource, path, starts):
+    start = time.time()
+    for t in starts:
+        provider = path.open()
+        d = resource._split_file(provider, t)
+        # the local provider reads synchronously
+        assert d.called
+        d.addErrback(lambda f: sys.exit("Seeking failed: %s"
+                                        % f.getErrorMessage()))
+        provider.close()
+    return len(starts) / (time.time() - start)
+
+
+def main(args):
+    if not args:
+        sys.exit("usage: mp4-seek-cache-bench.py file.mp4 [seeks] "
+                 "[seek points] [duration]")
+    if not httpfile.HAS_MP4SEEK:
+        sys.exit("mp4seek is needed")
+    path = localprovider.LocalPath(args[0])
+    seeks = 1000
+    if len(args) > 1:
+        seeks = int(args[1])
+    points = 100
+    if len(args) > 2:
+        points = int(args[2])
+    duration = 600.0
+    if len(args) > 3:
+        duration = float(args[3])
+
+    rand = random.Random(0)
+    choices = [rand.uniform(1.0, duration) for _ in range(points)]
+    starts = [rand.choice(choices) for _ in range(seeks)]
+
+    cache = mp4cache.SeekIndexCache(64 * 1024 * 1024, points)
+    cached = httpfile.MP4File(path, None, seekIndexCache=cache)
+    uncached = httpfile.MP4File(path, None)
+
+    cachedRate = bench(cached, path, starts)
+    uncachedRate = bench(uncached, path, starts)
+    print '%18s %18s %10s %10s' % ('cached seeks/s', 'uncached seeks/s',
+                                   'hits', 'misses')
+    print '%18.1f %18.1f %10d %10d' % (cachedRate, uncachedRate,
+                                       cache.hits, cache.misses)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure how fast the playlist producer's timeline handles a long
+# schedule: loading a playlist of back to back items, then adding items
+# over existing ones, removing playlists, and looking up the item
+# playing at some time and the items in a window of time.
+#
+# usage: playlist-bench.py [items] [edits]
+
+import random
+import sys
+import time
+
+import gst
+
+from flumotion.component.producers.playlist import playlistparser
+
+ITEM_DURATION = 30 * gst.SECOND
+# the number of items in each playlist id
+ITEMS_PER_ID = 100
+
+
+class FakeClock(object):
+
+    def get_time(self):
+        return 0
+
+
+class FakePipeline(object):
+
+    def get_clock(self):
+        return FakeClock()
+
+
+class FakeProducer(object):
+    pipeline = FakePipeline()
+
+    def scheduleItem(self, item):
+        return True
+
+    def unscheduleItem(self, item):
+        pass
+
+    def adjustItemScheduling(self, item):
+        pass
+
+
+def rate(count, start):
+    return count / (time.time() - start)
+
+
+def main(args):
+    items = 100000
+    if args:
+        items = int(args[0])
+    edits = 10000
+    if len(args) > 1:
+        edits = int(args[1])
+    rand = random.Random(0)
+    end = items * ITEM_DURATION
+
+    playlist = playlistparser.Playlist(FakeProducer())
+    start = time.time()
+    for i in range(items):
+        playlist.addItem('id%d' % (i / ITEMS_PER_ID), i * ITEM_DURATION,
+                         'file:///item%d.ogg' % i, 0, ITEM_DURATION,
+                         True, True)
+    loadRate = rate(items, start)
+
+    start = time.time()
+    for i in range(edits):
+        playlist.addItem('edit%d' % i, rand.randint(0, end),
+                         'file:///edit%d.ogg' % i, 0,
+                         rand.randint(1, 3) * ITEM_DURATION, True, True)
+    addRate = rate(edits, start)
+
+    ids = rand.sample(range(items / ITEMS_PER_ID), edits / ITEMS_PER_ID)
+    start = time.time()
+    for i in ids:
+        # removes a whole playlist of ITEMS_PER_ID items
+        playlist.removeItems('id%d' % i)
+    removeRate = rate(len(ids), start)
+
+    start = time.time()
+    for i in range(edits):
+        playlist._findItem(rand.randint(0, end))
+    findRate = rate(edits, start)
+
+    start = time.time()
+    for i in range(edits):
+        t = rand.randint(0, end)
+        playlist.getItemsInRange(t, t + 3600 * gst.SECOND)
+    rangeRate = rate(edits, start)
+
+    print '%10s %10s %12s %10s %10s' % ('loaded/s', 'added/s',
+                                        'playlists/s', 'found/s', 'ranges/s')
+    print '%10.1f %10.1f %12.1f %10.1f %10.1f' % (loadRate, addRate,
+                                                  removeRate, findRate,
+                                                  rangeRate)
+    print '%d items left in the playlist' % len(playlist)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
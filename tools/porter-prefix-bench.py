@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure the porter's prefix lookup rate for an increasing number of
+# registered prefixes.
+#
+# usage: porter-prefix-bench.py [lookups]
+
+import random
+import sys
+import time
+
+from flumotion.common import pathtree
+
+
+def randomSegment(rand):
+    return ''.join([rand.choice('abcdefghijklmnopqrstuvwxyz0123456789')
+                    for _ in range(rand.randint(3, 10))])
+
+
+def makePrefixes(rand, count):
+    prefixes = set()
+    while len(prefixes) < count:
+        depth = rand.randint(1, 4)
+        prefixes.add('/' + '/'.join([randomSegment(rand)
+                                     for _ in range(depth)]) + '/')
+    return list(prefixes)
+
+
+def naiveLookup(prefixes, path):
+    # the algorithm the porter used before the radix tree
+    found = None
+    for prefix in prefixes.keys():
+        if (path.startswith(prefix) and
+            (not found or len(found) < len(prefix))):
+            found = prefix
+    if found:
+        return prefixes[found]
+
+
+def bench(lookup, paths):
+    start = time.time()
+    for path in paths:
+        lookup(path)
+    return len(paths) / (time.time() - start)
+
+
+def main(args):
+    lookups = 100000
+    if args:
+        lookups = int(args[0])
+    rand = random.Random(0)
+
+    print '%10s %18s %18s' % ('prefixes', 'tree lookups/s', 'naive lookups/s')
+    for count in (10, 1000, 100000):
+        prefixes = makePrefixes(rand, count)
+        tree = pathtree.PathTree()
+        mapping = {}
+        for prefix in prefixes:
+            tree[prefix] = prefix
+            mapping[prefix] = prefix
+
+        # half of the requests hit a registered prefix, half don't
+        paths = []
+        for _ in range(lookups):
+            if rand.random() < 0.5:
+                paths.append(rand.choice(prefixes) + 'stream.ogg')
+            else:
+                paths.append('/' + randomSegment(rand) + '/stream.ogg')
+
+        treeRate = bench(tree.longestPrefixValue, paths)
+        # the naive lookup is linear, keep its run time bounded
+        naivePaths = paths[:max(10, lookups * 10 / count)]
+        naiveRate = bench(lambda p: naiveLookup(mapping, p), naivePaths)
+        print '%10d %18.0f %18.0f' % (count, treeRate, naiveRate)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure the rate at which porter processes sharing a port with
+# SO_REUSEPORT accept, parse and answer connections, for an increasing
+# number of processes. Requests are for an unregistered path, so every
+# connection gets a 404 from the porter itself.
+#
+# usage: porter-reuseport-bench.py [seconds] [client processes]
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+from flumotion.component.misc.porter import porterworker
+from flumotion.twisted import fdserver
+
+PROTOCOL = 'flumotion.component.misc.porter.porter.HTTPPorterProtocol'
+REQUEST = 'GET /not/registered HTTP/1.0\r\n\r\n'
+
+
+def packagePath():
+    path = porterworker.__file__
+    for _ in porterworker.__name__.split('.'):
+        path = os.path.dirname(path)
+    return path
+
+
+def spawnWorkers(count, port):
+    workers = []
+    for i in range(count):
+        socketPath = tempfile.mktemp('.socket', 'porter-bench.')
+        args = [sys.executable, '-c', porterworker.BOOTSTRAP, packagePath(),
+                socketPath, str(port), '127.0.0.1', PROTOCOL, '30', '0']
+        worker = subprocess.Popen(args, stdin=subprocess.PIPE)
+        worker.stdin.write('bench\nbench\n')
+        worker.stdin.flush()
+        workers.append(worker)
+    return workers
+
+
+def stopWorkers(workers):
+    for worker in workers:
+        worker.stdin.close()
+    for worker in workers:
+        worker.wait()
+
+
+def client(port, seconds, results):
+    count = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall(REQUEST)
+        while s.recv(4096):
+            pass
+        s.close()
+        count += 1
+    results.put(count)
+
+
+def waitListening(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise SystemExit('porter workers did not start')
+
+
+def main(args):
+    seconds = 5
+    clients = 8
+    if args:
+        seconds = int(args[0])
+    if len(args) > 1:
+        clients = int(args[1])
+
+    if not fdserver.canReusePort():
+        raise SystemExit('SO_REUSEPORT is not supported on this system')
+
+    # find a free port
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    print '%10s %12s' % ('processes', 'conn/s')
+    for count in (1, 2, 4):
+        workers = spawnWorkers(count, port)
+        try:
+            waitListening(port)
+            results = Queue()
+            procs = [Process(target=client, args=(port, seconds, results))
+                     for _ in range(clients)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
+            total = sum([results.get() for _ in procs])
+        finally:
+            stopWorkers(workers)
+        print '%10d %12.0f' % (count, total / float(seconds))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Measure the lookup rate of a routing table loaded from a file with
+# RoutingTable.fromFile, against a linear scan of its subnets.
+#
+# usage: routing-table-bench.py [subnets] [lookups]
+
+import random
+import StringIO
+import sys
+import time
+
+from flumotion.common import netutils
+
+
+def makeTable(rand, count):
+    lines = []
+    subnets = set()
+    while len(subnets) < count:
+        bits = rand.randint(8, 32)
+        net = rand.randint(0, (1 << 32) - 1) >> (32 - bits) << (32 - bits)
+        if (net, bits) in subnets:
+            continue
+        subnets.add((net, bits))
+        lines.append('%s/%d route%d\n' % (netutils.ipv4IntToString(net),
+                                          bits, rand.randint(0, 99)))
+    lines.append('0.0.0.0/0 default\n')
+    return ''.join(lines)
+
+
+def naiveRoute(table, ip):
+    # the algorithm RoutingTable used before the trie
+    for netmask, net, route in table:
+        if ip & netmask == net:
+            return route
+
+
+def bench(lookup, ips):
+    start = time.time()
+    for ip in ips:
+        lookup(ip)
+    return len(ips) / (time.time() - start)
+
+
+def main(args):
+    count = 100000
+    lookups = 100000
+    if args:
+        count = int(args[0])
+    if len(args) > 1:
+        lookups = int(args[1])
+    rand = random.Random(0)
+
+    start = time.time()
+    table = netutils.RoutingTable.fromFile(
+        StringIO.StringIO(makeTable(rand, count)))
+    print 'loaded %d subnets in %.2f s' % (len(table), time.time() - start)
+
+    ips = [netutils.ipv4IntToString(rand.randint(0, (1 << 32) - 1))
+           for _ in range(lookups)]
+    print 'trie:   %10.0f lookups/s' % bench(table.route, ips)
+    # the linear scan is slow, keep its run time bounded
+    naiveIPs = [netutils.ipv4StringToInt(ip)
+                for ip in ips[:max(10, lookups * 100 / count)]]
+    print 'linear: %10.0f lookups/s' % bench(
+        lambda ip: naiveRoute(table, ip), naiveIPs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])